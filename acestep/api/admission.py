@@ -0,0 +1,205 @@
+"""
+コストに基づく受付制御
+
+投入されたが終了していないリクエスト（待機中・処理中）の見積もりGPU秒
+（CostModel.estimate：音声長・ステップ数・ガイダンスのモードから算出）を合計し、
+予算を超える投入を 429 で拒否する。Retry-After は、直近に完了した作業量の速度
+（見積もりGPU秒/秒）から、予算を超えた分が捌けるまでの時間として求める。
+
+アップロードを伴うエンドポイントは一時ファイルでディスクも消費するため、
+エンドポイントごとの同時受付数、1ファイルの上限、一時ファイルの合計バイト数も制限する。
+
+イベントループ上でのみ操作する前提のため、ロックは使用しない。
+"""
+
+import math
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from acestep.api.degradation import ThroughputMeter
+from acestep.api.policy import CostModel
+
+class AdmissionRejected(Exception):
+    """受付制御によって拒否された（status_code と Retry-After の秒数を持つ）"""
+
+    def __init__(self, reason: str, retry_after: Optional[int] = None, status_code: int = 429):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    """"/endpoint=4,/other=2" 形式をエンドポイントごとの上限に変換する"""
+    limits = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        endpoint, limit = item.split("=", 1)
+        limits[endpoint.strip()] = int(limit)
+    return limits
+
+
+@dataclass
+class AdmissionConfig:
+    # 未完了リクエストの見積もりGPU秒の上限（0 で無効）
+    max_queued_seconds: float = 3600.0
+    max_retry_after: int = 3600
+    # アップロードを伴うエンドポイントごとの同時受付数（未完了の件数）
+    max_uploads_per_endpoint: int = 16
+    upload_limits: Dict[str, int] = field(default_factory=dict)
+    max_upload_bytes: int = 50 * 1024 ** 2
+    max_temp_bytes: int = 1024 ** 3
+
+    @classmethod
+    def from_env(cls) -> "AdmissionConfig":
+        """環境変数 ACE_ADMISSION_* から設定を読み込む"""
+        default = cls()
+        return cls(
+            max_queued_seconds=float(
+                os.environ.get("ACE_ADMISSION_MAX_QUEUED_SECONDS", str(default.max_queued_seconds))
+            ),
+            max_retry_after=int(os.environ.get("ACE_ADMISSION_MAX_RETRY_AFTER", str(default.max_retry_after))),
+            max_uploads_per_endpoint=int(
+                os.environ.get("ACE_ADMISSION_MAX_UPLOADS", str(default.max_uploads_per_endpoint))
+            ),
+            upload_limits=_parse_limits(os.environ.get("ACE_ADMISSION_UPLOAD_LIMITS", "")),
+            max_upload_bytes=int(
+                float(os.environ.get("ACE_ADMISSION_MAX_UPLOAD_MB", str(default.max_upload_bytes // 1024 ** 2)))
+                * 1024 ** 2
+            ),
+            max_temp_bytes=int(
+                float(os.environ.get("ACE_ADMISSION_MAX_TEMP_MB", str(default.max_temp_bytes // 1024 ** 2)))
+                * 1024 ** 2
+            ),
+        )
+
+    def upload_limit(self, endpoint: str) -> int:
+        return self.upload_limits.get(endpoint, self.max_uploads_per_endpoint)
+
+
+class _Admission:
+    __slots__ = ("seconds", "endpoint", "upload_bytes")
+
+    def __init__(self, seconds: float, endpoint: Optional[str], upload_bytes: int):
+        self.seconds = seconds
+        self.endpoint = endpoint
+        self.upload_bytes = upload_bytes
+
+
+class AdmissionController:
+    """
+    受け付けたリクエストの見積もりGPU秒・アップロードを記録し、上限を超える投入を拒否する
+
+    work_meter: 完了したリクエストの見積もりGPU秒を amount として記録する ThroughputMeter
+    """
+
+    def __init__(self, config: AdmissionConfig, cost_model: CostModel, work_meter: ThroughputMeter):
+        self.config = config
+        self.cost_model = cost_model
+        self.work_meter = work_meter
+        self._admitted: Dict[str, _Admission] = {}
+        self._queued_seconds = 0.0
+        self._temp_bytes = 0
+        self._uploads: Dict[str, int] = {}
+        self.metrics: Dict[str, int] = {
+            "admitted": 0,
+            "rejected_gpu_budget": 0,
+            "rejected_uploads": 0,
+            "rejected_temp_disk": 0,
+            "rejected_upload_size": 0,
+        }
+
+    def queued_seconds(self) -> float:
+        return self._queued_seconds
+
+    def retry_after(self, excess_seconds: float) -> int:
+        """予算を超えた見積もりGPU秒が、直近の処理速度で捌けるまでの秒数"""
+        rate = self.work_meter.rate()
+        # 計測値がない場合は、1秒あたり1GPU秒を処理するとみなす
+        seconds = excess_seconds / rate if rate > 0 else excess_seconds
+        return int(min(max(math.ceil(seconds), 1), self.config.max_retry_after))
+
+    def check_upload_size(self, upload_bytes: int):
+        """1ファイルの上限を確認する（取り込み中のアップロードにはチャンクごとに呼び出す）"""
+        if upload_bytes > self.config.max_upload_bytes:
+            self.metrics["rejected_upload_size"] += 1
+            raise AdmissionRejected(
+                f"Uploaded audio is {upload_bytes} bytes; the limit is {self.config.max_upload_bytes} bytes",
+                status_code=413,
+            )
+
+    def check_upload(self, endpoint: str, upload_bytes: int):
+        """アップロードを取り込む前に、1ファイル・エンドポイント・一時領域の上限を確認する"""
+        self.check_upload_size(upload_bytes)
+        limit = self.config.upload_limit(endpoint)
+        if self._uploads.get(endpoint, 0) >= limit:
+            self.metrics["rejected_uploads"] += 1
+            raise AdmissionRejected(
+                f"Too many outstanding uploads for {endpoint} (limit {limit})",
+                retry_after=self._retry_after_for_uploads(endpoint),
+            )
+        if self._temp_bytes + upload_bytes > self.config.max_temp_bytes:
+            self.metrics["rejected_temp_disk"] += 1
+            raise AdmissionRejected(
+                "Temporary storage for uploaded audio is full",
+                retry_after=self._retry_after_for_uploads(None),
+            )
+
+    def admit(self, key: str, request: Any, endpoint: Optional[str] = None, upload_bytes: int = 0) -> float:
+        """
+        リクエストを受け付け、その見積もりGPU秒を返す
+        上限を超える場合は AdmissionRejected（待ち行列が空なら予算を超えるリクエストも受け付ける）
+        """
+        if upload_bytes > 0 and endpoint is not None:
+            self.check_upload(endpoint, upload_bytes)
+        seconds = self.cost_model.estimate(request)
+        budget = self.config.max_queued_seconds
+        if budget > 0 and self._admitted and self._queued_seconds + seconds > budget:
+            self.metrics["rejected_gpu_budget"] += 1
+            raise AdmissionRejected(
+                f"Server is busy: {self._queued_seconds:.0f}s of queued GPU work "
+                f"(budget {budget:.0f}s, this request {seconds:.0f}s)",
+                retry_after=self.retry_after(self._queued_seconds + seconds - budget),
+            )
+
+        self._admitted[key] = _Admission(seconds, endpoint if upload_bytes > 0 else None, upload_bytes)
+        self._queued_seconds += seconds
+        if upload_bytes > 0 and endpoint is not None:
+            self._uploads[endpoint] = self._uploads.get(endpoint, 0) + 1
+            self._temp_bytes += upload_bytes
+        self.metrics["admitted"] += 1
+        return seconds
+
+    def release(self, key: str):
+        """リクエストの終了（完了・失敗・キャンセル・失効）時に記録を取り除く（複数回呼んでもよい）"""
+        admission = self._admitted.pop(key, None)
+        if admission is None:
+            return
+        self._queued_seconds = max(0.0, self._queued_seconds - admission.seconds)
+        if admission.endpoint is not None:
+            self._uploads[admission.endpoint] -= 1
+            self._temp_bytes -= admission.upload_bytes
+        if not self._admitted:
+            # 浮動小数点の誤差を持ち越さない
+            self._queued_seconds = 0.0
+
+    def _retry_after_for_uploads(self, endpoint: Optional[str]) -> int:
+        """最も早く終わる見込みのアップロード（endpoint=None なら全エンドポイント）が捌けるまでの秒数"""
+        seconds = [
+            admission.seconds for admission in self._admitted.values()
+            if admission.endpoint is not None and endpoint in (None, admission.endpoint)
+        ]
+        return self.retry_after(min(seconds) if seconds else 1.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queued_seconds": self._queued_seconds,
+            "max_queued_seconds": self.config.max_queued_seconds,
+            "work_rate": self.work_meter.rate(),
+            "outstanding_uploads": dict(self._uploads),
+            "temp_bytes": self._temp_bytes,
+            "max_temp_bytes": self.config.max_temp_bytes,
+            **self.metrics,
+        }
@@ -0,0 +1,196 @@
+"""
+音楽データのエンコード用プロセスプール
+
+MP3 / OGG / FLAC のエンコードはCPUを数秒使うため、GPUワーカーのスレッドで行うと
+その間は次のジョブを開始できない。エンコードを専用のプロセスプール（ACE_ENCODER_PROCESSES）に移し、
+GPUワーカーは latents2audio の直後に次のジョブに移る。
+波形はピクルせず共有メモリ（acestep.api.model_worker.SharedWaveform）に書き込み、名前と形状だけを送る。
+エンコードしたバイト列を返すか、パスを指定した場合はワーカープロセスがファイルに直接書き込む。
+
+ACE_ENCODER_FORMATS に含まれない形式（デフォルトでは WAV、ほぼコピーのみで安い）と、
+ACE_ENCODER_PROCESSES=0 の場合は、従来どおり呼び出したスレッドでエンコードする。
+プロセスは起動時（start）に立ち上げて torchaudio を読み込んでおき、最初のリクエストが起動時間を負担しない。
+CUDA を使うプロセスから fork しないよう、ワーカーは spawn で起動する。
+ワーカーが異常終了した場合、そのエンコードは失敗とし、次の投入時にプールを作り直す。
+"""
+
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from acestep.api.model_worker import SharedWaveform
+
+
+def _default_processes() -> int:
+    return min(4, os.cpu_count() or 1)
+
+
+@dataclass
+class AudioEncoderConfig:
+    # エンコード用プロセスの数（0 の場合は呼び出したスレッドでエンコードする）
+    processes: int = field(default_factory=_default_processes)
+    # プロセスプールでエンコードする形式
+    formats: List[str] = field(default_factory=lambda: ["mp3", "ogg", "flac"])
+
+    @classmethod
+    def from_env(cls) -> "AudioEncoderConfig":
+        """環境変数 ACE_ENCODER_PROCESSES / ACE_ENCODER_FORMATS から設定を読み込む"""
+        default = cls()
+        formats = os.environ.get("ACE_ENCODER_FORMATS")
+        return cls(
+            processes=max(0, int(os.environ.get("ACE_ENCODER_PROCESSES", str(default.processes)))),
+            formats=(
+                [f.strip().lower() for f in formats.split(",") if f.strip()] if formats is not None
+                else default.formats
+            ),
+        )
+
+
+def save_waveform(audio: Any, sample_rate: int, format: str, target: Any):
+    """波形（チャンネル×サンプルのテンソル）を target（パスまたはファイルオブジェクト）にエンコード"""
+    import torchaudio
+
+    backend = "soundfile"
+    if format == "ogg":
+        backend = "sox"
+    torchaudio.save(target, audio, sample_rate=sample_rate, format=format, backend=backend)
+
+
+def encode_waveform(audio: Any, sample_rate: int, format: str, path: Optional[str] = None) -> Optional[bytes]:
+    """エンコードしたバイト列を返す（path を指定した場合はファイルに書き込んで None を返す）"""
+    if path is not None:
+        save_waveform(audio, sample_rate, format, path)
+        return None
+    buffer = io.BytesIO()
+    save_waveform(audio, sample_rate, format, buffer)
+    return buffer.getvalue()
+
+
+def _warm_up() -> int:
+    """ワーカープロセスで torchaudio を読み込んでおく"""
+    import torchaudio  # noqa: F401
+
+    return os.getpid()
+
+
+def _encode_shared(shared: SharedWaveform, sample_rate: int, format: str, path: Optional[str]) -> Optional[bytes]:
+    """ワーカープロセス側：共有メモリから波形を取り出してエンコードする"""
+    import torch
+
+    return encode_waveform(torch.from_numpy(shared.take()), sample_rate, format, path)
+
+
+class AudioEncoder:
+    """エンコードをプロセスプールに投入する（複数のワーカースレッドから呼び出せる）"""
+
+    def __init__(self, config: AudioEncoderConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.metrics: Dict[str, Any] = {
+            "submitted": 0, "completed": 0, "failed": 0, "inline": 0, "in_flight": 0, "restarts": 0,
+            "encode_seconds": 0.0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.processes > 0
+
+    def offloads(self, format: str) -> bool:
+        """プロセスプールでエンコードする形式か"""
+        return self.enabled and format.lower() in self.config.formats
+
+    def start(self):
+        """プロセスを起動し、torchaudio を読み込んでおく（完了は待たない）"""
+        if not self.enabled:
+            return
+        pool = self._get_pool()
+        for _ in range(self.config.processes):
+            pool.submit(_warm_up)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.config.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def _discard_pool(self, pool: ProcessPoolExecutor):
+        """異常終了したプールを捨てる（次の投入時に作り直す）"""
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self.metrics["restarts"] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def encode(self, audio: Any, sample_rate: int, format: str, path: Optional[str] = None) -> Optional[bytes]:
+        """呼び出したスレッドでエンコードする"""
+        with self._lock:
+            self.metrics["inline"] += 1
+        return encode_waveform(audio, sample_rate, format, path)
+
+    def submit(self, audio: Any, sample_rate: int, format: str, path: Optional[str] = None) -> Future:
+        """
+        プロセスプールにエンコードを投入し、バイト列（path を指定した場合は None）を結果とする Future を返す
+        Future の完了コールバックはプールの管理スレッドで呼ばれる
+        """
+        shared = SharedWaveform.create(audio.detach().float().cpu().contiguous().numpy())
+        pool = self._get_pool()
+        try:
+            encoded = pool.submit(_encode_shared, shared, sample_rate, format.lower(), path)
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            pool = self._get_pool()
+            try:
+                encoded = pool.submit(_encode_shared, shared, sample_rate, format.lower(), path)
+            except BaseException:
+                shared.discard()
+                raise
+        except BaseException:
+            shared.discard()
+            raise
+        submitted_at = time.time()
+        with self._lock:
+            self.metrics["submitted"] += 1
+            self.metrics["in_flight"] += 1
+
+        def on_done(future: Future):
+            failed = future.cancelled() or future.exception() is not None
+            if failed:
+                # ワーカーが取り出す前に失敗した場合は共有メモリが残っている
+                shared.discard()
+                if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                    self._discard_pool(pool)
+            with self._lock:
+                self.metrics["in_flight"] -= 1
+                self.metrics["failed" if failed else "completed"] += 1
+                self.metrics["encode_seconds"] += time.time() - submitted_at
+
+        encoded.add_done_callback(on_done)
+        return encoded
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self.metrics)
+        finished = metrics["completed"] + metrics["failed"]
+        encode_seconds = metrics.pop("encode_seconds")
+        return {
+            "processes": self.config.processes,
+            "formats": self.config.formats if self.enabled else [],
+            **metrics,
+            "avg_encode_seconds": encode_seconds / finished if finished else None,
+        }
@@ -0,0 +1,326 @@
+"""
+分散キューのノード（ACE_QUEUE_BACKEND=sqlite / redis）
+
+ジョブの待ち行列・状態のバックエンド（acestep.api.job_backend）と、このプロセスのスケジューラの間の処理:
+  - 受け付けたジョブをバックエンドに登録し、いずれかのノードでの終了時に完了する Future を返す
+  - ワーカーの空きの分だけバックエンドからジョブを取得（claim）してスケジューラに投入し、終了後に結果を書き戻す
+  - 取得したジョブのリースをハートビートで延長し、他のノードで受け付けたキャンセルを反映する
+  - このノードで受け付け、他のノードが処理しているジョブの終了を確認して結果を取り込む
+
+ジョブ（リクエスト）の組み立て・状態遷移・終了時の通知はAPIのコールバックで行う。
+バックエンドの操作はブロッキングのため専用のスレッドで投入順に実行し、イベントループはブロックしない。
+
+イベントループ上でのみ操作する前提のため、ロックは使用しない。
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+from acestep.api.job_backend import COMPLETED, FAILED, PROCESSING, JobBackend, JobBackendConfig, JobRecord
+from acestep.api.spool import ResultSpool
+
+
+def read_result_audio(result: Optional[Dict]) -> Optional[bytes]:
+    """結果の音楽データ（メモリまたはスプール）を読み込む"""
+    if not result:
+        return None
+    if "audio_data" in result:
+        return result["audio_data"]
+    if "spool_path" in result:
+        with open(result["spool_path"], "rb") as f:
+            return f.read()
+    return None
+
+
+class BackendNode:
+    """
+    分散キューのノード
+
+    from_record:       取得した他のノードのジョブ（記録と参照音声）からジョブを作る
+    is_finished:       ジョブが終了しているか
+    outcome:           このノードで終了したジョブの (ステータス, 結果, エラー)
+    public_result:     バックエンドに書き戻す結果（音楽データは別に書き戻す）
+    settle:            このノードで受け付けたジョブの終了を反映する
+                       (job, ステータス, 結果, エラー, 開始時刻, 終了時刻)
+    on_remote_start:   このノードで受け付けたジョブを他のノードが処理し始めた (job, 開始時刻)
+    on_lease_lost:     取得したジョブのリースが切れ、他のノードが取得し直した（他のノードで受け付けたジョブのみ）
+    on_cancel_request: 取得したジョブのキャンセルが他のノードで受け付けられた
+    release:           他のノードで受け付けたジョブの結果を書き戻した後に、保持しているデータを解放する
+    """
+
+    def __init__(
+        self,
+        backend: JobBackend,
+        config: JobBackendConfig,
+        scheduler: Any,
+        result_spool: ResultSpool,
+        from_record: Callable[[JobRecord, Optional[bytes]], Any],
+        is_finished: Callable[[Any], bool],
+        outcome: Callable[[Any], Tuple[str, Optional[Dict], Optional[str]]],
+        public_result: Callable[[Optional[Dict]], Optional[Dict]],
+        settle: Callable[[Any, str, Optional[Dict], Optional[str], Optional[float], Optional[float]], None],
+        on_remote_start: Callable[[Any, Optional[float]], None],
+        on_lease_lost: Callable[[Any], None],
+        on_cancel_request: Callable[[Any], None],
+        release: Callable[[Any], None],
+    ):
+        self.backend = backend
+        self.config = config
+        self._scheduler = scheduler
+        self._result_spool = result_spool
+        self._from_record = from_record
+        self._is_finished = is_finished
+        self._outcome = outcome
+        self._public_result = public_result
+        self._settle = settle
+        self._on_remote_start = on_remote_start
+        self._on_lease_lost = on_lease_lost
+        self._on_cancel_request = on_cancel_request
+        self._release = release
+        # バックエンドの操作（ブロッキング）を行うスレッド（操作は投入順に実行される）
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ace-queue-backend")
+        # このノードで受け付けたジョブ（ジョブID → (ジョブ, いずれかのノードでの終了時に完了する Future)）
+        self._waiters: Dict[str, Tuple[Any, asyncio.Future]] = {}
+        # このノードが取得してスケジューラに投入したジョブ（ジョブID → ジョブ）
+        self._claimed: Dict[str, Any] = {}
+        # 新しいジョブの登録・ワーカーの空きを run に知らせる
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def node_id(self) -> str:
+        return self.config.node_id
+
+    def call(self, func: Callable, *args) -> asyncio.Future:
+        """バックエンドの操作を専用スレッドで実行する（投入順に実行され、イベントループはブロックしない）"""
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def is_claimed(self, job_id: str) -> bool:
+        return job_id in self._claimed
+
+    def enqueue(self, job: Any, record: JobRecord, ref_audio: Any = None) -> asyncio.Future:
+        """
+        ジョブをバックエンドの待ち行列に登録し、いずれかのノードでの終了時に完了する Future を返す
+        アップロードされた参照音声（ref_audio.open() で読める UploadBuffer）はジョブと一緒に登録し、取得したノードに渡す
+        """
+        done = asyncio.get_running_loop().create_future()
+        self._waiters[record.job_id] = (job, done)
+        asyncio.ensure_future(self._register(job, self.call(self._enqueue_record, record, ref_audio)))
+        return done
+
+    def resolve(self, job: Any):
+        """このノードで受け付けたジョブの Future を完了する（キャンセル時など）"""
+        waiter = self._waiters.pop(job.request_id, None)
+        if waiter is not None and not waiter[1].done():
+            waiter[1].set_result(job)
+
+    def cancel(self, job_id: str):
+        """バックエンドでジョブをキャンセルする（処理中のノードがハートビートで中断する）"""
+        asyncio.ensure_future(self._cancel(job_id))
+
+    async def watch(self, job_id: str, is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncIterator[Optional[JobRecord]]:
+        """
+        他のノードで受け付けたジョブの記録を config.poll_seconds ごとに返す
+        ジョブが終了した・バックエンドから削除された（None）・接続が切れた時点で終了する
+        """
+        while True:
+            await asyncio.sleep(self.config.poll_seconds)
+            if await is_disconnected():
+                return
+            record = await self.call(self.backend.get, job_id)
+            yield record
+            if record is None or record.finished:
+                return
+
+    async def snapshot(self) -> Dict[str, Any]:
+        return {
+            **(await self.call(self.backend.stats)),
+            "node_id": self.node_id,
+            "claimed_jobs": len(self._claimed),
+            "waiting_jobs": len(self._waiters),
+        }
+
+    async def run(self):
+        """
+        ワーカーの空きの分だけバックエンドからジョブを取得してスケジューラに投入し、
+        取得したジョブのリースを延長し、他のノードが処理しているこのノードのジョブの終了を確認する
+        停止（キャンセル）時に取得済みで終了していないジョブは、リースが切れた後に他のノードが取得し直す
+        """
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        next_heartbeat = next_poll = 0.0
+        while True:
+            self._wakeup.clear()
+            try:
+                # 起動時の読み込み中（スケジューラの起動前）は取得しない
+                while (self._scheduler.started
+                       and self._scheduler.pending_count() < self._scheduler.idle_workers() + self.config.prefetch):
+                    claimed = await self.call(self.backend.claim, self.node_id)
+                    if claimed is None:
+                        break
+                    self._start_claimed(*claimed)
+                now = loop.time()
+                if now >= next_heartbeat:
+                    next_heartbeat = now + self.config.heartbeat_seconds
+                    await self._heartbeat()
+                if now >= next_poll:
+                    next_poll = now + self.config.poll_seconds
+                    await self._poll()
+            except Exception as e:
+                print(f"Warning: {self.backend.name} queue backend error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.config.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """バックエンドの操作の完了を待ち、接続を閉じる（run の停止後に呼び出す）"""
+        self._executor.shutdown(wait=True)
+        self.backend.close()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _enqueue_record(self, record: JobRecord, ref_audio: Any):
+        """参照音声（一時ファイルの場合もある）を読み込み、ジョブと一緒に登録する（バックエンドのスレッド側）"""
+        attachment = ref_audio.open().read() if ref_audio is not None else None
+        self.backend.enqueue(record, attachment)
+
+    async def _register(self, job: Any, enqueued: asyncio.Future):
+        """登録の完了を待ち、失敗した場合はジョブを失敗とする"""
+        try:
+            await enqueued
+        except Exception as e:
+            print(f"Failed to enqueue job {job.request_id} to the {self.backend.name} queue backend: {e}")
+            if not self._is_finished(job):
+                self._settle(job, FAILED, None, f"Failed to enqueue the job: {e}", None, time.time())
+                self.resolve(job)
+            return
+        self._wake()
+
+    async def _cancel(self, job_id: str):
+        try:
+            await self.call(self.backend.cancel, job_id)
+        except Exception as e:
+            print(f"Warning: Failed to cancel job {job_id} in the {self.backend.name} queue backend: {e}")
+
+    def _start_claimed(self, record: JobRecord, attachment: Optional[bytes]):
+        """取得したジョブをこのノードのスケジューラに投入する"""
+        waiter = self._waiters.get(record.job_id)
+        job = waiter[0] if waiter is not None else self._from_record(record, attachment)
+        self._claimed[record.job_id] = job
+        if self._is_finished(job):
+            # 取得までの間にキャンセルされた
+            asyncio.ensure_future(self._complete_claimed(job))
+            return
+        done = self._scheduler.submit(job)
+        done.add_done_callback(lambda _: asyncio.ensure_future(self._complete_claimed(job)))
+
+    async def _complete_claimed(self, job: Any):
+        """このノードで終了したジョブの結果（音楽データを含む）をバックエンドに書き戻す"""
+        job_id = job.request_id
+        try:
+            status, result, error = self._outcome(job)
+            completed = status == COMPLETED
+            audio = await self.call(read_result_audio, result) if completed else None
+            recorded = await self.call(
+                self.backend.finish,
+                job_id,
+                self.node_id,
+                status,
+                self._public_result(result) if completed else None,
+                error,
+                audio,
+            )
+            if not recorded:
+                print(f"Warning: Lease of job {job_id} was lost before it finished; the result was not recorded")
+        except Exception as e:
+            print(f"Warning: Failed to record job {job_id} in the {self.backend.name} queue backend: {e}")
+        finally:
+            self._claimed.pop(job_id, None)
+            if job_id in self._waiters:
+                self.resolve(job)
+            else:
+                # 他のノードで受け付けたジョブの結果は、バックエンドに書き戻した時点で不要になる
+                self._release(job)
+            self._wake()
+
+    async def _heartbeat(self):
+        """取得したジョブのリースを延長し、他のノードで受け付けたキャンセルを反映する"""
+        for job_id, job in list(self._claimed.items()):
+            cancel_requested = await self.call(self.backend.heartbeat, job_id, self.node_id)
+            if self._claimed.get(job_id) is not job:
+                continue
+            if cancel_requested is None:
+                # 他のノードが取得し直した：このノードで受け付けたジョブは結果を返すために続行し、それ以外は中断する
+                print(f"Warning: Lease of job {job_id} expired and it was requeued")
+                if job_id not in self._waiters:
+                    self._on_lease_lost(job)
+            elif cancel_requested:
+                self._on_cancel_request(job)
+
+    def _load_result(self, record: JobRecord) -> Optional[Dict]:
+        """他のノードが書き戻した結果を、このノードの結果として読み込む（音楽データはスプールまたはメモリに保持する）"""
+        result = record.result
+        if record.status != COMPLETED or not result or "audio_size_bytes" not in result:
+            return result
+        audio = self.backend.get_audio(record.job_id)
+        if audio is None:
+            raise RuntimeError("Result audio is no longer available in the queue backend")
+        loaded = {key: result.get(key) for key in ("success", "content_type", "format", "params_json", "cached")}
+        if self._result_spool.enabled:
+            temp_path, final_path = self._result_spool.allocate(record.job_id, result["format"])
+            try:
+                with open(temp_path, "wb") as f:
+                    f.write(audio)
+                loaded.update(self._result_spool.commit(temp_path, final_path))
+            except OSError:
+                self._result_spool.delete(temp_path)
+                raise
+        else:
+            loaded["audio_data"] = audio
+        return loaded
+
+    async def _poll(self):
+        """他のノードが取得したこのノードのジョブの状態を確認し、終了したものは結果を取り込む"""
+        waiting = [job_id for job_id in self._waiters if job_id not in self._claimed]
+        if not waiting:
+            return
+        records = await self.call(self.backend.get_many, waiting)
+        for job_id in waiting:
+            waiter = self._waiters.get(job_id)
+            if waiter is None or job_id in self._claimed:
+                continue
+            job = waiter[0]
+            if self._is_finished(job):
+                # このノードでキャンセルした
+                self.resolve(job)
+                continue
+            record = records.get(job_id)
+            if record is not None and record.status == PROCESSING:
+                self._on_remote_start(job, record.started_at)
+                continue
+            if record is not None and not record.finished:
+                continue
+            try:
+                if record is None:
+                    raise RuntimeError("Job is no longer in the queue backend")
+                result = await self.call(self._load_result, record)
+                status, error = record.status, record.error
+            except Exception as e:
+                result, status, error = None, FAILED, str(e)
+            if self._is_finished(job):
+                if result:
+                    self._result_spool.delete(result.get("spool_path"))
+                continue
+            self._settle(
+                job,
+                status,
+                result,
+                error,
+                record.started_at if record else None,
+                (record.completed_at if record else None) or time.time(),
+            )
+            self.resolve(job)
@@ -0,0 +1,79 @@
+"""
+互換リクエストの動的バッチング
+
+ACEStepPipeline.__call__ はバッチ全体で1つの値を取るパラメータ
+（長さ・ステップ数・スケジューラ・ガイダンス設定・LoRAなど）と、
+サンプルごとに指定できるパラメータ（prompt, lyrics, manual_seeds）を持つ。
+前者がすべて一致するリクエスト同士を1回のパイプライン呼び出しにまとめる。
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+# バッチ全体で共有されるパラメータ（一致しないとまとめられない）
+BATCH_KEY_FIELDS = (
+    "audio_duration",
+    "infer_step",
+    "scheduler_type",
+    "cfg_type",
+    "lora_name_or_path",
+    "lora_weight",
+    "guidance_scale",
+    "omega_scale",
+    "guidance_interval",
+    "guidance_interval_decay",
+    "min_guidance_scale",
+    "use_erg_tag",
+    "use_erg_lyric",
+    "use_erg_diffusion",
+    "oss_steps",
+    "guidance_scale_text",
+    "guidance_scale_lyric",
+    # 開始時に品質引き下げでパラメータが書き換わるため、許可の有無が異なるものはまとめない
+    "allow_degradation",
+)
+
+
+@dataclass
+class BatchingConfig:
+    max_batch_size: int = 1
+    max_wait_seconds: float = 0.05
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1
+
+    @classmethod
+    def from_env(cls) -> "BatchingConfig":
+        """環境変数 ACE_MAX_BATCH_SIZE / ACE_BATCH_WAIT_MS から設定を読み込む"""
+        return cls(
+            max_batch_size=max(1, int(os.environ.get("ACE_MAX_BATCH_SIZE", "1"))),
+            max_wait_seconds=float(os.environ.get("ACE_BATCH_WAIT_MS", "50")) / 1000,
+        )
+
+
+def batch_key(request: Any) -> Optional[Tuple]:
+    """
+    バッチングのキーを返す
+    audio2audio やランダム長（audio_duration <= 0）のリクエストはバッチ不可として None を返す
+    """
+    if getattr(request, "audio2audio_enable", False) or getattr(request, "ref_audio_input", None):
+        return None
+    if request.audio_duration <= 0:
+        return None
+    return tuple(getattr(request, field, None) for field in BATCH_KEY_FIELDS)
+
+
+def first_seed(manual_seeds: Optional[str]) -> Optional[int]:
+    """manual_seeds 文字列からバッチ内の1サンプル分のシードを取り出す"""
+    if manual_seeds is None:
+        return None
+    if isinstance(manual_seeds, int):
+        return manual_seeds
+    manual_seeds = str(manual_seeds).strip()
+    if "," in manual_seeds:
+        manual_seeds = manual_seeds.split(",")[0].strip()
+    if manual_seeds.isdigit():
+        return int(manual_seeds)
+    return None
@@ -0,0 +1,166 @@
+"""
+待ち行列の混雑に応じた品質の段階的な引き下げ
+
+allow_degradation=True のリクエストに限り、ジョブ開始時点の待ち行列の深さと
+直近のスループットから混雑レベルを求め、レベルに応じて生成パラメータを軽くする。
+
+  レベル1: ERG（tag / lyric / diffusion）とダブルコンディションガイダンスを無効化
+  レベル2: さらに infer_step を reduced_steps 以下に制限（oss_steps 指定時はその部分集合）
+  レベル3: さらに oss_steps を短いスケジュールに置き換える
+
+実際に適用した変更は params_json["degradation"] として結果に含める。
+"""
+
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+DEFAULT_OSS_STEPS = "16,29,52,96,129,158,172,183,189,200"
+
+
+def _parse_list(value: str, cast) -> Tuple:
+    return tuple(cast(v.strip()) for v in value.split(",") if v.strip())
+
+
+@dataclass
+class DegradationConfig:
+    # 各レベルに入る待ち行列の深さ（レベル1, 2, 3）
+    queue_depths: Tuple[int, ...] = (4, 8, 16)
+    # 各レベルに入る見込み待ち時間（秒）。待ち行列の深さ / 直近のスループットで求める
+    wait_seconds: Tuple[float, ...] = (120.0, 300.0, 600.0)
+    reduced_steps: int = 27
+    oss_steps: str = DEFAULT_OSS_STEPS
+    throughput_window_seconds: float = 300.0
+
+    @classmethod
+    def from_env(cls) -> "DegradationConfig":
+        """環境変数 ACE_DEGRADE_* から設定を読み込む"""
+        default = cls()
+        return cls(
+            queue_depths=_parse_list(
+                os.environ.get("ACE_DEGRADE_QUEUE_DEPTHS", ",".join(map(str, default.queue_depths))), int
+            ),
+            wait_seconds=_parse_list(
+                os.environ.get("ACE_DEGRADE_WAIT_SECONDS", ",".join(map(str, default.wait_seconds))), float
+            ),
+            reduced_steps=int(os.environ.get("ACE_DEGRADE_STEPS", str(default.reduced_steps))),
+            oss_steps=os.environ.get("ACE_DEGRADE_OSS_STEPS", default.oss_steps),
+            throughput_window_seconds=float(
+                os.environ.get("ACE_DEGRADE_WINDOW_SECONDS", str(default.throughput_window_seconds))
+            ),
+        )
+
+
+class ThroughputMeter:
+    """
+    直近 window_seconds の完了ジョブ数からスループット（ジョブ/秒）を求める
+    record(amount=...) で重みを付けると、完了した作業量の速度（例: 見積もりGPU秒/秒）になる
+    """
+
+    def __init__(self, window_seconds: float = 300.0):
+        self.window_seconds = window_seconds
+        self._completions: Deque[Tuple[float, float]] = deque()
+
+    def record(self, now: Optional[float] = None, amount: float = 1.0):
+        now = time.time() if now is None else now
+        self._completions.append((now, amount))
+        self._trim(now)
+
+    def rate(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        self._trim(now)
+        if len(self._completions) < 2:
+            return 0.0
+        elapsed = now - self._completions[0][0]
+        if elapsed <= 0:
+            return 0.0
+        return sum(amount for _, amount in self._completions) / elapsed
+
+    def _trim(self, now: float):
+        while self._completions and self._completions[0][0] < now - self.window_seconds:
+            self._completions.popleft()
+
+
+def _subset(steps: List[int], count: int) -> List[int]:
+    """ステップ列から等間隔に count 個を選ぶ（最後のステップは必ず残す）"""
+    if count >= len(steps):
+        return list(steps)
+    if count <= 1:
+        return [steps[-1]]
+    last = len(steps) - 1
+    indices = sorted({round(i * last / (count - 1)) for i in range(count)})
+    return [steps[i] for i in indices]
+
+
+def _parse_oss_steps(oss_steps: Optional[str]) -> List[int]:
+    if isinstance(oss_steps, str) and oss_steps.strip():
+        return [int(v) for v in oss_steps.split(",") if v.strip()]
+    return []
+
+
+class DegradationPolicy:
+    def __init__(self, config: DegradationConfig, meter: ThroughputMeter):
+        self.config = config
+        self.meter = meter
+        self.applied_counts: Dict[int, int] = {}
+
+    def level(self, queue_depth: int, now: Optional[float] = None) -> int:
+        """混雑レベル（0 で引き下げなし）"""
+        level = sum(1 for threshold in self.config.queue_depths if queue_depth >= threshold)
+        throughput = self.meter.rate(now)
+        if throughput > 0:
+            expected_wait = queue_depth / throughput
+            level = max(level, sum(1 for threshold in self.config.wait_seconds if expected_wait >= threshold))
+        return min(level, 3)
+
+    def apply(self, request: Any, queue_depth: int, now: Optional[float] = None) -> Optional[Dict]:
+        """
+        混雑レベルに応じて request を書き換え、適用した変更を返す
+        引き下げ不要、または何も変わらなかった場合は None
+        """
+        level = self.level(queue_depth, now)
+        if level == 0:
+            return None
+
+        changes: Dict[str, List] = {}
+
+        def update(name: str, value):
+            current = getattr(request, name)
+            if current != value:
+                changes[name] = [current, value]
+                setattr(request, name, value)
+
+        update("use_erg_tag", False)
+        update("use_erg_lyric", False)
+        update("use_erg_diffusion", False)
+        update("guidance_scale_text", 0.0)
+        update("guidance_scale_lyric", 0.0)
+
+        if level >= 2:
+            oss_steps = _parse_oss_steps(request.oss_steps)
+            if oss_steps:
+                update("oss_steps", ",".join(map(str, _subset(oss_steps, self.config.reduced_steps))))
+            else:
+                update("infer_step", min(request.infer_step, self.config.reduced_steps))
+
+        if level >= 3:
+            degraded = _parse_oss_steps(self.config.oss_steps)
+            current = _parse_oss_steps(request.oss_steps)
+            current_count = len(current) if current else request.infer_step
+            if degraded and len(degraded) < current_count:
+                update("oss_steps", ",".join(map(str, degraded)))
+
+        if not changes:
+            return None
+        self.applied_counts[level] = self.applied_counts.get(level, 0) + 1
+        return {"level": level, "queue_depth": queue_depth, "changes": changes}
+
+    def snapshot(self) -> Dict:
+        return {
+            "throughput_jobs_per_second": self.meter.rate(),
+            "queue_depths": list(self.config.queue_depths),
+            "wait_seconds": list(self.config.wait_seconds),
+            "applied_counts": dict(self.applied_counts),
+        }
@@ -0,0 +1,286 @@
+"""
+複数デバイスのパイプラインプール
+
+デバイスごとにパイプラインのレプリカと専用のワーカースレッド（Executor）を持ち、
+スケジューラが待ち行列から取り出したジョブを、取り出した時点でレプリカに割り当てる。
+待ち行列は1つのまま（優先度・期限・バッチングの判断は全デバイス共通）で、
+レプリカごとには割り当て済みのジョブ（実行待ち・実行中）と健全性を記録する。
+
+割り当て方（ACE_DEVICE_DISPATCH）:
+  least_loaded:  割り当て済みのジョブの見積もりGPU秒が最も少ないレプリカ
+  lora_affinity: 要求された LoRA を読み込み済みのレプリカを優先する
+                 （最も空いているレプリカとの差が affinity_slack_seconds 秒以内の場合のみ）
+
+連続して max_failures 回失敗したレプリカは cooldown_seconds 秒間割り当てから外す。
+全レプリカが外れている場合は、最も空いているレプリカに割り当てる（ジョブを失敗させない）。
+
+ACE_DEVICES には "cuda:0,cuda:1" のようにデバイスを列挙する（"auto" で全GPU）。
+"cpu,cpu" のように同じデバイスを複数指定すると、その数だけレプリカを作る
+（GPUのない環境で割り当てを試験できる）。未指定の場合は従来どおり1つのデバイスを使う。
+ACE_MODEL_WORKERS を指定した場合、各レプリカのパイプラインを別プロセス（acestep.api.model_worker）で動かし、
+その数だけレプリカを作る（デバイスは ACE_DEVICES を順に割り当てる）。
+
+イベントループ上でのみ操作する前提のため、ロックは使用しない。
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+DISPATCH_MODES = ("least_loaded", "lora_affinity")
+
+
+@dataclass
+class DevicePoolConfig:
+    # 空の場合は従来どおり1つのデバイス（initialize_pipeline の device_id）を使う
+    devices: List[str] = field(default_factory=list)
+    dispatch: str = "least_loaded"
+    max_failures: int = 3
+    cooldown_seconds: float = 60.0
+    affinity_slack_seconds: float = 60.0
+    # モデルワーカープロセスの数（0 の場合はパイプラインをこのプロセス内で動かす）
+    worker_processes: int = 0
+
+    @property
+    def replica_count(self) -> int:
+        return len(self.replica_devices())
+
+    def replica_devices(self) -> List[Optional[str]]:
+        """レプリカごとのデバイス（None は initialize_pipeline の device_id）"""
+        if self.worker_processes > 0:
+            devices = self.devices or [None]
+            return [devices[i % len(devices)] for i in range(self.worker_processes)]
+        return list(self.devices) or [None]
+
+    @classmethod
+    def from_env(cls, cuda_device_count: Optional[Callable[[], int]] = None) -> "DevicePoolConfig":
+        """
+        環境変数 ACE_DEVICES / ACE_DEVICE_DISPATCH / ACE_DEVICE_MAX_FAILURES /
+        ACE_DEVICE_COOLDOWN_SECONDS / ACE_DEVICE_AFFINITY_SLACK_SECONDS / ACE_MODEL_WORKERS から設定を読み込む
+        cuda_device_count は ACE_DEVICES=auto の解決に使う（torch.cuda.device_count）
+        """
+        default = cls()
+        dispatch = os.environ.get("ACE_DEVICE_DISPATCH", default.dispatch).strip().lower()
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError(f"Unknown device dispatch mode: {dispatch} (choose from {', '.join(DISPATCH_MODES)})")
+        return cls(
+            devices=parse_devices(os.environ.get("ACE_DEVICES", ""), cuda_device_count),
+            dispatch=dispatch,
+            max_failures=max(1, int(os.environ.get("ACE_DEVICE_MAX_FAILURES", str(default.max_failures)))),
+            cooldown_seconds=float(os.environ.get("ACE_DEVICE_COOLDOWN_SECONDS", str(default.cooldown_seconds))),
+            affinity_slack_seconds=float(
+                os.environ.get("ACE_DEVICE_AFFINITY_SLACK_SECONDS", str(default.affinity_slack_seconds))
+            ),
+            worker_processes=max(0, int(os.environ.get("ACE_MODEL_WORKERS", str(default.worker_processes)))),
+        )
+
+
+def parse_devices(value: str, cuda_device_count: Optional[Callable[[], int]] = None) -> List[str]:
+    """
+    "cuda:0,cuda:1" 形式のデバイス指定を解析する（数字のみは cuda:N とみなす）
+    "auto" は cuda_device_count() 個のGPU（GPUがない場合は "cpu"）
+    """
+    devices = []
+    for item in value.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        if item.isdigit():
+            item = f"cuda:{item}"
+        if item == "auto":
+            count = cuda_device_count() if cuda_device_count is not None else 0
+            devices.extend([f"cuda:{i}" for i in range(count)] or ["cpu"])
+            continue
+        devices.append(item)
+    return devices
+
+
+def is_device_error(error: BaseException) -> bool:
+    """
+    デバイス側の失敗か（メモリ不足・CUDAエラーは RuntimeError / MemoryError）
+    入力の誤りによる ValueError などはレプリカの健全性に数えない
+    """
+    return isinstance(error, (RuntimeError, MemoryError))
+
+
+class Replica:
+    """1つのデバイスに載せたパイプラインと、その専用ワーカースレッド"""
+
+    def __init__(self, index: int, device: Optional[str], pipeline: Any, capacity: int = 1, engine: Any = None,
+                 stages: Any = None):
+        self.index = index
+        self.device = device
+        self.pipeline = pipeline
+        self.engine = engine
+        # 段階パイプライン（acestep.api.stage_pipeline、無効な場合は None）
+        self.stages = stages
+        self.capacity = capacity
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"ace-replica-{index}")
+        # 割り当て済みのジョブ数と見積もりGPU秒
+        self.active_jobs = 0
+        self.load_seconds = 0.0
+        # 最後に割り当てたジョブの LoRA（実行後はパイプラインに読み込まれている）
+        self.lora: Optional[str] = None
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.last_error: Optional[str] = None
+
+    def healthy(self, now: Optional[float] = None) -> bool:
+        return (now if now is not None else time.time()) >= self.unhealthy_until
+
+    @property
+    def loaded_lora(self) -> Optional[str]:
+        return getattr(self.pipeline, "lora_path", None) if self.pipeline is not None else None
+
+    def shutdown(self):
+        if self.engine is not None:
+            self.engine.stop()
+        if self.stages is not None:
+            self.stages.shutdown()
+        close = getattr(self.pipeline, "close", None)
+        if close is not None:
+            # モデルワーカープロセスを停止する
+            close()
+        self.executor.shutdown(wait=False)
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "device": self.device or "default",
+            "pid": getattr(self.pipeline, "pid", None),
+            "healthy": self.healthy(now),
+            "active_jobs": self.active_jobs,
+            "capacity": self.capacity,
+            "load_seconds": self.load_seconds,
+            "lora": self.lora or self.loaded_lora,
+            "completed": self.completed,
+            "failed": self.failed,
+            "consecutive_failures": self.consecutive_failures,
+            "unhealthy_for_seconds": max(0.0, self.unhealthy_until - now),
+            "last_error": self.last_error,
+            "stages": self.stages.snapshot() if self.stages is not None else None,
+        }
+
+
+class DevicePool:
+    """
+    レプリカへのジョブの割り当て
+
+    estimate: ジョブ（バッチ）の見積もりGPU秒
+    lora_of:  ジョブが要求する LoRA（lora_affinity で使用）
+    """
+
+    def __init__(
+        self,
+        config: DevicePoolConfig,
+        estimate: Callable[[Sequence[Any]], float],
+        lora_of: Callable[[Any], Optional[str]],
+    ):
+        self.config = config
+        self._estimate = estimate
+        self._lora_of = lora_of
+        self.replicas: List[Replica] = []
+        # 割り当て中のバッチ（先頭ジョブの id）→ (レプリカ, 見積もりGPU秒)
+        self._leases: Dict[int, Tuple[Replica, float]] = {}
+        self.metrics: Dict[str, int] = {"dispatched": 0, "affinity_hits": 0, "unhealthy_fallbacks": 0}
+
+    @property
+    def primary(self) -> Optional[Replica]:
+        return self.replicas[0] if self.replicas else None
+
+    def add(self, device: Optional[str], pipeline: Any, capacity: int = 1, engine: Any = None,
+            stages: Any = None) -> Replica:
+        replica = Replica(len(self.replicas), device, pipeline, capacity=capacity, engine=engine, stages=stages)
+        self.replicas.append(replica)
+        return replica
+
+    def clear(self):
+        """全レプリカを停止して取り除く（パイプラインの再初期化時）"""
+        for replica in self.replicas:
+            replica.shutdown()
+        self.replicas = []
+        self._leases.clear()
+
+    def acquire(self, jobs: Sequence[Any], pinned: Optional[Replica] = None) -> Replica:
+        """
+        バッチを1つのレプリカに割り当てる
+        pinned（中断したジョブのスナップショットを持つレプリカなど）を指定した場合はそのレプリカに割り当てる
+        """
+        if not self.replicas:
+            raise RuntimeError("Pipeline not initialized")
+        now = time.time()
+        if pinned is not None and pinned in self.replicas:
+            replica = pinned
+        else:
+            replica = self._choose(self._lora_of(jobs[0]), now)
+        seconds = self._estimate(jobs)
+        replica.active_jobs += len(jobs)
+        replica.load_seconds += seconds
+        replica.lora = self._lora_of(jobs[0])
+        self._leases[id(jobs[0])] = (replica, seconds)
+        self.metrics["dispatched"] += 1
+        return replica
+
+    def release(self, jobs: Sequence[Any], error: Optional[str] = None):
+        """
+        バッチの終了時に割り当てを解除し、レプリカの健全性を更新する
+        error はデバイス側の失敗（キャンセル・中断は None）
+        """
+        lease = self._leases.pop(id(jobs[0]), None)
+        if lease is None:
+            return
+        replica, seconds = lease
+        replica.active_jobs = max(0, replica.active_jobs - len(jobs))
+        replica.load_seconds = max(0.0, replica.load_seconds - seconds)
+        if error is None:
+            replica.completed += len(jobs)
+            replica.consecutive_failures = 0
+            return
+        replica.failed += len(jobs)
+        replica.consecutive_failures += 1
+        replica.last_error = error
+        if replica.consecutive_failures >= self.config.max_failures:
+            replica.unhealthy_until = time.time() + self.config.cooldown_seconds
+            replica.consecutive_failures = 0
+            print(f"Device replica {replica.index} ({replica.device or 'default'}) marked unhealthy "
+                  f"for {self.config.cooldown_seconds:.0f}s: {error}")
+
+    def replica_of(self, job: Any) -> Optional[Replica]:
+        lease = self._leases.get(id(job))
+        return lease[0] if lease is not None else None
+
+    def _choose(self, lora: Optional[str], now: float) -> Replica:
+        candidates = [replica for replica in self.replicas if replica.healthy(now)]
+        if not candidates:
+            self.metrics["unhealthy_fallbacks"] += 1
+            candidates = self.replicas
+        # 空きのあるレプリカを優先し、その中で見積もりGPU秒（容量あたり）が最も少ないもの
+        free = [replica for replica in candidates if replica.active_jobs < replica.capacity] or candidates
+
+        def load(replica: Replica) -> Tuple[float, int]:
+            return replica.load_seconds / replica.capacity, replica.index
+
+        best = min(free, key=load)
+        if self.config.dispatch == "lora_affinity" and lora and lora != "none":
+            affine = [
+                replica for replica in free
+                if lora in (replica.lora, replica.loaded_lora)
+            ]
+            if affine:
+                nearest = min(affine, key=load)
+                if load(nearest)[0] - load(best)[0] <= self.config.affinity_slack_seconds:
+                    self.metrics["affinity_hits"] += int(nearest is not best)
+                    best = nearest
+        return best
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "dispatch": self.config.dispatch,
+            "replicas": [replica.snapshot(now) for replica in self.replicas],
+            **self.metrics,
+        }
@@ -0,0 +1,107 @@
+"""
+待ち行列の開始・完了予測（ETA）
+
+実行中のジョブの残り時間と、スケジューリングポリシーによる取り出し順から、
+待機中の各ジョブの開始・完了予測時刻を求める。処理時間は CostModel
+（timecosts のオンライン回帰）で見積もるため、ハードウェアの変化にも追従する。
+
+デバイス（レプリカ）ごとに、実行中のジョブは同時に（バッチとして）処理され、
+待機中のジョブは最も早く空くデバイスで1件ずつ処理されるとみなす。
+"""
+
+import heapq
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from acestep.api.policy import CostModel, SchedulingPolicy
+
+
+@dataclass
+class JobEta:
+    request_id: str
+    status: str
+    # 待ち行列での順番（実行中は 0、待機中は 1 から）
+    position: int
+    estimated_seconds: float
+    predicted_start_at: float
+    predicted_finish_at: float
+
+    def poll_after(self, now: Optional[float] = None) -> float:
+        """完了予測時刻までの秒数（次にポーリングすべき目安、最短1秒）"""
+        now = time.time() if now is None else now
+        return max(1.0, self.predicted_finish_at - now)
+
+    def to_dict(self, now: Optional[float] = None) -> Dict[str, Any]:
+        return {**asdict(self), "poll_after_seconds": self.poll_after(now)}
+
+
+class EtaPredictor:
+    """
+    running_jobs / pending_jobs: スケジューラの実行中・待機中のジョブ一覧を返す
+    max_age: 予測を再利用する秒数（ポーリングが集中しても並べ替えを繰り返さない）
+    devices: ジョブを並行して処理するデバイスの数を返す（省略時は1台）
+    device_of: 実行中のジョブが割り当てられたデバイスの番号（不明な場合は None）
+    """
+
+    def __init__(
+        self,
+        cost_model: CostModel,
+        running_jobs: Callable[[], List[Any]],
+        pending_jobs: Callable[[], List[Any]],
+        policy: Optional[SchedulingPolicy] = None,
+        max_age: float = 1.0,
+        devices: Optional[Callable[[], int]] = None,
+        device_of: Optional[Callable[[Any], Optional[int]]] = None,
+    ):
+        self.cost_model = cost_model
+        self.policy = policy or SchedulingPolicy()
+        self._running_jobs = running_jobs
+        self._pending_jobs = pending_jobs
+        self.max_age = max_age
+        self._devices = devices
+        self._device_of = device_of
+        self._computed_at = 0.0
+        self._schedule: List[JobEta] = []
+        self._by_id: Dict[str, JobEta] = {}
+
+    def schedule(self, now: Optional[float] = None) -> List[JobEta]:
+        """実行中・待機中の全ジョブの予測（実行中、取り出し順の待機中の順）"""
+        now = time.time() if now is None else now
+        if now - self._computed_at >= self.max_age or now < self._computed_at:
+            self._compute(now)
+        return self._schedule
+
+    def lookup(self, request_id: str, now: Optional[float] = None) -> Optional[JobEta]:
+        self.schedule(now)
+        return self._by_id.get(request_id)
+
+    def invalidate(self):
+        self._computed_at = 0.0
+
+    def _compute(self, now: float):
+        schedule = []
+        device_count = max(1, self._devices()) if self._devices is not None else 1
+        # デバイスごとの空く時刻
+        free_at = [now] * device_count
+        for job in self._running_jobs():
+            estimate = self.cost_model.estimate(job.request)
+            started_at = job.started_at or now
+            # 見積もりを超過しているジョブは間もなく終わるとみなす
+            finish = max(now, started_at + estimate)
+            device = self._device_of(job) if self._device_of is not None else None
+            if device is None or not 0 <= device < device_count:
+                device = free_at.index(min(free_at)) if device_count > 1 else 0
+            free_at[device] = max(free_at[device], finish)
+            schedule.append(JobEta(job.request_id, "processing", 0, estimate, started_at, finish))
+
+        heapq.heapify(free_at)
+        for position, job in enumerate(self.policy.order(self._pending_jobs()), start=1):
+            estimate = self.cost_model.estimate(job.request)
+            start = heapq.heappop(free_at)
+            heapq.heappush(free_at, start + estimate)
+            schedule.append(JobEta(job.request_id, "pending", position, estimate, start, start + estimate))
+
+        self._schedule = schedule
+        self._by_id = {eta.request_id: eta for eta in schedule}
+        self._computed_at = now
@@ -0,0 +1,180 @@
+"""
+リクエストごとの進捗イベントの配信
+
+GPUスレッドのパイプラインフック（acestep.progress）が報告したイベントを
+イベントループに渡し、/events/{request_id} の購読者（Server-Sent Events）に配信する。
+
+イベントの種類（type）:
+  queued:    待ち行列での順番と開始・完了予測
+  status:    ステータスの変化（processing など）
+  stage:     ステージの遷移（text_encoding / diffusion / dcae_decode / vocoder / encoding）
+  progress:  拡散ステップ・デコード窓ごとの進捗（step / total）
+  completed / failed: 終了（これを送った後にストリームを閉じる）
+
+購読者がいないリクエストの進捗は最新状態の記録のみ行い、イベントループには渡さない。
+途中から接続した購読者には、最初に最新状態を送る。
+
+相乗り（acestep.api.singleflight）のフォロワーには、follow() で登録したリーダーの
+ステージ・進捗イベントを転送する。
+
+wait_for_state_change() はステータスの変化（status / completed / failed）だけを待つ
+ロングポーリング用の待機で、進捗イベントは受け取らない。
+"""
+
+import asyncio
+import json
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from acestep.progress import ProgressCallback
+
+TERMINAL_EVENTS = ("completed", "failed")
+STATE_EVENTS = ("status",) + TERMINAL_EVENTS
+
+
+class Subscription:
+    """1つの購読者の待ち行列（溢れた場合は古い進捗イベントから捨てる）"""
+
+    def __init__(self, request_id: str, max_events: int):
+        self.request_id = request_id
+        self.max_events = max_events
+        self._events: Deque[Dict] = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, event: Dict):
+        if len(self._events) >= self.max_events:
+            # 進捗は最新の値だけが意味を持つため、最も古い progress イベントを捨てる
+            for i, queued in enumerate(self._events):
+                if queued["type"] == "progress":
+                    del self._events[i]
+                    break
+            else:
+                self._events.popleft()
+        self._events.append(event)
+        self._ready.set()
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict]:
+        """次のイベント（timeout 秒以内に届かなければ None）"""
+        if not self._events:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._events.popleft()
+
+
+class EventBroker:
+    def __init__(self, max_events_per_subscriber: int = 256):
+        self.max_events_per_subscriber = max_events_per_subscriber
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Dict[str, List[Subscription]] = {}
+        # リクエストごとの最新の進捗（GPUスレッドから辞書ごと置き換える）
+        self._latest: Dict[str, Dict] = {}
+        # ステータスの変化を待つロングポーリング（リクエストIDごとの Future）
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        # リーダーのリクエストID → 進捗を転送するフォロワーのリクエストID
+        self._followers: Dict[str, Tuple[str, ...]] = {}
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """GPUスレッドからのイベントを渡すイベントループを設定する（起動時に呼び出す）"""
+        self._loop = loop
+
+    def subscribe(self, request_id: str) -> Subscription:
+        subscription = Subscription(request_id, self.max_events_per_subscriber)
+        self._subscribers.setdefault(request_id, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscribers.get(subscription.request_id, [])
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+        if not subscriptions:
+            self._subscribers.pop(subscription.request_id, None)
+
+    def subscribed_ids(self) -> List[str]:
+        return list(self._subscribers)
+
+    def follow(self, follower_id: str, leader_id: str):
+        """leader_id のステージ・進捗イベントを follower_id にも配信する"""
+        self._followers[leader_id] = self._followers.get(leader_id, ()) + (follower_id,)
+        latest = self._latest.get(leader_id)
+        if latest is not None:
+            self._latest[follower_id] = latest
+
+    def unfollow(self, follower_id: str, leader_id: str):
+        followers = tuple(f for f in self._followers.get(leader_id, ()) if f != follower_id)
+        if followers:
+            self._followers[leader_id] = followers
+        else:
+            self._followers.pop(leader_id, None)
+
+    def latest(self, request_id: str) -> Optional[Dict]:
+        return self._latest.get(request_id)
+
+    def publish(self, request_id: str, event: Dict):
+        """イベントを購読者に配信する（イベントループ上で呼び出す）"""
+        for subscription in self._subscribers.get(request_id, []):
+            subscription.put(event)
+        if event["type"] in STATE_EVENTS:
+            for waiter in self._waiters.get(request_id, []):
+                if not waiter.done():
+                    waiter.set_result(request_id)
+        if event["type"] in TERMINAL_EVENTS:
+            self._latest.pop(request_id, None)
+
+    def publish_threadsafe(self, request_id: str, event: Dict):
+        """GPUスレッドなどイベントループ外からイベントを配信する"""
+        if event["type"] in ("stage", "progress"):
+            self._latest[request_id] = event
+            # GPUスレッドから読むため、置き換えのみで更新するタプルを参照する
+            for follower_id in self._followers.get(request_id, ()):
+                self.publish_threadsafe(follower_id, event)
+        if self._loop is not None and (
+            request_id in self._subscribers or (event["type"] in STATE_EVENTS and request_id in self._waiters)
+        ):
+            self._loop.call_soon_threadsafe(self.publish, request_id, event)
+
+    async def wait_for_state_change(self, request_ids: Sequence[str], timeout: float) -> Optional[str]:
+        """
+        いずれかのリクエストのステータスが変化するまで待つ
+        変化したリクエストID、timeout 秒以内に変化しなければ None を返す
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        for request_id in request_ids:
+            self._waiters.setdefault(request_id, []).append(waiter)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            for request_id in request_ids:
+                waiters = self._waiters.get(request_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(request_id, None)
+
+    def progress_callback(self, *request_ids: str) -> ProgressCallback:
+        """
+        パイプラインの progress_callback として渡すフック
+        バッチ処理では同じ進捗をバッチ内の全リクエストに配信する
+        """
+        current = {"stage": None}
+
+        def callback(stage: str, step: Optional[int], total: Optional[int]):
+            if stage != current["stage"]:
+                current["stage"] = stage
+                for request_id in request_ids:
+                    self.publish_threadsafe(request_id, {"type": "stage", "stage": stage})
+            if step is not None:
+                event = {"type": "progress", "stage": stage, "step": step, "total": total}
+                for request_id in request_ids:
+                    self.publish_threadsafe(request_id, event)
+
+        return callback
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """イベントを Server-Sent Events の形式に変換する"""
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
@@ -0,0 +1,308 @@
+"""
+テナント（クライアント）間の重み付き公平キューイング
+
+待機中のジョブをテナントごとのサブキューに分け、見積もりGPU秒に基づく
+開始時刻公平キューイング（Start-time Fair Queuing）でテナントを選ぶ。
+  - テナントはジョブを開始するたびに「見積もりGPU秒 / 重み」だけ仮想時刻（finish_tag）が進む
+  - 待機中のジョブがあるテナントのうち、開始タグ max(finish_tag, 全体の仮想時刻) が最も小さいテナントを選ぶ
+  - しばらくジョブのなかったテナントの開始タグは全体の仮想時刻になるため、
+    大量のジョブを投入したテナントの待ち行列の後ろに並ばず、次に空いたワーカーで実行される
+テナントの中でどのジョブを取り出すかは、元のポリシー（fifo / priority / sjf）で決める。
+テナントの選択は優先度より先に行われ、テナントをまたいだ優先度の順序は保たれないため、
+ACE_FAIR_QUEUING=1 を指定した場合のみ有効にする（デフォルトは無効で、全体の優先度順に取り出す）。
+
+テナントは次の順に決める（ACE_TENANT_HEADERS で変更できる）:
+  X-Tenant-ID:   値をそのままテナント名とする
+  X-API-Key:     値の sha256 の先頭12文字（"key:..."、キーそのものは記録しない）
+  Authorization: 同上
+  いずれもない場合は接続元のアドレス（"ip:..."）
+
+ACE_TENANT_WEIGHTS="interactive=4,bulk=1" のようにテナントごとの重み（デフォルト ACE_TENANT_DEFAULT_WEIGHT）、
+ACE_TENANT_CONCURRENCY="bulk=1" のようにテナントごとの同時実行数の上限（デフォルト ACE_TENANT_MAX_CONCURRENCY、0 で無制限）を指定する。
+上限に達したテナントのジョブは、そのテナントのジョブが終了するまで取り出さない。
+バッチにまとめるジョブも同じ順序で選び、同じバッチのジョブを実行中として上限に数える。
+
+イベントループ上でのみ操作する前提のため、ロックは使用しない。
+"""
+
+import hashlib
+import heapq
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from acestep.api.policy import CostModel, SchedulingPolicy
+
+DEFAULT_TENANT = "default"
+# 値をハッシュして記録するヘッダー（資格情報）
+CREDENTIAL_HEADERS = ("x-api-key", "authorization")
+# 状態を保持するテナント数の上限（超えた場合は待機中・実行中のジョブのないテナントから削除する）
+MAX_TENANTS = 1024
+
+
+def parse_tenant_values(value: str, cast: Callable[[str], Any]) -> Dict[str, Any]:
+    """"name=value,name=value" 形式の指定を解析する"""
+    values = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, raw = item.partition("=")
+        if not raw:
+            raise ValueError(f"Invalid tenant setting (expected name=value): {item}")
+        values[name.strip()] = cast(raw.strip())
+    return values
+
+
+@dataclass
+class FairQueuingConfig:
+    enabled: bool = False
+    headers: List[str] = field(default_factory=lambda: ["x-tenant-id", "x-api-key", "authorization"])
+    default_weight: float = 1.0
+    weights: Dict[str, float] = field(default_factory=dict)
+    # テナントごとの同時実行数の上限（0 で無制限）
+    max_concurrency: int = 0
+    concurrency: Dict[str, int] = field(default_factory=dict)
+
+    def weight(self, tenant: str) -> float:
+        return max(1e-6, self.weights.get(tenant, self.default_weight))
+
+    def concurrency_limit(self, tenant: str) -> int:
+        return self.concurrency.get(tenant, self.max_concurrency)
+
+    @classmethod
+    def from_env(cls) -> "FairQueuingConfig":
+        """
+        環境変数 ACE_FAIR_QUEUING / ACE_TENANT_HEADERS / ACE_TENANT_DEFAULT_WEIGHT / ACE_TENANT_WEIGHTS /
+        ACE_TENANT_MAX_CONCURRENCY / ACE_TENANT_CONCURRENCY から設定を読み込む
+        """
+        default = cls()
+        headers = os.environ.get("ACE_TENANT_HEADERS")
+        return cls(
+            enabled=os.environ.get("ACE_FAIR_QUEUING", "0").strip().lower() in ("1", "true", "yes", "on"),
+            headers=[h.strip().lower() for h in headers.split(",") if h.strip()] if headers else default.headers,
+            default_weight=float(os.environ.get("ACE_TENANT_DEFAULT_WEIGHT", str(default.default_weight))),
+            weights=parse_tenant_values(os.environ.get("ACE_TENANT_WEIGHTS", ""), float),
+            max_concurrency=max(0, int(os.environ.get("ACE_TENANT_MAX_CONCURRENCY", str(default.max_concurrency)))),
+            concurrency=parse_tenant_values(os.environ.get("ACE_TENANT_CONCURRENCY", ""), int),
+        )
+
+
+def tenant_of_request(headers: Any, client_host: Optional[str], config: FairQueuingConfig) -> str:
+    """リクエストヘッダー（大文字小文字を区別しない Mapping）と接続元からテナント名を決める"""
+    for name in config.headers:
+        value = headers.get(name)
+        if not value:
+            continue
+        value = value.strip()
+        if name in CREDENTIAL_HEADERS:
+            return "key:" + hashlib.sha256(value.encode("utf-8")).hexdigest()[:12]
+        return value
+    return f"ip:{client_host}" if client_host else DEFAULT_TENANT
+
+
+def job_tenant(job: Any) -> str:
+    return getattr(job, "tenant", None) or DEFAULT_TENANT
+
+
+class TenantState:
+    """テナントの仮想時刻と統計"""
+
+    def __init__(self):
+        self.finish_tag = 0.0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.served_seconds = 0.0
+        self.last_active = time.time()
+        # 直近のジョブの待ち時間（投入から開始まで）
+        self.waits: Deque[float] = deque(maxlen=256)
+
+    def snapshot(self) -> Dict[str, Any]:
+        waits = sorted(self.waits)
+        return {
+            "started": self.started,
+            "completed": self.completed,
+            "failed": self.failed,
+            "served_seconds": self.served_seconds,
+            "avg_wait_seconds": sum(waits) / len(waits) if waits else None,
+            "p95_wait_seconds": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else None,
+        }
+
+
+class FairQueuingPolicy(SchedulingPolicy):
+    """
+    テナント間の重み付き公平キューイング（テナント内の順序は inner のポリシー）
+
+    running_jobs: 実行中のジョブ（同時実行数の上限の確認に使う）
+    """
+
+    def __init__(
+        self,
+        inner: SchedulingPolicy,
+        cost_model: CostModel,
+        config: FairQueuingConfig,
+        running_jobs: Callable[[], Sequence[Any]] = lambda: [],
+    ):
+        self.inner = inner
+        self.cost_model = cost_model
+        self.config = config
+        self._running_jobs = running_jobs
+        self.name = f"fair+{inner.name}"
+        # 最後に開始したジョブの開始タグ
+        self.virtual_time = 0.0
+        self.tenants: Dict[str, TenantState] = {}
+
+    def _state(self, tenant: str) -> TenantState:
+        state = self.tenants.get(tenant)
+        if state is None:
+            state = self.tenants[tenant] = TenantState()
+        return state
+
+    def _start_tag(self, tenant: str, finish_tags: Dict[str, float], virtual_time: float) -> float:
+        return max(finish_tags.get(tenant, 0.0), virtual_time)
+
+    def _pick(self, pending: Sequence[Any], finish_tags: Dict[str, float], virtual_time: float,
+              blocked: Sequence[str] = ()) -> Optional[Tuple[str, Any]]:
+        queues: Dict[str, List[Any]] = {}
+        for job in pending:
+            tenant = job_tenant(job)
+            if tenant not in blocked:
+                queues.setdefault(tenant, []).append(job)
+        best = None
+        for tenant, jobs in queues.items():
+            head = self.inner.select(jobs)
+            # 開始タグが同じなら先に投入されたジョブのテナント
+            key = (self._start_tag(tenant, finish_tags, virtual_time), head.created_at)
+            if best is None or key < best[0]:
+                best = (key, tenant, head)
+        return (best[1], best[2]) if best is not None else None
+
+    def _tenant_counts(self, jobs: Sequence[Any]) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for job in jobs:
+            tenant = job_tenant(job)
+            counts[tenant] = counts.get(tenant, 0) + 1
+        return counts
+
+    def _blocked_tenants(self) -> List[str]:
+        return [
+            tenant for tenant, count in self._tenant_counts(self._running_jobs()).items()
+            if 0 < self.config.concurrency_limit(tenant) <= count
+        ]
+
+    def admits(self, job: Any, batch: Sequence[Any]) -> bool:
+        """バッチのジョブ（まだ実行中に含まれない）も数えて、job のテナントが同時実行数の上限に達していなければ True"""
+        tenant = job_tenant(job)
+        limit = self.config.concurrency_limit(tenant)
+        if limit <= 0:
+            return True
+        return self._tenant_counts(list(self._running_jobs()) + list(batch)).get(tenant, 0) < limit
+
+    def select(self, pending: Sequence[Any]) -> Optional[Any]:
+        """次に実行するジョブ（全テナントが同時実行数の上限に達している場合は None）"""
+        finish_tags = {tenant: state.finish_tag for tenant, state in self.tenants.items()}
+        picked = self._pick(pending, finish_tags, self.virtual_time, self._blocked_tenants())
+        return picked[1] if picked is not None else None
+
+    def order(self, pending: Sequence[Any]) -> List[Any]:
+        """
+        取り出し順の予測（同時実行数の上限は考慮せず、開始ごとの仮想時刻の進みを模擬する）
+        テナントごとの順序は inner.order で一度だけ求め、次のテナントはヒープで選ぶ（見積もりはジョブごとに1回）
+        """
+        queues: Dict[str, List[Any]] = {}
+        for job in pending:
+            queues.setdefault(job_tenant(job), []).append(job)
+        virtual_time = self.virtual_time
+        # 仮想時刻に追いついたテナント（開始タグ = 仮想時刻）は先頭のジョブの投入順、それ以外は finish_tag の順
+        caught_up: List[Tuple[float, int, str]] = []
+        behind: List[Tuple[float, float, int, str]] = []
+        heads: Dict[str, int] = {}
+        for seq, (tenant, jobs) in enumerate(queues.items()):
+            queues[tenant] = self.inner.order(jobs)
+            heads[tenant] = 0
+            state = self.tenants.get(tenant)
+            finish_tag = state.finish_tag if state is not None else 0.0
+            heapq.heappush(behind, (finish_tag, queues[tenant][0].created_at, seq, tenant))
+        ordered = []
+        while caught_up or behind:
+            while behind and behind[0][0] <= virtual_time:
+                _, created_at, seq, tenant = heapq.heappop(behind)
+                heapq.heappush(caught_up, (created_at, seq, tenant))
+            if caught_up:
+                _, seq, tenant = heapq.heappop(caught_up)
+            else:
+                virtual_time, _, seq, tenant = heapq.heappop(behind)
+            job = queues[tenant][heads[tenant]]
+            heads[tenant] += 1
+            ordered.append(job)
+            if heads[tenant] < len(queues[tenant]):
+                finish_tag = virtual_time + self._cost(job) / self.config.weight(tenant)
+                heapq.heappush(behind, (finish_tag, queues[tenant][heads[tenant]].created_at, seq, tenant))
+        return ordered
+
+    def _cost(self, job: Any) -> float:
+        return self.cost_model.estimate(job.request)
+
+    def job_started(self, job: Any, now: Optional[float] = None):
+        """ジョブの開始時にテナントの仮想時刻を進める（中断からの再開では呼び出さない）"""
+        now = time.time() if now is None else now
+        tenant = job_tenant(job)
+        state = self._state(tenant)
+        cost = self._cost(job)
+        start_tag = max(state.finish_tag, self.virtual_time)
+        self.virtual_time = start_tag
+        state.finish_tag = start_tag + cost / self.config.weight(tenant)
+        state.started += 1
+        state.served_seconds += cost
+        state.last_active = now
+        state.waits.append(max(0.0, now - job.created_at))
+        if len(self.tenants) > MAX_TENANTS:
+            self._prune()
+
+    def job_finished(self, job: Any, succeeded: bool):
+        state = self._state(job_tenant(job))
+        if succeeded:
+            state.completed += 1
+        else:
+            state.failed += 1
+        state.last_active = time.time()
+
+    def _prune(self):
+        """仮想時刻が全体に追いついた（開始タグに影響しない）テナントを古い順に削除する"""
+        active = {job_tenant(job) for job in self._running_jobs()}
+        idle = sorted(
+            (state.last_active, tenant) for tenant, state in self.tenants.items()
+            if tenant not in active and state.finish_tag <= self.virtual_time
+        )
+        for _, tenant in idle[:len(self.tenants) - MAX_TENANTS]:
+            del self.tenants[tenant]
+
+    def snapshot(self, pending: Sequence[Any]) -> Dict[str, Any]:
+        """テナントごとの待機中・実行中のジョブ数、見積もりGPU秒、仮想時刻の遅れ、待ち時間"""
+        tenants: Dict[str, Dict[str, Any]] = {}
+
+        def entry(tenant: str) -> Dict[str, Any]:
+            if tenant not in tenants:
+                state = self.tenants.get(tenant) or TenantState()
+                tenants[tenant] = {
+                    "weight": self.config.weight(tenant),
+                    "concurrency_limit": self.config.concurrency_limit(tenant) or None,
+                    "pending": 0,
+                    "pending_seconds": 0.0,
+                    "running": 0,
+                    "virtual_lag_seconds": max(0.0, state.finish_tag - self.virtual_time),
+                    **state.snapshot(),
+                }
+            return tenants[tenant]
+
+        for job in pending:
+            item = entry(job_tenant(job))
+            item["pending"] += 1
+            item["pending_seconds"] += self._cost(job)
+        for job in self._running_jobs():
+            entry(job_tenant(job))["running"] += 1
+        for tenant in self.tenants:
+            entry(tenant)
+        return {"virtual_time": self.virtual_time, "tenants": tenants}
@@ -0,0 +1,127 @@
+"""
+アップロードされた参照音声の取り込み
+
+リクエストボディをチャンク単位で読み込み、メモリ（ACE_UPLOAD_MEMORY_MB を超えた分は一時ファイル）に保持する。
+base64 は読み込みながら4文字単位で復号するため、復号後のバイト列全体を別途作らない。
+取り込み中に書き込むたびにサイズの上限を確認し、上限を超えた時点で読み込みを中止する。
+
+保持したデータは一時ファイルのパスを介さず、ファイルオブジェクトとしてパイプラインの
+ref_audio_input に渡し、直接テンソルにデコードする。
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, BinaryIO, Callable, Optional, Union
+
+
+@dataclass
+class IngestConfig:
+    # メモリに保持するバイト数（超えた場合は一時ファイルに書き出す）
+    memory_bytes: int = 16 * 1024 ** 2
+    chunk_bytes: int = 256 * 1024
+
+    @classmethod
+    def from_env(cls) -> "IngestConfig":
+        """環境変数 ACE_UPLOAD_MEMORY_MB / ACE_UPLOAD_CHUNK_KB から設定を読み込む"""
+        default = cls()
+        return cls(
+            memory_bytes=int(
+                float(os.environ.get("ACE_UPLOAD_MEMORY_MB", str(default.memory_bytes // 1024 ** 2))) * 1024 ** 2
+            ),
+            chunk_bytes=max(
+                1, int(float(os.environ.get("ACE_UPLOAD_CHUNK_KB", str(default.chunk_bytes // 1024))) * 1024)
+            ),
+        )
+
+
+class UploadBuffer:
+    """
+    取り込んだ音声データ（サイズと sha256 は書き込みながら求める）
+
+    check_size: 書き込み後の合計バイト数を受け取り、上限を超える場合に例外を送出する
+    """
+
+    def __init__(self, config: IngestConfig, check_size: Optional[Callable[[int], None]] = None,
+                 filename: Optional[str] = None):
+        self.filename = filename
+        self.size = 0
+        self._check_size = check_size
+        self._file = tempfile.SpooledTemporaryFile(max_size=config.memory_bytes)
+        self._digest = hashlib.sha256()
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        if self._check_size is not None:
+            self._check_size(self.size + len(data))
+        self._file.write(data)
+        self.size += len(data)
+        self._digest.update(data)
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    def open(self) -> BinaryIO:
+        """先頭から読み込むファイルオブジェクト（同時に読み込めるのは1か所のみ）"""
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        self._file.close()
+
+    def __repr__(self) -> str:
+        name = f" {self.filename}" if self.filename else ""
+        return f"<uploaded audio{name} {self.size} bytes sha256={self.sha256[:12]}>"
+
+
+class Base64Decoder:
+    """チャンク単位の base64 復号（空白・改行は無視し、4文字に満たない末尾は次のチャンクに持ち越す）"""
+
+    def __init__(self):
+        self._pending = b""
+
+    def decode(self, data: Union[bytes, str]) -> bytes:
+        if isinstance(data, str):
+            data = data.encode("ascii")
+        data = self._pending + b"".join(data.split())
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        if not usable:
+            return b""
+        return base64.b64decode(data[:usable], validate=True)
+
+    def flush(self):
+        if self._pending:
+            raise binascii.Error(f"Truncated base64 data ({len(self._pending)} trailing characters)")
+
+
+async def ingest_upload_file(upload: Any, buffer: UploadBuffer, chunk_bytes: int):
+    """multipart でアップロードされたファイル（UploadFile）をチャンク単位で取り込む"""
+    while True:
+        chunk = await upload.read(chunk_bytes)
+        if not chunk:
+            break
+        buffer.write(chunk)
+
+
+async def ingest_stream(chunks: AsyncIterator[bytes], buffer: UploadBuffer, decoder: Optional[Base64Decoder] = None):
+    """リクエストボディのストリームを取り込む（decoder を指定した場合は base64 として復号する）"""
+    async for chunk in chunks:
+        buffer.write(decoder.decode(chunk) if decoder is not None else chunk)
+    if decoder is not None:
+        decoder.flush()
+
+
+def ingest_base64_text(text: str, buffer: UploadBuffer, chunk_bytes: int):
+    """受信済みの base64 文字列を区切って復号しながら取り込む"""
+    decoder = Base64Decoder()
+    # 復号後に chunk_bytes 程度になる長さ（4の倍数）ずつ処理する
+    step = max(4, chunk_bytes // 3 * 4)
+    for start in range(0, len(text), step):
+        buffer.write(decoder.decode(text[start:start + step]))
+    decoder.flush()
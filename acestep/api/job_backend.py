@@ -0,0 +1,771 @@
+"""
+ジョブの待ち行列・状態のバックエンド（複数ノードでの分散処理）
+
+ACE_QUEUE_BACKEND:
+  memory: このプロセスの待ち行列のみを使う（従来の動作、デフォルト）
+  sqlite: SQLite（WALモード）のファイルを待ち行列・状態として共有する（同じホストの複数プロセス）
+  redis:  Redis を待ち行列・状態として共有する（複数ノード）
+
+sqlite / redis の場合、どのノードのAPIも受け付けたジョブをバックエンドに登録し、
+どのノードも空きがあるときにジョブを取得（claim）して自分のスケジューラで処理する。
+取得したジョブにはリース（lease_seconds 秒）を設定し、処理中はハートビートで延長する。
+ノードが停止してリースが切れたジョブは待ち行列に戻され、max_attempts 回を超えた場合は失敗とする。
+処理結果（ステータス・params_json・音楽データ）はバックエンドに書き戻し、どのノードからも参照できる。
+
+MemoryJobBackend は同じインタフェースをプロセス内で実装したもの（試験・組み込み用）。
+RedisJobBackend は redis パッケージ（または互換のクライアント、fakeredis など）を使う。
+
+バックエンドの操作はブロッキングのため、APIからは専用のスレッドで呼び出す。
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+BACKENDS = ("memory", "sqlite", "redis")
+PENDING = "pending"
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+TERMINAL_STATES = (COMPLETED, FAILED)
+
+
+@dataclass
+class JobBackendConfig:
+    backend: str = "memory"
+    # sqlite: データベースファイルのパス、redis: redis://host:port/db
+    url: str = ""
+    lease_seconds: float = 30.0
+    heartbeat_seconds: float = 10.0
+    max_attempts: int = 3
+    # 他のノードで処理中のジョブの完了を確認する間隔
+    poll_seconds: float = 0.5
+    # 終了したジョブの記録を保持する秒数
+    result_ttl_seconds: float = 3600.0
+    # 空いているワーカーの数に加えて取得しておくジョブの数（0 の場合は空きの分のみ取得し、残りは他のノードが取得する）
+    prefetch: int = 0
+    node_id: str = field(default_factory=lambda: f"{socket.gethostname()}-{os.getpid()}")
+
+    @property
+    def distributed(self) -> bool:
+        return self.backend != "memory"
+
+    @classmethod
+    def from_env(cls) -> "JobBackendConfig":
+        """
+        環境変数 ACE_QUEUE_BACKEND / ACE_QUEUE_URL / ACE_QUEUE_LEASE_SECONDS / ACE_QUEUE_HEARTBEAT_SECONDS /
+        ACE_QUEUE_MAX_ATTEMPTS / ACE_QUEUE_POLL_SECONDS / ACE_QUEUE_PREFETCH / ACE_RESULT_TTL_SECONDS /
+        ACE_NODE_ID から設定を読み込む
+        """
+        default = cls()
+        backend = os.environ.get("ACE_QUEUE_BACKEND", default.backend).strip().lower()
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown queue backend: {backend} (choose from {', '.join(BACKENDS)})")
+        return cls(
+            backend=backend,
+            url=os.environ.get("ACE_QUEUE_URL", default.url),
+            lease_seconds=float(os.environ.get("ACE_QUEUE_LEASE_SECONDS", str(default.lease_seconds))),
+            heartbeat_seconds=float(os.environ.get("ACE_QUEUE_HEARTBEAT_SECONDS", str(default.heartbeat_seconds))),
+            max_attempts=max(1, int(os.environ.get("ACE_QUEUE_MAX_ATTEMPTS", str(default.max_attempts)))),
+            poll_seconds=float(os.environ.get("ACE_QUEUE_POLL_SECONDS", str(default.poll_seconds))),
+            result_ttl_seconds=float(os.environ.get("ACE_RESULT_TTL_SECONDS", str(default.result_ttl_seconds))),
+            prefetch=max(0, int(os.environ.get("ACE_QUEUE_PREFETCH", str(default.prefetch)))),
+            node_id=os.environ.get("ACE_NODE_ID") or default.node_id,
+        )
+
+
+@dataclass
+class JobRecord:
+    job_id: str
+    # リクエストのパラメータ（GenerateMusicRequest のフィールド）
+    payload: Dict[str, Any]
+    priority: int = 0
+    created_at: float = 0.0
+    status: str = PENDING
+    # 投入したテナント（公平キューイング）
+    tenant: Optional[str] = None
+    # 受け付けたノードと、取得したノード
+    submitted_by: Optional[str] = None
+    node: Optional[str] = None
+    lease_expires_at: float = 0.0
+    attempts: int = 0
+    cancel_requested: bool = False
+    started_at: Optional[float] = None
+    completed_at: Optional[float] = None
+    error: Optional[str] = None
+    # 音楽データを除いた結果（params_json など）
+    result: Optional[Dict[str, Any]] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATES
+
+
+class JobBackend:
+    """
+    ジョブの待ち行列・状態のインタフェース（実装の基底クラス）
+
+    attachment はジョブと一緒に渡すデータ（アップロードされた参照音声）、
+    audio は完了したジョブのエンコード済みの音楽データ
+    """
+
+    name = "base"
+
+    def __init__(self, config: JobBackendConfig):
+        self.config = config
+
+    def enqueue(self, record: JobRecord, attachment: Optional[bytes] = None):
+        raise NotImplementedError
+
+    def claim(self, node: str) -> Optional[Tuple[JobRecord, Optional[bytes]]]:
+        """優先度の高い順（同じ優先度なら投入順）に待機中のジョブを1件取得し、リースを設定する"""
+        raise NotImplementedError
+
+    def heartbeat(self, job_id: str, node: str) -> Optional[bool]:
+        """
+        リースを延長し、キャンセルが要求されているかを返す
+        リースを失っている（他のノードに移った・終了した）場合は None
+        """
+        raise NotImplementedError
+
+    def finish(self, job_id: str, node: str, status: str, result: Optional[Dict] = None,
+               error: Optional[str] = None, audio: Optional[bytes] = None) -> bool:
+        """取得したジョブの終了を記録する（リースを失っていた場合は記録せず False）"""
+        raise NotImplementedError
+
+    def cancel(self, job_id: str, reason: str = "Cancelled by user") -> Optional[str]:
+        """
+        キャンセルする（待機中は失敗とし、処理中はハートビートで取得したノードに伝える）
+        キャンセル後のステータス、存在しない・終了済みの場合は None を返す
+        """
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        raise NotImplementedError
+
+    def get_many(self, job_ids: Iterable[str]) -> Dict[str, JobRecord]:
+        records = {}
+        for job_id in job_ids:
+            record = self.get(job_id)
+            if record is not None:
+                records[job_id] = record
+        return records
+
+    def get_audio(self, job_id: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def requeue_expired(self, now: Optional[float] = None) -> int:
+        """リースが切れたジョブを待ち行列に戻す（max_attempts 回を超えたものは失敗とする）"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _expired_error(self, record: JobRecord) -> str:
+        return f"Job lease expired {record.attempts} times (last node: {record.node})"
+
+
+def _record_from_dict(values: Dict[str, Any]) -> JobRecord:
+    names = {f.name for f in fields(JobRecord)}
+    return JobRecord(**{k: v for k, v in values.items() if k in names})
+
+
+class MemoryJobBackend(JobBackend):
+    """プロセス内の実装（全ノードが同じプロセスにいる場合のみ共有される）"""
+
+    name = "memory"
+
+    def __init__(self, config: JobBackendConfig):
+        super().__init__(config)
+        self._lock = threading.Lock()
+        self._records: Dict[str, JobRecord] = {}
+        self._attachments: Dict[str, bytes] = {}
+        self._audio: Dict[str, bytes] = {}
+
+    def enqueue(self, record: JobRecord, attachment: Optional[bytes] = None):
+        with self._lock:
+            self._records[record.job_id] = record
+            if attachment is not None:
+                self._attachments[record.job_id] = attachment
+
+    def claim(self, node: str) -> Optional[Tuple[JobRecord, Optional[bytes]]]:
+        now = time.time()
+        self.requeue_expired(now)
+        with self._lock:
+            pending = [r for r in self._records.values() if r.status == PENDING]
+            if not pending:
+                return None
+            record = min(pending, key=lambda r: (-r.priority, r.created_at))
+            record.status = PROCESSING
+            record.node = node
+            record.lease_expires_at = now + self.config.lease_seconds
+            record.attempts += 1
+            record.started_at = record.started_at or now
+            return _record_from_dict(asdict(record)), self._attachments.get(record.job_id)
+
+    def heartbeat(self, job_id: str, node: str) -> Optional[bool]:
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record.status != PROCESSING or record.node != node:
+                return None
+            record.lease_expires_at = time.time() + self.config.lease_seconds
+            return record.cancel_requested
+
+    def finish(self, job_id: str, node: str, status: str, result: Optional[Dict] = None,
+               error: Optional[str] = None, audio: Optional[bytes] = None) -> bool:
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record.status != PROCESSING or record.node != node:
+                return False
+            record.status = status
+            record.result = result
+            record.error = error
+            record.completed_at = time.time()
+            self._attachments.pop(job_id, None)
+            if audio is not None:
+                self._audio[job_id] = audio
+            self._purge_locked(record.completed_at)
+            return True
+
+    def cancel(self, job_id: str, reason: str = "Cancelled by user") -> Optional[str]:
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record.finished:
+                return None
+            if record.status == PENDING:
+                record.status = FAILED
+                record.error = reason
+                record.completed_at = time.time()
+                self._attachments.pop(job_id, None)
+            else:
+                record.cancel_requested = True
+            return record.status
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        with self._lock:
+            record = self._records.get(job_id)
+            return _record_from_dict(asdict(record)) if record is not None else None
+
+    def get_audio(self, job_id: str) -> Optional[bytes]:
+        with self._lock:
+            return self._audio.get(job_id)
+
+    def requeue_expired(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        count = 0
+        with self._lock:
+            for record in self._records.values():
+                if record.status != PROCESSING or record.lease_expires_at >= now:
+                    continue
+                count += 1
+                if record.attempts >= self.config.max_attempts:
+                    record.status = FAILED
+                    record.error = self._expired_error(record)
+                    record.completed_at = now
+                    self._attachments.pop(record.job_id, None)
+                else:
+                    record.status = PENDING
+                    record.node = None
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {PENDING: 0, PROCESSING: 0, COMPLETED: 0, FAILED: 0}
+            for record in self._records.values():
+                counts[record.status] += 1
+            return {"backend": self.name, **counts}
+
+    def _purge_locked(self, now: float):
+        expired = [
+            job_id for job_id, record in self._records.items()
+            if record.finished and now - (record.completed_at or now) > self.config.result_ttl_seconds
+        ]
+        for job_id in expired:
+            del self._records[job_id]
+            self._audio.pop(job_id, None)
+            self._attachments.pop(job_id, None)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    tenant TEXT,
+    submitted_by TEXT,
+    node TEXT,
+    lease_expires_at REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    completed_at REAL,
+    error TEXT,
+    result TEXT,
+    attachment BLOB,
+    audio BLOB
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority DESC, created_at);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (status, lease_expires_at);
+"""
+_SQLITE_COLUMNS = (
+    "job_id, payload, priority, created_at, status, tenant, submitted_by, node, lease_expires_at, attempts, "
+    "cancel_requested, started_at, completed_at, error, result"
+)
+
+
+class SQLiteJobBackend(JobBackend):
+    """
+    SQLite（WALモード）の実装：同じファイルを開いた複数プロセスで待ち行列を共有する
+    取得は BEGIN IMMEDIATE のトランザクションで行い、同じジョブを2つのプロセスが取得しないようにする
+    """
+
+    name = "sqlite"
+
+    def __init__(self, config: JobBackendConfig):
+        super().__init__(config)
+        path = config.url or os.path.join(os.path.expanduser("~"), ".cache", "ace-step", "jobs.sqlite3")
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SQLITE_SCHEMA)
+
+    def _transaction(self):
+        return _SQLiteTransaction(self._conn, self._lock)
+
+    def enqueue(self, record: JobRecord, attachment: Optional[bytes] = None):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, payload, priority, created_at, status, tenant, submitted_by, attachment) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (record.job_id, json.dumps(record.payload), record.priority, record.created_at,
+                 PENDING, record.tenant, record.submitted_by, attachment),
+            )
+
+    def claim(self, node: str) -> Optional[Tuple[JobRecord, Optional[bytes]]]:
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_expired(conn, now)
+            row = conn.execute(
+                f"SELECT {_SQLITE_COLUMNS}, attachment FROM jobs WHERE status = ? "
+                "ORDER BY priority DESC, created_at LIMIT 1",
+                (PENDING,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, node = ?, lease_expires_at = ?, attempts = attempts + 1, "
+                "started_at = COALESCE(started_at, ?) WHERE job_id = ?",
+                (PROCESSING, node, now + self.config.lease_seconds, now, row[0]),
+            )
+            record = self._record(row[:-1])
+        record.status = PROCESSING
+        record.node = node
+        record.lease_expires_at = now + self.config.lease_seconds
+        record.attempts += 1
+        record.started_at = record.started_at or now
+        return record, row[-1]
+
+    def heartbeat(self, job_id: str, node: str) -> Optional[bool]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT cancel_requested FROM jobs WHERE job_id = ? AND status = ? AND node = ?",
+                (job_id, PROCESSING, node),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE job_id = ?",
+                (time.time() + self.config.lease_seconds, job_id),
+            )
+            return bool(row[0])
+
+    def finish(self, job_id: str, node: str, status: str, result: Optional[Dict] = None,
+               error: Optional[str] = None, audio: Optional[bytes] = None) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, audio = ?, completed_at = ?, attachment = NULL "
+                "WHERE job_id = ? AND status = ? AND node = ?",
+                (status, json.dumps(result, default=str) if result is not None else None, error, audio, now,
+                 job_id, PROCESSING, node),
+            ).rowcount
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND completed_at < ?",
+                (*TERMINAL_STATES, now - self.config.result_ttl_seconds),
+            )
+        return updated > 0
+
+    def cancel(self, job_id: str, reason: str = "Cancelled by user") -> Optional[str]:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None or row[0] in TERMINAL_STATES:
+                return None
+            if row[0] == PENDING:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, completed_at = ?, attachment = NULL WHERE job_id = ?",
+                    (FAILED, reason, time.time(), job_id),
+                )
+                return FAILED
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+            return PROCESSING
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_SQLITE_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def get_audio(self, job_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT audio FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def requeue_expired(self, now: Optional[float] = None) -> int:
+        with self._transaction() as conn:
+            return self._requeue_expired(conn, time.time() if now is None else now)
+
+    def _requeue_expired(self, conn: sqlite3.Connection, now: float) -> int:
+        failed = conn.execute(
+            "UPDATE jobs SET status = ?, completed_at = ?, attachment = NULL, "
+            "error = 'Job lease expired ' || attempts || ' times (last node: ' || node || ')' "
+            "WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+            (FAILED, now, PROCESSING, now, self.config.max_attempts),
+        ).rowcount
+        requeued = conn.execute(
+            "UPDATE jobs SET status = ?, node = NULL WHERE status = ? AND lease_expires_at < ?",
+            (PENDING, PROCESSING, now),
+        ).rowcount
+        return failed + requeued
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {PENDING: 0, PROCESSING: 0, COMPLETED: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return {"backend": self.name, "path": self.path, **counts}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _record(row: Tuple) -> JobRecord:
+        (job_id, payload, priority, created_at, status, tenant, submitted_by, node, lease_expires_at, attempts,
+         cancel_requested, started_at, completed_at, error, result) = row
+        return JobRecord(
+            job_id=job_id,
+            payload=json.loads(payload),
+            priority=priority,
+            created_at=created_at,
+            status=status,
+            tenant=tenant,
+            submitted_by=submitted_by,
+            node=node,
+            lease_expires_at=lease_expires_at,
+            attempts=attempts,
+            cancel_requested=bool(cancel_requested),
+            started_at=started_at,
+            completed_at=completed_at,
+            error=error,
+            result=json.loads(result) if result is not None else None,
+        )
+
+
+class _SQLiteTransaction:
+    """BEGIN IMMEDIATE（書き込みロックを先に取得）のトランザクション"""
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+class RedisJobBackend(JobBackend):
+    """
+    Redis の実装：複数ノードで待ち行列を共有する
+
+    キー（prefix は ACE_QUEUE_REDIS_PREFIX、デフォルト "ace:"）:
+      {prefix}pending          待機中のジョブ（sorted set、スコアは優先度と投入時刻）
+      {prefix}leases           取得済みのジョブ（sorted set、スコアはリースの期限）
+      {prefix}job:{id}         ジョブの状態（hash）
+      {prefix}attachment:{id}  参照音声、{prefix}audio:{id} 音楽データ
+    取得・延長・終了は WATCH / MULTI による楽観的トランザクションで行う
+    client には redis.Redis 互換のクライアント（fakeredis など）を渡せる
+    """
+
+    name = "redis"
+
+    def __init__(self, config: JobBackendConfig, client: Any = None):
+        super().__init__(config)
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("ACE_QUEUE_BACKEND=redis requires the redis package (pip install redis)")
+            client = redis.Redis.from_url(config.url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = os.environ.get("ACE_QUEUE_REDIS_PREFIX", "ace:")
+        self._pending = f"{self.prefix}pending"
+        self._leases = f"{self.prefix}leases"
+
+    def _job(self, job_id: str) -> str:
+        return f"{self.prefix}job:{job_id}"
+
+    def _attachment(self, job_id: str) -> str:
+        return f"{self.prefix}attachment:{job_id}"
+
+    def _audio(self, job_id: str) -> str:
+        return f"{self.prefix}audio:{job_id}"
+
+    @staticmethod
+    def _score(record: JobRecord) -> float:
+        # 優先度の高い順、同じ優先度なら投入順（スコアの小さい順に取り出す）
+        return -record.priority * 1e10 + record.created_at
+
+    def _retry(self, watch: Tuple[str, ...], body):
+        """WATCH したキーが他のノードに変更された場合はやり直す"""
+        from redis.exceptions import WatchError
+
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(*watch)
+                    return body(pipe)
+                except WatchError:
+                    continue
+
+    def enqueue(self, record: JobRecord, attachment: Optional[bytes] = None):
+        pipe = self.client.pipeline()
+        pipe.hset(self._job(record.job_id), mapping=self._encode(record))
+        if attachment is not None:
+            pipe.set(self._attachment(record.job_id), attachment)
+        pipe.zadd(self._pending, {record.job_id: self._score(record)})
+        pipe.execute()
+
+    def claim(self, node: str) -> Optional[Tuple[JobRecord, Optional[bytes]]]:
+        now = time.time()
+        self.requeue_expired(now)
+
+        def take(pipe):
+            ids = pipe.zrange(self._pending, 0, 0)
+            if not ids:
+                pipe.unwatch()
+                return None
+            job_id = ids[0].decode() if isinstance(ids[0], bytes) else ids[0]
+            pipe.multi()
+            pipe.zrem(self._pending, job_id)
+            pipe.zadd(self._leases, {job_id: now + self.config.lease_seconds})
+            pipe.hset(self._job(job_id), mapping={
+                "status": PROCESSING, "node": node, "lease_expires_at": now + self.config.lease_seconds,
+            })
+            pipe.hsetnx(self._job(job_id), "started_at", now)
+            pipe.hincrby(self._job(job_id), "attempts", 1)
+            pipe.execute()
+            return job_id
+
+        job_id = self._retry((self._pending,), take)
+        if job_id is None:
+            return None
+        return self.get(job_id), self.client.get(self._attachment(job_id))
+
+    def heartbeat(self, job_id: str, node: str) -> Optional[bool]:
+        key = self._job(job_id)
+
+        def extend(pipe):
+            status, owner, cancel_requested = pipe.hmget(key, "status", "node", "cancel_requested")
+            if self._str(status) != PROCESSING or self._str(owner) != node:
+                pipe.unwatch()
+                return None
+            expires = time.time() + self.config.lease_seconds
+            pipe.multi()
+            pipe.zadd(self._leases, {job_id: expires})
+            pipe.hset(key, "lease_expires_at", expires)
+            pipe.execute()
+            return self._str(cancel_requested) == "1"
+
+        return self._retry((key,), extend)
+
+    def finish(self, job_id: str, node: str, status: str, result: Optional[Dict] = None,
+               error: Optional[str] = None, audio: Optional[bytes] = None) -> bool:
+        key = self._job(job_id)
+        ttl = max(1, int(self.config.result_ttl_seconds))
+
+        def record(pipe):
+            current, owner = pipe.hmget(key, "status", "node")
+            if self._str(current) != PROCESSING or self._str(owner) != node:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.zrem(self._leases, job_id)
+            pipe.hset(key, mapping={
+                "status": status,
+                "result": json.dumps(result, default=str) if result is not None else "",
+                "error": error or "",
+                "completed_at": time.time(),
+            })
+            pipe.expire(key, ttl)
+            pipe.delete(self._attachment(job_id))
+            if audio is not None:
+                pipe.set(self._audio(job_id), audio, ex=ttl)
+            pipe.execute()
+            return True
+
+        return self._retry((key,), record)
+
+    def cancel(self, job_id: str, reason: str = "Cancelled by user") -> Optional[str]:
+        key = self._job(job_id)
+
+        def cancel(pipe):
+            status = self._str(pipe.hget(key, "status"))
+            if status not in (PENDING, PROCESSING):
+                pipe.unwatch()
+                return None
+            pipe.multi()
+            if status == PENDING:
+                pipe.zrem(self._pending, job_id)
+                pipe.hset(key, mapping={"status": FAILED, "error": reason, "completed_at": time.time()})
+                pipe.expire(key, max(1, int(self.config.result_ttl_seconds)))
+                pipe.delete(self._attachment(job_id))
+                status = FAILED
+            else:
+                pipe.hset(key, "cancel_requested", 1)
+            pipe.execute()
+            return status
+
+        return self._retry((key,), cancel)
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        values = self.client.hgetall(self._job(job_id))
+        return self._decode(job_id, values) if values else None
+
+    def get_audio(self, job_id: str) -> Optional[bytes]:
+        return self.client.get(self._audio(job_id))
+
+    def requeue_expired(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        count = 0
+        for raw_id in self.client.zrangebyscore(self._leases, 0, now):
+            job_id = self._str(raw_id)
+            key = self._job(job_id)
+
+            def requeue(pipe):
+                score = pipe.zscore(self._leases, job_id)
+                if score is None or score >= now:
+                    pipe.unwatch()
+                    return 0
+                values = pipe.hgetall(key)
+                pipe.multi()
+                pipe.zrem(self._leases, job_id)
+                if not values:
+                    pipe.execute()
+                    return 0
+                record = self._decode(job_id, values)
+                if record.attempts >= self.config.max_attempts:
+                    pipe.hset(key, mapping={
+                        "status": FAILED, "error": self._expired_error(record), "completed_at": now,
+                    })
+                    pipe.expire(key, max(1, int(self.config.result_ttl_seconds)))
+                    pipe.delete(self._attachment(job_id))
+                else:
+                    pipe.hset(key, mapping={"status": PENDING, "node": ""})
+                    pipe.zadd(self._pending, {job_id: self._score(record)})
+                pipe.execute()
+                return 1
+
+            count += self._retry((self._leases, key), requeue)
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            PENDING: self.client.zcard(self._pending),
+            PROCESSING: self.client.zcard(self._leases),
+        }
+
+    def close(self):
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+    @staticmethod
+    def _str(value: Any) -> Optional[str]:
+        if value is None:
+            return None
+        return value.decode() if isinstance(value, bytes) else str(value)
+
+    @staticmethod
+    def _encode(record: JobRecord) -> Dict[str, Any]:
+        return {
+            "payload": json.dumps(record.payload),
+            "priority": record.priority,
+            "created_at": record.created_at,
+            "status": record.status,
+            "tenant": record.tenant or "",
+            "submitted_by": record.submitted_by or "",
+            "node": "",
+            "lease_expires_at": 0,
+            "attempts": 0,
+            "cancel_requested": 0,
+        }
+
+    def _decode(self, job_id: str, values: Dict) -> JobRecord:
+        values = {self._str(k): self._str(v) for k, v in values.items()}
+
+        def number(name: str) -> Optional[float]:
+            value = values.get(name)
+            return float(value) if value else None
+
+        return JobRecord(
+            job_id=job_id,
+            payload=json.loads(values.get("payload") or "{}"),
+            priority=int(values.get("priority") or 0),
+            created_at=number("created_at") or 0.0,
+            status=values.get("status") or PENDING,
+            tenant=values.get("tenant") or None,
+            submitted_by=values.get("submitted_by") or None,
+            node=values.get("node") or None,
+            lease_expires_at=number("lease_expires_at") or 0.0,
+            attempts=int(values.get("attempts") or 0),
+            cancel_requested=values.get("cancel_requested") == "1",
+            started_at=number("started_at"),
+            completed_at=number("completed_at"),
+            error=values.get("error") or None,
+            result=json.loads(values["result"]) if values.get("result") else None,
+        )
+
+
+def create_job_backend(config: JobBackendConfig, client: Any = None) -> JobBackend:
+    if config.backend == "memory":
+        return MemoryJobBackend(config)
+    if config.backend == "sqlite":
+        return SQLiteJobBackend(config)
+    if config.backend == "redis":
+        return RedisJobBackend(config, client=client)
+    raise ValueError(f"Unknown queue backend: {config.backend}")
@@ -0,0 +1,387 @@
+"""
+モデルワーカープロセス
+
+HTTPを受け付けるプロセス（ゲートウェイ）はジョブの管理（待ち行列・ステータス・結果）のみを行い、
+パイプラインは別プロセス（モデルワーカー）で動かす。ゲートウェイ側の ProcessPipeline は
+ACEStepPipeline と同じ呼び出し方で使えるため、デバイスのレプリカ（acestep.api.device_pool）として
+そのまま割り当ての対象になる。
+
+ゲートウェイとワーカーはパイプ（multiprocessing.Pipe）でつなぎ、次のメッセージをやり取りする:
+  ゲートウェイ → ワーカー: run（生成パラメータ）/ cancel / preempt / stop
+  ワーカー → ゲートウェイ: ready / progress / done / preempted / error
+
+生成した波形はピクルせず共有メモリ（SharedMemory）に書き込み、名前と形状だけを送る。
+ゲートウェイは受け取った時点で共有メモリから取り出して削除する。
+キャンセル・中断の要求はゲートウェイ側で確認してワーカーに送り、ワーカーはステップ境界で処理を止める。
+中断時のスナップショットはデバイス上のテンソルを含むためワーカーに残し、再開時は ID で指定する
+（同じレプリカで再開するため、ワーカーが再起動していなければ必ず見つかる）。
+
+ワーカーが終了した場合、次のジョブの割り当て時に起動し直す。
+CUDA を使うため、ワーカーは spawn で起動する。
+"""
+
+import io
+import itertools
+import multiprocessing
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, Optional, Tuple
+
+from acestep.api.device_pool import is_device_error
+from acestep.cancellation import CancellationToken, GenerationCancelled
+from acestep.preemption import GenerationPreempted
+
+# ゲートウェイ側でキャンセル・中断の要求を確認する間隔
+POLL_SECONDS = 0.1
+# ワーカーに残す中断時のスナップショットの上限（再開されなかったものは古い順に捨てる）
+MAX_SNAPSHOTS = 16
+
+
+class ModelWorkerError(Exception):
+    """ワーカープロセスで発生した、デバイス以外の原因のエラー"""
+
+
+class SharedWaveform:
+    """共有メモリ上の波形（作成したプロセスは閉じるだけで、受け取った側が取り出して削除する）"""
+
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def create(cls, array: Any) -> "SharedWaveform":
+        import numpy as np
+
+        shm = SharedMemory(create=True, size=max(1, array.nbytes))
+        # 削除は受け取った側が行うため、このプロセスの終了時に削除されないよう登録を外す
+        resource_tracker.unregister(shm._name, "shared_memory")
+        try:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        finally:
+            shm.close()
+        return cls(shm.name, tuple(array.shape), str(array.dtype))
+
+    def take(self) -> Any:
+        """波形を取り出し、共有メモリを削除する"""
+        import numpy as np
+
+        shm = SharedMemory(name=self.name)
+        try:
+            return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def discard(self):
+        try:
+            shm = SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+class RemoteSnapshot:
+    """ワーカーに残した中断時のスナップショットの参照"""
+
+    def __init__(self, snapshot_id: str, step_index: int, generation: int):
+        self.snapshot_id = snapshot_id
+        self.step_index = step_index
+        # ワーカーの起動回数（再起動した場合、スナップショットは失われている）
+        self.generation = generation
+
+
+def _share_results(results: Any) -> Any:
+    """return_audio_data=True の結果の波形を共有メモリに移す"""
+    if not isinstance(results, (list, tuple)):
+        return results
+    shared = []
+    for item in results:
+        if isinstance(item, dict) and hasattr(item.get("audio"), "numpy"):
+            audio = item["audio"].detach().float().cpu().contiguous().numpy()
+            item = {**item, "audio": SharedWaveform.create(audio)}
+        shared.append(item)
+    return shared
+
+
+def _restore_results(results: Any) -> Any:
+    """共有メモリの波形をテンソルに戻す"""
+    if not isinstance(results, list):
+        return results
+    restored = []
+    for item in results:
+        if isinstance(item, dict) and isinstance(item.get("audio"), SharedWaveform):
+            import torch
+
+            item = {**item, "audio": torch.from_numpy(item["audio"].take())}
+        restored.append(item)
+    return restored
+
+
+def _discard_results(results: Any):
+    for item in results if isinstance(results, list) else []:
+        if isinstance(item, dict) and isinstance(item.get("audio"), SharedWaveform):
+            item["audio"].discard()
+
+
+class _WorkerLoop:
+    """ワーカー側：受信スレッドで制御メッセージを処理し、メインスレッドでジョブを順に実行する"""
+
+    def __init__(self, conn: Any, pipeline: Any):
+        self.conn = conn
+        self.pipeline = pipeline
+        self.jobs: "queue.Queue[Optional[Tuple]]" = queue.Queue()
+        # 実行待ち・実行中のジョブのキャンセルトークンと中断要求
+        self.controls: Dict[int, Tuple[CancellationToken, threading.Event]] = {}
+        self.snapshots: "OrderedDict[str, Any]" = OrderedDict()
+
+    def serve(self):
+        threading.Thread(target=self._receive, name="ace-model-worker-receiver", daemon=True).start()
+        while True:
+            message = self.jobs.get()
+            if message is None:
+                break
+            self._run(*message[1:])
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # ゲートウェイが終了した
+                self.jobs.put(None)
+                return
+            kind = message[0]
+            if kind == "run":
+                self.controls[message[1]] = (CancellationToken(), threading.Event())
+                self.jobs.put(message)
+            elif kind in ("cancel", "preempt"):
+                controls = self.controls.get(message[1])
+                if controls is None:
+                    continue
+                if kind == "cancel":
+                    controls[0].cancel(message[2])
+                else:
+                    controls[1].set()
+            elif kind == "stop":
+                self.jobs.put(None)
+                return
+
+    def _run(self, job_id: int, kwargs: Dict, options: Dict):
+        token, preempt = self.controls[job_id]
+        if options.get("ref_audio") is not None:
+            kwargs["ref_audio_input"] = io.BytesIO(options["ref_audio"])
+        snapshot_id = options.get("resume_snapshot")
+        if snapshot_id is not None:
+            snapshot = self.snapshots.pop(snapshot_id, None)
+            if snapshot is None:
+                print(f"Model worker: snapshot {snapshot_id} is no longer available, restarting the generation")
+            kwargs["resume_state"] = snapshot
+
+        def progress(stage: str, step: Optional[int], total: Optional[int]):
+            self.conn.send(("progress", job_id, stage, step, total))
+
+        try:
+            results = self.pipeline(
+                **kwargs,
+                cancellation_token=token,
+                should_preempt=preempt.is_set if options.get("preemptible") else None,
+                progress_callback=progress if options.get("progress") else None,
+            )
+            self.conn.send(("done", job_id, _share_results(results)))
+        except GenerationPreempted as e:
+            snapshot_id = uuid.uuid4().hex
+            self.snapshots[snapshot_id] = e.snapshot
+            while len(self.snapshots) > MAX_SNAPSHOTS:
+                self.snapshots.popitem(last=False)
+            self.conn.send(("preempted", job_id, snapshot_id, e.snapshot.step_index))
+        except GenerationCancelled as e:
+            self.conn.send(("error", job_id, "cancelled", str(e)))
+        except Exception as e:
+            self.conn.send(("error", job_id, "device" if is_device_error(e) else "request", str(e)))
+        finally:
+            self.controls.pop(job_id, None)
+
+
+def worker_main(conn: Any, init_kwargs: Dict):
+    """ワーカープロセスのエントリポイント"""
+    from acestep.pipeline_ace_step import ACEStepPipeline
+
+    try:
+        pipeline = ACEStepPipeline(**init_kwargs)
+        # チェックポイントは起動時に読み込む（ready を返した時点でジョブを処理できる）
+        pipeline.ensure_loaded()
+    except Exception as e:
+        conn.send(("error", None, "device", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", {
+        "device": str(pipeline.device),
+        "dtype": str(pipeline.dtype),
+        "checkpoint_dir": pipeline.checkpoint_dir,
+    }))
+    _WorkerLoop(conn, pipeline).serve()
+
+
+class ProcessPipeline:
+    """
+    モデルワーカープロセスで動かすパイプラインの代理（ACEStepPipeline と同じ呼び出し方）
+    レプリカの専用スレッドから呼び出す前提で、呼び出しはロックで1件ずつに制限する
+    """
+
+    def __init__(self, init_kwargs: Dict, name: str = "ace-model-worker", start_timeout: float = 600.0):
+        self.init_kwargs = dict(init_kwargs)
+        self.name = name
+        self.start_timeout = start_timeout
+        # 結果キャッシュのフィンガープリントなどで参照する属性（dtype・device・checkpoint_dir はワーカーの起動時に更新）
+        self.checkpoint_dir = init_kwargs.get("checkpoint_dir")
+        self.overlapped_decode = init_kwargs.get("overlapped_decode", False)
+        self.cpu_offload = init_kwargs.get("cpu_offload", False)
+        self.dtype = init_kwargs.get("dtype")
+        self.device = init_kwargs.get("device")
+        self.lora_path = "none"
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+        self._process = None
+        self._conn = None
+        self._start()
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=worker_main, args=(child_conn, self.init_kwargs), name=self.name, daemon=True
+        )
+        process.start()
+        child_conn.close()
+        if not conn.poll(self.start_timeout):
+            process.terminate()
+            raise RuntimeError(f"Model worker {self.name} did not start within {self.start_timeout:.0f}s")
+        try:
+            message = conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Model worker {self.name} exited during startup (exit code {process.exitcode})")
+        if message[0] != "ready":
+            process.join(timeout=5)
+            raise RuntimeError(f"Model worker {self.name} failed to start: {message[3]}")
+        self.device = message[1]["device"]
+        self.dtype = message[1]["dtype"]
+        self.checkpoint_dir = message[1]["checkpoint_dir"]
+        self.lora_path = "none"
+        self.generation += 1
+        self._process = process
+        self._conn = conn
+
+    def ensure_loaded(self):
+        """ワーカーは起動時にチェックポイントを読み込むため、終了していれば起動し直すのみ"""
+        with self._lock:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        if not self.alive:
+            if self._process is not None:
+                print(f"Model worker {self.name} exited (exit code {self._process.exitcode}), restarting")
+            self._start()
+
+    def __call__(self, **kwargs):
+        token = kwargs.pop("cancellation_token", None)
+        should_preempt = kwargs.pop("should_preempt", None)
+        resume_state = kwargs.pop("resume_state", None)
+        progress_callback = kwargs.pop("progress_callback", None)
+        options = {
+            "preemptible": should_preempt is not None,
+            "progress": progress_callback is not None,
+            "resume_snapshot": None,
+            "ref_audio": None,
+        }
+        ref_audio = kwargs.get("ref_audio_input")
+        if ref_audio is not None and not isinstance(ref_audio, str):
+            # アップロードを取り込んだファイルオブジェクトは内容を送る
+            options["ref_audio"] = ref_audio.read()
+            kwargs["ref_audio_input"] = None
+
+        with self._lock:
+            self._ensure_started()
+            if isinstance(resume_state, RemoteSnapshot) and resume_state.generation == self.generation:
+                options["resume_snapshot"] = resume_state.snapshot_id
+            job_id = next(self._job_ids)
+            self._conn.send(("run", job_id, kwargs, options))
+            self.lora_path = kwargs.get("lora_name_or_path", self.lora_path)
+            return self._wait(job_id, token, should_preempt, progress_callback)
+
+    def _wait(self, job_id: int, token: Any, should_preempt: Any, progress_callback: Any):
+        cancel_sent = preempt_sent = False
+        while True:
+            if token is not None and token.cancelled and not cancel_sent:
+                self._conn.send(("cancel", job_id, getattr(token, "reason", None) or "cancelled"))
+                cancel_sent = True
+            if should_preempt is not None and not preempt_sent and should_preempt():
+                self._conn.send(("preempt", job_id))
+                preempt_sent = True
+            try:
+                if not self._conn.poll(POLL_SECONDS):
+                    if not self._process.is_alive():
+                        raise EOFError
+                    continue
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                raise RuntimeError(f"Model worker {self.name} exited (exit code {self._process.exitcode})")
+            kind = message[0]
+            if message[1] != job_id:
+                # 以前のジョブの残り（中断したジョブの結果など）
+                if kind == "done":
+                    _discard_results(message[2])
+                continue
+            if kind == "progress":
+                if progress_callback is not None:
+                    progress_callback(*message[2:])
+            elif kind == "done":
+                return _restore_results(message[2])
+            elif kind == "preempted":
+                raise GenerationPreempted(RemoteSnapshot(message[2], message[3], self.generation))
+            elif kind == "error":
+                category, error = message[2], message[3]
+                if category == "cancelled":
+                    raise GenerationCancelled(error)
+                if category == "device":
+                    raise RuntimeError(error)
+                raise ModelWorkerError(error)
+
+    def save_wav_file(self, target_wav, idx, save_path=None, sample_rate=48000, format="wav"):
+        """ACEStepPipeline.save_wav_file と同じ規則でゲートウェイ側に保存する"""
+        from acestep.pipeline_ace_step import ACEStepPipeline
+
+        return ACEStepPipeline.save_wav_file(
+            self, target_wav, idx, save_path=save_path, sample_rate=sample_rate, format=format
+        )
+
+    def close(self, timeout: float = 10.0):
+        """ワーカーを停止する（実行中のジョブは終わるまで待ち、timeout 秒を過ぎたら強制終了する）"""
+        if self._process is None:
+            return
+        try:
+            self._conn.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(5)
+        self._conn.close()
+        self._process = None
+
+    def __repr__(self) -> str:
+        return f"<ProcessPipeline {self.name} pid={self.pid} device={self.device}>"
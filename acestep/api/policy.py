@@ -0,0 +1,302 @@
+"""
+コストを考慮したスケジューリングポリシー
+
+ジョブのコストは概ね audio_duration × infer_step × (CFGのパス数) に比例する。
+CostModel は各生成が記録する timecosts（preprocess / diffusion / latent2audio）を
+ステージごとに音声長・ステップ数・バッチサイズ・CFGのモードへオンラインで回帰し、
+待機中のジョブの所要時間を見積もる。
+
+ポリシー:
+  - fifo:     投入順
+  - priority: 優先度の高い順（同じ優先度なら投入順）
+  - sjf:      優先度の高い順、同じ優先度の中では見積もり時間の短い順
+              （待ち時間に応じて見積もりを割り引き、長いジョブの飢餓を防ぐ）
+
+deadline（投入からの秒数）が指定されたジョブは、取り出し時点で
+見積もり完了時刻が期限を過ぎる場合、GPUを使う前に失効させる。
+"""
+
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+# audio_duration <= 0（ランダム長 30〜240秒）の見積もりに使う期待値
+RANDOM_DURATION_EXPECTATION = 135.0
+
+# 回帰の特徴量の単位（60秒の音声 × 60ステップ を1とする）
+REFERENCE_AUDIO_SECONDS = 60.0
+REFERENCE_WORK = REFERENCE_AUDIO_SECONDS * 60
+
+
+def audio_seconds(request: Any) -> float:
+    return request.audio_duration if request.audio_duration > 0 else RANDOM_DURATION_EXPECTATION
+
+
+def diffusion_steps(request: Any) -> int:
+    oss_steps = getattr(request, "oss_steps", None)
+    if isinstance(oss_steps, str) and oss_steps.strip():
+        return len(oss_steps.split(","))
+    return request.infer_step
+
+
+def cfg_mode(request: Any) -> str:
+    """
+    CFGのモード
+      none:   ガイダンスなし（条件付きの推論のみ）
+      cfg:    無条件の推論を追加
+      double: ダブルコンディションガイダンス（テキストのみ条件の推論も追加）
+    """
+    if request.guidance_scale in (0.0, 1.0):
+        return "none"
+    if (request.guidance_scale_text or 0.0) > 1.0 and (request.guidance_scale_lyric or 0.0) > 1.0:
+        return "double"
+    return "cfg"
+
+
+def diffusion_work(request: Any) -> float:
+    """拡散ループの作業量：音声長（秒）× ステップ数 × ステップあたりのトランスフォーマー呼び出し回数"""
+    passes = 1.0
+    mode = cfg_mode(request)
+    if mode != "none":
+        # ガイダンス区間内のステップでは無条件（とテキストのみ条件）の推論が追加される
+        passes += min(max(request.guidance_interval, 0.0), 1.0) * (2.0 if mode == "double" else 1.0)
+    return audio_seconds(request) * diffusion_steps(request) * passes
+
+
+def decode_work(request: Any) -> float:
+    """VAEデコードの作業量：音声長（秒）"""
+    return audio_seconds(request)
+
+
+def stage_features(request: Any, batch_size: int = 1) -> Dict[str, List[float]]:
+    """
+    ステージごとの回帰の特徴量
+      preprocess:   [1, バッチサイズ]
+      diffusion:    [1, 条件付き推論の作業量, 無条件推論の作業量, テキストのみ条件の推論の作業量]
+      latent2audio: [1, デコードする音声長]
+    作業量はバッチ全体の値で、REFERENCE_WORK / REFERENCE_AUDIO_SECONDS を1とする
+    """
+    work = audio_seconds(request) * diffusion_steps(request) * batch_size / REFERENCE_WORK
+    interval = min(max(request.guidance_interval, 0.0), 1.0)
+    mode = cfg_mode(request)
+    return {
+        "preprocess": [1.0, float(batch_size)],
+        "diffusion": [
+            1.0,
+            work,
+            work * interval if mode != "none" else 0.0,
+            work * interval if mode == "double" else 0.0,
+        ],
+        "latent2audio": [1.0, decode_work(request) * batch_size / REFERENCE_AUDIO_SECONDS],
+    }
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """部分ピボット選択付きのガウスの消去法で matrix x = vector を解く"""
+    n = len(vector)
+    a = [row[:] + [vector[i]] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        if abs(a[col][col]) < 1e-12:
+            raise ValueError("singular matrix")
+        for r in range(col + 1, n):
+            factor = a[r][col] / a[col][col]
+            for c in range(col, n + 1):
+                a[r][c] -= factor * a[col][c]
+    x = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (a[r][n] - sum(a[r][c] * x[c] for c in range(r + 1, n))) / a[r][r]
+    return x
+
+
+class OnlineRegression:
+    """
+    直近の観測に指数的な重みを付けたリッジ回帰（事前の係数に向けて正則化）
+
+    decay:  観測1件ごとに古い観測の重みに掛ける係数（ハードウェアの変化に追従する）
+    ridge:  事前の係数に引き戻す強さ（観測何件分に相当するか）
+    window: 保持する観測数
+    """
+
+    def __init__(self, prior: Sequence[float], ridge: float = 1.0, decay: float = 0.97, window: int = 256):
+        self.prior = list(prior)
+        self.coefficients = list(prior)
+        self.ridge = ridge
+        self.decay = decay
+        self._samples: Deque[Tuple[List[float], float]] = deque(maxlen=window)
+
+    def predict(self, features: Sequence[float]) -> float:
+        return max(0.0, sum(c * x for c, x in zip(self.coefficients, features)))
+
+    def observe(self, features: Sequence[float], target: float):
+        self._samples.append((list(features), target))
+        self._fit()
+
+    def _fit(self):
+        n = len(self.prior)
+        matrix = [[self.ridge if i == j else 0.0 for j in range(n)] for i in range(n)]
+        vector = [self.ridge * p for p in self.prior]
+        weight = 1.0
+        for features, target in reversed(self._samples):
+            for i in range(n):
+                vector[i] += weight * features[i] * target
+                for j in range(n):
+                    matrix[i][j] += weight * features[i] * features[j]
+            weight *= self.decay
+        try:
+            self.coefficients = _solve(matrix, vector)
+        except ValueError:
+            pass
+
+
+class CostModel:
+    """
+    timecosts からステージごとの所要時間を回帰で推定するコストモデル
+
+    事前の係数は、preprocess が一定、diffusion が diffusion_work に、
+    latent2audio が decode_work に比例するモデルに相当する。
+    """
+
+    STAGES = ("preprocess", "diffusion", "latent2audio")
+
+    def __init__(
+        self,
+        preprocess_seconds: float = 0.5,
+        diffusion_seconds_per_unit: float = 0.002,
+        decode_seconds_per_audio_second: float = 0.03,
+        ridge: float = 1.0,
+        decay: float = 0.97,
+    ):
+        per_pass = diffusion_seconds_per_unit * REFERENCE_WORK
+        priors = {
+            "preprocess": [preprocess_seconds, 0.0],
+            "diffusion": [0.0, per_pass, per_pass, per_pass],
+            "latent2audio": [0.0, decode_seconds_per_audio_second * REFERENCE_AUDIO_SECONDS],
+        }
+        self.models = {
+            stage: OnlineRegression(prior, ridge=ridge, decay=decay) for stage, prior in priors.items()
+        }
+        self.observations = 0
+
+    def estimate_stages(self, request: Any, batch_size: int = 1) -> Dict[str, float]:
+        features = stage_features(request, batch_size)
+        return {stage: self.models[stage].predict(features[stage]) for stage in self.STAGES}
+
+    def estimate(self, request: Any, batch_size: int = 1) -> float:
+        """リクエスト（batch_size 件をまとめて処理する場合はバッチ全体）の処理時間（秒）の見積もり"""
+        return sum(self.estimate_stages(request, batch_size).values())
+
+    def observe(self, request: Any, timecosts: Dict[str, float], batch_size: int = 1):
+        """1回の生成（バッチの場合はバッチ全体）の timecosts で回帰を更新する"""
+        features = stage_features(request, batch_size)
+        for stage in self.STAGES:
+            if stage in timecosts:
+                self.models[stage].observe(features[stage], timecosts[stage])
+        self.observations += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "coefficients": {stage: list(model.coefficients) for stage, model in self.models.items()},
+            "observations": self.observations,
+        }
+
+
+def job_priority(job: Any) -> int:
+    return getattr(job.request, "priority", 0)
+
+
+class SchedulingPolicy:
+    """投入順（FIFO）に取り出すポリシー。他のポリシーの基底クラス"""
+
+    name = "fifo"
+
+    def select(self, pending: Sequence[Any]) -> Any:
+        return pending[0]
+
+    def admits(self, job: Any, batch: Sequence[Any]) -> bool:
+        """取り出したジョブのバッチ（batch）に job を加えてよいか（同時実行数の上限などで制限するポリシーが上書きする）"""
+        return True
+
+    def order(self, pending: Sequence[Any]) -> List[Any]:
+        """待機中のジョブを取り出される順に並べる（ETAの予測やバッチに加える順に使う）"""
+        remaining = list(pending)
+        ordered = []
+        while remaining:
+            job = self.select(remaining)
+            remaining.remove(job)
+            ordered.append(job)
+        return ordered
+
+
+class PriorityPolicy(SchedulingPolicy):
+    name = "priority"
+
+    def select(self, pending: Sequence[Any]) -> Any:
+        # max() は同じ値なら先頭を返すため、同じ優先度の中では投入順になる
+        return max(pending, key=job_priority)
+
+    def order(self, pending: Sequence[Any]) -> List[Any]:
+        # sorted() は安定なため、同じ優先度の中では投入順になる
+        return sorted(pending, key=lambda job: -job_priority(job))
+
+
+class ShortestJobFirstPolicy(SchedulingPolicy):
+    """
+    優先度クラスごとに見積もり時間の短いジョブから取り出す
+
+    aging: 待ち時間1秒あたりに見積もり時間から差し引く秒数（0で純粋なSJF）
+    """
+
+    name = "sjf"
+
+    def __init__(self, cost_model: CostModel, aging: float = 0.1):
+        self.cost_model = cost_model
+        self.aging = aging
+
+    def _key(self, now: float):
+        def key(job):
+            waited = max(0.0, now - job.created_at)
+            return (-job_priority(job), self.cost_model.estimate(job.request) - self.aging * waited)
+
+        return key
+
+    def select(self, pending: Sequence[Any]) -> Any:
+        return min(pending, key=self._key(time.time()))
+
+    def order(self, pending: Sequence[Any]) -> List[Any]:
+        return sorted(pending, key=self._key(time.time()))
+
+
+def build_policy(name: str, cost_model: CostModel) -> SchedulingPolicy:
+    if name == "fifo":
+        return SchedulingPolicy()
+    if name == "priority":
+        return PriorityPolicy()
+    if name == "sjf":
+        return ShortestJobFirstPolicy(
+            cost_model, aging=float(os.environ.get("ACE_SJF_AGING", "0.1"))
+        )
+    raise ValueError(f"Unknown scheduling policy: {name}")
+
+
+def policy_from_env(cost_model: CostModel) -> SchedulingPolicy:
+    """環境変数 ACE_SCHEDULING_POLICY（fifo / priority / sjf、デフォルト priority）からポリシーを作成する"""
+    return build_policy(os.environ.get("ACE_SCHEDULING_POLICY", "priority"), cost_model)
+
+
+def absolute_deadline(job: Any) -> Optional[float]:
+    deadline = getattr(job.request, "deadline", None)
+    if deadline is None:
+        return None
+    return job.created_at + deadline
+
+
+def misses_deadline(job: Any, cost_model: CostModel, now: Optional[float] = None) -> bool:
+    """今すぐ開始しても期限までに完了しない見込みなら True"""
+    deadline = absolute_deadline(job)
+    if deadline is None:
+        return False
+    now = time.time() if now is None else now
+    return now + cost_model.estimate(job.request) > deadline
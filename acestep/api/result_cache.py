@@ -0,0 +1,287 @@
+"""
+決定的なリクエストの結果キャッシュ（コンテンツアドレス）
+
+manual_seeds を指定したリクエストの生成結果は、プロンプト・歌詞・生成パラメータ・LoRA・
+チェックポイントで決まる。正規化したリクエストとモデルのフィンガープリントのハッシュをキーとして、
+エンコード済みの音楽データと params_json をディスクに保存し、同じリクエストはGPUを使わずに返す。
+
+キャッシュの合計サイズが上限を超えた場合は、最も長く参照されていないものから削除する。
+プロセスを再起動してもキャッシュは保持される（起動時にディレクトリを走査して索引を作り直す）。
+
+GPUワーカーのスレッド（保存）とイベントループ（参照）の両方から使うため、索引はロックで保護する。
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+# キーに含めないフィールド（出力の内容に影響しない）
+NON_CONTENT_FIELDS = ("return_file_data", "priority", "deadline", "allow_degradation", "ref_audio_input")
+# チェックポイントのうちフィンガープリントに含めるモデル（ACEStepPipeline.load_checkpoint が読み込むもの）
+MODEL_DIRS = ("music_dcae_f8c8", "music_vocoder", "ace_step_transformer", "umt5-base")
+
+
+@dataclass
+class ResultCacheConfig:
+    directory: str
+    max_bytes: int = 2 * 1024 ** 3
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.max_bytes > 0
+
+    @classmethod
+    def from_env(cls) -> "ResultCacheConfig":
+        """環境変数 ACE_RESULT_CACHE_DIR（空文字で無効）/ ACE_RESULT_CACHE_MB から設定を読み込む"""
+        return cls(
+            directory=os.environ.get(
+                "ACE_RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ace_step_result_cache")
+            ),
+            max_bytes=int(float(os.environ.get("ACE_RESULT_CACHE_MB", "2048")) * 1024 ** 2),
+        )
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(source_path: str, target_path: str):
+    """ハードリンクを作成する（別のファイルシステムなどで作成できなければコピーする）"""
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+def model_fingerprint(pipeline: Any) -> Optional[str]:
+    """
+    出力に影響するモデルの構成のハッシュ（チェックポイントが未ダウンロードの場合は None）
+    チェックポイントの各モデルのファイル（相対パス・サイズ・更新時刻）、dtype、重ね合わせデコードの有無を含む
+    同じディレクトリにダウンロードされる LoRA はリクエスト側（lora_name_or_path）でキーに含まれるため除外する
+    """
+    checkpoint_dir = os.path.abspath(getattr(pipeline, "checkpoint_dir", "") or "")
+    files = []
+    for root, _, names in os.walk(checkpoint_dir):
+        relative_root = os.path.relpath(root, checkpoint_dir)
+        if not set(relative_root.split(os.sep)) & set(MODEL_DIRS):
+            continue
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((os.path.join(relative_root, name), stat.st_size, int(stat.st_mtime)))
+    if not files:
+        return None
+    payload = {
+        "checkpoint_dir": checkpoint_dir,
+        "files": sorted(files),
+        "dtype": str(getattr(pipeline, "dtype", "")),
+        "overlapped_decode": bool(getattr(pipeline, "overlapped_decode", False)),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _normalize_seeds(manual_seeds: Any) -> Optional[Tuple[int, ...]]:
+    if manual_seeds is None:
+        return None
+    if isinstance(manual_seeds, str):
+        values = [v.strip() for v in manual_seeds.split(",") if v.strip()]
+    elif isinstance(manual_seeds, (list, tuple)):
+        values = list(manual_seeds)
+    else:
+        values = [manual_seeds]
+    try:
+        seeds = tuple(int(v) for v in values)
+    except (TypeError, ValueError):
+        return None
+    return seeds or None
+
+
+def canonical_request_key(request: Any, ref_audio_sha256: Optional[str] = None) -> Optional[str]:
+    """
+    正規化したリクエストのハッシュ（決定的でないリクエストは None）
+    シード未指定・音声長がランダム（audio_duration <= 0）の場合は決定的でない
+    参照音声はファイルの内容のハッシュをキーに含める（取り込み済みのアップロードは ref_audio_sha256 で渡す）
+    """
+    seeds = _normalize_seeds(getattr(request, "manual_seeds", None))
+    if seeds is None or request.audio_duration <= 0:
+        return None
+    fields = request.dict() if hasattr(request, "dict") else dict(vars(request))
+    for name in NON_CONTENT_FIELDS:
+        fields.pop(name, None)
+    fields["manual_seeds"] = list(seeds)
+    fields["format"] = str(fields.get("format", "wav")).lower()
+    if ref_audio_sha256 is not None:
+        fields["ref_audio_sha256"] = ref_audio_sha256
+    elif getattr(request, "audio2audio_enable", False) and getattr(request, "ref_audio_input", None):
+        try:
+            fields["ref_audio_sha256"] = _file_digest(request.ref_audio_input)
+        except OSError:
+            return None
+    payload = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def request_cache_key(canonical_key: Optional[str], fingerprint: Optional[str]) -> Optional[str]:
+    """正規化したリクエストのハッシュとモデルのフィンガープリントから結果キャッシュのキーを求める"""
+    if canonical_key is None or fingerprint is None:
+        return None
+    return hashlib.sha256(f"{fingerprint}:{canonical_key}".encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("audio_path", "meta_path", "size")
+
+    def __init__(self, audio_path: str, meta_path: str, size: int):
+        self.audio_path = audio_path
+        self.meta_path = meta_path
+        self.size = size
+
+
+class ResultCache:
+    def __init__(self, config: ResultCacheConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.metrics: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.enabled
+
+    def load(self):
+        """キャッシュディレクトリを走査し、索引を作り直す（参照時刻の古い順）"""
+        if not self.enabled:
+            return
+        os.makedirs(self.config.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.config.directory):
+            if not name.endswith(".json") or name.startswith("."):
+                continue
+            key = name[:-len(".json")]
+            meta_path = os.path.join(self.config.directory, name)
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                audio_path = os.path.join(self.config.directory, f"{key}.{meta['format']}")
+                stat = os.stat(audio_path)
+            except (OSError, ValueError, KeyError):
+                # 書き込み途中で終了したエントリなど
+                self._remove_files(meta_path, None)
+                continue
+            found.append((stat.st_mtime, key, _Entry(audio_path, meta_path, stat.st_size)))
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            for _, key, entry in sorted(found, key=lambda item: item[0]):
+                self._entries[key] = entry
+                self._bytes += entry.size
+            self._evict_locked()
+
+    def get(self, key: Optional[str]) -> Optional[Tuple[str, Dict]]:
+        """キャッシュ済みなら (音楽ファイルのパス, メタデータ) を返す"""
+        if key is None or not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(entry.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            # 参照時刻を更新（再起動後も LRU の順序を保つ）
+            os.utime(entry.audio_path)
+        except (OSError, ValueError):
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._entries.pop(key)
+                    self._bytes -= entry.size
+                self.metrics["misses"] += 1
+            return None
+        with self._lock:
+            self.metrics["hits"] += 1
+        return entry.audio_path, meta
+
+    def put(self, key: Optional[str], source_path: Optional[str], audio_bytes: Optional[bytes], meta: Dict):
+        """
+        エンコード済みの音楽データを保存する
+        source_path（スプール済みのファイル）があればハードリンク（できなければコピー）、なければ audio_bytes を書き込む
+        """
+        if key is None or not self.enabled or not str(meta.get("format", "")).isalnum():
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+        os.makedirs(self.config.directory, exist_ok=True)
+        audio_path = os.path.join(self.config.directory, f"{key}.{meta['format']}")
+        meta_path = os.path.join(self.config.directory, f"{key}.json")
+        temp_suffix = f".{uuid.uuid4().hex}.tmp"
+        temp_audio = os.path.join(self.config.directory, f".{key}.{meta['format']}{temp_suffix}")
+        temp_meta = os.path.join(self.config.directory, f".{key}.json{temp_suffix}")
+        try:
+            if source_path is not None:
+                link_or_copy(source_path, temp_audio)
+            else:
+                with open(temp_audio, "wb") as f:
+                    f.write(audio_bytes)
+            with open(temp_meta, "w", encoding="utf-8") as f:
+                json.dump({**meta, "stored_at": time.time()}, f, ensure_ascii=False, default=str)
+            # 音楽ファイルを先に置き、メタデータの配置でエントリを完成させる
+            os.replace(temp_audio, audio_path)
+            os.replace(temp_meta, meta_path)
+        except OSError as e:
+            print(f"Warning: Failed to store result cache entry {key}: {e}")
+            self._remove_files(temp_audio, temp_meta)
+            return
+        size = os.path.getsize(audio_path)
+        with self._lock:
+            self._entries[key] = _Entry(audio_path, meta_path, size)
+            self._bytes += size
+            self.metrics["stores"] += 1
+            self._evict_locked()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.config.max_bytes,
+                "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+                **self.metrics,
+            }
+
+    def _evict_locked(self):
+        while self._bytes > self.config.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.metrics["evictions"] += 1
+            self._remove_files(entry.meta_path, entry.audio_path)
+
+    @staticmethod
+    def _remove_files(*paths: Optional[str]):
+        for path in paths:
+            if not path:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
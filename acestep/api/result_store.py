@@ -0,0 +1,197 @@
+"""
+上限付きのリクエスト結果ストア
+
+完了したリクエスト（音楽データのバイト列を含む場合がある）を
+バイト数の上限・エントリごとのTTL・LRUで管理する。
+待機中・処理中のエントリは削除対象にならない（ピン留め）。
+削除されたIDは一定数まで記録し、404（存在しない）と 410（削除済み）を区別できるようにする。
+
+イベントループ上でのみ操作する前提のため、ロックは使用しない。
+"""
+
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+class ResultEvictedError(KeyError):
+    """削除済みのリクエストIDが参照された"""
+
+    def __init__(self, request_id: str, reason: str, evicted_at: float):
+        super().__init__(request_id)
+        self.request_id = request_id
+        self.reason = reason
+        self.evicted_at = evicted_at
+
+
+@dataclass
+class ResultStoreConfig:
+    max_bytes: int = 1024 ** 3
+    ttl_seconds: float = 3600.0
+    max_entries: int = 10000
+    # 削除済みIDの記録数（410 応答用）
+    tombstone_limit: int = 100000
+
+    @classmethod
+    def from_env(cls) -> "ResultStoreConfig":
+        """環境変数 ACE_RESULT_STORE_MAX_MB / ACE_RESULT_TTL_SECONDS / ACE_RESULT_STORE_MAX_ENTRIES から設定を読み込む"""
+        default = cls()
+        return cls(
+            max_bytes=int(float(os.environ.get("ACE_RESULT_STORE_MAX_MB", str(default.max_bytes // 1024 ** 2))) * 1024 ** 2),
+            ttl_seconds=float(os.environ.get("ACE_RESULT_TTL_SECONDS", str(default.ttl_seconds))),
+            max_entries=int(os.environ.get("ACE_RESULT_STORE_MAX_ENTRIES", str(default.max_entries))),
+        )
+
+
+class _Entry:
+    __slots__ = ("value", "size", "finished_at")
+
+    def __init__(self, value: Any):
+        self.value = value
+        self.size = 0
+        self.finished_at: Optional[float] = None
+
+
+class ResultStore:
+    """
+    リクエストIDをキーとするLRUストア
+
+    size_of(value):     完了したエントリのバイト数
+    is_finished(value): 完了（削除可能）なエントリか
+    on_evict(value):    削除時に呼ばれる（一時ファイルの削除など）
+    """
+
+    # エントリ1件あたりのメタデータの概算バイト数
+    ENTRY_OVERHEAD = 1024
+
+    def __init__(
+        self,
+        config: ResultStoreConfig,
+        size_of: Callable[[Any], int],
+        is_finished: Callable[[Any], bool],
+        on_evict: Optional[Callable[[Any], None]] = None,
+    ):
+        self.config = config
+        self._size_of = size_of
+        self._is_finished = is_finished
+        self._on_evict = on_evict
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._tombstones: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._last_sweep = 0.0
+        self.metrics: Dict[str, int] = {
+            "evicted_ttl": 0,
+            "evicted_lru": 0,
+            "evicted_bytes": 0,
+            "gone_lookups": 0,
+        }
+
+    def __contains__(self, request_id: str) -> bool:
+        return request_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._entries))
+
+    def __setitem__(self, request_id: str, value: Any):
+        self.add(request_id, value)
+
+    def __getitem__(self, request_id: str) -> Any:
+        return self.lookup(request_id)
+
+    def values(self):
+        return [entry.value for entry in self._entries.values()]
+
+    def add(self, request_id: str, value: Any):
+        if request_id in self._entries:
+            self._remove(request_id)
+        self._tombstones.pop(request_id, None)
+        self._entries[request_id] = _Entry(value)
+        if self._is_finished(value):
+            self.mark_finished(request_id)
+        else:
+            self._enforce_limits()
+
+    def lookup(self, request_id: str) -> Any:
+        """
+        エントリを取得し、最近使用したものとして扱う
+        存在しなければ KeyError、削除済みなら ResultEvictedError
+        """
+        self._sweep_expired()
+        entry = self._entries.get(request_id)
+        if entry is None:
+            tombstone = self._tombstones.get(request_id)
+            if tombstone is not None:
+                self.metrics["gone_lookups"] += 1
+                raise ResultEvictedError(request_id, *tombstone)
+            raise KeyError(request_id)
+        self._entries.move_to_end(request_id)
+        return entry.value
+
+    def mark_finished(self, request_id: str):
+        """完了したエントリのサイズを確定し、上限を超えていれば古いエントリを削除する"""
+        entry = self._entries.get(request_id)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        entry.size = self._size_of(entry.value) + self.ENTRY_OVERHEAD
+        entry.finished_at = time.time()
+        self._bytes += entry.size
+        self._entries.move_to_end(request_id)
+        self._enforce_limits()
+
+    def total_bytes(self) -> int:
+        return self._bytes
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.config.max_bytes,
+            "max_entries": self.config.max_entries,
+            "ttl_seconds": self.config.ttl_seconds,
+            **self.metrics,
+        }
+
+    def _sweep_expired(self, force: bool = False):
+        now = time.time()
+        # 全件走査になるため、頻繁なアクセスでも1秒に1回までに抑える
+        if not force and now - self._last_sweep < 1.0:
+            return
+        self._last_sweep = now
+        expired = [
+            request_id for request_id, entry in self._entries.items()
+            if entry.finished_at is not None and now - entry.finished_at > self.config.ttl_seconds
+        ]
+        for request_id in expired:
+            self._evict(request_id, "expired")
+
+    def _enforce_limits(self):
+        self._sweep_expired()
+        if self._bytes <= self.config.max_bytes and len(self._entries) <= self.config.max_entries:
+            return
+        # 最も長く使われていない完了済みエントリから削除（待機中・処理中はピン留め）
+        for request_id in list(self._entries):
+            if self._bytes <= self.config.max_bytes and len(self._entries) <= self.config.max_entries:
+                break
+            if self._entries[request_id].finished_at is not None:
+                self._evict(request_id, "evicted")
+
+    def _evict(self, request_id: str, reason: str):
+        entry = self._remove(request_id)
+        self.metrics["evicted_ttl" if reason == "expired" else "evicted_lru"] += 1
+        self.metrics["evicted_bytes"] += entry.size
+        self._tombstones[request_id] = (reason, time.time())
+        while len(self._tombstones) > self.config.tombstone_limit:
+            self._tombstones.popitem(last=False)
+        if self._on_evict is not None:
+            self._on_evict(entry.value)
+
+    def _remove(self, request_id: str) -> _Entry:
+        entry = self._entries.pop(request_id)
+        self._bytes -= entry.size
+        return entry
@@ -0,0 +1,348 @@
+"""
+GPUジョブスケジューラ
+
+asyncioネイティブな待ち行列でGPUジョブを管理する。
+submit() されたジョブは待機中のワーカーを即座に起こし、
+ワーカーはExecutorが空いた時点で次のジョブを取り出す。
+バッチングが有効な場合、互換パラメータを持つ待機中のジョブを
+最大待ち時間の範囲でまとめ、1回の batch_runner 呼び出しで処理する。
+優先度が設定されている場合、待機中のジョブは優先度の高い順に取り出され、
+全ワーカーが使用中のときに高優先度のジョブが投入されると、
+最も優先度の低い実行中ジョブにステップ境界での中断を要求する。
+中断されたジョブは待ち行列に戻され、後で再開される。
+取り出し順は SchedulingPolicy（acestep.api.policy）で差し替えられ（select が None を返した場合は取り出しを保留する）、
+バッチに加えるジョブもポリシーの順序（order）で選び、admits が False を返したジョブは加えない。
+should_expire が True を返したジョブはGPUを使わずに失効させる。
+is_cancelled が True を返したジョブは取り出し時に読み飛ばし、
+cancel() で待ち行列から直接取り除くこともできる。
+pause() の間は新しいジョブを取り出さず（パイプラインの再初期化など）、resume() で再開する。
+dispatch を指定した場合、取り出したジョブ（バッチ）ごとに実行するExecutor（デバイスのレプリカ）を選び、
+処理が終わると on_dispatch_end で割り当ての解除を通知する。
+runner / batch_runner が Future（concurrent.futures）を返した場合、GPUを使わない後処理（音楽データのエンコードなど）が
+残っているとみなし、ワーカーと割り当てはすぐに解放して次のジョブを取り出し、ジョブの終了（on_finish）は Future の完了後に行う。
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set
+
+from acestep.api.batching import BatchingConfig
+from acestep.api.policy import SchedulingPolicy
+
+
+class GPUJobScheduler:
+    """
+    イベント駆動のジョブスケジューラ
+
+    ジョブの状態遷移（PROCESSING への移行）はイベントループ側で行い、
+    実際の生成処理（runner）だけをExecutorのスレッドで実行する。
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        runner: Callable[[Any], Any],
+        num_workers: int = 1,
+        on_start: Optional[Callable[[Any], None]] = None,
+        on_finish: Optional[Callable[[Any], None]] = None,
+        batch_runner: Optional[Callable[[List[Any]], Any]] = None,
+        batch_key: Optional[Callable[[Any], Optional[Hashable]]] = None,
+        batching: Optional[BatchingConfig] = None,
+        priority: Optional[Callable[[Any], int]] = None,
+        preempt: Optional[Callable[[Any], None]] = None,
+        is_preempted: Optional[Callable[[Any], bool]] = None,
+        policy: Optional[SchedulingPolicy] = None,
+        should_expire: Optional[Callable[[Any], bool]] = None,
+        on_expire: Optional[Callable[[Any], None]] = None,
+        is_cancelled: Optional[Callable[[Any], bool]] = None,
+        dispatch: Optional[Callable[[List[Any]], Optional[Executor]]] = None,
+        on_dispatch_end: Optional[Callable[[List[Any]], None]] = None,
+    ):
+        self._executor = executor
+        self._runner = runner
+        self._num_workers = num_workers
+        self._on_start = on_start
+        self._on_finish = on_finish
+        self._batch_runner = batch_runner
+        self._batch_key = batch_key
+        self._batching = batching or BatchingConfig()
+        self._priority = priority
+        self._preempt = preempt
+        self._is_preempted = is_preempted
+        self._policy = policy
+        self._should_expire = should_expire
+        self._on_expire = on_expire
+        self._is_cancelled = is_cancelled
+        self._dispatch = dispatch
+        self._on_dispatch_end = on_dispatch_end
+        self._busy_workers = 0
+        self._preempt_requested: Set[int] = set()
+        self._pending: Deque[Any] = deque()
+        self._running: List[Any] = []
+        self._done_futures: Dict[int, asyncio.Future] = {}
+        self._has_work: Optional[asyncio.Event] = None
+        self._submitted: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        # 後処理の完了を待ってジョブを終了させるタスク
+        self._finishing: Set[asyncio.Task] = set()
+        # 後処理中（GPUを使い終わった）のジョブの id（中断の対象にしない）
+        self._post_processing: Set[int] = set()
+        self._paused = False
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    def start(self):
+        """ワーカーを起動する（イベントループ内から呼び出す）"""
+        if self._workers:
+            return
+        self._has_work = asyncio.Event()
+        self._submitted = asyncio.Event()
+        if self._pending:
+            self._has_work.set()
+        for i in range(self._num_workers):
+            self._workers.append(asyncio.create_task(self._worker_loop(i)))
+
+    async def stop(self):
+        """ワーカーを停止する"""
+        tasks = self._workers + list(self._finishing)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+        self._finishing.clear()
+        self._post_processing.clear()
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    def pause(self):
+        """新しいジョブの取り出しを止める（実行中のジョブは続行する）"""
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+        if self._has_work is not None and self._pending:
+            self._has_work.set()
+
+    def submit(self, job: Any) -> asyncio.Future:
+        """
+        ジョブを登録し、待機中のワーカーを即座に起こす
+        戻り値のFutureはジョブの処理が終わった時点で job を結果として完了する
+        """
+        done = asyncio.get_event_loop().create_future()
+        self._done_futures[id(job)] = done
+        self._pending.append(job)
+        if self._has_work is not None:
+            self._has_work.set()
+            self._submitted.set()
+        self._maybe_preempt(job)
+        return done
+
+    async def run(self, job: Any) -> Any:
+        """ジョブを登録し、処理が終わるまで待機する（イベントループはブロックしない）"""
+        return await self.submit(job)
+
+    def cancel(self, job: Any) -> bool:
+        """待機中のジョブを待ち行列から取り除く（取り除けた場合 True、実行中・終了済みは False）"""
+        try:
+            self._pending.remove(job)
+        except ValueError:
+            return False
+        self._resolve(job)
+        return True
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def running_count(self) -> int:
+        return len(self._running)
+
+    def idle_workers(self) -> int:
+        """ジョブを実行していないワーカーの数"""
+        return self._num_workers - self._busy_workers
+
+    def pending_jobs(self) -> List[Any]:
+        return list(self._pending)
+
+    def running_jobs(self) -> List[Any]:
+        return list(self._running)
+
+    def _next_job(self) -> Optional[Any]:
+        if self._paused:
+            return None
+        while self._pending:
+            if self._policy is not None:
+                job = self._policy.select(self._pending)
+                if job is None:
+                    # ポリシーが取り出しを保留した（テナントの同時実行数の上限など）
+                    return None
+                self._pending.remove(job)
+            elif self._priority is not None:
+                # 優先度が最も高いジョブ（同じ優先度なら先に並んだもの）
+                job = max(self._pending, key=self._priority)
+                self._pending.remove(job)
+            else:
+                job = self._pending.popleft()
+            if self._expire_if_needed(job):
+                continue
+            return job
+        return None
+
+    def _expire_if_needed(self, job: Any) -> bool:
+        """キャンセル済み・期限に間に合わないジョブをGPUを使う前に取り除く"""
+        if self._is_cancelled is not None and self._is_cancelled(job):
+            self._resolve(job)
+            return True
+        if self._should_expire is None or not self._should_expire(job):
+            return False
+        if self._on_expire is not None:
+            self._on_expire(job)
+        self._resolve(job)
+        return True
+
+    def _maybe_preempt(self, job: Any):
+        """空きワーカーがなければ、投入されたジョブより優先度の低い実行中ジョブに中断を要求する"""
+        if self._preempt is None or self._priority is None:
+            return
+        if self._busy_workers < self._num_workers:
+            return
+        job_priority = self._priority(job)
+        candidates = [
+            running for running in self._running
+            if id(running) not in self._preempt_requested and id(running) not in self._post_processing
+            and self._priority(running) < job_priority
+        ]
+        if not candidates:
+            return
+        victim = min(candidates, key=self._priority)
+        self._preempt_requested.add(id(victim))
+        self._preempt(victim)
+
+    async def _worker_loop(self, worker_index: int):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                # 取り出せるジョブがない場合のみ待機（submit()・他のワーカーのジョブの終了で即座に起床する）
+                self._has_work.clear()
+                await self._has_work.wait()
+                continue
+
+            batch = await self._collect_batch(job)
+            if self._paused:
+                # バッチの収集中に停止された場合は、実行せずに待ち行列の先頭に戻す
+                self._pending.extendleft(reversed(batch))
+                continue
+            for batch_job in batch:
+                self._running.append(batch_job)
+                if self._on_start is not None:
+                    self._on_start(batch_job)
+            self._busy_workers += 1
+            dispatched = False
+            remaining = None
+            try:
+                executor = self._executor
+                if self._dispatch is not None:
+                    # None の場合は既定のExecutorで実行する
+                    executor = self._dispatch(batch) or self._executor
+                    dispatched = True
+                if len(batch) == 1:
+                    remaining = await loop.run_in_executor(executor, self._runner, job)
+                else:
+                    remaining = await loop.run_in_executor(executor, self._batch_runner, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"GPU worker {worker_index} error: {e}")
+            finally:
+                self._busy_workers -= 1
+                if dispatched and self._on_dispatch_end is not None:
+                    self._on_dispatch_end(batch)
+                if isinstance(remaining, Future):
+                    # 後処理の完了を待たずに次のジョブを取り出す（ジョブは完了まで実行中のまま）
+                    self._post_processing.update(id(batch_job) for batch_job in batch)
+                    task = asyncio.ensure_future(self._finish_after(batch, remaining))
+                    self._finishing.add(task)
+                    task.add_done_callback(self._finishing.discard)
+                else:
+                    self._finish_batch(batch)
+
+    async def _finish_after(self, batch: List[Any], remaining: Future):
+        try:
+            await asyncio.wrap_future(remaining)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"GPU job post-processing error: {e}")
+        self._finish_batch(batch)
+
+    def _finish_batch(self, batch: List[Any]):
+        for batch_job in batch:
+            self._running.remove(batch_job)
+            self._preempt_requested.discard(id(batch_job))
+            self._post_processing.discard(id(batch_job))
+            if self._is_preempted is not None and self._is_preempted(batch_job):
+                # 中断されたジョブは先頭に戻す（優先度順の取り出しで高優先度のジョブが先に実行される）
+                self._pending.appendleft(batch_job)
+                self._has_work.set()
+                continue
+            if self._on_finish is not None:
+                self._on_finish(batch_job)
+            self._resolve(batch_job)
+        if self._pending:
+            # 保留されていたジョブを待機中の他のワーカーも取り出せるようにする
+            self._has_work.set()
+
+    async def _collect_batch(self, job: Any) -> List[Any]:
+        """先頭ジョブと互換なジョブを最大待ち時間の範囲で集める"""
+        if self._batch_runner is None or self._batch_key is None or not self._batching.enabled:
+            return [job]
+        key = self._batch_key(job)
+        if key is None:
+            return [job]
+
+        loop = asyncio.get_event_loop()
+        batch = [job]
+        deadline = loop.time() + self._batching.max_wait_seconds
+        while True:
+            self._take_compatible(key, batch)
+            if len(batch) >= self._batching.max_batch_size:
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # 新しいジョブの投入を待つ（タイムアウト後にもう一度だけ収集する）
+            self._submitted.clear()
+            try:
+                await asyncio.wait_for(self._submitted.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return batch
+
+    def _take_compatible(self, key: Hashable, batch: List[Any]):
+        # ポリシーの取り出し順に、ポリシーが認める（テナントの同時実行数の上限などに達していない）ジョブだけを加える
+        candidates = self._policy.order(self._pending) if self._policy is not None else list(self._pending)
+        for candidate in candidates:
+            if len(batch) >= self._batching.max_batch_size:
+                break
+            if self._batch_key(candidate) != key:
+                continue
+            if self._policy is not None and not self._policy.admits(candidate, batch):
+                continue
+            self._pending.remove(candidate)
+            if not self._expire_if_needed(candidate):
+                batch.append(candidate)
+
+    def _resolve(self, job: Any):
+        done = self._done_futures.pop(id(job), None)
+        if done is not None and not done.done():
+            done.set_result(job)
+
@@ -0,0 +1,89 @@
+"""
+同一リクエストの相乗り（single-flight）
+
+タイムアウト後の再送などで、待機中・処理中のジョブと同じ内容のリクエストが投入された場合、
+新しいリクエストをGPUで実行せず、先行するジョブ（リーダー）の完了を待つ相乗り（フォロワー）とする。
+N件の同一リクエストはGPUを1回だけ使い、全員が同じ結果を受け取る。
+
+キーは結果キャッシュと同じ正規化したリクエストのハッシュ（acestep.api.result_cache.request_cache_key）で、
+決定的なリクエスト（manual_seeds 指定）だけが対象になる。
+
+イベントループ上でのみ操作する前提のため、ロックは使用しない。
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class SingleFlight:
+    def __init__(self):
+        # キーごとの実行中（待機中・処理中）のジョブ
+        self._leaders: Dict[str, Any] = {}
+        # キーごとのフォロワーと、リーダーの終了時に完了する Future
+        self._followers: Dict[str, List[Tuple[Any, asyncio.Future]]] = {}
+        # フォロワーのリクエストID → リーダーのリクエストID
+        self._leader_ids: Dict[str, str] = {}
+        self.metrics: Dict[str, int] = {"runs": 0, "deduplicated": 0}
+
+    def leader(self, key: Optional[str]) -> Optional[Any]:
+        if key is None:
+            return None
+        return self._leaders.get(key)
+
+    def lead(self, key: str, job: Any):
+        """job をキーの実行中のジョブとして登録する"""
+        self._leaders[key] = job
+        self.metrics["runs"] += 1
+
+    def follow(self, key: str, job: Any) -> asyncio.Future:
+        """
+        job を実行中のジョブのフォロワーとして登録する
+        戻り値の Future はリーダーの終了（finish）または離脱（leave）時に job を結果として完了する
+        """
+        leader = self._leaders[key]
+        done = asyncio.get_running_loop().create_future()
+        self._followers.setdefault(key, []).append((job, done))
+        self._leader_ids[job.request_id] = leader.request_id
+        self.metrics["deduplicated"] += 1
+        return done
+
+    def followers(self, key: Optional[str]) -> List[Any]:
+        if key is None:
+            return []
+        return [job for job, _ in self._followers.get(key, [])]
+
+    def leader_id(self, request_id: str) -> Optional[str]:
+        """フォロワーであればリーダーのリクエストIDを返す"""
+        return self._leader_ids.get(request_id)
+
+    def leave(self, key: str, job: Any) -> Optional[asyncio.Future]:
+        """フォロワーを離脱させ、その Future を返す（完了させるのは呼び出し側）"""
+        followers = self._followers.get(key, [])
+        for i, (follower, done) in enumerate(followers):
+            if follower is job:
+                del followers[i]
+                if not followers:
+                    self._followers.pop(key, None)
+                self._leader_ids.pop(job.request_id, None)
+                return done
+        return None
+
+    def finish(self, key: Optional[str], job: Any) -> List[Tuple[Any, asyncio.Future]]:
+        """
+        リーダーの終了時に呼び出し、登録を解除してフォロワーと Future の一覧を返す
+        job がキーのリーダーでなければ何もしない
+        """
+        if key is None or self._leaders.get(key) is not job:
+            return []
+        del self._leaders[key]
+        followers = self._followers.pop(key, [])
+        for follower, _ in followers:
+            self._leader_ids.pop(follower.request_id, None)
+        return followers
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._leaders),
+            "followers": len(self._leader_ids),
+            **self.metrics,
+        }
@@ -0,0 +1,237 @@
+"""
+生成結果の音楽ファイルのスプール
+
+エンコード済みの音楽データをスプールディレクトリに一度だけ書き込み、
+ダウンロード時はファイルから直接返す（サーバーのメモリにバイト列を保持しない）。
+Range（206 Partial Content）、If-None-Match / If-Range（ETag）に対応する。
+
+スプールディレクトリ（ACE_RESULT_SPOOL_DIR）は同じホストの複数のサーバで共有されうるため、
+プロセスごとのサブディレクトリ（owner、ノードIDなど）に書き込み、
+起動時の掃除もそのサブディレクトリ内のスプールのファイル（<request_id>.<fmt> と .<request_id>.<hex>.<fmt>）だけを削除する。
+"""
+
+import os
+import re
+import socket
+import tempfile
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+CHUNK_SIZE = 1024 * 1024
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+# スプールが作るファイル名（最終ファイルと書き込み中の一時ファイル）
+_SPOOL_FILE_PATTERN = re.compile(r"^(?:[A-Za-z0-9_-]+|\.[A-Za-z0-9_-]+\.[0-9a-f]{32})\.[A-Za-z0-9]+$")
+# 既定のノードID（<hostname>-<pid>）のサブディレクトリ
+_DEFAULT_OWNER_PATTERN = re.compile(r"^(?P<host>.+)-(?P<pid>\d+)$")
+
+
+@dataclass
+class SpoolConfig:
+    directory: str
+    enabled: bool = True
+
+    @classmethod
+    def from_env(cls) -> "SpoolConfig":
+        """環境変数 ACE_RESULT_SPOOL_DIR（空文字でスプール無効）から設定を読み込む"""
+        directory = os.environ.get(
+            "ACE_RESULT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ace_step_results")
+        )
+        return cls(directory=directory, enabled=bool(directory))
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # 権限がない場合は存在する
+        return True
+    return True
+
+
+def _remove_spool_files(directory: str):
+    """ディレクトリ内のスプールのファイルだけを削除し、空になればディレクトリも削除する"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        if _SPOOL_FILE_PATTERN.match(name) and os.path.isfile(path) and not os.path.islink(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Warning: Failed to remove spooled result {path}: {e}")
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+
+class ResultSpool:
+    """
+    owner: このプロセスのサブディレクトリ名（ノードID、既定は <hostname>-<pid>）
+    """
+
+    def __init__(self, config: SpoolConfig, owner: str):
+        self.config = config
+        self.root = config.directory
+        self.owner = re.sub(r"[^A-Za-z0-9_.-]", "_", owner) or "default"
+        self.directory = os.path.join(config.directory, self.owner) if config.enabled else config.directory
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.enabled
+
+    def prepare(self):
+        """
+        このプロセスのサブディレクトリを作成し、同じ owner の前回のプロセスが残したファイルを削除する
+        同じホストで終了したプロセス（既定のノードID <hostname>-<pid>）のサブディレクトリも同様に掃除する
+        他のプロセスのファイルや、スプール以外のファイルは削除しない
+        """
+        if not self.enabled:
+            return
+        _remove_spool_files(self.directory)
+        hostname = socket.gethostname()
+        try:
+            siblings = os.listdir(self.root)
+        except FileNotFoundError:
+            siblings = []
+        for name in siblings:
+            match = _DEFAULT_OWNER_PATTERN.match(name)
+            if (name != self.owner and match is not None and match.group("host") == hostname
+                    and not _process_alive(int(match.group("pid")))):
+                path = os.path.join(self.root, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    _remove_spool_files(path)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def allocate(self, request_id: str, file_format: str) -> Tuple[str, str]:
+        """書き込み用の一時パスと、完了後の最終パスを返す"""
+        os.makedirs(self.directory, exist_ok=True)
+        final_path = os.path.join(self.directory, f"{request_id}.{file_format}")
+        temp_path = os.path.join(self.directory, f".{request_id}.{uuid.uuid4().hex}.{file_format}")
+        return temp_path, final_path
+
+    def commit(self, temp_path: str, final_path: str) -> Dict:
+        """書き込み済みの一時ファイルを最終パスに移動し、ダウンロード用のメタデータを返す"""
+        os.replace(temp_path, final_path)
+        stat = os.stat(final_path)
+        return {
+            "spool_path": final_path,
+            "audio_size_bytes": stat.st_size,
+            "etag": f'"{os.path.basename(final_path)}-{stat.st_size}-{int(stat.st_mtime)}"',
+        }
+
+    def delete(self, path: Optional[str]):
+        if not path:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Failed to remove spooled result {path}: {e}")
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(",")]
+    # 弱いETag（W/"..."）も同一とみなす
+    return "*" in candidates or any(
+        (value[2:] if value.startswith("W/") else value) == etag for value in candidates
+    )
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    単一の bytes=start-end を (start, end)（end を含む）に変換する
+    Range 指定なし・複数範囲など対応しない形式は None（全体を返す）
+    満たせない範囲は ValueError
+    """
+    if not header:
+        return None
+    match = _RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        # 末尾から end バイト
+        length = int(end)
+        if length == 0:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+def _iter_file_range(path: str, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def spooled_file_response(
+    request: Optional[Request],
+    path: str,
+    media_type: str,
+    filename: str,
+    etag: str,
+    background=None,
+) -> Response:
+    """スプールしたファイルを返す（条件付きリクエストと Range に対応）"""
+    size = os.path.getsize(path)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+
+    if request is not None and _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag}, background=background)
+
+    byte_range = None
+    if request is not None:
+        if_range = request.headers.get("if-range")
+        # If-Range が一致しない（ファイルが変わった）場合は全体を返す
+        if not if_range or if_range.strip() == etag:
+            try:
+                byte_range = parse_range(request.headers.get("range"), size)
+            except ValueError:
+                return Response(
+                    status_code=416,
+                    headers={"Content-Range": f"bytes */{size}", "ETag": etag},
+                    background=background,
+                )
+
+    if byte_range is None:
+        # 全体はファイルから直接送信する（サーバーが対応していれば sendfile を使用）
+        return FileResponse(path, media_type=media_type, headers=headers, background=background)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _iter_file_range(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+        background=background,
+    )
@@ -0,0 +1,144 @@
+"""
+段階パイプライン実行（連続するリクエストの段階の重ね合わせ）
+
+1回の生成は次の段階に分かれる（ACEStepPipeline の prepare_generation / diffuse_generation / decode_generation）。
+  prepare: シードの設定・テキストのエンコード・歌詞のトークン化（CPU中心）
+  diffuse: LoRA の読み込み・参照音声のエンコード・拡散ループ（GPUを占有する）
+  decode:  latents2audio（VAE・ボコーダ）と、結果のエンコード（MP3/WAV/OGG）・保存
+
+段階ごとに専用のスレッドを1つ持ち、段階の間を上限付きの待ち行列（ACE_STAGE_QUEUE_SIZE）でつなぐ。
+リクエスト N が拡散中の間に、リクエスト N+1 のテキスト・歌詞のエンコードと
+リクエスト N-1 のデコード・エンコードが並行して進む。
+下流の段階が詰まっている場合、上流の段階は待ち行列が空くまで次のジョブを渡さない（先行しすぎない）。
+各段階は同時に1つのジョブしか処理しないため、拡散ループが同じパイプラインで重なることはない。
+
+ACE_STAGE_PIPELINE=1 で有効化する（デフォルトは無効）。有効な場合、スケジューラはレプリカごとに
+ACE_STAGE_PIPELINE_DEPTH 個（デフォルトは段階の数）のジョブを同時に割り当てる。
+CPUオフロードが有効な場合、段階ごとに別のモデルがGPUに載るため、ピークのVRAM使用量は増える。
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+STAGES = ("prepare", "diffuse", "decode")
+
+
+@dataclass
+class StagePipelineConfig:
+    enabled: bool = False
+    # レプリカごとに同時に割り当てるジョブ数（0 の場合は段階の数）
+    depth: int = 0
+    # 段階の間の待ち行列の長さ
+    queue_size: int = 1
+
+    @property
+    def jobs_per_replica(self) -> int:
+        return self.depth or len(STAGES)
+
+    @classmethod
+    def from_env(cls) -> "StagePipelineConfig":
+        """環境変数 ACE_STAGE_PIPELINE / ACE_STAGE_PIPELINE_DEPTH / ACE_STAGE_QUEUE_SIZE から設定を読み込む"""
+        default = cls()
+        return cls(
+            enabled=os.environ.get("ACE_STAGE_PIPELINE", "0").strip().lower() in ("1", "true", "yes", "on"),
+            depth=max(0, int(os.environ.get("ACE_STAGE_PIPELINE_DEPTH", str(default.depth)))),
+            queue_size=max(1, int(os.environ.get("ACE_STAGE_QUEUE_SIZE", str(default.queue_size)))),
+        )
+
+
+class _StageStats:
+    """段階ごとの処理数・処理時間（その段階のスレッドだけが更新する）"""
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.busy_since: Optional[float] = None
+
+
+class StagePipeline:
+    """
+    段階ごとのスレッドと、段階の間の上限付き待ち行列
+
+    submit() には段階ごとの関数を渡す。i 番目の関数は i 番目の段階のスレッドで、
+    前の段階の戻り値（最初の段階は value）を引数に呼び出される。
+    いずれかの段階で例外が発生した場合、残りの段階は実行せず Future に例外を設定する。
+    """
+
+    def __init__(self, stages: Sequence[str] = STAGES, queue_size: int = 1, name: str = "ace-stage"):
+        self.stages = list(stages)
+        # 最初の待ち行列はスケジューラが割り当てた数で上限が決まるため、長さを制限しない
+        self._queues: List[queue.Queue] = [queue.Queue()] + [
+            queue.Queue(maxsize=queue_size) for _ in self.stages[1:]
+        ]
+        self._stats = [_StageStats() for _ in self.stages]
+        self._started_at = time.time()
+        self._threads = [
+            threading.Thread(target=self._run, args=(index,), name=f"{name}-{stage}", daemon=True)
+            for index, stage in enumerate(self.stages)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, functions: Sequence[Callable[[Any], Any]], value: Any = None) -> Future:
+        if len(functions) != len(self.stages):
+            raise ValueError(f"Expected {len(self.stages)} stage functions, got {len(functions)}")
+        future: Future = Future()
+        self._queues[0].put((future, list(functions), value))
+        return future
+
+    def shutdown(self):
+        """各段階のスレッドを停止する（処理中・待機中のジョブは完了させない）"""
+        self._queues[0].put(None)
+
+    def _run(self, index: int):
+        stats = self._stats[index]
+        last = index == len(self.stages) - 1
+        while True:
+            item = self._queues[index].get()
+            if item is None:
+                if not last:
+                    self._queues[index + 1].put(None)
+                return
+            future, functions, value = item
+            if index == 0 and not future.set_running_or_notify_cancel():
+                continue
+            stats.busy_since = time.time()
+            try:
+                value = functions[index](value)
+            except BaseException as e:
+                stats.failed += 1
+                future.set_exception(e)
+                continue
+            finally:
+                stats.busy_seconds += time.time() - stats.busy_since
+                stats.busy_since = None
+            stats.processed += 1
+            if last:
+                future.set_result(value)
+            else:
+                # 次の段階の待ち行列が空くまで待つ（下流が詰まっている間は先行しない）
+                self._queues[index + 1].put((future, functions, value))
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        elapsed = max(1e-9, now - self._started_at)
+        stages = {}
+        for index, stage in enumerate(self.stages):
+            stats = self._stats[index]
+            busy_since = stats.busy_since
+            busy_seconds = stats.busy_seconds + (now - busy_since if busy_since is not None else 0.0)
+            stages[stage] = {
+                "busy": busy_since is not None,
+                "queued": self._queues[index].qsize(),
+                "processed": stats.processed,
+                "failed": stats.failed,
+                "busy_seconds": busy_seconds,
+                "utilization": busy_seconds / elapsed,
+            }
+        return stages
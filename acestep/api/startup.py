@@ -0,0 +1,152 @@
+"""
+起動時のモデルの読み込みとウォームアップ
+
+ACEStepPipeline はチェックポイントを最初の呼び出し時に読み込むため、そのままでは最初のリクエストが
+モデルの読み込み・CUDAコンテキストの作成・torch.compile の時間を負担する。
+ACE_PRELOAD が有効な場合（デフォルト）、サーバの起動時（lifespan）にバックグラウンドで
+パイプラインを初期化してチェックポイントを読み込み、ACE_WARMUP_DURATIONS の音声長ごとに
+短い生成（ACE_WARMUP_STEPS ステップ）を実行してから、ジョブの受け付け（レディネス）を開始する。
+
+段階（phase）:
+  idle:       未初期化（ACE_PRELOAD=0 で /initialize を待っている）
+  loading:    パイプラインの初期化・チェックポイントの読み込み中
+  warming_up: ウォームアップの生成中
+  ready:      ジョブを処理できる
+  failed:     初期化に失敗した（error に理由）
+
+初期化の引数は ACE_CHECKPOINT_PATH / ACE_DEVICE_ID / ACE_BF16 / ACE_TORCH_COMPILE /
+ACE_CPU_OFFLOAD / ACE_OVERLAPPED_DECODE で指定する（initialize_pipeline と同じデフォルト値）。
+
+イベントループ上でのみ更新する前提のため、ロックは使用しない。
+"""
+
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+PHASES = ("idle", "loading", "warming_up", "ready", "failed")
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
+
+
+@dataclass
+class StartupConfig:
+    preload: bool = True
+    # initialize_pipeline に渡す引数
+    checkpoint_path: str = ""
+    device_id: int = 0
+    bf16: bool = True
+    torch_compile: bool = False
+    cpu_offload: bool = True
+    overlapped_decode: bool = False
+    # ウォームアップで生成する音声長（秒）と拡散ステップ数（空の場合はウォームアップしない）
+    warmup_durations: List[float] = field(default_factory=lambda: [30.0, 60.0, 120.0])
+    warmup_steps: int = 5
+
+    def initialize_kwargs(self) -> Dict[str, Any]:
+        return {
+            "checkpoint_path": self.checkpoint_path,
+            "device_id": self.device_id,
+            "bf16": self.bf16,
+            "torch_compile": self.torch_compile,
+            "cpu_offload": self.cpu_offload,
+            "overlapped_decode": self.overlapped_decode,
+        }
+
+    @classmethod
+    def from_env(cls) -> "StartupConfig":
+        """
+        環境変数 ACE_PRELOAD / ACE_CHECKPOINT_PATH / ACE_DEVICE_ID / ACE_BF16 / ACE_TORCH_COMPILE / ACE_CPU_OFFLOAD /
+        ACE_OVERLAPPED_DECODE / ACE_WARMUP_DURATIONS / ACE_WARMUP_STEPS から設定を読み込む
+        """
+        default = cls()
+        durations = os.environ.get("ACE_WARMUP_DURATIONS")
+        return cls(
+            preload=_env_flag("ACE_PRELOAD", default.preload),
+            checkpoint_path=os.environ.get("ACE_CHECKPOINT_PATH", default.checkpoint_path),
+            device_id=int(os.environ.get("ACE_DEVICE_ID", str(default.device_id))),
+            bf16=_env_flag("ACE_BF16", default.bf16),
+            torch_compile=_env_flag("ACE_TORCH_COMPILE", default.torch_compile),
+            cpu_offload=_env_flag("ACE_CPU_OFFLOAD", default.cpu_offload),
+            overlapped_decode=_env_flag("ACE_OVERLAPPED_DECODE", default.overlapped_decode),
+            warmup_durations=(
+                [float(d) for d in durations.split(",") if d.strip()] if durations is not None
+                else default.warmup_durations
+            ),
+            warmup_steps=max(1, int(os.environ.get("ACE_WARMUP_STEPS", str(default.warmup_steps)))),
+        )
+
+
+class StartupState:
+    """初期化・ウォームアップの進捗（/health/ready と /health で返す）"""
+
+    def __init__(self):
+        self.phase = "idle"
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        # ウォームアップの生成（レプリカ数 × 音声長の数）のうち終わった数
+        self.warmup_total = 0
+        self.warmup_done = 0
+        # レプリカごとの読み込み秒数と、音声長ごとのウォームアップの秒数
+        self.load_seconds: Dict[int, float] = {}
+        self.warmup_seconds: Dict[int, Dict[str, float]] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    @property
+    def busy(self) -> bool:
+        return self.phase in ("loading", "warming_up")
+
+    def begin(self, warmup_total: int):
+        self.phase = "loading"
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.warmup_total = warmup_total
+        self.warmup_done = 0
+        self.load_seconds = {}
+        self.warmup_seconds = {}
+        print("Model loading started")
+
+    def loaded(self, replica_index: int, seconds: float):
+        self.load_seconds[replica_index] = seconds
+        print(f"Replica {replica_index} loaded in {seconds:.1f}s")
+
+    def warming_up(self):
+        self.phase = "warming_up"
+
+    def warmed_up(self, replica_index: int, duration: float, seconds: float):
+        self.warmup_seconds.setdefault(replica_index, {})[f"{duration:g}"] = seconds
+        self.warmup_done += 1
+        print(f"Replica {replica_index} warmed up {duration:g}s audio in {seconds:.1f}s "
+              f"({self.warmup_done}/{self.warmup_total})")
+
+    def finish(self, error: Optional[str] = None):
+        self.phase = "failed" if error is not None else "ready"
+        self.error = error
+        self.finished_at = time.time()
+        if error is not None:
+            print(f"Model loading failed: {error}")
+        else:
+            print(f"Model ready in {self.finished_at - self.started_at:.1f}s")
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "phase": self.phase,
+            "ready": self.ready,
+            "elapsed_seconds": ((self.finished_at or now) - self.started_at) if self.started_at else None,
+            "warmup": {"done": self.warmup_done, "total": self.warmup_total},
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "error": self.error,
+        }
@@ -0,0 +1,61 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Cooperative cancellation for long-running generations.
+
+A `CancellationToken` is shared between the thread that wants to cancel a job and
+the thread running it. The pipeline checks it between diffusion steps and between
+VAE / vocoder decode windows and raises `GenerationCancelled`, so a cancelled job
+releases the GPU within one step.
+"""
+
+import threading
+from typing import Optional
+
+
+class GenerationCancelled(Exception):
+    """Raised inside the pipeline when its cancellation token has been cancelled."""
+
+
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+
+def check_cancelled(token: Optional[CancellationToken]):
+    """Convenience for optional tokens: no-op when `token` is None."""
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+class AllCancelledToken:
+    """Token for a batch of jobs: cancelled only once every member token is cancelled."""
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+
+    @property
+    def cancelled(self) -> bool:
+        return all(token.cancelled for token in self.tokens)
+
+    def raise_if_cancelled(self):
+        if self.tokens and self.cancelled:
+            raise GenerationCancelled(self.tokens[0].reason)
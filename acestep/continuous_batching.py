@@ -0,0 +1,638 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Continuous (step-level) batching for text2music diffusion.
+
+Every request owns a slot with its own latents, scheduler instance, step
+index, momentum buffer and generator. At each step boundary the engine admits
+newly submitted requests, runs one transformer step for a group of slots that
+share the same latent length (each sample with its own timestep; groups of
+different lengths take turns step by step), and retires finished slots to VAE
+decode. A short request submitted while a long one is
+running therefore starts diffusing at the next step instead of waiting for the
+whole generation to finish.
+"""
+
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable, List, Optional
+
+import torch
+from loguru import logger
+from diffusers.utils.torch_utils import randn_tensor
+
+from acestep.apg_guidance import (
+    apg_forward,
+    MomentumBuffer,
+    cfg_forward,
+    cfg_zero_star,
+    cfg_double_condition_forward,
+)
+from acestep.cpu_offload import CpuOffloader
+from acestep.cancellation import CancellationToken, GenerationCancelled
+from acestep.progress import DIFFUSION, TEXT_ENCODING, ProgressCallback, report_progress
+
+
+@dataclass
+class GenerationSpec:
+    """Parameters of one text2music request handled by the engine."""
+
+    prompt: str = ""
+    lyrics: str = ""
+    format: str = "wav"
+    audio_duration: float = 60.0
+    infer_step: int = 60
+    guidance_scale: float = 15.0
+    scheduler_type: str = "euler"
+    cfg_type: str = "apg"
+    omega_scale: float = 10.0
+    manual_seeds: Optional[str] = None
+    guidance_interval: float = 0.5
+    guidance_interval_decay: float = 0.0
+    min_guidance_scale: float = 3.0
+    use_erg_tag: bool = True
+    use_erg_lyric: bool = False
+    use_erg_diffusion: bool = True
+    oss_steps: Optional[str] = None
+    guidance_scale_text: float = 0.0
+    guidance_scale_lyric: float = 0.0
+    lora_name_or_path: str = "none"
+    lora_weight: float = 1.0
+
+    @classmethod
+    def from_request(cls, request: Any) -> "GenerationSpec":
+        """Builds a spec from any object exposing the same attribute names (e.g. an API request)."""
+        return cls(**{f.name: getattr(request, f.name) for f in fields(cls) if hasattr(request, f.name)})
+
+
+@dataclass
+class DiffusionSlot:
+    spec: GenerationSpec
+    future: Future
+    frame_length: int
+    latents: torch.Tensor
+    scheduler: Any
+    timesteps: torch.Tensor
+    num_inference_steps: int
+    random_generators: List[torch.Generator]
+    actual_seeds: List[int]
+    oss_steps: List[int]
+    encoder_hidden_states: torch.Tensor
+    encoder_hidden_mask: torch.Tensor
+    encoder_hidden_states_null: torch.Tensor
+    encoder_hidden_states_no_lyric: Optional[torch.Tensor]
+    do_classifier_free_guidance: bool
+    start_idx: int
+    end_idx: int
+    momentum_buffer: MomentumBuffer = field(default_factory=MomentumBuffer)
+    cancellation_token: Optional[CancellationToken] = None
+    progress_callback: Optional[ProgressCallback] = None
+    step_index: int = 0
+    admitted_at: float = 0.0
+    preprocess_time_cost: float = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.step_index >= self.num_inference_steps
+
+    @property
+    def timestep(self) -> torch.Tensor:
+        return self.timesteps[self.step_index]
+
+    @property
+    def in_guidance_interval(self) -> bool:
+        return self.do_classifier_free_guidance and self.start_idx <= self.step_index < self.end_idx
+
+    def current_guidance_scale(self) -> float:
+        spec = self.spec
+        if spec.guidance_interval_decay > 0:
+            progress = (self.step_index - self.start_idx) / (self.end_idx - self.start_idx - 1)
+            return (
+                spec.guidance_scale
+                - (spec.guidance_scale - spec.min_guidance_scale)
+                * progress
+                * spec.guidance_interval_decay
+            )
+        return spec.guidance_scale
+
+
+class _ExclusiveTask:
+    def __init__(self, fn: Callable, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+def _pad_cat(states: List[torch.Tensor], masks: List[torch.Tensor]):
+    """Concatenates encoder states of different sequence lengths, zero-padding states and masks."""
+    max_length = max(state.shape[1] for state in states)
+    padded_states = []
+    padded_masks = []
+    for state, mask in zip(states, masks):
+        pad = max_length - state.shape[1]
+        if pad > 0:
+            state = torch.nn.functional.pad(state, (0, 0, 0, pad))
+            mask = torch.nn.functional.pad(mask, (0, pad))
+        padded_states.append(state)
+        padded_masks.append(mask)
+    return torch.cat(padded_states, dim=0), torch.cat(padded_masks, dim=0)
+
+
+class ContinuousBatchingEngine:
+    """
+    Runs text2music requests on a shared, continuously refilled batch.
+
+    All GPU work submitted through the engine (slots and exclusive tasks) runs on
+    the engine thread, so it is serialized with respect to the diffusion loop.
+    """
+
+    def __init__(self, pipeline, max_batch_size: int = 4):
+        self.pipeline = pipeline
+        self.max_batch_size = max(1, max_batch_size)
+        self._incoming: "queue.Queue" = queue.Queue()
+        self._deferred: List[Any] = []
+        self._slots: List[DiffusionSlot] = []
+        self._last_frame_length: Optional[int] = None
+        self._active_lora = None
+        self._offloader = None
+        self._stop = threading.Event()
+        # serializes submissions with stop() so nothing is queued after the final drain
+        self._submit_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def supports(request: Any) -> bool:
+        """Only plain text2music requests are batched; audio2audio etc. run as exclusive tasks."""
+        if getattr(request, "audio2audio_enable", False) or getattr(request, "ref_audio_input", None):
+            return False
+        return getattr(request, "task", "text2music") == "text2music"
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ace-continuous-batching", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the engine thread. Requests still in a slot, deferred or queued fail
+        with RuntimeError; later submissions raise.
+        """
+        with self._submit_lock:
+            self._stop.set()
+            self._incoming.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_outstanding(RuntimeError("continuous batching engine stopped"))
+        self._release_transformer()
+
+    def _fail_outstanding(self, error: Exception):
+        futures = [slot.future for slot in self._slots]
+        pending = self._deferred
+        while True:
+            try:
+                pending.append(self._incoming.get_nowait())
+            except queue.Empty:
+                break
+        for item in pending:
+            if isinstance(item, _ExclusiveTask):
+                futures.append(item.future)
+            elif item is not None:
+                futures.append(item[1])
+        self._slots = []
+        self._deferred = []
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _enqueue(self, item):
+        with self._submit_lock:
+            if self._stop.is_set():
+                raise RuntimeError("continuous batching engine stopped")
+            self._incoming.put(item)
+
+    def submit(
+        self,
+        spec: GenerationSpec,
+        cancellation_token: Optional[CancellationToken] = None,
+        progress_callback: Optional[ProgressCallback] = None,
+    ) -> Future:
+        """
+        Queues a request; the future resolves to the same audio dict as `return_audio_data=True`.
+        Cancelling the token drops the request from its slot at the next step boundary.
+        `progress_callback` receives the same stage / step events as `ACEStepPipeline.__call__`.
+        """
+        future = Future()
+        self._enqueue((spec, future, cancellation_token, progress_callback))
+        return future
+
+    def run_exclusive(self, fn: Callable, *args, **kwargs) -> Future:
+        """Runs `fn` on the engine thread between two diffusion steps."""
+        task = _ExclusiveTask(fn, args, kwargs)
+        self._enqueue(task)
+        return task.future
+
+    def active_count(self) -> int:
+        return len(self._slots)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._slots and not self._deferred:
+                # idle: block until work arrives
+                item = self._incoming.get()
+                if item is None:
+                    continue
+                self._deferred.append(item)
+            with torch.no_grad():
+                self._admit()
+                if self._slots:
+                    self._step()
+                    self._retire()
+            if not self._slots:
+                self._release_transformer()
+
+    def _acquire_transformer(self):
+        if self.pipeline.cpu_offload and self._offloader is None:
+            self._offloader = CpuOffloader(self.pipeline.ace_step_transformer, self.pipeline.device)
+            self._offloader.__enter__()
+
+    def _release_transformer(self):
+        if self._offloader is not None:
+            self._offloader.__exit__(None, None, None)
+            self._offloader = None
+
+    def _admit(self):
+        while True:
+            try:
+                item = self._incoming.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._deferred.append(item)
+
+        still_deferred = []
+        barrier = False
+        for item in self._deferred:
+            if isinstance(item, _ExclusiveTask):
+                if self._slots or barrier:
+                    # exclusive tasks may offload weights or switch LoRA, so they wait for the batch to drain
+                    still_deferred.append(item)
+                    barrier = True
+                    continue
+                self._release_transformer()
+                self._run_exclusive_task(item)
+                self._active_lora = None
+                continue
+            spec, future, cancellation_token, progress_callback = item
+            if future.cancelled():
+                continue
+            if cancellation_token is not None and cancellation_token.cancelled:
+                future.set_exception(GenerationCancelled(cancellation_token.reason))
+                continue
+            lora = (spec.lora_name_or_path, spec.lora_weight)
+            if barrier or len(self._slots) >= self.max_batch_size or (
+                self._slots and lora != self._active_lora
+            ):
+                # wait for a free slot, or for the running batch to drain before switching LoRA
+                still_deferred.append(item)
+                continue
+            try:
+                self._slots.append(self._prepare_slot(spec, future, cancellation_token, progress_callback))
+            except Exception as e:
+                logger.exception("continuous batching: failed to admit request")
+                future.set_exception(e)
+        self._deferred = still_deferred
+
+    def _run_exclusive_task(self, task: _ExclusiveTask):
+        if not task.future.set_running_or_notify_cancel():
+            return
+        try:
+            task.future.set_result(task.fn(*task.args, **task.kwargs))
+        except Exception as e:
+            task.future.set_exception(e)
+
+    def _prepare_slot(
+        self,
+        spec: GenerationSpec,
+        future: Future,
+        cancellation_token: Optional[CancellationToken] = None,
+        progress_callback: Optional[ProgressCallback] = None,
+    ) -> DiffusionSlot:
+        pipeline = self.pipeline
+        start_time = time.time()
+        report_progress(progress_callback, TEXT_ENCODING)
+        pipeline.ensure_loaded()
+        lora = (spec.lora_name_or_path, spec.lora_weight)
+        if lora != self._active_lora:
+            pipeline.load_lora(spec.lora_name_or_path, spec.lora_weight)
+            self._active_lora = lora
+
+        if spec.audio_duration <= 0:
+            spec.audio_duration = random.uniform(30.0, 240.0)
+            logger.info(f"random audio duration: {spec.audio_duration}")
+
+        random_generators, actual_seeds = pipeline.set_seeds(1, spec.manual_seeds)
+        if isinstance(spec.oss_steps, str) and len(spec.oss_steps) > 0:
+            oss_steps = list(map(int, spec.oss_steps.split(",")))
+        else:
+            oss_steps = []
+
+        (
+            encoder_text_hidden_states,
+            text_attention_mask,
+            encoder_text_hidden_states_null,
+            speaker_embeds,
+            lyric_token_idx,
+            lyric_mask,
+        ) = pipeline.prepare_text_conditions(
+            spec.prompt, spec.lyrics, batch_size=1, use_erg_tag=spec.use_erg_tag
+        )
+
+        do_classifier_free_guidance = spec.guidance_scale not in (0.0, 1.0)
+        do_double_condition_guidance = (
+            spec.guidance_scale_text is not None
+            and spec.guidance_scale_text > 1.0
+            and spec.guidance_scale_lyric is not None
+            and spec.guidance_scale_lyric > 1.0
+        )
+
+        self._acquire_transformer()
+        (
+            encoder_hidden_states,
+            encoder_hidden_mask,
+            encoder_hidden_states_null,
+            encoder_hidden_states_no_lyric,
+        ) = pipeline.encode_diffusion_conditions(
+            encoder_text_hidden_states,
+            text_attention_mask,
+            speaker_embeds,
+            lyric_token_idx,
+            lyric_mask,
+            encoder_text_hidden_states_null=encoder_text_hidden_states_null,
+            use_erg_lyric=spec.use_erg_lyric,
+            do_double_condition_guidance=do_double_condition_guidance,
+        )
+
+        scheduler = pipeline.build_scheduler(spec.scheduler_type)
+        timesteps, num_inference_steps, _ = pipeline.retrieve_inference_timesteps(
+            scheduler, spec.infer_step, oss_steps
+        )
+        frame_length = int(spec.audio_duration * 44100 / 512 / 8)
+        latents = randn_tensor(
+            shape=(1, 8, 16, frame_length),
+            generator=random_generators,
+            device=pipeline.device,
+            dtype=pipeline.dtype,
+        )
+
+        slot = DiffusionSlot(
+            spec=spec,
+            future=future,
+            frame_length=frame_length,
+            latents=latents,
+            scheduler=scheduler,
+            timesteps=timesteps,
+            num_inference_steps=num_inference_steps,
+            random_generators=random_generators,
+            actual_seeds=actual_seeds,
+            oss_steps=oss_steps,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_hidden_mask=encoder_hidden_mask,
+            encoder_hidden_states_null=encoder_hidden_states_null,
+            encoder_hidden_states_no_lyric=encoder_hidden_states_no_lyric,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            start_idx=int(num_inference_steps * ((1 - spec.guidance_interval) / 2)),
+            end_idx=int(num_inference_steps * (spec.guidance_interval / 2 + 0.5)),
+            admitted_at=time.time(),
+            cancellation_token=cancellation_token,
+            progress_callback=progress_callback,
+        )
+        slot.preprocess_time_cost = slot.admitted_at - start_time
+        logger.info(
+            f"continuous batching: admitted request ({num_inference_steps} steps, "
+            f"{frame_length} frames), {len(self._slots) + 1} active"
+        )
+        return slot
+
+    def _next_group(self) -> List[DiffusionSlot]:
+        # latent lengths take turns (in order of their oldest slot), so a long-running group
+        # cannot stall slots of another length that already hold admission capacity
+        lengths = list(dict.fromkeys(slot.frame_length for slot in self._slots))
+        if self._last_frame_length in lengths:
+            frame_length = lengths[(lengths.index(self._last_frame_length) + 1) % len(lengths)]
+        else:
+            frame_length = lengths[0]
+        self._last_frame_length = frame_length
+        return [slot for slot in self._slots if slot.frame_length == frame_length][: self.max_batch_size]
+
+    def _drop_cancelled(self):
+        for slot in [slot for slot in self._slots if slot.cancellation_token is not None
+                     and slot.cancellation_token.cancelled]:
+            self._slots.remove(slot)
+            logger.info("continuous batching: dropped cancelled request")
+            slot.future.set_exception(GenerationCancelled(slot.cancellation_token.reason))
+
+    def _step(self):
+        self._drop_cancelled()
+        if not self._slots:
+            return
+        group = self._next_group()
+        try:
+            self._step_group(group)
+        except Exception as e:
+            logger.exception("continuous batching: diffusion step failed")
+            for slot in group:
+                self._slots.remove(slot)
+                if not slot.future.done():
+                    slot.future.set_exception(e)
+
+    def _step_group(self, slots: List[DiffusionSlot]):
+        transformer = self.pipeline.ace_step_transformer
+        frame_length = slots[0].frame_length
+        latents = torch.cat([slot.latents for slot in slots], dim=0)
+        timestep = torch.stack([slot.timestep for slot in slots]).to(latents.device)
+        attention_mask = torch.ones(
+            len(slots), frame_length, device=self.pipeline.device, dtype=self.pipeline.dtype
+        )
+        encoder_hidden_states, encoder_hidden_mask = _pad_cat(
+            [slot.encoder_hidden_states for slot in slots],
+            [slot.encoder_hidden_mask for slot in slots],
+        )
+
+        # P(x|speaker, text, lyric) for every slot
+        noise_pred_with_cond = transformer.decode(
+            hidden_states=latents,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_hidden_mask=encoder_hidden_mask,
+            output_length=frame_length,
+            timestep=timestep,
+        ).sample
+        noise_preds = list(noise_pred_with_cond.split(1, dim=0))
+
+        guided = [i for i, slot in enumerate(slots) if slot.in_guidance_interval]
+        if guided:
+            noise_pred_uncond = {}
+            noise_pred_with_only_text_cond = {}
+            # ERG temperature hooks apply to a whole forward pass, so split by the flag
+            for use_erg_diffusion in (True, False):
+                members = [i for i in guided if slots[i].spec.use_erg_diffusion == use_erg_diffusion]
+                if not members:
+                    continue
+                null_states, null_mask = _pad_cat(
+                    [slots[i].encoder_hidden_states_null for i in members],
+                    [slots[i].encoder_hidden_mask for i in members],
+                )
+                inputs = {
+                    "encoder_hidden_states": null_states,
+                    "encoder_hidden_mask": null_mask,
+                    "output_length": frame_length,
+                    "attention_mask": attention_mask[members],
+                }
+                if use_erg_diffusion:
+                    outputs = self.pipeline.decode_with_temperature(
+                        hidden_states=latents[members], timestep=timestep[members], inputs=inputs
+                    )
+                else:
+                    outputs = transformer.decode(
+                        hidden_states=latents[members], timestep=timestep[members], **inputs
+                    ).sample
+                for i, output in zip(members, outputs.split(1, dim=0)):
+                    noise_pred_uncond[i] = output
+
+            double = [i for i in guided if slots[i].encoder_hidden_states_no_lyric is not None]
+            if double:
+                text_states, text_mask = _pad_cat(
+                    [slots[i].encoder_hidden_states_no_lyric for i in double],
+                    [slots[i].encoder_hidden_mask for i in double],
+                )
+                outputs = transformer.decode(
+                    hidden_states=latents[double],
+                    attention_mask=attention_mask[double],
+                    encoder_hidden_states=text_states,
+                    encoder_hidden_mask=text_mask,
+                    output_length=frame_length,
+                    timestep=timestep[double],
+                ).sample
+                for i, output in zip(double, outputs.split(1, dim=0)):
+                    noise_pred_with_only_text_cond[i] = output
+
+            for i in guided:
+                noise_preds[i] = self._guide(
+                    slots[i],
+                    noise_preds[i],
+                    noise_pred_uncond[i],
+                    noise_pred_with_only_text_cond.get(i),
+                )
+
+        for slot, noise_pred in zip(slots, noise_preds):
+            slot.latents = slot.scheduler.step(
+                model_output=noise_pred,
+                timestep=slot.timestep,
+                sample=slot.latents,
+                return_dict=False,
+                omega=slot.spec.omega_scale,
+                generator=slot.random_generators[0],
+            )[0]
+            slot.step_index += 1
+            report_progress(slot.progress_callback, DIFFUSION, slot.step_index, slot.num_inference_steps)
+
+    def _guide(self, slot, noise_pred_with_cond, noise_pred_uncond, noise_pred_with_only_text_cond):
+        spec = slot.spec
+        current_guidance_scale = slot.current_guidance_scale()
+        if noise_pred_with_only_text_cond is not None:
+            return cfg_double_condition_forward(
+                cond_output=noise_pred_with_cond,
+                uncond_output=noise_pred_uncond,
+                only_text_cond_output=noise_pred_with_only_text_cond,
+                guidance_scale_text=spec.guidance_scale_text,
+                guidance_scale_lyric=spec.guidance_scale_lyric,
+            )
+        elif spec.cfg_type == "apg":
+            return apg_forward(
+                pred_cond=noise_pred_with_cond,
+                pred_uncond=noise_pred_uncond,
+                guidance_scale=current_guidance_scale,
+                momentum_buffer=slot.momentum_buffer,
+            )
+        elif spec.cfg_type == "cfg":
+            return cfg_forward(
+                cond_output=noise_pred_with_cond,
+                uncond_output=noise_pred_uncond,
+                cfg_strength=current_guidance_scale,
+            )
+        elif spec.cfg_type == "cfg_star":
+            return cfg_zero_star(
+                noise_pred_with_cond=noise_pred_with_cond,
+                noise_pred_uncond=noise_pred_uncond,
+                guidance_scale=current_guidance_scale,
+                i=slot.step_index,
+                zero_steps=1,
+                use_zero_init=True,
+            )
+        return noise_pred_with_cond
+
+    def _retire(self):
+        for slot in [slot for slot in self._slots if slot.finished]:
+            self._slots.remove(slot)
+            try:
+                slot.future.set_result(self._decode(slot))
+            except Exception as e:
+                logger.exception("continuous batching: decode failed")
+                slot.future.set_exception(e)
+
+    def _decode(self, slot: DiffusionSlot):
+        spec = slot.spec
+        diffusion_time_cost = time.time() - slot.admitted_at
+        start_time = time.time()
+        audio_data = self.pipeline.latents2audio(
+            latents=slot.latents,
+            target_wav_duration_second=spec.audio_duration,
+            format=spec.format,
+            return_audio_data=True,
+            cancellation_token=slot.cancellation_token,
+            progress_callback=slot.progress_callback,
+        )[0]
+        audio_data["input_params"] = {
+            "format": spec.format,
+            "lora_name_or_path": spec.lora_name_or_path,
+            "lora_weight": spec.lora_weight,
+            "task": "text2music",
+            "prompt": spec.prompt,
+            "lyrics": spec.lyrics,
+            "audio_duration": spec.audio_duration,
+            "infer_step": spec.infer_step,
+            "guidance_scale": spec.guidance_scale,
+            "scheduler_type": spec.scheduler_type,
+            "cfg_type": spec.cfg_type,
+            "omega_scale": spec.omega_scale,
+            "guidance_interval": spec.guidance_interval,
+            "guidance_interval_decay": spec.guidance_interval_decay,
+            "min_guidance_scale": spec.min_guidance_scale,
+            "use_erg_tag": spec.use_erg_tag,
+            "use_erg_lyric": spec.use_erg_lyric,
+            "use_erg_diffusion": spec.use_erg_diffusion,
+            "oss_steps": slot.oss_steps,
+            "timecosts": {
+                "preprocess": slot.preprocess_time_cost,
+                "diffusion": diffusion_time_cost,
+                "latent2audio": time.time() - start_time,
+            },
+            "actual_seeds": slot.actual_seeds,
+            "guidance_scale_text": spec.guidance_scale_text,
+            "guidance_scale_lyric": spec.guidance_scale_lyric,
+            "audio2audio_enable": False,
+            "continuous_batching": True,
+        }
+        return audio_data
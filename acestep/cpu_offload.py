@@ -1,6 +1,20 @@
 import torch
 import functools
-from typing import Callable, TypeVar
+import threading
+from typing import Callable, Dict, TypeVar
+
+
+# Threads currently using each model (id(model) -> [users, lock]). Pipeline stages
+# running on different threads may share a model (e.g. the DCAE encodes reference
+# audio while the previous request is being decoded), so the model is moved to the
+# device by the first user and back to the CPU by the last one.
+_users: Dict[int, list] = {}
+_users_lock = threading.Lock()
+
+
+def _usage(model) -> list:
+    with _users_lock:
+        return _users.setdefault(id(model), [0, threading.Lock()])
 
 
 class CpuOffloader:
@@ -10,13 +24,21 @@ class CpuOffloader:
         self.original_dtype = model.dtype
     
     def __enter__(self):
-        if not hasattr(self.model,"torchao_quantized"):
-            self.model.to(self.original_device, dtype=self.original_dtype)
+        usage = _usage(self.model)
+        with usage[1]:
+            usage[0] += 1
+            if usage[0] == 1 and not hasattr(self.model,"torchao_quantized"):
+                self.model.to(self.original_device, dtype=self.original_dtype)
         return self.model
     
     def __exit__(self, *args):
-        if not hasattr(self.model,"torchao_quantized"):
-            self.model.to("cpu")
+        usage = _usage(self.model)
+        with usage[1]:
+            usage[0] -= 1
+            if usage[0] > 0:
+                return
+            if not hasattr(self.model,"torchao_quantized"):
+                self.model.to("cpu")
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.synchronize()
@@ -6,6 +6,7 @@ https://github.com/ace-step/ACE-Step
 Apache 2.0 License
 """
 
+import math
 import os
 import torch
 from diffusers import AutoencoderDC
@@ -21,6 +22,22 @@ try:
 except ImportError:
     from music_vocoder import ADaMoSHiFiGANV1
 
+try:
+    from acestep.cancellation import check_cancelled
+except ImportError:
+    def check_cancelled(token):
+        if token is not None:
+            token.raise_if_cancelled()
+
+try:
+    from acestep.progress import DCAE_DECODE, VOCODER, report_progress
+except ImportError:
+    DCAE_DECODE, VOCODER = "dcae_decode", "vocoder"
+
+    def report_progress(callback, stage, step=None, total=None):
+        if callback is not None:
+            callback(stage, step, total)
+
 
 root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DEFAULT_PRETRAINED_PATH = os.path.join(root_dir, "checkpoints", "music_dcae_f8c8")
@@ -59,8 +76,21 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         self.scale_factor = 0.1786
         self.shift_factor = -1.9091
 
-    def load_audio(self, audio_path):
-        audio, sr = torchaudio.load(audio_path)
+    def load_audio(self, audio_path, offset=0.0, duration=None):
+        """
+        Load an audio file (path or binary file object) as a stereo tensor.
+        With `offset` / `duration` (seconds) only that window is decoded, so a
+        long upload does not have to be decoded and encoded in full.
+        """
+        frame_offset, num_frames = 0, -1
+        if offset > 0 or duration is not None:
+            sample_rate = torchaudio.info(audio_path).sample_rate
+            if hasattr(audio_path, "seek"):
+                audio_path.seek(0)
+            frame_offset = int(offset * sample_rate)
+            if duration is not None:
+                num_frames = max(1, int(math.ceil(duration * sample_rate)))
+        audio, sr = torchaudio.load(audio_path, frame_offset=frame_offset, num_frames=num_frames)
         if audio.shape[0] == 1:
             audio = audio.repeat(2, 1)
         return audio, sr
@@ -112,19 +142,24 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         return latents, latent_lengths
 
     @torch.no_grad()
-    def decode(self, latents, audio_lengths=None, sr=None):
+    def decode(self, latents, audio_lengths=None, sr=None, cancellation_token=None, progress_callback=None):
         latents = latents / self.scale_factor + self.shift_factor
 
         pred_wavs = []
 
-        for latent in latents:
+        for latent_idx, latent in enumerate(latents):
+            check_cancelled(cancellation_token)
+            report_progress(progress_callback, DCAE_DECODE, latent_idx, len(latents))
             mels = self.dcae.decoder(latent.unsqueeze(0))
             mels = mels * 0.5 + 0.5
             mels = mels * (self.max_mel_value - self.min_mel_value) + self.min_mel_value
 
             # wav = self.vocoder.decode(mels[0]).squeeze(1)
             # decode waveform for each channels to reduce vram footprint
+            check_cancelled(cancellation_token)
+            report_progress(progress_callback, VOCODER, latent_idx, len(latents))
             wav_ch1 = self.vocoder.decode(mels[:,0,:,:]).squeeze(1).cpu()
+            check_cancelled(cancellation_token)
             wav_ch2 = self.vocoder.decode(mels[:,1,:,:]).squeeze(1).cpu()
             wav = torch.cat([wav_ch1, wav_ch2],dim=0)
 
@@ -144,7 +179,7 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         return sr, pred_wavs
 
     @torch.no_grad()
-    def decode_overlap(self, latents, audio_lengths=None, sr=None):
+    def decode_overlap(self, latents, audio_lengths=None, sr=None, cancellation_token=None, progress_callback=None):
         """
         Decodes latents into waveforms using an overlapped DCAE and Vocoder.
         """
@@ -202,6 +237,8 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
                     dcae_anchors = [dcae_anchor_offset]
                 
                 for i, anchor in enumerate(dcae_anchors):
+                    check_cancelled(cancellation_token)
+                    report_progress(progress_callback, DCAE_DECODE, i, len(dcae_anchors))
                     win_start_idx = max(0, anchor - dcae_anchor_offset)
                     win_end_idx = min(latent_len, win_start_idx + dcae_win_len_latent)
                     
@@ -264,20 +301,25 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
                     pad_len = vocoder_input_mel_frames_per_block - mel_block.shape[2]
                     mel_block = torch.nn.functional.pad(mel_block, (0, pad_len), mode='constant', value=0) # Pad last dim
                 
+                conceptual_total_audio_len_native_sr = mel_total_frames * VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
+                pbar_total = 1 + max(0, (conceptual_total_audio_len_native_sr - (vocoder_win_len_audio - vocoder_overlap_len_audio))) // vocoder_hop_len_audio
+                report_progress(progress_callback, VOCODER, 0, pbar_total)
+
                 current_audio_output = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
                 current_audio_output = current_audio_output[:, :, :-vocoder_overlap_len_audio] # Remove end overlap
 
                 # p_audio_samples tracks the start of the *next* audio segment to generate (in conceptual total audio samples)
                 p_audio_samples = vocoder_hop_len_audio 
-                conceptual_total_audio_len_native_sr = mel_total_frames * VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
-                
-                pbar_total = 1 + max(0, (conceptual_total_audio_len_native_sr - (vocoder_win_len_audio - vocoder_overlap_len_audio))) // vocoder_hop_len_audio
                 
                 # Use tqdm if you want a progress bar for the vocoder part
                 # with tqdm(total=pbar_total, desc=f"Vocoder {latent_idx+1}/{len(latents)}", leave=False) as pbar:
                 # pbar.update(1) # For initial window
+                vocoder_window = 1
                 # The loop for subsequent windows
                 while p_audio_samples < conceptual_total_audio_len_native_sr:
+                    check_cancelled(cancellation_token)
+                    report_progress(progress_callback, VOCODER, vocoder_window, pbar_total)
+                    vocoder_window += 1
                     mel_frame_start = p_audio_samples // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
                     mel_frame_end = mel_frame_start + vocoder_input_mel_frames_per_block
                     
@@ -6,6 +6,7 @@ https://github.com/ace-step/ACE-Step
 Apache 2.0 License
 """
 
+import inspect
 import random
 import time
 import os
@@ -16,6 +17,8 @@ from loguru import logger
 from tqdm import tqdm
 import json
 import math
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
 from huggingface_hub import snapshot_download
 
 # from diffusers.pipelines.pipeline_utils import DiffusionPipeline
@@ -48,6 +51,9 @@ from acestep.apg_guidance import (
 )
 import torchaudio
 from .cpu_offload import cpu_offload
+from .preemption import DiffusionSnapshot, GenerationPreempted
+from .cancellation import check_cancelled
+from .progress import DIFFUSION, TEXT_ENCODING, report_progress
 
 
 torch.backends.cudnn.benchmark = False
@@ -90,6 +96,26 @@ REPO_ID = "ACE-Step/ACE-Step-v1-3.5B"
 REPO_ID_QUANT = REPO_ID + "-q4-K-M" # ??? update this i guess
 
 
+@dataclass
+class GenerationPlan:
+    """Normalized arguments and text/lyric conditioning of one generation.
+
+    Produced by ``ACEStepPipeline.prepare_generation`` and consumed by
+    ``diffuse_generation`` and ``decode_generation``, so that the three stages
+    of ``__call__`` can run on different threads.
+    """
+
+    params: Dict[str, Any]
+    random_generators: List[torch.Generator]
+    actual_seeds: List[int]
+    retake_random_generators: List[torch.Generator]
+    actual_retake_seeds: List[int]
+    text_conditions: Tuple
+    target_text_conditions: Optional[Tuple] = None
+    ref_audio_duration: Optional[float] = None
+    timecosts: Dict[str, float] = field(default_factory=dict)
+
+
 # class ACEStepPipeline(DiffusionPipeline):
 class ACEStepPipeline:
     def __init__(
@@ -103,6 +129,7 @@ class ACEStepPipeline:
         cpu_offload=False,
         quantized=False,
         overlapped_decode=False,
+        device=None,
         **kwargs,
     ):
         if not checkpoint_dir:
@@ -118,13 +145,17 @@ class ACEStepPipeline:
         self.checkpoint_dir = checkpoint_dir
         self.lora_path = "none"
         self.lora_weight = 1
-        device = (
-            torch.device(f"cuda:{device_id}")
-            if torch.cuda.is_available()
-            else torch.device("cpu")
-        )
-        if device.type == "cpu" and torch.backends.mps.is_available():
-            device = torch.device("mps")
+        if device is not None:
+            # explicit device (e.g. "cuda:1" or "cpu"), takes precedence over device_id
+            device = torch.device(device)
+        else:
+            device = (
+                torch.device(f"cuda:{device_id}")
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+            if device.type == "cpu" and torch.backends.mps.is_available():
+                device = torch.device("mps")
         self.dtype = torch.bfloat16 if dtype == "bfloat16" else torch.float32
         if device.type == "mps" and self.dtype == torch.bfloat16:
             self.dtype = torch.float16
@@ -396,7 +427,7 @@ class ACEStepPipeline:
                 elif manual_seeds.isdigit():
                     processed_input_seeds = int(manual_seeds)
             elif isinstance(manual_seeds, list) and all(
-                isinstance(s, int) for s in manual_seeds
+                s is None or isinstance(s, int) for s in manual_seeds
             ):
                 if len(manual_seeds) > 0:
                     processed_input_seeds = list(manual_seeds)
@@ -468,6 +499,76 @@ class ACEStepPipeline:
                 print("tokenize error", e, "for line", line, "major_language", lang)
         return lyric_token_idx
 
+    def tokenize_lyrics_batch(self, lyrics_list, debug=False):
+        """Tokenize one lyric per sample and right-pad to a common length."""
+        token_lists = []
+        mask_lists = []
+        for lyrics in lyrics_list:
+            if lyrics is not None and len(lyrics) > 0:
+                token_idx = self.tokenize_lyrics(lyrics, debug=debug)
+                mask = [1] * len(token_idx)
+            else:
+                token_idx = [0]
+                mask = [0]
+            token_lists.append(token_idx)
+            mask_lists.append(mask)
+        max_length = max(len(token_idx) for token_idx in token_lists)
+        lyric_token_idx = torch.tensor(
+            [token_idx + [0] * (max_length - len(token_idx)) for token_idx in token_lists]
+        ).to(self.device).long()
+        lyric_mask = torch.tensor(
+            [mask + [0] * (max_length - len(mask)) for mask in mask_lists]
+        ).to(self.device).long()
+        return lyric_token_idx, lyric_mask
+
+    def prepare_text_conditions(self, prompt, lyrics, batch_size=1, use_erg_tag=True, debug=False):
+        """Text/lyric preprocessing shared by every text2music-style task."""
+        # a list of prompts batches independent requests: one prompt (and lyric) per sample
+        is_batched_prompt = isinstance(prompt, (list, tuple))
+        texts = list(prompt) if is_batched_prompt else [prompt]
+        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(texts)
+        if not is_batched_prompt:
+            encoder_text_hidden_states = encoder_text_hidden_states.repeat(batch_size, 1, 1)
+            text_attention_mask = text_attention_mask.repeat(batch_size, 1)
+
+        encoder_text_hidden_states_null = None
+        if use_erg_tag:
+            encoder_text_hidden_states_null = self.get_text_embeddings_null(texts)
+            if not is_batched_prompt:
+                encoder_text_hidden_states_null = encoder_text_hidden_states_null.repeat(batch_size, 1, 1)
+
+        # not support for released checkpoint
+        speaker_embeds = torch.zeros(batch_size, 512).to(self.device).to(self.dtype)
+
+        # 6 lyric
+        lyric_token_idx = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
+        lyric_mask = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
+        if isinstance(lyrics, (list, tuple)):
+            lyric_token_idx, lyric_mask = self.tokenize_lyrics_batch(lyrics, debug=debug)
+        elif len(lyrics) > 0:
+            lyric_token_idx = self.tokenize_lyrics(lyrics, debug=debug)
+            lyric_mask = [1] * len(lyric_token_idx)
+            lyric_token_idx = (
+                torch.tensor(lyric_token_idx)
+                .unsqueeze(0)
+                .to(self.device)
+                .repeat(batch_size, 1)
+            )
+            lyric_mask = (
+                torch.tensor(lyric_mask)
+                .unsqueeze(0)
+                .to(self.device)
+                .repeat(batch_size, 1)
+            )
+        return (
+            encoder_text_hidden_states,
+            text_attention_mask,
+            encoder_text_hidden_states_null,
+            speaker_embeds,
+            lyric_token_idx,
+            lyric_mask,
+        )
+
     @cpu_offload("ace_step_transformer")
     def calc_v(
         self,
@@ -583,6 +684,8 @@ class ACEStepPipeline:
         n_max=1.0,
         n_avg=1,
         scheduler_type="euler",
+        cancellation_token=None,
+        progress_callback=None,
     ):
 
         do_classifier_free_guidance = True
@@ -661,6 +764,8 @@ class ACEStepPipeline:
 
             if i < n_min:
                 continue
+            check_cancelled(cancellation_token)
+            report_progress(progress_callback, DIFFUSION, i, T_steps)
 
             t_i = t / 1000
 
@@ -766,35 +871,196 @@ class ACEStepPipeline:
         target_latents = zt_edit if xt_tar is None else xt_tar
         return target_latents
 
-    def add_latents_noise(
-        self,
-        gt_latents,
-        sigma_max,
-        noise,
-        scheduler_type,
-        infer_steps,
-    ):
-
-        bsz = gt_latents.shape[0]
+    def build_scheduler(self, scheduler_type, **kwargs):
         if scheduler_type == "euler":
-            scheduler = FlowMatchEulerDiscreteScheduler(
+            return FlowMatchEulerDiscreteScheduler(
                 num_train_timesteps=1000,
                 shift=3.0,
-                sigma_max=sigma_max,
+                **kwargs,
             )
         elif scheduler_type == "heun":
-            scheduler = FlowMatchHeunDiscreteScheduler(
+            return FlowMatchHeunDiscreteScheduler(
                 num_train_timesteps=1000,
                 shift=3.0,
-                sigma_max=sigma_max,
+                **kwargs,
             )
         elif scheduler_type == "pingpong":
-            scheduler = FlowMatchPingPongScheduler(
+            return FlowMatchPingPongScheduler(
                 num_train_timesteps=1000,
                 shift=3.0,
-                sigma_max=sigma_max
+                **kwargs,
             )
 
+    def retrieve_inference_timesteps(self, scheduler, infer_steps, oss_steps=[]):
+        """Returns (timesteps, num_inference_steps, infer_steps) honoring optimal-step-size (oss) schedules."""
+        if len(oss_steps) > 0:
+            infer_steps = max(oss_steps)
+            timesteps, num_inference_steps = retrieve_timesteps(
+                scheduler,
+                num_inference_steps=infer_steps,
+                device=self.device,
+                timesteps=None,
+            )
+            new_timesteps = torch.zeros(len(oss_steps), dtype=self.dtype, device=self.device)
+            for idx in range(len(oss_steps)):
+                new_timesteps[idx] = timesteps[oss_steps[idx] - 1]
+            num_inference_steps = len(oss_steps)
+            sigmas = (new_timesteps / 1000).float().cpu().numpy()
+            timesteps, num_inference_steps = retrieve_timesteps(
+                scheduler,
+                num_inference_steps=num_inference_steps,
+                device=self.device,
+                sigmas=sigmas,
+            )
+            logger.info(
+                f"oss_steps: {oss_steps}, num_inference_steps: {num_inference_steps} after remapping to timesteps {timesteps}"
+            )
+        else:
+            timesteps, num_inference_steps = retrieve_timesteps(
+                scheduler,
+                num_inference_steps=infer_steps,
+                device=self.device,
+                timesteps=None,
+            )
+        return timesteps, num_inference_steps, infer_steps
+
+    def encode_with_temperature(self, inputs, tau=0.01, l_min=4, l_max=6):
+        handlers = []
+
+        def hook(module, input, output):
+            output[:] *= tau
+            return output
+
+        for i in range(l_min, l_max):
+            handler = self.ace_step_transformer.lyric_encoder.encoders[
+                i
+            ].self_attn.linear_q.register_forward_hook(hook)
+            handlers.append(handler)
+
+        encoder_hidden_states, encoder_hidden_mask = (
+            self.ace_step_transformer.encode(**inputs)
+        )
+
+        for hook in handlers:
+            hook.remove()
+
+        return encoder_hidden_states
+
+    def decode_with_temperature(
+        self, hidden_states, timestep, inputs, tau=0.01, l_min=15, l_max=20
+    ):
+        handlers = []
+
+        def hook(module, input, output):
+            output[:] *= tau
+            return output
+
+        for i in range(l_min, l_max):
+            handler = self.ace_step_transformer.transformer_blocks[
+                i
+            ].attn.to_q.register_forward_hook(hook)
+            handlers.append(handler)
+            handler = self.ace_step_transformer.transformer_blocks[
+                i
+            ].cross_attn.to_q.register_forward_hook(hook)
+            handlers.append(handler)
+
+        sample = self.ace_step_transformer.decode(
+            hidden_states=hidden_states, timestep=timestep, **inputs
+        ).sample
+
+        for hook in handlers:
+            hook.remove()
+
+        return sample
+
+    def encode_diffusion_conditions(
+        self,
+        encoder_text_hidden_states,
+        text_attention_mask,
+        speaker_embds,
+        lyric_token_ids,
+        lyric_mask,
+        encoder_text_hidden_states_null=None,
+        use_erg_lyric=False,
+        do_double_condition_guidance=False,
+    ):
+        """Encodes the conditional, unconditional and (optionally) text-only transformer conditions."""
+        # P(speaker, text, lyric)
+        encoder_hidden_states, encoder_hidden_mask = self.ace_step_transformer.encode(
+            encoder_text_hidden_states,
+            text_attention_mask,
+            speaker_embds,
+            lyric_token_ids,
+            lyric_mask,
+        )
+
+        if use_erg_lyric:
+            # P(null_speaker, text_weaker, lyric_weaker)
+            encoder_hidden_states_null = self.encode_with_temperature(
+                inputs={
+                    "encoder_text_hidden_states": (
+                        encoder_text_hidden_states_null
+                        if encoder_text_hidden_states_null is not None
+                        else torch.zeros_like(encoder_text_hidden_states)
+                    ),
+                    "text_attention_mask": text_attention_mask,
+                    "speaker_embeds": torch.zeros_like(speaker_embds),
+                    "lyric_token_idx": lyric_token_ids,
+                    "lyric_mask": lyric_mask,
+                },
+            )
+        else:
+            # P(null_speaker, null_text, null_lyric)
+            encoder_hidden_states_null, _ = self.ace_step_transformer.encode(
+                torch.zeros_like(encoder_text_hidden_states),
+                text_attention_mask,
+                torch.zeros_like(speaker_embds),
+                torch.zeros_like(lyric_token_ids),
+                lyric_mask,
+            )
+
+        encoder_hidden_states_no_lyric = None
+        if do_double_condition_guidance:
+            # P(null_speaker, text, lyric_weaker)
+            if use_erg_lyric:
+                encoder_hidden_states_no_lyric = self.encode_with_temperature(
+                    inputs={
+                        "encoder_text_hidden_states": encoder_text_hidden_states,
+                        "text_attention_mask": text_attention_mask,
+                        "speaker_embeds": torch.zeros_like(speaker_embds),
+                        "lyric_token_idx": lyric_token_ids,
+                        "lyric_mask": lyric_mask,
+                    },
+                )
+            # P(null_speaker, text, no_lyric)
+            else:
+                encoder_hidden_states_no_lyric, _ = self.ace_step_transformer.encode(
+                    encoder_text_hidden_states,
+                    text_attention_mask,
+                    torch.zeros_like(speaker_embds),
+                    torch.zeros_like(lyric_token_ids),
+                    lyric_mask,
+                )
+        return (
+            encoder_hidden_states,
+            encoder_hidden_mask,
+            encoder_hidden_states_null,
+            encoder_hidden_states_no_lyric,
+        )
+
+    def add_latents_noise(
+        self,
+        gt_latents,
+        sigma_max,
+        noise,
+        scheduler_type,
+        infer_steps,
+    ):
+
+        bsz = gt_latents.shape[0]
+        scheduler = self.build_scheduler(scheduler_type, sigma_max=sigma_max)
+
         infer_steps = int(sigma_max * infer_steps)
         timesteps, num_inference_steps = retrieve_timesteps(
             scheduler,
@@ -842,6 +1108,10 @@ class ACEStepPipeline:
         audio2audio_enable=False,
         ref_audio_strength=0.5,
         ref_latents=None,
+        should_preempt=None,
+        resume_state=None,
+        cancellation_token=None,
+        progress_callback=None,
     ):
 
         logger.info(
@@ -871,21 +1141,7 @@ class ACEStepPipeline:
 
         bsz = encoder_text_hidden_states.shape[0]
 
-        if scheduler_type == "euler":
-            scheduler = FlowMatchEulerDiscreteScheduler(
-                num_train_timesteps=1000,
-                shift=3.0,
-            )
-        elif scheduler_type == "heun":
-            scheduler = FlowMatchHeunDiscreteScheduler(
-                num_train_timesteps=1000,
-                shift=3.0,
-            )
-        elif scheduler_type == "pingpong":
-            scheduler = FlowMatchPingPongScheduler(
-                num_train_timesteps=1000,
-                shift=3.0,
-            )
+        scheduler = self.build_scheduler(scheduler_type)
 
         frame_length = int(duration * 44100 / 512 / 8)
         if src_latents is not None:
@@ -894,36 +1150,9 @@ class ACEStepPipeline:
         if ref_latents is not None:
             frame_length = ref_latents.shape[-1]
 
-        if len(oss_steps) > 0:
-            infer_steps = max(oss_steps)
-            scheduler.set_timesteps
-            timesteps, num_inference_steps = retrieve_timesteps(
-                scheduler,
-                num_inference_steps=infer_steps,
-                device=self.device,
-                timesteps=None,
-            )
-            new_timesteps = torch.zeros(len(oss_steps), dtype=self.dtype, device=self.device)
-            for idx in range(len(oss_steps)):
-                new_timesteps[idx] = timesteps[oss_steps[idx] - 1]
-            num_inference_steps = len(oss_steps)
-            sigmas = (new_timesteps / 1000).float().cpu().numpy()
-            timesteps, num_inference_steps = retrieve_timesteps(
-                scheduler,
-                num_inference_steps=num_inference_steps,
-                device=self.device,
-                sigmas=sigmas,
-            )
-            logger.info(
-                f"oss_steps: {oss_steps}, num_inference_steps: {num_inference_steps} after remapping to timesteps {timesteps}"
-            )
-        else:
-            timesteps, num_inference_steps = retrieve_timesteps(
-                scheduler,
-                num_inference_steps=infer_steps,
-                device=self.device,
-                timesteps=None,
-            )
+        timesteps, num_inference_steps, infer_steps = self.retrieve_inference_timesteps(
+            scheduler, infer_steps, oss_steps
+        )
 
         target_latents = randn_tensor(
             shape=(bsz, 8, 16, frame_length),
@@ -1075,117 +1304,54 @@ class ACEStepPipeline:
 
         momentum_buffer = MomentumBuffer()
 
-        def forward_encoder_with_temperature(self, inputs, tau=0.01, l_min=4, l_max=6):
-            handlers = []
-
-            def hook(module, input, output):
-                output[:] *= tau
-                return output
-
-            for i in range(l_min, l_max):
-                handler = self.ace_step_transformer.lyric_encoder.encoders[
-                    i
-                ].self_attn.linear_q.register_forward_hook(hook)
-                handlers.append(handler)
-
-            encoder_hidden_states, encoder_hidden_mask = (
-                self.ace_step_transformer.encode(**inputs)
-            )
-
-            for hook in handlers:
-                hook.remove()
-
-            return encoder_hidden_states
-
-        # P(speaker, text, lyric)
-        encoder_hidden_states, encoder_hidden_mask = self.ace_step_transformer.encode(
+        (
+            encoder_hidden_states,
+            encoder_hidden_mask,
+            encoder_hidden_states_null,
+            encoder_hidden_states_no_lyric,
+        ) = self.encode_diffusion_conditions(
             encoder_text_hidden_states,
             text_attention_mask,
             speaker_embds,
             lyric_token_ids,
             lyric_mask,
+            encoder_text_hidden_states_null=encoder_text_hidden_states_null,
+            use_erg_lyric=use_erg_lyric,
+            do_double_condition_guidance=do_double_condition_guidance,
         )
 
-        if use_erg_lyric:
-            # P(null_speaker, text_weaker, lyric_weaker)
-            encoder_hidden_states_null = forward_encoder_with_temperature(
-                self,
-                inputs={
-                    "encoder_text_hidden_states": (
-                        encoder_text_hidden_states_null
-                        if encoder_text_hidden_states_null is not None
-                        else torch.zeros_like(encoder_text_hidden_states)
-                    ),
-                    "text_attention_mask": text_attention_mask,
-                    "speaker_embeds": torch.zeros_like(speaker_embds),
-                    "lyric_token_idx": lyric_token_ids,
-                    "lyric_mask": lyric_mask,
-                },
-            )
-        else:
-            # P(null_speaker, null_text, null_lyric)
-            encoder_hidden_states_null, _ = self.ace_step_transformer.encode(
-                torch.zeros_like(encoder_text_hidden_states),
-                text_attention_mask,
-                torch.zeros_like(speaker_embds),
-                torch.zeros_like(lyric_token_ids),
-                lyric_mask,
+        resume_step = 0
+        if resume_state is not None:
+            target_latents = resume_state.restore(
+                self.device,
+                scheduler,
+                momentum_buffer,
+                random_generators=random_generators,
+                retake_random_generators=retake_random_generators,
             )
-
-        encoder_hidden_states_no_lyric = None
-        if do_double_condition_guidance:
-            # P(null_speaker, text, lyric_weaker)
-            if use_erg_lyric:
-                encoder_hidden_states_no_lyric = forward_encoder_with_temperature(
-                    self,
-                    inputs={
-                        "encoder_text_hidden_states": encoder_text_hidden_states,
-                        "text_attention_mask": text_attention_mask,
-                        "speaker_embeds": torch.zeros_like(speaker_embds),
-                        "lyric_token_idx": lyric_token_ids,
-                        "lyric_mask": lyric_mask,
-                    },
-                )
-            # P(null_speaker, text, no_lyric)
-            else:
-                encoder_hidden_states_no_lyric, _ = self.ace_step_transformer.encode(
-                    encoder_text_hidden_states,
-                    text_attention_mask,
-                    torch.zeros_like(speaker_embds),
-                    torch.zeros_like(lyric_token_ids),
-                    lyric_mask,
-                )
-
-        def forward_diffusion_with_temperature(
-            self, hidden_states, timestep, inputs, tau=0.01, l_min=15, l_max=20
-        ):
-            handlers = []
-
-            def hook(module, input, output):
-                output[:] *= tau
-                return output
-
-            for i in range(l_min, l_max):
-                handler = self.ace_step_transformer.transformer_blocks[
-                    i
-                ].attn.to_q.register_forward_hook(hook)
-                handlers.append(handler)
-                handler = self.ace_step_transformer.transformer_blocks[
-                    i
-                ].cross_attn.to_q.register_forward_hook(hook)
-                handlers.append(handler)
-
-            sample = self.ace_step_transformer.decode(
-                hidden_states=hidden_states, timestep=timestep, **inputs
-            ).sample
-
-            for hook in handlers:
-                hook.remove()
-
-            return sample
+            resume_step = resume_state.step_index
+            logger.info(f"resume diffusion from step {resume_step}")
 
         for i, t in tqdm(enumerate(timesteps), total=num_inference_steps):
 
+            if i < resume_step:
+                continue
+            check_cancelled(cancellation_token)
+            # pause at a step boundary (at least one step is run per call so preemption always makes progress)
+            if should_preempt is not None and i > resume_step and should_preempt():
+                logger.info(f"diffusion preempted at step {i}")
+                raise GenerationPreempted(
+                    DiffusionSnapshot.capture(
+                        i,
+                        target_latents,
+                        scheduler,
+                        momentum_buffer,
+                        random_generators=random_generators,
+                        retake_random_generators=retake_random_generators,
+                    )
+                )
+            report_progress(progress_callback, DIFFUSION, i, num_inference_steps)
+
             if is_repaint:
                 if i < n_min:
                     continue
@@ -1243,8 +1409,7 @@ class ACEStepPipeline:
                     ).sample
 
                 if use_erg_diffusion:
-                    noise_pred_uncond = forward_diffusion_with_temperature(
-                        self,
+                    noise_pred_uncond = self.decode_with_temperature(
                         hidden_states=latent_model_input,
                         timestep=timestep,
                         inputs={
@@ -1354,6 +1519,8 @@ class ACEStepPipeline:
         save_path=None,
         format="wav",
         return_audio_data=False,
+        cancellation_token=None,
+        progress_callback=None,
     ):
         output_audio_paths = []
         audio_data_list = []
@@ -1361,9 +1528,19 @@ class ACEStepPipeline:
         pred_latents = latents
         with torch.no_grad():
             if self.overlapped_decode and target_wav_duration_second > 48:
-                _, pred_wavs = self.music_dcae.decode_overlap(pred_latents, sr=sample_rate)
+                _, pred_wavs = self.music_dcae.decode_overlap(
+                    pred_latents,
+                    sr=sample_rate,
+                    cancellation_token=cancellation_token,
+                    progress_callback=progress_callback,
+                )
             else:
-                _, pred_wavs = self.music_dcae.decode(pred_latents, sr=sample_rate)
+                _, pred_wavs = self.music_dcae.decode(
+                    pred_latents,
+                    sr=sample_rate,
+                    cancellation_token=cancellation_token,
+                    progress_callback=progress_callback,
+                )
         pred_wavs = [pred_wav.cpu().float() for pred_wav in pred_wavs]
         
         if return_audio_data:
@@ -1417,15 +1594,23 @@ class ACEStepPipeline:
         return output_path_wav
 
     @cpu_offload("music_dcae")
-    def infer_latents(self, input_audio_path):
+    def infer_latents(self, input_audio_path, offset=0.0, duration=None):
         if input_audio_path is None:
             return None
-        input_audio, sr = self.music_dcae.load_audio(input_audio_path)
+        input_audio, sr = self.music_dcae.load_audio(input_audio_path, offset=offset, duration=duration)
         input_audio = input_audio.unsqueeze(0)
         input_audio = input_audio.to(device=self.device, dtype=self.dtype)
         latents, _ = self.music_dcae.encode(input_audio, sr=sr)
         return latents
 
+    def ensure_loaded(self):
+        if not self.loaded:
+            logger.warning("Checkpoint not loaded, loading checkpoint...")
+            if self.quantized:
+                self.load_quantized_checkpoint(self.checkpoint_dir)
+            else:
+                self.load_checkpoint(self.checkpoint_dir)
+
     def load_lora(self, lora_name_or_path, lora_weight):
         if (lora_name_or_path != self.lora_path or lora_weight != self.lora_weight) and lora_name_or_path != "none":
             if not os.path.exists(lora_name_or_path):
@@ -1483,83 +1668,170 @@ class ACEStepPipeline:
         save_path: str = None,
         batch_size: int = 1,
         return_audio_data: bool = False,
+        should_preempt=None,
+        resume_state: DiffusionSnapshot = None,
+        cancellation_token=None,
+        progress_callback=None,
         debug: bool = False,
     ):
+        params = {name: value for name, value in locals().items() if name != "self"}
+        plan = self.prepare_generation(**params)
+        target_latents = self.diffuse_generation(plan)
+        return self.decode_generation(plan, target_latents)
+
+    def prepare_generation(self, **kwargs) -> GenerationPlan:
+        """First stage of ``__call__``: seeds and text/lyric conditioning.
+
+        Accepts the keyword arguments of ``__call__`` (missing ones take its
+        defaults). Lyric tokenization is CPU bound, so a serving loop can run
+        this for the next request while another one is diffusing.
+        """
+        bound = inspect.signature(self.__call__).bind(**kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
 
         start_time = time.time()
 
-        if audio2audio_enable and ref_audio_input is not None:
-            task = "audio2audio"
+        if params["audio2audio_enable"] and params["ref_audio_input"] is not None:
+            params["task"] = "audio2audio"
+        task = params["task"]
 
-        if not self.loaded:
-            logger.warning("Checkpoint not loaded, loading checkpoint...")
-            if self.quantized:
-                self.load_quantized_checkpoint(self.checkpoint_dir)
-            else:
-                self.load_checkpoint(self.checkpoint_dir)
-
-        self.load_lora(lora_name_or_path, lora_weight)
+        self.ensure_loaded()
         load_model_cost = time.time() - start_time
         logger.info(f"Model loaded in {load_model_cost:.2f} seconds.")
 
         start_time = time.time()
 
-        random_generators, actual_seeds = self.set_seeds(batch_size, manual_seeds)
+        prompt = params["prompt"]
+        batch_size = params["batch_size"]
+        if isinstance(prompt, (list, tuple)):
+            batch_size = params["batch_size"] = len(prompt)
+
+        resume_state = params["resume_state"]
+        if resume_state is not None:
+            # a resumed generation must reuse the seeds and duration of the preempted run
+            params["manual_seeds"] = resume_state.actual_seeds
+            params["retake_seeds"] = resume_state.retake_seeds
+            params["audio_duration"] = resume_state.audio_duration
+
+        random_generators, actual_seeds = self.set_seeds(batch_size, params["manual_seeds"])
         retake_random_generators, actual_retake_seeds = self.set_seeds(
-            batch_size, retake_seeds
+            batch_size, params["retake_seeds"]
         )
 
+        oss_steps = params["oss_steps"]
         if isinstance(oss_steps, str) and len(oss_steps) > 0:
-            oss_steps = list(map(int, oss_steps.split(",")))
+            params["oss_steps"] = list(map(int, oss_steps.split(",")))
         else:
-            oss_steps = []
+            params["oss_steps"] = []
+
+        report_progress(params["progress_callback"], TEXT_ENCODING)
+        text_conditions = self.prepare_text_conditions(
+            prompt,
+            params["lyrics"],
+            batch_size=batch_size,
+            use_erg_tag=params["use_erg_tag"],
+            debug=params["debug"],
+        )
 
-        texts = [prompt]
-        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(texts)
-        encoder_text_hidden_states = encoder_text_hidden_states.repeat(batch_size, 1, 1)
-        text_attention_mask = text_attention_mask.repeat(batch_size, 1)
+        # audio2audio keeps the reference length when no duration is requested
+        audio_duration = params["audio_duration"]
+        ref_audio_duration = audio_duration if audio_duration > 0 else None
+        if audio_duration <= 0:
+            audio_duration = params["audio_duration"] = random.uniform(30.0, 240.0)
+            logger.info(f"random audio duration: {audio_duration}")
 
-        encoder_text_hidden_states_null = None
-        if use_erg_tag:
-            encoder_text_hidden_states_null = self.get_text_embeddings_null(texts)
-            encoder_text_hidden_states_null = encoder_text_hidden_states_null.repeat(batch_size, 1, 1)
+        # retake equal to repaint
+        if task == "retake":
+            params["repaint_start"] = 0
+            params["repaint_end"] = audio_duration
 
-        # not support for released checkpoint
-        speaker_embeds = torch.zeros(batch_size, 512).to(self.device).to(self.dtype)
+        target_text_conditions = None
+        if task == "edit":
+            target_text_conditions = self.prepare_edit_target_conditions(
+                params["edit_target_prompt"], params["edit_target_lyrics"], batch_size
+            )
 
-        # 6 lyric
-        lyric_token_idx = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-        lyric_mask = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-        if len(lyrics) > 0:
-            lyric_token_idx = self.tokenize_lyrics(lyrics, debug=debug)
-            lyric_mask = [1] * len(lyric_token_idx)
-            lyric_token_idx = (
-                torch.tensor(lyric_token_idx)
+        return GenerationPlan(
+            params=params,
+            random_generators=random_generators,
+            actual_seeds=actual_seeds,
+            retake_random_generators=retake_random_generators,
+            actual_retake_seeds=actual_retake_seeds,
+            text_conditions=text_conditions,
+            target_text_conditions=target_text_conditions,
+            ref_audio_duration=ref_audio_duration,
+            timecosts={"preprocess": time.time() - start_time},
+        )
+
+    def prepare_edit_target_conditions(self, edit_target_prompt, edit_target_lyrics, batch_size):
+        """Text/lyric conditioning of the edit target (``task="edit"``)."""
+        texts = [edit_target_prompt]
+        target_encoder_text_hidden_states, target_text_attention_mask = (
+            self.get_text_embeddings(texts)
+        )
+        target_encoder_text_hidden_states = (
+            target_encoder_text_hidden_states.repeat(batch_size, 1, 1)
+        )
+        target_text_attention_mask = target_text_attention_mask.repeat(
+            batch_size, 1
+        )
+
+        target_lyric_token_idx = (
+            torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
+        )
+        target_lyric_mask = (
+            torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
+        )
+        if len(edit_target_lyrics) > 0:
+            target_lyric_token_idx = self.tokenize_lyrics(
+                edit_target_lyrics, debug=True
+            )
+            target_lyric_mask = [1] * len(target_lyric_token_idx)
+            target_lyric_token_idx = (
+                torch.tensor(target_lyric_token_idx)
                 .unsqueeze(0)
                 .to(self.device)
                 .repeat(batch_size, 1)
             )
-            lyric_mask = (
-                torch.tensor(lyric_mask)
+            target_lyric_mask = (
+                torch.tensor(target_lyric_mask)
                 .unsqueeze(0)
                 .to(self.device)
                 .repeat(batch_size, 1)
             )
+        return (
+            target_encoder_text_hidden_states,
+            target_text_attention_mask,
+            target_lyric_token_idx,
+            target_lyric_mask,
+        )
 
-        if audio_duration <= 0:
-            audio_duration = random.uniform(30.0, 240.0)
-            logger.info(f"random audio duration: {audio_duration}")
+    def diffuse_generation(self, plan: GenerationPlan):
+        """Second stage of ``__call__``: LoRA, reference latents and the diffusion loop.
+
+        Only this stage runs the transformer, so it must not run concurrently
+        with itself on the same pipeline.
+        """
+        params = plan.params
+        task = params["task"]
 
-        end_time = time.time()
-        preprocess_time_cost = end_time - start_time
-        start_time = end_time
+        self.load_lora(params["lora_name_or_path"], params["lora_weight"])
+
+        start_time = time.time()
+
+        (
+            encoder_text_hidden_states,
+            text_attention_mask,
+            encoder_text_hidden_states_null,
+            speaker_embeds,
+            lyric_token_idx,
+            lyric_mask,
+        ) = plan.text_conditions
 
         add_retake_noise = task in ("retake", "repaint", "extend")
-        # retake equal to repaint
-        if task == "retake":
-            repaint_start = 0
-            repaint_end = audio_duration
 
+        src_audio_path = params["src_audio_path"]
         src_latents = None
         if src_audio_path is not None:
             assert src_audio_path is not None and task in (
@@ -1571,50 +1843,27 @@ class ACEStepPipeline:
                 src_audio_path
             ), f"src_audio_path {src_audio_path} does not exist"
             src_latents = self.infer_latents(src_audio_path)
-        
+
+        ref_audio_input = params["ref_audio_input"]
+        audio2audio_enable = params["audio2audio_enable"]
         ref_latents = None
         if ref_audio_input is not None and audio2audio_enable:
             assert ref_audio_input is not None, "ref_audio_input is required for audio2audio task"
-            assert os.path.exists(
+            # ref_audio_input may also be an already-uploaded file object (decoded without a temp file)
+            assert not isinstance(ref_audio_input, str) or os.path.exists(
                 ref_audio_input
             ), f"ref_audio_input {ref_audio_input} does not exist"
-            ref_latents = self.infer_latents(ref_audio_input)
+            # the output is as long as the reference latents, so only the first
+            # audio_duration seconds of the reference are decoded and encoded
+            ref_latents = self.infer_latents(ref_audio_input, duration=plan.ref_audio_duration)
 
         if task == "edit":
-            texts = [edit_target_prompt]
-            target_encoder_text_hidden_states, target_text_attention_mask = (
-                self.get_text_embeddings(texts)
-            )
-            target_encoder_text_hidden_states = (
-                target_encoder_text_hidden_states.repeat(batch_size, 1, 1)
-            )
-            target_text_attention_mask = target_text_attention_mask.repeat(
-                batch_size, 1
-            )
-
-            target_lyric_token_idx = (
-                torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-            )
-            target_lyric_mask = (
-                torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-            )
-            if len(edit_target_lyrics) > 0:
-                target_lyric_token_idx = self.tokenize_lyrics(
-                    edit_target_lyrics, debug=True
-                )
-                target_lyric_mask = [1] * len(target_lyric_token_idx)
-                target_lyric_token_idx = (
-                    torch.tensor(target_lyric_token_idx)
-                    .unsqueeze(0)
-                    .to(self.device)
-                    .repeat(batch_size, 1)
-                )
-                target_lyric_mask = (
-                    torch.tensor(target_lyric_mask)
-                    .unsqueeze(0)
-                    .to(self.device)
-                    .repeat(batch_size, 1)
-                )
+            (
+                target_encoder_text_hidden_states,
+                target_text_attention_mask,
+                target_lyric_token_idx,
+                target_lyric_mask,
+            ) = plan.target_text_conditions
 
             target_speaker_embeds = speaker_embeds.clone()
 
@@ -1630,114 +1879,153 @@ class ACEStepPipeline:
                 target_lyric_token_ids=target_lyric_token_idx,
                 target_lyric_mask=target_lyric_mask,
                 src_latents=src_latents,
-                random_generators=retake_random_generators,  # more diversity
-                infer_steps=infer_step,
-                guidance_scale=guidance_scale,
-                n_min=edit_n_min,
-                n_max=edit_n_max,
-                n_avg=edit_n_avg,
-                scheduler_type=scheduler_type,
+                random_generators=plan.retake_random_generators,  # more diversity
+                infer_steps=params["infer_step"],
+                guidance_scale=params["guidance_scale"],
+                n_min=params["edit_n_min"],
+                n_max=params["edit_n_max"],
+                n_avg=params["edit_n_avg"],
+                scheduler_type=params["scheduler_type"],
+                cancellation_token=params["cancellation_token"],
+                progress_callback=params["progress_callback"],
             )
         else:
-            target_latents = self.text2music_diffusion_process(
-                duration=audio_duration,
-                encoder_text_hidden_states=encoder_text_hidden_states,
-                text_attention_mask=text_attention_mask,
-                speaker_embds=speaker_embeds,
-                lyric_token_ids=lyric_token_idx,
-                lyric_mask=lyric_mask,
-                guidance_scale=guidance_scale,
-                omega_scale=omega_scale,
-                infer_steps=infer_step,
-                random_generators=random_generators,
-                scheduler_type=scheduler_type,
-                cfg_type=cfg_type,
-                guidance_interval=guidance_interval,
-                guidance_interval_decay=guidance_interval_decay,
-                min_guidance_scale=min_guidance_scale,
-                oss_steps=oss_steps,
-                encoder_text_hidden_states_null=encoder_text_hidden_states_null,
-                use_erg_lyric=use_erg_lyric,
-                use_erg_diffusion=use_erg_diffusion,
-                retake_random_generators=retake_random_generators,
-                retake_variance=retake_variance,
-                add_retake_noise=add_retake_noise,
-                guidance_scale_text=guidance_scale_text,
-                guidance_scale_lyric=guidance_scale_lyric,
-                repaint_start=repaint_start,
-                repaint_end=repaint_end,
-                src_latents=src_latents,
-                audio2audio_enable=audio2audio_enable,
-                ref_audio_strength=ref_audio_strength,
-                ref_latents=ref_latents,
-            )
+            try:
+                target_latents = self.text2music_diffusion_process(
+                    duration=params["audio_duration"],
+                    encoder_text_hidden_states=encoder_text_hidden_states,
+                    text_attention_mask=text_attention_mask,
+                    speaker_embds=speaker_embeds,
+                    lyric_token_ids=lyric_token_idx,
+                    lyric_mask=lyric_mask,
+                    guidance_scale=params["guidance_scale"],
+                    omega_scale=params["omega_scale"],
+                    infer_steps=params["infer_step"],
+                    random_generators=plan.random_generators,
+                    scheduler_type=params["scheduler_type"],
+                    cfg_type=params["cfg_type"],
+                    guidance_interval=params["guidance_interval"],
+                    guidance_interval_decay=params["guidance_interval_decay"],
+                    min_guidance_scale=params["min_guidance_scale"],
+                    oss_steps=params["oss_steps"],
+                    encoder_text_hidden_states_null=encoder_text_hidden_states_null,
+                    use_erg_lyric=params["use_erg_lyric"],
+                    use_erg_diffusion=params["use_erg_diffusion"],
+                    retake_random_generators=plan.retake_random_generators,
+                    retake_variance=params["retake_variance"],
+                    add_retake_noise=add_retake_noise,
+                    guidance_scale_text=params["guidance_scale_text"],
+                    guidance_scale_lyric=params["guidance_scale_lyric"],
+                    repaint_start=params["repaint_start"],
+                    repaint_end=params["repaint_end"],
+                    src_latents=src_latents,
+                    audio2audio_enable=audio2audio_enable,
+                    ref_audio_strength=params["ref_audio_strength"],
+                    ref_latents=ref_latents,
+                    should_preempt=params["should_preempt"],
+                    resume_state=params["resume_state"],
+                    cancellation_token=params["cancellation_token"],
+                    progress_callback=params["progress_callback"],
+                )
+            except GenerationPreempted as e:
+                e.snapshot.actual_seeds = plan.actual_seeds
+                e.snapshot.retake_seeds = plan.actual_retake_seeds
+                e.snapshot.audio_duration = params["audio_duration"]
+                raise
+
+        plan.timecosts["diffusion"] = time.time() - start_time
+        return target_latents
+
+    def decode_generation(self, plan: GenerationPlan, target_latents):
+        """Last stage of ``__call__``: VAE decode, saving and the input parameters of each output."""
+        params = plan.params
+        task = params["task"]
+        format = params["format"]
+        prompt = params["prompt"]
+        lyrics = params["lyrics"]
+        audio_duration = params["audio_duration"]
+        return_audio_data = params["return_audio_data"]
+        ref_audio_input = params["ref_audio_input"]
 
-        end_time = time.time()
-        diffusion_time_cost = end_time - start_time
-        start_time = end_time
+        start_time = time.time()
 
         output_paths = self.latents2audio(
             latents=target_latents,
             target_wav_duration_second=audio_duration,
-            save_path=save_path,
+            save_path=params["save_path"],
             format=format,
             return_audio_data=return_audio_data,
+            cancellation_token=params["cancellation_token"],
+            progress_callback=params["progress_callback"],
         )
 
         # Clean up memory after generation
         self.cleanup_memory()
 
-        end_time = time.time()
-        latent2audio_time_cost = end_time - start_time
-        timecosts = {
-            "preprocess": preprocess_time_cost,
-            "diffusion": diffusion_time_cost,
-            "latent2audio": latent2audio_time_cost,
-        }
+        plan.timecosts["latent2audio"] = time.time() - start_time
+        timecosts = plan.timecosts
+        actual_seeds = plan.actual_seeds
+        actual_retake_seeds = plan.actual_retake_seeds
 
         input_params_json = {
             "format": format,
-            "lora_name_or_path": lora_name_or_path,
-            "lora_weight": lora_weight,
+            "lora_name_or_path": params["lora_name_or_path"],
+            "lora_weight": params["lora_weight"],
             "task": task,
-            "prompt": prompt if task != "edit" else edit_target_prompt,
-            "lyrics": lyrics if task != "edit" else edit_target_lyrics,
+            "prompt": prompt if task != "edit" else params["edit_target_prompt"],
+            "lyrics": lyrics if task != "edit" else params["edit_target_lyrics"],
             "audio_duration": audio_duration,
-            "infer_step": infer_step,
-            "guidance_scale": guidance_scale,
-            "scheduler_type": scheduler_type,
-            "cfg_type": cfg_type,
-            "omega_scale": omega_scale,
-            "guidance_interval": guidance_interval,
-            "guidance_interval_decay": guidance_interval_decay,
-            "min_guidance_scale": min_guidance_scale,
-            "use_erg_tag": use_erg_tag,
-            "use_erg_lyric": use_erg_lyric,
-            "use_erg_diffusion": use_erg_diffusion,
-            "oss_steps": oss_steps,
+            "infer_step": params["infer_step"],
+            "guidance_scale": params["guidance_scale"],
+            "scheduler_type": params["scheduler_type"],
+            "cfg_type": params["cfg_type"],
+            "omega_scale": params["omega_scale"],
+            "guidance_interval": params["guidance_interval"],
+            "guidance_interval_decay": params["guidance_interval_decay"],
+            "min_guidance_scale": params["min_guidance_scale"],
+            "use_erg_tag": params["use_erg_tag"],
+            "use_erg_lyric": params["use_erg_lyric"],
+            "use_erg_diffusion": params["use_erg_diffusion"],
+            "oss_steps": params["oss_steps"],
             "timecosts": timecosts,
             "actual_seeds": actual_seeds,
             "retake_seeds": actual_retake_seeds,
-            "retake_variance": retake_variance,
-            "guidance_scale_text": guidance_scale_text,
-            "guidance_scale_lyric": guidance_scale_lyric,
-            "repaint_start": repaint_start,
-            "repaint_end": repaint_end,
-            "edit_n_min": edit_n_min,
-            "edit_n_max": edit_n_max,
-            "edit_n_avg": edit_n_avg,
-            "src_audio_path": src_audio_path,
-            "edit_target_prompt": edit_target_prompt,
-            "edit_target_lyrics": edit_target_lyrics,
-            "audio2audio_enable": audio2audio_enable,
-            "ref_audio_strength": ref_audio_strength,
-            "ref_audio_input": ref_audio_input,
+            "retake_variance": params["retake_variance"],
+            "guidance_scale_text": params["guidance_scale_text"],
+            "guidance_scale_lyric": params["guidance_scale_lyric"],
+            "repaint_start": params["repaint_start"],
+            "repaint_end": params["repaint_end"],
+            "edit_n_min": params["edit_n_min"],
+            "edit_n_max": params["edit_n_max"],
+            "edit_n_avg": params["edit_n_avg"],
+            "src_audio_path": params["src_audio_path"],
+            "edit_target_prompt": params["edit_target_prompt"],
+            "edit_target_lyrics": params["edit_target_lyrics"],
+            "audio2audio_enable": params["audio2audio_enable"],
+            "ref_audio_strength": params["ref_audio_strength"],
+            "ref_audio_input": (
+                ref_audio_input
+                if ref_audio_input is None or isinstance(ref_audio_input, str)
+                else repr(ref_audio_input)
+            ),
         }
 
         if return_audio_data:
             # Return audio data directly without saving JSON files
-            for audio_data in output_paths:
-                audio_data['input_params'] = input_params_json
+            for i, audio_data in enumerate(output_paths):
+                if isinstance(prompt, (list, tuple)):
+                    # batched requests: report the parameters of each sample separately
+                    audio_data['input_params'] = {
+                        **input_params_json,
+                        "prompt": prompt[i],
+                        "lyrics": lyrics[i] if isinstance(lyrics, (list, tuple)) else lyrics,
+                        "actual_seeds": [actual_seeds[i]],
+                        "retake_seeds": [actual_retake_seeds[i]],
+                        "batch_size": params["batch_size"],
+                        "batch_index": i,
+                    }
+                else:
+                    audio_data['input_params'] = input_params_json
             return output_paths
         else:
             # Save input_params_json for each output file
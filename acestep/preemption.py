@@ -0,0 +1,104 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Step-boundary preemption for the diffusion loop.
+
+`text2music_diffusion_process` polls a `should_preempt` callback before each
+step. When it returns True, the loop raises `GenerationPreempted` carrying a
+`DiffusionSnapshot` with everything needed to continue later: the latents, the
+index of the next step, the scheduler's mutable state, the APG momentum buffer
+and the random generator states, all copied to host memory. Passing the snapshot
+back as `resume_state` rebuilds the deterministic setup (text conditions, sigmas)
+and continues from the same step, producing the same output as an
+uninterrupted run.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import torch
+
+from acestep.apg_guidance import MomentumBuffer
+
+
+# mutable per-run attributes of the flow-matching schedulers (euler / heun / pingpong)
+_SCHEDULER_STATE_ATTRS = ("_step_index", "_begin_index", "prev_derivative", "dt", "sample")
+
+
+def _to_host(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    return value
+
+
+def _to_device(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    return value
+
+
+@dataclass
+class DiffusionSnapshot:
+    step_index: int
+    target_latents: torch.Tensor
+    scheduler_state: Dict[str, Any] = field(default_factory=dict)
+    momentum_running_average: Any = 0
+    generator_states: List[torch.Tensor] = field(default_factory=list)
+    retake_generator_states: List[torch.Tensor] = field(default_factory=list)
+    # filled in by ACEStepPipeline.__call__ so a resumed call reuses the same seeds and duration
+    actual_seeds: Optional[List[int]] = None
+    retake_seeds: Optional[List[int]] = None
+    audio_duration: Optional[float] = None
+
+    @classmethod
+    def capture(
+        cls,
+        step_index,
+        target_latents,
+        scheduler,
+        momentum_buffer: MomentumBuffer,
+        random_generators=None,
+        retake_random_generators=None,
+    ) -> "DiffusionSnapshot":
+        return cls(
+            step_index=step_index,
+            target_latents=_to_host(target_latents),
+            scheduler_state={
+                attr: _to_host(getattr(scheduler, attr))
+                for attr in _SCHEDULER_STATE_ATTRS
+                if hasattr(scheduler, attr)
+            },
+            momentum_running_average=_to_host(momentum_buffer.running_average),
+            generator_states=[g.get_state() for g in random_generators or []],
+            retake_generator_states=[g.get_state() for g in retake_random_generators or []],
+        )
+
+    def restore(
+        self,
+        device,
+        scheduler,
+        momentum_buffer: MomentumBuffer,
+        random_generators=None,
+        retake_random_generators=None,
+    ) -> torch.Tensor:
+        """Restores scheduler, momentum and generator state in place and returns the latents on `device`."""
+        for attr, value in self.scheduler_state.items():
+            setattr(scheduler, attr, _to_device(value, device))
+        momentum_buffer.running_average = _to_device(self.momentum_running_average, device)
+        for generator, state in zip(random_generators or [], self.generator_states):
+            generator.set_state(state)
+        for generator, state in zip(retake_random_generators or [], self.retake_generator_states):
+            generator.set_state(state)
+        return self.target_latents.to(device)
+
+
+class GenerationPreempted(Exception):
+    """Raised at a step boundary when the caller asked the diffusion loop to pause."""
+
+    def __init__(self, snapshot: DiffusionSnapshot):
+        super().__init__(f"generation preempted at step {snapshot.step_index}")
+        self.snapshot = snapshot
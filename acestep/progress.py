@@ -0,0 +1,32 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Progress hook for long-running generations.
+
+The pipeline calls `report_progress(callback, stage, step, total)` when it
+enters a stage and after each diffusion step / decode window. Without a
+callback the hook is a single `None` check, so it costs nothing when unused.
+The callback runs on the generation thread and must return quickly (e.g. hand
+the event over to another thread).
+"""
+
+from typing import Callable, Optional
+
+TEXT_ENCODING = "text_encoding"
+DIFFUSION = "diffusion"
+DCAE_DECODE = "dcae_decode"
+VOCODER = "vocoder"
+
+# callback(stage, step, total): `step` of `total` units of the stage are done
+ProgressCallback = Callable[[str, Optional[int], Optional[int]], None]
+
+
+def report_progress(
+    callback: Optional[ProgressCallback], stage: str, step: Optional[int] = None, total: Optional[int] = None
+):
+    if callback is not None:
+        callback(stage, step, total)
@@ -0,0 +1,118 @@
+"""
+混雑時の品質引き下げ（acestep.api.degradation）のシミュレーション
+
+GPU1台の待ち行列を離散イベントで模擬し、品質引き下げの有無でレイテンシ
+（投入から完了まで）の分布を比較する。処理時間は CostModel の初期係数による見積もりを使う。
+GPUやモデルは使用しない。
+
+使い方:
+    python benchmarks/degradation_simulation.py --jobs 2000 --load 1.2
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+from collections import deque
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from acestep.api.degradation import DegradationConfig, DegradationPolicy, ThroughputMeter
+from acestep.api.policy import CostModel
+
+# (audio_duration, infer_step, 割合)
+REQUEST_MIX = [
+    (30.0, 60, 0.5),
+    (60.0, 60, 0.3),
+    (120.0, 60, 0.15),
+    (240.0, 100, 0.05),
+]
+
+
+def make_request(rng: random.Random):
+    r = rng.random()
+    for duration, steps, weight in REQUEST_MIX:
+        if r < weight:
+            break
+        r -= weight
+    return SimpleNamespace(
+        audio_duration=duration,
+        infer_step=steps,
+        oss_steps=None,
+        guidance_scale=15.0,
+        guidance_scale_text=0.0,
+        guidance_scale_lyric=0.0,
+        guidance_interval=0.5,
+        use_erg_tag=True,
+        use_erg_lyric=False,
+        use_erg_diffusion=True,
+    )
+
+
+def simulate(num_jobs: int, load: float, seed: int, degrade: bool, config: DegradationConfig):
+    rng = random.Random(seed)
+    cost_model = CostModel()
+    requests = [make_request(rng) for _ in range(num_jobs)]
+    mean_service = statistics.mean(cost_model.estimate(r) for r in requests)
+    arrival_rate = load / mean_service
+
+    arrivals = []
+    t = 0.0
+    for request in requests:
+        t += rng.expovariate(arrival_rate)
+        arrivals.append((t, request))
+
+    policy = DegradationPolicy(config, ThroughputMeter(config.throughput_window_seconds))
+    queue = deque()
+    latencies = []
+    steps_served = []
+    degraded = 0
+    now = 0.0
+    i = 0
+    while i < len(arrivals) or queue:
+        if not queue:
+            now = max(now, arrivals[i][0])
+        while i < len(arrivals) and arrivals[i][0] <= now:
+            queue.append(arrivals[i])
+            i += 1
+        arrived_at, request = queue.popleft()
+        if degrade and policy.apply(request, len(queue), now=now) is not None:
+            degraded += 1
+        now += cost_model.estimate(request)
+        policy.meter.record(now=now)
+        latencies.append(now - arrived_at)
+        steps_served.append(len(request.oss_steps.split(",")) if request.oss_steps else request.infer_step)
+    return latencies, steps_served, degraded
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(label, latencies, steps_served, degraded):
+    print(f"[{label}]")
+    print(
+        f"  latency  p50={percentile(latencies, 0.50):8.1f}s p95={percentile(latencies, 0.95):8.1f}s "
+        f"p99={percentile(latencies, 0.99):8.1f}s max={max(latencies):8.1f}s"
+    )
+    print(f"  mean diffusion steps served={statistics.mean(steps_served):.1f} degraded jobs={degraded}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue-pressure degradation simulation")
+    parser.add_argument("--jobs", type=int, default=2000, help="Number of simulated requests")
+    parser.add_argument("--load", type=float, default=1.2, help="Offered load relative to full-quality capacity")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = DegradationConfig.from_env()
+    print(f"offered load={args.load:.2f}, thresholds: depths={config.queue_depths} wait={config.wait_seconds}")
+    report("no degradation", *simulate(args.jobs, args.load, args.seed, False, config))
+    report("degradation (all requests opt in)", *simulate(args.jobs, args.load, args.seed, True, config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+GPUジョブスケジューラのディスパッチ遅延ベンチマーク
+
+旧実装（queue.Queue を 100ms 間隔でポーリングする background_worker）と
+GPUJobScheduler を比較し、以下を計測する:
+  - submit から処理開始までの遅延（アイドル状態のサーバーに投入した場合）
+  - 連続ジョブ間の空き時間（前のジョブ完了から次のジョブ開始まで）
+
+GPUは使用せず、time.sleep でジョブ実行時間を模擬する。
+
+使い方:
+    python benchmarks/scheduler_latency.py --jobs 50 --job-ms 20
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from acestep.api.scheduler import GPUJobScheduler
+
+
+class DummyJob:
+    def __init__(self, job_seconds: float):
+        self.job_seconds = job_seconds
+        self.submitted_at = 0.0
+        self.started_at = 0.0
+        self.finished_at = 0.0
+
+
+def run_job(job: DummyJob):
+    job.started_at = time.perf_counter()
+    time.sleep(job.job_seconds)
+    job.finished_at = time.perf_counter()
+
+
+async def legacy_worker(request_queue: Queue, executor: ThreadPoolExecutor):
+    """旧 background_worker と同じポーリングループ"""
+    while True:
+        if not request_queue.empty():
+            job = request_queue.get()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(executor, run_job, job)
+        await asyncio.sleep(0.1)
+
+
+def summarize(label: str, values_ms):
+    values_ms = sorted(values_ms)
+    p95 = values_ms[min(len(values_ms) - 1, int(len(values_ms) * 0.95))]
+    print(
+        f"  {label:<28} mean={statistics.mean(values_ms):7.2f}ms "
+        f"p50={statistics.median(values_ms):7.2f}ms p95={p95:7.2f}ms max={values_ms[-1]:7.2f}ms"
+    )
+
+
+async def bench_legacy(num_jobs: int, job_seconds: float, idle_probes: int):
+    executor = ThreadPoolExecutor(max_workers=1)
+    request_queue = Queue()
+    task = asyncio.create_task(legacy_worker(request_queue, executor))
+
+    # アイドル状態への投入
+    idle = []
+    for _ in range(idle_probes):
+        job = DummyJob(0.0)
+        job.submitted_at = time.perf_counter()
+        request_queue.put(job)
+        while job.finished_at == 0.0:
+            await asyncio.sleep(0.001)
+        idle.append((job.started_at - job.submitted_at) * 1000)
+        await asyncio.sleep(0.037)  # ポーリング周期とずらす
+
+    # 連続投入
+    jobs = [DummyJob(job_seconds) for _ in range(num_jobs)]
+    for job in jobs:
+        job.submitted_at = time.perf_counter()
+        request_queue.put(job)
+    while jobs[-1].finished_at == 0.0:
+        await asyncio.sleep(0.005)
+
+    task.cancel()
+    executor.shutdown()
+    return idle, jobs
+
+
+async def bench_scheduler(num_jobs: int, job_seconds: float, idle_probes: int):
+    executor = ThreadPoolExecutor(max_workers=1)
+    scheduler = GPUJobScheduler(executor=executor, runner=run_job, num_workers=1)
+    scheduler.start()
+
+    idle = []
+    for _ in range(idle_probes):
+        job = DummyJob(0.0)
+        job.submitted_at = time.perf_counter()
+        scheduler.submit(job)
+        while job.finished_at == 0.0:
+            await asyncio.sleep(0.001)
+        idle.append((job.started_at - job.submitted_at) * 1000)
+        await asyncio.sleep(0.037)
+
+    jobs = [DummyJob(job_seconds) for _ in range(num_jobs)]
+    for job in jobs:
+        job.submitted_at = time.perf_counter()
+        scheduler.submit(job)
+    while jobs[-1].finished_at == 0.0:
+        await asyncio.sleep(0.005)
+
+    await scheduler.stop()
+    executor.shutdown()
+    return idle, jobs
+
+
+def report(label: str, idle, jobs, wall_seconds: float):
+    gaps = [
+        (jobs[i].started_at - jobs[i - 1].finished_at) * 1000
+        for i in range(1, len(jobs))
+    ]
+    print(f"[{label}]")
+    summarize("submit->start (idle)", idle)
+    summarize("gap between jobs", gaps)
+    print(f"  {'total wall time':<28} {wall_seconds:.2f}s for {len(jobs)} jobs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scheduler dispatch latency benchmark")
+    parser.add_argument("--jobs", type=int, default=50, help="Number of back-to-back jobs")
+    parser.add_argument("--job-ms", type=float, default=20.0, help="Simulated job duration (ms)")
+    parser.add_argument("--idle-probes", type=int, default=20, help="Number of idle submit probes")
+    args = parser.parse_args()
+
+    job_seconds = args.job_ms / 1000
+
+    start = time.perf_counter()
+    idle, jobs = asyncio.run(bench_legacy(args.jobs, job_seconds, args.idle_probes))
+    report("legacy polling worker", idle, jobs, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    idle, jobs = asyncio.run(bench_scheduler(args.jobs, job_seconds, args.idle_probes))
+    report("GPUJobScheduler", idle, jobs, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+段階パイプライン実行のスループットベンチマーク
+
+1リクエストの段階（prepare → diffuse → decode+エンコード）を1つのスレッドで順に実行する従来の方式と、
+StagePipeline（段階ごとのスレッドと上限付き待ち行列）で連続するリクエストの段階を重ねる方式を比較し、
+持続的なスループット（jobs/hour）を計測する。
+
+デフォルトではGPUを使用せず、time.sleep で各段階の処理時間を模擬する
+（--prepare-s / --diffuse-s / --decode-s、実機の timecosts に合わせて指定する）。
+--checkpoint-path を指定すると ACEStepPipeline を読み込み、実際の生成で計測する。
+
+使い方:
+    python benchmarks/stage_pipeline_throughput.py --jobs 20
+    python benchmarks/stage_pipeline_throughput.py --jobs 20 --prepare-s 1.2 --diffuse-s 9 --decode-s 3.5
+    python benchmarks/stage_pipeline_throughput.py --jobs 8 --checkpoint-path ./checkpoints --duration 60 --format mp3
+"""
+
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+from typing import Callable, List, Sequence
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from acestep.api.stage_pipeline import STAGES, StagePipeline
+
+
+def simulated_stages(prepare_s: float, diffuse_s: float, decode_s: float) -> List[Callable]:
+    """段階ごとの処理時間を time.sleep で模擬する（拡散はパイプラインにつき同時に1つ）"""
+    diffusion_lock = threading.Lock()
+
+    def prepare(_):
+        time.sleep(prepare_s)
+
+    def diffuse(_):
+        with diffusion_lock:
+            time.sleep(diffuse_s)
+
+    def decode(_):
+        time.sleep(decode_s)
+
+    return [prepare, diffuse, decode]
+
+
+def pipeline_stages(pipeline, duration: float, infer_step: int, format: str) -> List[Callable]:
+    """ACEStepPipeline の段階と、APIと同じ torchaudio によるエンコード"""
+    import torchaudio
+
+    def encode(outputs):
+        audio_data = outputs[0]
+        buffer = io.BytesIO()
+        torchaudio.save(
+            buffer, audio_data["audio"], sample_rate=audio_data["sample_rate"], format=format,
+            backend="sox" if format == "ogg" else "soundfile",
+        )
+        return len(buffer.getvalue())
+
+    return [
+        lambda _: pipeline.prepare_generation(
+            audio_duration=duration, infer_step=infer_step, format=format, return_audio_data=True,
+            prompt="funk, pop, soul, rock, melodic, guitar, drums, bass, 105 BPM, energetic",
+            lyrics="[verse]\nNeon lights they flicker bright\nCity hums in dead of night\n",
+        ),
+        lambda plan: (plan, pipeline.diffuse_generation(plan)),
+        lambda diffused: encode(pipeline.decode_generation(*diffused)),
+    ]
+
+
+def run_sequential(stages: Sequence[Callable], num_jobs: int) -> float:
+    """従来の方式：1つのスレッドで1リクエストずつ全段階を実行する"""
+    start = time.perf_counter()
+    for _ in range(num_jobs):
+        value = None
+        for stage in stages:
+            value = stage(value)
+    return time.perf_counter() - start
+
+
+def run_staged(stages: Sequence[Callable], num_jobs: int, depth: int, queue_size: int) -> float:
+    """段階パイプライン：スケジューラと同じく、同時に投入するジョブを depth 件までに制限する"""
+    pipeline = StagePipeline(STAGES, queue_size=queue_size, name="bench-stage")
+    slots = threading.Semaphore(depth)
+    futures = []
+    start = time.perf_counter()
+    for _ in range(num_jobs):
+        slots.acquire()
+        future = pipeline.submit(stages)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    print(f"  stage utilization: " + ", ".join(
+        f"{stage}={stats['utilization']:.0%}" for stage, stats in pipeline.snapshot().items()
+    ))
+    pipeline.shutdown()
+    return elapsed
+
+
+def report(label: str, num_jobs: int, elapsed: float, baseline: float = None):
+    jobs_per_hour = num_jobs / elapsed * 3600
+    line = f"  {label:<22} {elapsed:8.2f}s for {num_jobs} jobs  {jobs_per_hour:9.1f} jobs/hour"
+    if baseline is not None:
+        line += f"  ({baseline / elapsed:.2f}x)"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage-pipelined execution throughput benchmark")
+    parser.add_argument("--jobs", type=int, default=20, help="Number of back-to-back jobs")
+    parser.add_argument("--depth", type=int, default=len(STAGES), help="Jobs in flight per replica (ACE_STAGE_PIPELINE_DEPTH)")
+    parser.add_argument("--queue-size", type=int, default=1, help="Bounded queue length between stages (ACE_STAGE_QUEUE_SIZE)")
+    parser.add_argument("--scale", type=float, default=0.1, help="Multiply the simulated stage durations (1.0 = real time)")
+    parser.add_argument("--prepare-s", type=float, default=1.5, help="Simulated text/lyric encoding seconds")
+    parser.add_argument("--diffuse-s", type=float, default=10.0, help="Simulated diffusion seconds")
+    parser.add_argument("--decode-s", type=float, default=4.0, help="Simulated latents2audio + audio encoding seconds")
+    parser.add_argument("--checkpoint-path", type=str, default=None, help="Benchmark the real pipeline with this checkpoint")
+    parser.add_argument("--duration", type=float, default=60.0, help="Audio duration of real generations")
+    parser.add_argument("--infer-step", type=int, default=60, help="Diffusion steps of real generations")
+    parser.add_argument("--format", type=str, default="mp3", help="Output encoding of real generations")
+    parser.add_argument("--cpu-offload", action="store_true", help="Enable CPU offload for the real pipeline")
+    args = parser.parse_args()
+
+    if args.checkpoint_path is not None:
+        from acestep.pipeline_ace_step import ACEStepPipeline
+
+        pipeline = ACEStepPipeline(
+            checkpoint_dir=args.checkpoint_path, cpu_offload=args.cpu_offload, disable_progress_bar=True
+        )
+        stages = pipeline_stages(pipeline, args.duration, args.infer_step, args.format)
+        # チェックポイントの読み込みと初回のコンパイルを計測から除く
+        run_sequential(stages, 1)
+        print(f"[ACEStepPipeline {args.duration:g}s audio, {args.infer_step} steps, {args.format}]")
+    else:
+        stages = simulated_stages(args.prepare_s * args.scale, args.diffuse_s * args.scale, args.decode_s * args.scale)
+        print(
+            f"[simulated prepare={args.prepare_s * args.scale:g}s diffuse={args.diffuse_s * args.scale:g}s "
+            f"decode={args.decode_s * args.scale:g}s]"
+        )
+
+    sequential = run_sequential(stages, args.jobs)
+    report("sequential", args.jobs, sequential)
+    staged = run_staged(stages, args.jobs, args.depth, args.queue_size)
+    report("stage pipeline", args.jobs, staged, baseline=sequential)
+
+
+if __name__ == "__main__":
+    main()
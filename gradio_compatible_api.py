@@ -8,35 +8,111 @@ import os
 import uuid
 import time
 import asyncio
-import threading
 import gc
-from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
-from typing import Optional, List, Dict
-from dataclasses import dataclass
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+import json
+from typing import Optional, List, Dict, Tuple, Union
+from dataclasses import dataclass, field, replace
 from enum import Enum
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
-from fastapi.responses import Response
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ValidationError
 import uvicorn
 import tempfile
-import base64
 
 from acestep.pipeline_ace_step import ACEStepPipeline
 from acestep.data_sampler import DataSampler
+from acestep.api.scheduler import GPUJobScheduler
+from acestep.api.batching import BatchingConfig, batch_key, first_seed
+from acestep.api.policy import CostModel, misses_deadline, policy_from_env
+from acestep.api.fairness import DEFAULT_TENANT, FairQueuingConfig, FairQueuingPolicy, tenant_of_request
+from acestep.api.degradation import DegradationConfig, DegradationPolicy, ThroughputMeter
+from acestep.api.result_store import ResultEvictedError, ResultStore, ResultStoreConfig
+from acestep.api.spool import ResultSpool, SpoolConfig, spooled_file_response
+from acestep.api.admission import AdmissionConfig, AdmissionController, AdmissionRejected
+from acestep.api.eta import EtaPredictor
+from acestep.api.events import TERMINAL_EVENTS, EventBroker, format_sse
+from acestep.api.result_cache import (
+    ResultCache, ResultCacheConfig, canonical_request_key, link_or_copy, model_fingerprint, request_cache_key
+)
+from acestep.api.singleflight import SingleFlight
+from acestep.api.ingest import (
+    Base64Decoder, IngestConfig, UploadBuffer, ingest_base64_text, ingest_stream, ingest_upload_file
+)
+from acestep.api.device_pool import DevicePool, DevicePoolConfig, Replica, is_device_error
+from acestep.api.model_worker import ProcessPipeline
+from acestep.api.startup import StartupConfig, StartupState
+from acestep.api.stage_pipeline import STAGES, StagePipeline, StagePipelineConfig
+from acestep.api.audio_encoder import AudioEncoder, AudioEncoderConfig
+from acestep.api.job_backend import JobBackendConfig, JobRecord, create_job_backend
+from acestep.api.backend_node import BackendNode
+from acestep.continuous_batching import ContinuousBatchingEngine, GenerationSpec
+from acestep.preemption import DiffusionSnapshot, GenerationPreempted
+from acestep.cancellation import AllCancelledToken, CancellationToken
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """FastAPI lifespan event handler"""
     # Startup
-    asyncio.create_task(background_worker())
+    event_broker.bind(asyncio.get_running_loop())
+    result_spool.prepare()
+    result_cache.load()
+    audio_encoder.start()
+    preload = None
+    if startup_config.preload:
+        # 読み込み・ウォームアップの完了後にスケジューラを起動する（それまでのジョブは待ち行列で待つ）
+        preload = asyncio.create_task(preload_models())
+    else:
+        scheduler.start()
+    backend_node_task = asyncio.create_task(backend_node.run()) if backend_node is not None else None
     yield
-    # Shutdown (if needed)
-    pass
+    # Shutdown
+    if preload is not None and not preload.done():
+        preload.cancel()
+    if backend_node_task is not None:
+        # 取得済みで終了していないジョブは、リースが切れた後に他のノードが取得し直す
+        backend_node_task.cancel()
+        try:
+            await backend_node_task
+        except asyncio.CancelledError:
+            pass
+    await scheduler.stop()
+    device_pool.clear()
+    audio_encoder.shutdown()
+    if backend_node is not None:
+        backend_node.close()
 
 app = FastAPI(title="ACE-Step Gradio Compatible API", lifespan=lifespan)
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """受付制御による拒否を 429（Retry-After 付き）または 413 として返す"""
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after is not None else None
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.reason, "retry_after": exc.retry_after},
+        headers=headers,
+    )
+
+# テナント（APIキー・ヘッダー・接続元）ごとの公平キューイングの設定（ACE_FAIR_QUEUING=1 で有効 / ACE_TENANT_*）
+fair_queuing_config = FairQueuingConfig.from_env()
+# 処理中のHTTPリクエストのテナント（QueuedRequest の作成時に記録する）
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+@app.middleware("http")
+async def assign_tenant(request: Request, call_next):
+    """リクエストヘッダー・接続元からテナントを決める"""
+    client_host = request.client.host if request.client is not None else None
+    token = current_tenant.set(tenant_of_request(request.headers, client_host, fair_queuing_config))
+    try:
+        return await call_next(request)
+    finally:
+        current_tenant.reset(token)
+
 class RequestStatus(Enum):
     PENDING = "pending"
     PROCESSING = "processing"
@@ -53,18 +129,139 @@ class QueuedRequest:
     created_at: float = 0.0
     started_at: Optional[float] = None
     completed_at: Optional[float] = None
+    # ステップ境界での中断要求と、中断時点のスナップショット（再開時に使用）
+    preempt_event: threading.Event = field(default_factory=threading.Event)
+    snapshot: Optional[DiffusionSnapshot] = None
+    preemption_count: int = 0
+    # 混雑時に適用した品質の引き下げ（params_json["degradation"] として返す）
+    degradation: Optional[Dict] = None
+    # キャンセル要求（パイプラインがステップ・デコード窓ごとに確認する）
+    cancellation_token: CancellationToken = field(default_factory=CancellationToken)
+    # 結果キャッシュのキー（決定的でないリクエスト・キャッシュ無効時は None）
+    cache_key: Optional[str] = None
+    # 同一リクエストの相乗りのキー（決定的でないリクエストは None）
+    flight_key: Optional[str] = None
+    # フォロワーのいるジョブがキャンセルされた場合、ジョブは続行し、このリクエストのみ終了時にキャンセル扱いにする
+    detached: bool = False
+    # アップロードされた参照音声（メモリまたは一時ファイル、request.ref_audio_input の代わりに使う）
+    ref_audio: Optional[UploadBuffer] = None
+    # 割り当てられたデバイスのレプリカ（中断からの再開は同じレプリカで行う）
+    replica: Optional[Replica] = None
+    # デバイス側の失敗（メモリ不足・CUDAエラーなど、レプリカの健全性に数える）
+    device_error: bool = False
+    # 投入したテナント（公平キューイングのサブキュー）
+    tenant: str = field(default_factory=current_tenant.get)
+    # ワーカーが記録した終了時の (結果, エラー)（finish_request がイベントループ上でステータスに反映する）
+    outcome: Optional[Tuple[Optional[Dict], Optional[str]]] = None
+
+# 進捗イベントの配信（/events/{request_id}）
+event_broker = EventBroker()
+# 進捗イベントが届かない間に送るコメント行の間隔（プロキシによる切断を防ぐ）
+SSE_KEEPALIVE_SECONDS = 15.0
+# /status のロングポーリング（wait）の上限秒数と、/status/batch で一度に問い合わせられる件数
+STATUS_MAX_WAIT_SECONDS = float(os.environ.get("ACE_STATUS_MAX_WAIT_SECONDS", "60"))
+STATUS_BATCH_LIMIT = 1000
+
+
+# 音楽データのエンコード用プロセスプール（ACE_ENCODER_PROCESSES / ACE_ENCODER_FORMATS）
+# GPUワーカーはエンコードを投入した時点で次のジョブに移り、ジョブはエンコードの完了後に終了する
+audio_encoder = AudioEncoder(AudioEncoderConfig.from_env())
+
+# manual_seeds 指定のリクエストの結果キャッシュ（ACE_RESULT_CACHE_DIR / ACE_RESULT_CACHE_MB、再起動後も保持）
+result_cache = ResultCache(ResultCacheConfig.from_env())
+
+# 待機中・処理中のジョブと同じ内容のリクエストの相乗り（イベントループ上でのみ操作する）
+singleflight = SingleFlight()
+
+# アップロードの取り込み（ACE_UPLOAD_MEMORY_MB までメモリに保持、ACE_UPLOAD_CHUNK_KB 単位で読み込む）
+ingest_config = IngestConfig.from_env()
+
+# ジョブの待ち行列・状態のバックエンド（ACE_QUEUE_BACKEND）
+# memory の場合はこのプロセスのスケジューラのみを使い、sqlite / redis の場合は複数ノードで待ち行列を共有する
+job_backend_config = JobBackendConfig.from_env()
 
-# リクエストキューとステータス管理
-request_queue = Queue()
-request_status: Dict[str, QueuedRequest] = {}
-request_lock = threading.Lock()
+# 完了した音楽データの書き出し先（ACE_RESULT_SPOOL_DIR、空文字の場合はメモリに保持）
+# 同じディレクトリを共有する他のサーバと衝突しないよう、ノードIDのサブディレクトリに書き込む
+result_spool = ResultSpool(SpoolConfig.from_env(), owner=job_backend_config.node_id)
+job_backend = create_job_backend(job_backend_config) if job_backend_config.distributed else None
 
-# ワーカースレッド用のExecutor
-executor = ThreadPoolExecutor(max_workers=1)  # GPU使用のため1つのワーカー
+def queued_request_size(queued_request: QueuedRequest) -> int:
+    """結果として保持している音楽データのバイト数（メモリまたはスプール）"""
+    if not queued_request.result:
+        return 0
+    if "audio_data" in queued_request.result:
+        return len(queued_request.result["audio_data"])
+    return queued_request.result.get("audio_size_bytes", 0)
 
-# グローバル変数でパイプラインを管理
+def release_queued_request(queued_request: QueuedRequest):
+    """結果ストアから削除されたリクエストのスプールファイルを削除"""
+    if queued_request.result:
+        result_spool.delete(queued_request.result.get("spool_path"))
+
+def is_queued_request_finished(queued_request: QueuedRequest) -> bool:
+    return queued_request.status in (RequestStatus.COMPLETED, RequestStatus.FAILED)
+
+# リクエストのステータス管理（イベントループ上でのみ更新する）
+# ワーカー・エンコード用プロセスプールのスレッドは終了時の結果を outcome に記録するのみで、
+# ステータス・結果は finish_request がイベントループ上で反映する
+# 完了した結果はバイト数上限・TTL・LRUで削除される（ACE_RESULT_STORE_MAX_MB / ACE_RESULT_TTL_SECONDS）
+request_status = ResultStore(
+    ResultStoreConfig.from_env(),
+    size_of=queued_request_size,
+    is_finished=is_queued_request_finished,
+    on_evict=release_queued_request,
+)
+
+# ワーカースレッド用のExecutor（初期化処理と、レプリカが未初期化の場合のジョブの実行に使う）
+# GPU処理はデバイスのレプリカごとの専用スレッドで行う
+executor = ThreadPoolExecutor(max_workers=1)
+
+# パイプラインを載せるデバイス（ACE_DEVICES、未指定の場合は1つのデバイス）とジョブの割り当て方
+def cuda_device_count() -> int:
+    import torch
+    return torch.cuda.device_count() if torch.cuda.is_available() else 0
+
+device_pool_config = DevicePoolConfig.from_env(cuda_device_count)
+
+# 連続バッチングのスロット数（0 で無効、レプリカごと）
+# 有効な場合、GPU処理はエンジンのスレッドで行い、ワーカーは完了待ちのみを行う
+# エンジンはパイプラインと同じプロセスで動かす必要があるため、モデルワーカープロセスでは使わない
+CONTINUOUS_BATCHING_SLOTS = max(0, int(os.environ.get("ACE_CONTINUOUS_BATCHING", "0")))
+if CONTINUOUS_BATCHING_SLOTS > 0 and device_pool_config.worker_processes > 0:
+    print("Warning: continuous batching is not available with model worker processes, disabling it")
+    CONTINUOUS_BATCHING_SLOTS = 0
+continuous_wait_executor = (
+    ThreadPoolExecutor(max_workers=CONTINUOUS_BATCHING_SLOTS * device_pool_config.replica_count)
+    if CONTINUOUS_BATCHING_SLOTS > 0 else None
+)
+
+# 段階パイプライン（ACE_STAGE_PIPELINE、レプリカごと）
+# 有効な場合、prepare / diffuse / decode をレプリカの段階ごとのスレッドで実行し、連続するリクエストの段階を重ねる
+# ワーカーはレプリカ数×ACE_STAGE_PIPELINE_DEPTH だけ起動し、待機用スレッドで完了を待つ
+# パイプラインの段階を個別に呼び出すため、連続バッチング・モデルワーカープロセスとは併用しない
+stage_pipeline_config = StagePipelineConfig.from_env()
+if stage_pipeline_config.enabled and (CONTINUOUS_BATCHING_SLOTS > 0 or device_pool_config.worker_processes > 0):
+    print("Warning: stage pipelining is not available with continuous batching or model worker processes, disabling it")
+    stage_pipeline_config.enabled = False
+STAGE_PIPELINE_JOBS = stage_pipeline_config.jobs_per_replica if stage_pipeline_config.enabled else 0
+stage_wait_executor = (
+    ThreadPoolExecutor(max_workers=STAGE_PIPELINE_JOBS * device_pool_config.replica_count)
+    if STAGE_PIPELINE_JOBS > 0 else None
+)
+
+# グローバル変数でパイプラインを管理（model_demo は先頭のレプリカのパイプライン）
 model_demo = None
 data_sampler = None
+# 結果キャッシュのキーに含めるモデルのフィンガープリント（チェックポイントの確認後に設定）
+current_fingerprint: Optional[str] = None
+
+# 起動時のモデルの読み込みとウォームアップ（ACE_PRELOAD / ACE_WARMUP_*）と、その進捗
+startup_config = StartupConfig.from_env()
+startup_state = StartupState()
+# 実行中の読み込み（lifespan・/initialize・レガシーの自動初期化で共有する）
+model_loading: Optional[asyncio.Task] = None
+# 完了した読み込みの引数（同じ引数の /initialize では読み込み直さない）
+loaded_initialize_kwargs: Optional[Dict] = None
 
 # デフォルト値（Gradioアプリと同じ）
 TAG_DEFAULT = "funk, pop, soul, rock, melodic, guitar, drums, bass, keyboard, percussion, 105 BPM, energetic, upbeat, groovy, vibrant, dynamic"
@@ -131,6 +328,14 @@ class GenerateMusicRequest(BaseModel):
     lora_name_or_path: str = "none"
     lora_weight: float = 1.0
     return_file_data: bool = False  # True の場合、ファイルデータを直接返す
+    priority: int = 0  # 大きいほど優先。実行中の低優先度ジョブはステップ境界で中断される
+    deadline: Optional[float] = None  # 投入からの秒数。間に合わない見込みのジョブはGPUを使う前に失敗とする
+    allow_degradation: bool = False  # True の場合、混雑時にステップ数削減などの品質引き下げを許可する
+
+class StatusBatchRequest(BaseModel):
+    request_ids: List[str]
+    wait: float = 0.0  # 秒。いずれかのステータスが statuses から変わるまで待機する（0 で即時）
+    statuses: Optional[Dict[str, str]] = None  # クライアントが最後に確認したステータス（省略時は呼び出し時点の値）
 
 class GenerateMusicResponse(BaseModel):
     success: bool
@@ -163,6 +368,9 @@ class GenerateMusicWithBase64Request(BaseModel):
     lora_name_or_path: str = "none"
     lora_weight: float = 1.0
     return_file_data: bool = False
+    priority: int = 0
+    deadline: Optional[float] = None
+    allow_degradation: bool = False
 
 def initialize_pipeline(
     checkpoint_path: str = "",
@@ -172,10 +380,16 @@ def initialize_pipeline(
     cpu_offload: bool = True,  # メモリ不足対策でデフォルトでCPUオフロードを有効化
     overlapped_decode: bool = False
 ):
-    """Gradioアプリと同じ方法でパイプラインを初期化"""
-    global model_demo, data_sampler
+    """
+    Gradioアプリと同じ方法でパイプラインを初期化
+    ACE_DEVICES を指定した場合はデバイスごとにレプリカを作る（device_id は使わない）
+    ACE_MODEL_WORKERS を指定した場合は各レプリカのパイプラインをモデルワーカープロセスで動かす
+    """
+    global model_demo, data_sampler, current_fingerprint
     
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
+    if not device_pool_config.devices:
+        # 従来どおり1つのデバイスのみを見せる（モデルワーカープロセスにも引き継がれる）
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
     
     # メモリクリア
     import torch
@@ -183,32 +397,407 @@ def initialize_pipeline(
         torch.cuda.empty_cache()
         print(f"CUDA memory before initialization: {torch.cuda.memory_allocated() / 1024**3:.2f} GB")
     
-    model_demo = ACEStepPipeline(
-        checkpoint_dir=checkpoint_path,
-        dtype="bfloat16" if bf16 else "float32",
-        torch_compile=torch_compile,
-        cpu_offload=cpu_offload,
-        overlapped_decode=overlapped_decode,
-        disable_progress_bar=True
-    )
+    device_pool.clear()
+    for index, device in enumerate(device_pool_config.replica_devices()):
+        pipeline_kwargs = dict(
+            checkpoint_dir=checkpoint_path,
+            dtype="bfloat16" if bf16 else "float32",
+            torch_compile=torch_compile,
+            cpu_offload=cpu_offload,
+            overlapped_decode=overlapped_decode,
+            disable_progress_bar=True,
+            device=device
+        )
+        if device_pool_config.worker_processes > 0:
+            pipeline = ProcessPipeline(pipeline_kwargs, name=f"ace-model-worker-{index}")
+            print(f"Started model worker {index} (pid {pipeline.pid}, device {pipeline.device})")
+        else:
+            pipeline = ACEStepPipeline(**pipeline_kwargs)
+        engine = None
+        if CONTINUOUS_BATCHING_SLOTS > 0:
+            engine = ContinuousBatchingEngine(pipeline, max_batch_size=CONTINUOUS_BATCHING_SLOTS)
+            engine.start()
+        stages = None
+        if STAGE_PIPELINE_JOBS > 0:
+            stages = StagePipeline(STAGES, queue_size=stage_pipeline_config.queue_size, name=f"ace-stage-{index}")
+        device_pool.add(
+            device, pipeline, capacity=max(1, CONTINUOUS_BATCHING_SLOTS, STAGE_PIPELINE_JOBS),
+            engine=engine, stages=stages
+        )
+    model_demo = device_pool.primary.pipeline
     data_sampler = DataSampler()
+    current_fingerprint = None
     
     if torch.cuda.is_available():
         print(f"CUDA memory after initialization: {torch.cuda.memory_allocated() / 1024**3:.2f} GB")
     
     return model_demo, data_sampler
 
-def process_music_generation(queued_request: QueuedRequest):
-    """音楽生成の実際の処理（ブロッキング）"""
+def pipeline_available() -> bool:
+    """パイプラインが初期化済み、または読み込み中か（読み込み中に投入したジョブは完了後に処理される）"""
+    return model_demo is not None or startup_state.busy
+
+def run_warmup(pipeline, request: 'GenerateMusicRequest') -> Optional[Dict]:
+    """ウォームアップの生成（レプリカのスレッドで実行、結果は保存せず timecosts のみ返す）"""
+    results = pipeline(
+        format=request.format,
+        audio_duration=request.audio_duration,
+        prompt=request.prompt,
+        lyrics=request.lyrics,
+        infer_step=request.infer_step,
+        return_audio_data=True
+    )
+    if isinstance(results, (list, tuple)) and results and isinstance(results[0], dict):
+        return (results[0].get('input_params') or {}).get('timecosts')
+    return None
+
+async def load_replica(replica: Replica):
+    """レプリカのチェックポイントを読み込む"""
+    started = time.time()
+    await asyncio.get_running_loop().run_in_executor(replica.executor, replica.pipeline.ensure_loaded)
+    startup_state.loaded(replica.index, time.time() - started)
+
+async def warmup_replica(replica: Replica):
+    """音声長ごとに短い生成を行い、CUDAの初期化・カーネルの選択・torch.compile を済ませる"""
+    loop = asyncio.get_running_loop()
+    for index, duration in enumerate(startup_config.warmup_durations):
+        request = GenerateMusicRequest(audio_duration=duration, infer_step=startup_config.warmup_steps)
+        started = time.time()
+        timecosts = await loop.run_in_executor(replica.executor, run_warmup, replica.pipeline, request)
+        startup_state.warmed_up(replica.index, duration, time.time() - started)
+        # 最初の生成は初期化・コンパイルの時間を含むため、コストモデルには2回目以降のみ反映する
+        if index > 0 and timecosts:
+            cost_model.observe(request, timecosts)
+
+async def load_models(initialize_kwargs: Dict):
+    """パイプラインを初期化し、全レプリカのチェックポイントの読み込みとウォームアップを行う"""
+    global loaded_initialize_kwargs
+    loaded_initialize_kwargs = None
+    startup_state.begin(warmup_total=len(startup_config.warmup_durations) * device_pool_config.replica_count)
     try:
-        queued_request.status = RequestStatus.PROCESSING
-        queued_request.started_at = time.time()
+        await asyncio.get_running_loop().run_in_executor(
+            executor, lambda: initialize_pipeline(**initialize_kwargs)
+        )
+        await asyncio.gather(*(load_replica(replica) for replica in device_pool.replicas))
+        startup_state.warming_up()
+        await asyncio.gather(*(warmup_replica(replica) for replica in device_pool.replicas))
+    except Exception as e:
+        startup_state.finish(f"{type(e).__name__}: {e}")
+        raise
+    startup_state.finish()
+    loaded_initialize_kwargs = dict(initialize_kwargs)
+
+def start_model_loading(initialize_kwargs: Dict) -> asyncio.Task:
+    """
+    読み込みを開始する（読み込み中の場合は実行中のものを返す）
+    再初期化は既存のレプリカを停止するため、完了までスケジューラの取り出しを止める
+    （実行中のジョブがないことは呼び出し側で確認する）
+    """
+    global model_loading
+    if model_loading is None or model_loading.done():
+        reloading = bool(device_pool.replicas)
+        if reloading:
+            scheduler.pause()
+        model_loading = asyncio.ensure_future(load_models(initialize_kwargs))
+        if reloading:
+            model_loading.add_done_callback(lambda _: scheduler.resume())
+    return model_loading
+
+async def preload_models():
+    """起動時の読み込み：完了（または失敗）した時点でスケジューラを起動する"""
+    try:
+        await start_model_loading(startup_config.initialize_kwargs())
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        scheduler.start()
+
+def audio_content_type(format_type: str) -> str:
+    """Content-Typeを正しく設定"""
+    content_type = "audio/wav"  # デフォルト
+    if format_type.lower() == 'mp3':
+        content_type = "audio/mpeg"
+    elif format_type.lower() == 'wav':
+        content_type = "audio/wav"
+    return content_type
+
+def store_audio_data_result(queued_request: QueuedRequest, audio_data_dict: Dict,
+                            params_json: Optional[Dict]) -> Union[Dict, Future]:
+    """
+    音楽データをエンコードしてリクエストの結果を作る（スプール有効時はファイルに一度だけ書き込む）
+    エンコード用プロセスプールでエンコードする形式の場合は投入だけして戻り、結果を返す Future を返す
+    """
+    event_broker.publish_threadsafe(queued_request.request_id, {"type": "stage", "stage": "encoding"})
+    format_type = audio_data_dict['format']
+    temp_path, final_path = (
+        result_spool.allocate(queued_request.request_id, format_type) if result_spool.enabled else (None, None)
+    )
+    
+    def store(audio_bytes: Optional[bytes]) -> Dict:
+        if temp_path is None:
+            result = {
+                "success": True,
+                "audio_data": audio_bytes,
+                "params_json": params_json,
+                "content_type": audio_content_type(format_type),
+                "format": format_type
+            }
+            store_cached_result(queued_request, result, None, audio_bytes)
+            return result
+        spooled = result_spool.commit(temp_path, final_path)
+        result = {
+            "success": True,
+            **spooled,
+            "params_json": params_json,
+            "content_type": audio_content_type(format_type),
+            "format": format_type
+        }
+        store_cached_result(queued_request, result, spooled["spool_path"], None)
+        return result
+    
+    # スプール有効時はエンコード先（ワーカープロセスを含む）が一時ファイルに直接書き込む
+    audio_args = (audio_data_dict['audio'], audio_data_dict['sample_rate'], format_type, temp_path)
+    if not audio_encoder.offloads(format_type):
+        try:
+            return store(audio_encoder.encode(*audio_args))
+        except Exception:
+            result_spool.delete(temp_path)
+            raise
+    
+    stored = Future()
+    
+    def on_encoded(encoded: Future):
+        # プールの管理スレッドで実行される（リクエストには触れず、結果は stored で返す）
+        try:
+            result = store(encoded.result())
+        except BaseException as e:
+            result_spool.delete(temp_path)
+            stored.set_exception(e)
+            return
+        stored.set_result(result)
+    
+    audio_encoder.submit(*audio_args).add_done_callback(on_encoded)
+    return stored
+
+def complete_request(queued_request: QueuedRequest, result: Union[Dict, Future]) -> Optional[Future]:
+    """
+    リクエストの結果を outcome に記録する（ワーカー側、COMPLETED への遷移は finish_request が行う）
+    エンコード中（result が結果を返す Future）の場合は完了後に結果（失敗した場合はエラー）を記録し、
+    その完了を表す Future を返す
+    """
+    if not isinstance(result, Future):
+        queued_request.outcome = (result, None)
+        return None
+    completed = Future()
+    
+    def on_stored(future: Future):
+        # プールの管理スレッドで実行される
+        try:
+            queued_request.outcome = (future.result(), None)
+        except BaseException as e:
+            queued_request.outcome = (None, str(e))
+        completed.set_result(None)
+    
+    result.add_done_callback(on_stored)
+    return completed
+
+def fail_request(queued_request: QueuedRequest, error: Exception):
+    """リクエストの失敗を outcome に記録する（ワーカー側、FAILED への遷移は finish_request が行う）"""
+    queued_request.outcome = (None, str(error))
+
+def apply_outcome(queued_request: QueuedRequest):
+    """ワーカーが記録した結果・エラーをステータスに反映する（イベントループ側）"""
+    if queued_request.outcome is None:
+        return
+    result, error = queued_request.outcome
+    queued_request.outcome = None
+    queued_request.result = result
+    queued_request.error = error
+    queued_request.status = RequestStatus.COMPLETED if error is None else RequestStatus.FAILED
+    queued_request.completed_at = time.time()
+
+def all_completed(futures: List[Optional[Future]]) -> Optional[Future]:
+    """全ての Future（None は完了済み）が完了した時点で完了する Future（全て完了済みなら None）"""
+    pending = [future for future in futures if future is not None]
+    if not pending:
+        return None
+    completed = Future()
+    remaining = [len(pending)]
+    lock = threading.Lock()
+    
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        completed.set_result(None)
+    
+    for future in pending:
+        future.add_done_callback(on_done)
+    return completed
+
+def get_model_fingerprint() -> Optional[str]:
+    """モデルのフィンガープリント（チェックポイントのダウンロード前は None）"""
+    global current_fingerprint
+    if current_fingerprint is None and model_demo is not None:
+        current_fingerprint = model_fingerprint(model_demo)
+    return current_fingerprint
+
+def assign_request_keys(queued_request: QueuedRequest):
+    """決定的なリクエストに相乗りのキーと結果キャッシュのキーを設定する（イベントループ側）"""
+    request = queued_request.request
+    ref_audio_sha256 = queued_request.ref_audio.sha256 if queued_request.ref_audio is not None else None
+    canonical_key = canonical_request_key(request, ref_audio_sha256)
+    if canonical_key is None:
+        return
+    # 返却方法と品質引き下げの可否が異なるリクエストは同じ結果を共有できない
+    queued_request.flight_key = f"{canonical_key}:{int(request.return_file_data)}:{int(request.allow_degradation)}"
+    if result_cache.enabled and request.return_file_data:
+        queued_request.cache_key = request_cache_key(canonical_key, get_model_fingerprint())
+
+def serve_cached_result(queued_request: QueuedRequest) -> bool:
+    """結果キャッシュにあれば GPU を使わずにリクエストを完了させる（イベントループ側）"""
+    cached = result_cache.get(queued_request.cache_key)
+    if cached is None:
+        return False
+    cache_path, meta = cached
+    format_type = meta["format"]
+    try:
+        if result_spool.enabled:
+            temp_path, final_path = result_spool.allocate(queued_request.request_id, format_type)
+            try:
+                link_or_copy(cache_path, temp_path)
+                audio_result = result_spool.commit(temp_path, final_path)
+            except OSError:
+                result_spool.delete(temp_path)
+                raise
+        else:
+            with open(cache_path, "rb") as f:
+                audio_result = {"audio_data": f.read()}
+    except OSError as e:
+        print(f"Warning: Failed to read result cache entry {queued_request.cache_key}: {e}")
+        return False
+    queued_request.result = {
+        "success": True,
+        **audio_result,
+        "params_json": meta.get("params_json"),
+        "content_type": meta.get("content_type") or audio_content_type(format_type),
+        "format": format_type,
+        "cached": True
+    }
+    queued_request.status = RequestStatus.COMPLETED
+    queued_request.started_at = queued_request.completed_at = time.time()
+    release_ref_audio(queued_request)
+    return True
+
+def store_cached_result(queued_request: QueuedRequest, result: Dict, source_path: Optional[str],
+                        audio_bytes: Optional[bytes]):
+    """完了した結果を結果キャッシュに保存（GPUワーカー側、品質を引き下げた結果は保存しない）"""
+    if queued_request.cache_key is None or queued_request.degradation is not None:
+        return
+    result_cache.put(queued_request.cache_key, source_path, audio_bytes, {
+        "params_json": result.get("params_json"),
+        "content_type": result.get("content_type"),
+        "format": result.get("format")
+    })
+
+def store_generation_output(queued_request: QueuedRequest, audio_data_dict: Dict, idx: int) -> Optional[Future]:
+    """
+    return_audio_data=True で得た1サンプル分の出力をリクエストの結果に設定
+    エンコードをプロセスプールに投入した場合は、リクエストの完了を表す Future を返す
+    """
+    params_json = audio_data_dict.get('input_params')
+    audio_data_dict['format'] = queued_request.request.format
+    if params_json is not None:
+        params_json['format'] = queued_request.request.format
+    
+    if queued_request.request.return_file_data:
+        return complete_request(queued_request, store_audio_data_result(queued_request, audio_data_dict, params_json))
+    else:
+        # ファイルパスを返す場合：パイプラインと同じ規則で保存
+        audio_path = pipeline_for(queued_request).save_wav_file(
+            audio_data_dict['audio'],
+            idx,
+            sample_rate=audio_data_dict['sample_rate'],
+            format=queued_request.request.format
+        )
+        if params_json is not None:
+            params_json["audio_path"] = audio_path
+            json_path = audio_path.replace(f".{queued_request.request.format}", "_input_params.json")
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(params_json, f, indent=4, ensure_ascii=False)
+        return complete_request(queued_request, {
+            "success": True,
+            "audio_path": audio_path,
+            "params_json": params_json
+        })
+
+def cleanup_temp_ref_audio(request):
+    """ref_audio_inputが一時ファイルの場合に削除"""
+    if (getattr(request, 'ref_audio_input', None) and
+        request.ref_audio_input.startswith(tempfile.gettempdir())):
+        try:
+            temp_audio_path = request.ref_audio_input
+            temp_dir = os.path.dirname(temp_audio_path)
+            if os.path.exists(temp_audio_path):
+                os.remove(temp_audio_path)
+            if os.path.exists(temp_dir) and not os.listdir(temp_dir):
+                os.rmdir(temp_dir)
+        except Exception as cleanup_error:
+            print(f"Warning: Failed to cleanup temporary audio file: {cleanup_error}")
+
+def reference_audio_input(queued_request: QueuedRequest):
+    """パイプラインに渡す参照音声（アップロードを取り込んだものはファイルオブジェクト、それ以外はパス）"""
+    if queued_request.ref_audio is not None:
+        return queued_request.ref_audio.open()
+    return queued_request.request.ref_audio_input
+
+def release_ref_audio(queued_request: QueuedRequest):
+    """取り込んだ参照音声と、ref_audio_input の一時ファイルを解放"""
+    if queued_request.ref_audio is not None:
+        queued_request.ref_audio.close()
+        queued_request.ref_audio = None
+    cleanup_temp_ref_audio(queued_request.request)
+
+def pipeline_for(queued_request: QueuedRequest):
+    """ジョブに割り当てられたレプリカのパイプライン（割り当て前は先頭のレプリカ）"""
+    if queued_request.replica is not None:
+        return queued_request.replica.pipeline
+    if model_demo is None:
+        raise RuntimeError(startup_state.error or "Pipeline not initialized")
+    return model_demo
+
+def run_pipeline(queued_request: QueuedRequest, generation_kwargs: Dict, handle_results):
+    """
+    パイプラインを呼び出し、出力を handle_results で結果に設定する（ブロッキング、handle_results の戻り値を返す）
+    段階パイプラインが有効な場合は prepare / diffuse / decode をレプリカの段階ごとのスレッドで実行し、
+    handle_results（音楽データのエンコード・保存）も decode の段階で行う
+    """
+    pipeline = pipeline_for(queued_request)
+    stages = queued_request.replica.stages if queued_request.replica is not None else None
+    if stages is None:
+        return handle_results(pipeline(**generation_kwargs))
+    return stages.submit([
+        lambda _: pipeline.prepare_generation(**generation_kwargs),
+        lambda plan: (plan, pipeline.diffuse_generation(plan)),
+        lambda diffused: handle_results(pipeline.decode_generation(*diffused)),
+    ]).result()
+
+def process_music_generation(queued_request: QueuedRequest) -> Optional[Future]:
+    """
+    音楽生成の実際の処理（ブロッキング）
+    エンコードをプロセスプールに投入した場合は、リクエストの完了を表す Future を返す（スケジューラは完了後にジョブを終了する）
+    """
+    try:
+        # 開始前にキャンセルされていれば実行しない
+        queued_request.cancellation_token.raise_if_cancelled()
         
         # return_file_dataがTrueの場合はreturn_audio_dataも使用
         use_return_audio_data = queued_request.request.return_file_data
         
         # 既存の音楽生成処理
-        results = model_demo(
+        return run_pipeline(queued_request, dict(
             format=queued_request.request.format,
             audio_duration=queued_request.request.audio_duration,
             prompt=queued_request.request.prompt,
@@ -230,110 +819,52 @@ def process_music_generation(queued_request: QueuedRequest):
             guidance_scale_lyric=queued_request.request.guidance_scale_lyric,
             audio2audio_enable=queued_request.request.audio2audio_enable,
             ref_audio_strength=queued_request.request.ref_audio_strength,
-            ref_audio_input=queued_request.request.ref_audio_input,
+            ref_audio_input=reference_audio_input(queued_request),
             lora_name_or_path=queued_request.request.lora_name_or_path,
             lora_weight=queued_request.request.lora_weight,
-            return_audio_data=use_return_audio_data
-        )
+            return_audio_data=use_return_audio_data,
+            should_preempt=queued_request.preempt_event.is_set,
+            resume_state=queued_request.snapshot,
+            cancellation_token=queued_request.cancellation_token,
+            progress_callback=event_broker.progress_callback(queued_request.request_id)
+        ), lambda results: store_pipeline_results(queued_request, results))
+    
+    except GenerationPreempted as e:
+        # 高優先度のジョブに譲るため中断：スナップショットを保持して待ち行列に戻る（一時ファイルは再開時に使うため残す）
+        queued_request.snapshot = e.snapshot
+        queued_request.preemption_count += 1
+        queued_request.status = RequestStatus.PENDING
+        event_broker.publish_threadsafe(queued_request.request_id, {"type": "status", "status": "pending"})
         
-        # 一時ファイルのクリーンアップ（ref_audio_inputが一時ファイルの場合）
-        if (queued_request.request.ref_audio_input and 
-            queued_request.request.ref_audio_input.startswith(tempfile.gettempdir())):
-            try:
-                temp_audio_path = queued_request.request.ref_audio_input
-                temp_dir = os.path.dirname(temp_audio_path)
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
-            except Exception as cleanup_error:
-                print(f"Warning: Failed to cleanup temporary audio file: {cleanup_error}")
+    except Exception as e:
+        # エラー時も参照音声を解放
+        release_ref_audio(queued_request)
         
-        # ファイルデータを返す場合の処理
-        if queued_request.request.return_file_data:
-            if use_return_audio_data:
-                # 新しい方式：音楽データを直接取得
-                if isinstance(results, (list, tuple)) and len(results) > 0:
-                    audio_data_dict = results[0]
-                    params_json = audio_data_dict.get('input_params')
-                else:
-                    audio_data_dict = results
-                    params_json = None
-                
-                # 音楽データをバイト形式に変換
-                audio_tensor = audio_data_dict['audio']
-                sample_rate = audio_data_dict['sample_rate']
-                format_type = audio_data_dict['format']
-                
-                # PyTorchテンソルをバイト形式に変換
-                import io
-                import torchaudio
-                
-                buffer = io.BytesIO()
-                backend = "soundfile"
-                if format_type == "ogg":
-                    backend = "sox"
-                
-                torchaudio.save(
-                    buffer, 
-                    audio_tensor, 
-                    sample_rate=sample_rate, 
-                    format=format_type, 
-                    backend=backend
-                )
-                audio_bytes = buffer.getvalue()
-                buffer.close()
-                
-                # Content-Typeを正しく設定
-                content_type = "audio/wav"  # デフォルト
-                if format_type.lower() == 'mp3':
-                    content_type = "audio/mpeg"
-                elif format_type.lower() == 'wav':
-                    content_type = "audio/wav"
-                
-                queued_request.result = {
-                    "success": True,
-                    "audio_data": audio_bytes,
-                    "params_json": params_json,
-                    "content_type": content_type,
-                    "format": format_type
-                }
+        fail_request(queued_request, e)
+        queued_request.device_error = is_device_error(e)
+
+def store_pipeline_results(queued_request: QueuedRequest, results) -> Optional[Future]:
+    """パイプラインの出力（1リクエスト分）をリクエストの結果として記録（エンコード中の場合は完了を表す Future を返す）"""
+    use_return_audio_data = queued_request.request.return_file_data
+    queued_request.snapshot = None
+    
+    # 参照音声の解放（取り込んだアップロード、またはref_audio_inputが一時ファイルの場合）
+    release_ref_audio(queued_request)
+    
+    # ファイルデータを返す場合の処理
+    if queued_request.request.return_file_data:
+        if use_return_audio_data:
+            # 新しい方式：音楽データを直接取得
+            if isinstance(results, (list, tuple)) and len(results) > 0:
+                audio_data_dict = results[0]
+                params_json = audio_data_dict.get('input_params')
             else:
-                # 旧方式：ファイルパスから読み込み（下位互換性のため残す）
-                if isinstance(results, (list, tuple)) and len(results) > 0:
-                    audio_path = results[0]
-                    params_json = results[1] if len(results) > 1 else None
-                else:
-                    audio_path = results
-                    params_json = None
-                
-                with open(audio_path, 'rb') as f:
-                    audio_data = f.read()
-                
-                try:
-                    os.remove(audio_path)
-                    json_path = audio_path.replace(f".{queued_request.request.format}", "_input_params.json")
-                    if os.path.exists(json_path):
-                        os.remove(json_path)
-                except:
-                    pass
-                
-                # Content-Typeを正しく設定
-                content_type = "audio/wav"  # デフォルト
-                if queued_request.request.format.lower() == 'mp3':
-                    content_type = "audio/mpeg"
-                elif queued_request.request.format.lower() == 'wav':
-                    content_type = "audio/wav"
-                
-                queued_request.result = {
-                    "success": True,
-                    "audio_data": audio_data,
-                    "params_json": params_json,
-                    "content_type": content_type,
-                    "format": queued_request.request.format
-                }
+                audio_data_dict = results
+                params_json = None
+            
+            result = store_audio_data_result(queued_request, audio_data_dict, params_json)
         else:
-            # ファイルパスを返す場合
+            # 旧方式：ファイルパスから読み込み（下位互換性のため残す）
             if isinstance(results, (list, tuple)) and len(results) > 0:
                 audio_path = results[0]
                 params_json = results[1] if len(results) > 1 else None
@@ -341,49 +872,656 @@ def process_music_generation(queued_request: QueuedRequest):
                 audio_path = results
                 params_json = None
             
-            queued_request.result = {
-                "success": True,
-                "audio_path": audio_path,
-                "params_json": params_json
-            }
-        
-        queued_request.status = RequestStatus.COMPLETED
-        queued_request.completed_at = time.time()
-        
-    except Exception as e:
-        # エラー時も一時ファイルをクリーンアップ
-        if (hasattr(queued_request.request, 'ref_audio_input') and 
-            queued_request.request.ref_audio_input and 
-            queued_request.request.ref_audio_input.startswith(tempfile.gettempdir())):
+            with open(audio_path, 'rb') as f:
+                audio_data = f.read()
+            
             try:
-                temp_audio_path = queued_request.request.ref_audio_input
-                temp_dir = os.path.dirname(temp_audio_path)
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
+                os.remove(audio_path)
+                json_path = audio_path.replace(f".{queued_request.request.format}", "_input_params.json")
+                if os.path.exists(json_path):
+                    os.remove(json_path)
             except:
                 pass
+            
+            # Content-Typeを正しく設定
+            content_type = "audio/wav"  # デフォルト
+            if queued_request.request.format.lower() == 'mp3':
+                content_type = "audio/mpeg"
+            elif queued_request.request.format.lower() == 'wav':
+                content_type = "audio/wav"
+            
+            result = {
+                "success": True,
+                "audio_data": audio_data,
+                "params_json": params_json,
+                "content_type": content_type,
+                "format": queued_request.request.format
+            }
+    else:
+        # ファイルパスを返す場合
+        if isinstance(results, (list, tuple)) and len(results) > 0:
+            audio_path = results[0]
+            params_json = results[1] if len(results) > 1 else None
+        else:
+            audio_path = results
+            params_json = None
         
-        queued_request.status = RequestStatus.FAILED
-        queued_request.error = str(e)
-        queued_request.completed_at = time.time()
+        result = {
+            "success": True,
+            "audio_path": audio_path,
+            "params_json": params_json
+        }
+    
+    return complete_request(queued_request, result)
 
-async def background_worker():
-    """バックグラウンドでキューを処理"""
-    while True:
+def process_music_generation_batch(queued_requests: List[QueuedRequest]) -> Optional[Future]:
+    """
+    互換パラメータを持つ複数リクエストを1回のパイプライン呼び出しで処理（ブロッキング）
+    prompt / lyrics / シードはサンプルごとに渡し、出力を各リクエストに振り分ける
+    エンコードをプロセスプールに投入した場合は、全リクエストの完了を表す Future を返す
+    """
+    shared = queued_requests[0].request
+    
+    def store_outputs(results):
+        completions = []
+        for idx, (queued_request, audio_data_dict) in enumerate(zip(queued_requests, results)):
+            try:
+                queued_request.cancellation_token.raise_if_cancelled()
+                completions.append(store_generation_output(queued_request, audio_data_dict, idx))
+            except Exception as e:
+                fail_request(queued_request, e)
+        return all_completed(completions)
+    
+    try:
+        # 全員がキャンセルした場合のみ生成を中断する
+        batch_token = AllCancelledToken(q.cancellation_token for q in queued_requests)
+        batch_token.raise_if_cancelled()
+        return run_pipeline(queued_requests[0], dict(
+            format=shared.format,
+            audio_duration=shared.audio_duration,
+            prompt=[q.request.prompt for q in queued_requests],
+            lyrics=[q.request.lyrics for q in queued_requests],
+            infer_step=shared.infer_step,
+            guidance_scale=shared.guidance_scale,
+            scheduler_type=shared.scheduler_type,
+            cfg_type=shared.cfg_type,
+            omega_scale=shared.omega_scale,
+            manual_seeds=[first_seed(q.request.manual_seeds) for q in queued_requests],
+            guidance_interval=shared.guidance_interval,
+            guidance_interval_decay=shared.guidance_interval_decay,
+            min_guidance_scale=shared.min_guidance_scale,
+            use_erg_tag=shared.use_erg_tag,
+            use_erg_lyric=shared.use_erg_lyric,
+            use_erg_diffusion=shared.use_erg_diffusion,
+            oss_steps=shared.oss_steps,
+            guidance_scale_text=shared.guidance_scale_text,
+            guidance_scale_lyric=shared.guidance_scale_lyric,
+            lora_name_or_path=shared.lora_name_or_path,
+            lora_weight=shared.lora_weight,
+            return_audio_data=True,
+            cancellation_token=batch_token,
+            progress_callback=event_broker.progress_callback(*(q.request_id for q in queued_requests))
+        ), store_outputs)
+    except Exception as e:
+        for queued_request in queued_requests:
+            fail_request(queued_request, e)
+            queued_request.device_error = is_device_error(e)
+
+def process_music_generation_continuous(queued_request: QueuedRequest) -> Optional[Future]:
+    """
+    連続バッチングエンジン経由の処理（ブロッキング、待機用スレッドで実行）
+    text2music はエンジンのスロットに投入し、ステップ境界で実行中のバッチに合流させる
+    それ以外（audio2audio 等）はエンジンのスレッドで単独実行する
+    """
+    engine = queued_request.replica.engine if queued_request.replica is not None else None
+    if engine is None:
+        return process_music_generation(queued_request)
+    if not ContinuousBatchingEngine.supports(queued_request.request):
+        return engine.run_exclusive(process_music_generation, queued_request).result()
+    try:
+        queued_request.cancellation_token.raise_if_cancelled()
+        spec = GenerationSpec.from_request(queued_request.request)
+        audio_data_dict = engine.submit(
+            spec,
+            queued_request.cancellation_token,
+            event_broker.progress_callback(queued_request.request_id),
+        ).result()
+        return store_generation_output(queued_request, audio_data_dict, 0)
+    except Exception as e:
+        fail_request(queued_request, e)
+        queued_request.device_error = is_device_error(e)
+
+def mark_request_started(queued_request: QueuedRequest):
+    """ワーカーがジョブを取り出した時点でPROCESSINGに遷移（イベントループ側）"""
+    queued_request.status = RequestStatus.PROCESSING
+    queued_request.preempt_event.clear()
+    if queued_request.started_at is None:
+        queued_request.started_at = time.time()
+    if fair_queuing is not None and queued_request.snapshot is None:
+        fair_queuing.job_started(queued_request)
+    publish_request_started(queued_request)
+    publish_queue_positions()
+    # 混雑時の品質引き下げ（中断からの再開時はパラメータを変えない）
+    if (queued_request.request.allow_degradation and queued_request.snapshot is None
+            and queued_request.degradation is None):
+        queued_request.degradation = degradation_policy.apply(queued_request.request, scheduler.pending_count())
+
+def publish_request_started(queued_request: QueuedRequest):
+    """処理の開始を購読者と相乗りしたリクエストに伝える（イベントループ側）"""
+    event_broker.publish(queued_request.request_id, {"type": "status", "status": queued_request.status.value})
+    for follower in singleflight.followers(queued_request.flight_key):
+        if follower.status == RequestStatus.PENDING:
+            follower.status = RequestStatus.PROCESSING
+            follower.started_at = queued_request.started_at
+            event_broker.publish(follower.request_id, {"type": "status", "status": follower.status.value})
+
+def finish_request(queued_request: QueuedRequest):
+    """
+    ジョブ終了時の記録：品質引き下げの報告・相乗りしたリクエストへの結果の共有・スループット・コストモデルの更新・
+    結果ストアのサイズ確定（イベントループ側）
+    """
+    apply_outcome(queued_request)
+    if queued_request.status == RequestStatus.COMPLETED and queued_request.result:
+        params_json = queued_request.result.get("params_json")
+        if params_json is not None and queued_request.degradation is not None:
+            params_json["degradation"] = queued_request.degradation
+        settle_followers(queued_request)
+        throughput_meter.record()
+        work_meter.record(amount=cost_model.estimate(queued_request.request))
+        record_request_cost(queued_request, params_json or {})
+    else:
+        settle_followers(queued_request)
+    if fair_queuing is not None:
+        fair_queuing.job_finished(queued_request, queued_request.status == RequestStatus.COMPLETED)
+    if queued_request.detached:
+        mark_request_cancelled(queued_request)
+    request_status.mark_finished(queued_request.request_id)
+    publish_request_finished(queued_request)
+    publish_queue_positions()
+
+def record_request_cost(queued_request: QueuedRequest, params_json: Dict):
+    """完了したジョブの timecosts でコストモデルを更新"""
+    # 連続バッチング・中断再開の実行時間は1回の生成のコストを表さないため除外
+    if params_json.get("continuous_batching") or queued_request.preemption_count > 0:
+        return
+    # バッチの timecosts はバッチ全体の値のため、先頭のサンプルでのみ記録する
+    batch_size = params_json.get("batch_size", 1)
+    if batch_size > 1 and params_json.get("batch_index", 0) != 0:
+        return
+    timecosts = params_json.get("timecosts")
+    if timecosts:
+        cost_model.observe(queued_request.request, timecosts, batch_size)
+
+def expire_request(queued_request: QueuedRequest):
+    """期限に間に合わない見込みのジョブを開始前に失敗とする"""
+    queued_request.status = RequestStatus.FAILED
+    queued_request.error = (
+        f"Deadline exceeded: expected {cost_model.estimate(queued_request.request):.1f}s of GPU time "
+        f"does not fit in the {queued_request.request.deadline}s deadline"
+    )
+    queued_request.completed_at = time.time()
+    if fair_queuing is not None:
+        fair_queuing.job_finished(queued_request, False)
+    settle_followers(queued_request)
+    request_status.mark_finished(queued_request.request_id)
+    publish_request_finished(queued_request)
+
+def request_preemption(queued_request: QueuedRequest):
+    """実行中のジョブに次のステップ境界での中断を要求"""
+    queued_request.preempt_event.set()
+
+def is_request_preempted(queued_request: QueuedRequest) -> bool:
+    """中断されて待ち行列に戻すべきジョブか"""
+    return queued_request.status == RequestStatus.PENDING and queued_request.snapshot is not None
+
+# timecosts から推定するコストモデルと、待ち行列の取り出し順を決めるポリシー（ACE_SCHEDULING_POLICY）
+cost_model = CostModel()
+scheduling_policy = policy_from_env(cost_model)
+# テナント間の重み付き公平キューイング（テナント内の取り出し順は ACE_SCHEDULING_POLICY）
+fair_queuing = (
+    FairQueuingPolicy(
+        scheduling_policy, cost_model, fair_queuing_config, running_jobs=lambda: scheduler.running_jobs()
+    )
+    if fair_queuing_config.enabled else None
+)
+if fair_queuing is not None:
+    scheduling_policy = fair_queuing
+
+# allow_degradation=True のリクエストに対する混雑時の品質引き下げ（ACE_DEGRADE_*）
+degradation_config = DegradationConfig.from_env()
+throughput_meter = ThroughputMeter(degradation_config.throughput_window_seconds)
+degradation_policy = DegradationPolicy(degradation_config, throughput_meter)
+
+# 見積もりGPU秒に基づく受付制御（ACE_ADMISSION_*）
+# work_meter は完了したリクエストの見積もりGPU秒を記録し、Retry-After の算出に使う
+work_meter = ThroughputMeter(degradation_config.throughput_window_seconds)
+admission = AdmissionController(AdmissionConfig.from_env(), cost_model, work_meter)
+
+# デバイスのレプリカへのジョブの割り当て（ACE_DEVICE_DISPATCH、レプリカは initialize_pipeline で作る）
+device_pool = DevicePool(
+    device_pool_config,
+    estimate=lambda jobs: cost_model.estimate(jobs[0].request, len(jobs)),
+    lora_of=lambda queued_request: queued_request.request.lora_name_or_path,
+)
+
+def dispatch_jobs(queued_requests: List[QueuedRequest]):
+    """
+    取り出したジョブ（バッチ）をレプリカに割り当て、実行するExecutorを返す（イベントループ側）
+    中断したジョブはスナップショットがレプリカのデバイス上にあるため、同じレプリカで再開する
+    """
+    if not device_pool.replicas:
+        return None
+    first = queued_requests[0]
+    pinned = first.replica if first.snapshot is not None else None
+    replica = device_pool.acquire(queued_requests, pinned=pinned)
+    for queued_request in queued_requests:
+        queued_request.replica = replica
+    # 連続バッチング・段階パイプラインでは待機用スレッドで完了を待ち、GPU処理はレプリカのエンジン・段階のスレッドが行う
+    return None if CONTINUOUS_BATCHING_SLOTS > 0 or STAGE_PIPELINE_JOBS > 0 else replica.executor
+
+def release_jobs(queued_requests: List[QueuedRequest]):
+    """ジョブの終了時にレプリカの割り当てを解除し、デバイス側の失敗を健全性に反映（イベントループ側）"""
+    error = next((q.error for q in queued_requests if q.device_error), None)
+    device_pool.release(queued_requests, error)
+
+# GPUジョブスケジューラ（submit時に即座にワーカーを起こす）
+# レプリカの数だけワーカーを起動し、取り出した時点でジョブをレプリカに割り当てる
+# ACE_MAX_BATCH_SIZE > 1 の場合、互換リクエストを動的にバッチ化する
+# ACE_CONTINUOUS_BATCHING > 0 の場合はレプリカ数×スロット数だけワーカーを起動し、各レプリカの連続バッチングエンジンに投入する
+# ACE_STAGE_PIPELINE が有効な場合はレプリカ数×ACE_STAGE_PIPELINE_DEPTH だけワーカーを起動し、各レプリカの段階パイプラインに投入する
+if CONTINUOUS_BATCHING_SLOTS > 0:
+    scheduler = GPUJobScheduler(
+        executor=continuous_wait_executor,
+        runner=process_music_generation_continuous,
+        num_workers=CONTINUOUS_BATCHING_SLOTS * device_pool_config.replica_count,
+        on_start=mark_request_started,
+        on_finish=finish_request,
+        priority=lambda queued_request: queued_request.request.priority,
+        policy=scheduling_policy,
+        should_expire=lambda queued_request: misses_deadline(queued_request, cost_model),
+        on_expire=expire_request,
+        is_cancelled=lambda queued_request: queued_request.cancellation_token.cancelled,
+        dispatch=dispatch_jobs,
+        on_dispatch_end=release_jobs,
+    )
+else:
+    scheduler = GPUJobScheduler(
+        executor=stage_wait_executor or executor,
+        runner=process_music_generation,
+        num_workers=device_pool_config.replica_count * max(1, STAGE_PIPELINE_JOBS),
+        on_start=mark_request_started,
+        on_finish=finish_request,
+        batch_runner=process_music_generation_batch,
+        batch_key=lambda queued_request: batch_key(queued_request.request),
+        batching=BatchingConfig.from_env(),
+        priority=lambda queued_request: queued_request.request.priority,
+        preempt=request_preemption,
+        is_preempted=is_request_preempted,
+        policy=scheduling_policy,
+        should_expire=lambda queued_request: misses_deadline(queued_request, cost_model),
+        on_expire=expire_request,
+        is_cancelled=lambda queued_request: queued_request.cancellation_token.cancelled,
+        dispatch=dispatch_jobs,
+        on_dispatch_end=release_jobs,
+    )
+
+# 待機中・実行中のジョブの開始・完了予測（/status と /queue/eta）
+eta_predictor = EtaPredictor(
+    cost_model,
+    running_jobs=scheduler.running_jobs,
+    pending_jobs=scheduler.pending_jobs,
+    policy=scheduling_policy,
+    devices=lambda: len(device_pool.replicas),
+    device_of=lambda queued_request: queued_request.replica.index if queued_request.replica is not None else None,
+)
+
+def get_job_eta(request_id: str, refresh: bool = True):
+    """
+    ジョブの予測を返す（相乗りしたリクエストはリーダーのジョブの予測）
+    refresh=True の場合、直前に投入されたジョブが予測に含まれていなければ再計算する
+    """
+    job_id = singleflight.leader_id(request_id) or request_id
+    eta = eta_predictor.lookup(job_id)
+    if eta is None and refresh:
+        eta_predictor.invalidate()
+        eta = eta_predictor.lookup(job_id)
+    if eta is not None and job_id != request_id:
+        eta = replace(eta, request_id=request_id)
+    return eta
+
+def public_result(result: Optional[Dict]) -> Optional[Dict]:
+    """レスポンスに含める結果（audio_data・スプールのパスは除外し、代わりにファイル情報のみを含める）"""
+    if result and ("audio_data" in result or "spool_path" in result):
+        return {
+            "success": result.get("success", True),
+            "content_type": result.get("content_type"),
+            "format": result.get("format"),
+            "audio_size_bytes": result_audio_size(result),
+            "params_json": result.get("params_json"),
+            "cached": result.get("cached", False),
+            "message": "Audio data ready for download. Use /result/{request_id} to download."
+        }
+    return result.copy() if result else None
+
+def request_finished_event(queued_request: QueuedRequest) -> Dict:
+    if queued_request.status == RequestStatus.COMPLETED:
+        return {"type": "completed", "status": queued_request.status.value,
+                "result": public_result(queued_request.result)}
+    return {"type": "failed", "status": queued_request.status.value, "error": queued_request.error}
+
+def publish_request_finished(queued_request: QueuedRequest):
+    """購読者に終了イベントを配信（イベントループ側）"""
+    event_broker.publish(queued_request.request_id, request_finished_event(queued_request))
+
+def publish_queue_positions():
+    """購読中の待機中リクエストに、待ち行列での順番と開始・完了予測を配信（イベントループ側）"""
+    if not event_broker.subscribed_ids():
+        return
+    eta_predictor.invalidate()
+    for request_id in event_broker.subscribed_ids():
+        eta = get_job_eta(request_id, refresh=False)
+        if eta is not None and eta.status == "pending":
+            event_broker.publish(request_id, {"type": "queued", **eta.to_dict()})
+
+def get_queued_request(request_id: str) -> QueuedRequest:
+    """リクエストを取得（存在しなければ404、結果ストアから削除済みなら410）"""
+    try:
+        return request_status.lookup(request_id)
+    except ResultEvictedError as e:
+        raise HTTPException(
+            status_code=410,
+            detail=f"Request result is no longer available ({e.reason} at {e.evicted_at:.0f})"
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Request not found")
+
+async def find_queued_request(request_id: str) -> QueuedRequest:
+    """
+    リクエストを取得する
+    分散キューの場合、このノードにないリクエストは他のノードで受け付けたものとしてバックエンドの記録を参照する
+    """
+    try:
+        return get_queued_request(request_id)
+    except HTTPException:
+        if backend_node is None:
+            raise
+        record = await backend_node.call(job_backend.get, request_id)
+        if record is None:
+            raise
+        return backend_record_view(record)
+
+def build_audio_response(audio_bytes: bytes, content_type: str, file_format: str) -> Response:
+    """音楽データをダウンロード用のレスポンスとして返す"""
+    filename = f"generated_music_{int(time.time())}.{file_format}"
+    return Response(
+        content=audio_bytes,
+        media_type=content_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Length": str(len(audio_bytes))
+        }
+    )
+
+def build_result_response(result: Dict, http_request: Optional[Request] = None, file_format: Optional[str] = None,
+                          content_type: Optional[str] = None, delete_after: bool = False) -> Response:
+    """
+    結果の音楽データをダウンロード用のレスポンスとして返す
+    スプール済みの場合はファイルから直接送信し、Range / If-None-Match に対応する
+    delete_after=True の場合は送信後にスプールファイルを削除する（同期エンドポイント用）
+    """
+    file_format = file_format or result["format"]
+    content_type = content_type or result["content_type"]
+    if "spool_path" in result:
+        background = BackgroundTask(result_spool.delete, result["spool_path"]) if delete_after else None
+        return spooled_file_response(
+            http_request,
+            result["spool_path"],
+            media_type=content_type,
+            filename=f"generated_music_{int(time.time())}.{file_format}",
+            etag=result["etag"],
+            background=background,
+        )
+    return build_audio_response(result["audio_data"], content_type, file_format)
+
+def result_audio_size(result: Dict) -> int:
+    if "audio_data" in result:
+        return len(result["audio_data"])
+    return result.get("audio_size_bytes", 0)
+
+def new_upload_buffer(endpoint: str, declared_bytes: Optional[int] = None,
+                      filename: Optional[str] = None) -> UploadBuffer:
+    """
+    アップロードの取り込み先を用意する
+    取り込み前にエンドポイント・一時領域の上限（サイズが分かっていれば1ファイルの上限も）を確認し、
+    取り込み中は書き込むたびに1ファイルの上限を確認する（超えた時点で 413）
+    """
+    admission.check_upload(endpoint, declared_bytes or 0)
+    return UploadBuffer(ingest_config, check_size=admission.check_upload_size, filename=filename)
+
+def submit_request(queued_request: QueuedRequest, endpoint: Optional[str] = None,
+                   upload_bytes: int = 0, store: bool = True) -> asyncio.Future:
+    """
+    受付制御を通してリクエストをスケジューラ（分散キューの場合はバックエンドの待ち行列）に投入する
+    見積もりGPU秒やアップロードの上限を超える場合は AdmissionRejected（待ち行列には入らない）
+    受付の記録はジョブの終了（完了・失敗・キャンセル・失効）時に解放する
+    結果キャッシュにあるリクエストは受付制御・スケジューラを通さず、完了済みの Future を返す
+    待機中・処理中のジョブと同じ内容のリクエストはそのジョブに相乗りし、ジョブの終了時に完了する Future を返す
+    """
+    assign_request_keys(queued_request)
+    if serve_cached_result(queued_request):
+        if store:
+            request_status[queued_request.request_id] = queued_request
+            request_status.mark_finished(queued_request.request_id)
+        done = asyncio.get_running_loop().create_future()
+        done.set_result(queued_request)
+        return done
+    done = join_in_flight(queued_request)
+    if done is not None:
+        if store:
+            request_status[queued_request.request_id] = queued_request
+        return done
+    admission.admit(queued_request.request_id, queued_request.request, endpoint, upload_bytes)
+    if store:
+        request_status[queued_request.request_id] = queued_request
+    if backend_node is not None:
+        done = backend_node.enqueue(queued_request, backend_job_record(queued_request), queued_request.ref_audio)
+    else:
+        done = scheduler.submit(queued_request)
+    done.add_done_callback(lambda _: admission.release(queued_request.request_id))
+    if queued_request.flight_key is not None and singleflight.leader(queued_request.flight_key) is None:
+        singleflight.lead(queued_request.flight_key, queued_request)
+    return done
+
+def can_join(queued_request: QueuedRequest, leader: QueuedRequest) -> bool:
+    """リーダーのジョブの完了を待つことで、リクエストの優先度・期限を損なわないか"""
+    request = queued_request.request
+    # 待機中の低優先度のジョブに、優先度の高いリクエストを待たせない
+    if leader.status == RequestStatus.PENDING and request.priority > leader.request.priority:
+        return False
+    # リーダーが期限切れで失敗する場合に、より長い期限のリクエストまで失敗させない
+    if leader.request.deadline is not None:
+        if request.deadline is None:
+            return False
+        if queued_request.created_at + request.deadline > leader.created_at + leader.request.deadline:
+            return False
+    return True
+
+def join_in_flight(queued_request: QueuedRequest) -> Optional[asyncio.Future]:
+    """同じ内容の待機中・処理中のジョブがあれば、フォロワーとして相乗りさせる（イベントループ側）"""
+    leader = singleflight.leader(queued_request.flight_key)
+    if leader is None or not can_join(queued_request, leader):
+        return None
+    done = singleflight.follow(queued_request.flight_key, queued_request)
+    if leader.status != RequestStatus.PENDING:
+        queued_request.status = RequestStatus.PROCESSING
+        queued_request.started_at = leader.started_at
+    event_broker.follow(queued_request.request_id, leader.request_id)
+    # 参照音声はリーダーのものを使うため、アップロードされた音声は不要
+    release_ref_audio(queued_request)
+    return done
+
+def share_result(result: Dict, request_id: str) -> Dict:
+    """結果を別のリクエスト用に複製する（スプール済みのファイルはハードリンクで共有する）"""
+    shared = dict(result)
+    if "spool_path" in result:
+        temp_path, final_path = result_spool.allocate(request_id, result["format"])
         try:
-            if not request_queue.empty():
-                queued_request = request_queue.get()
-                
-                # ThreadPoolExecutorで実行
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(executor, process_music_generation, queued_request)
-                
-            await asyncio.sleep(0.1)  # CPU使用率を下げる
-        except Exception as e:
-            print(f"Background worker error: {e}")
-            await asyncio.sleep(1)
+            link_or_copy(result["spool_path"], temp_path)
+            shared.update(result_spool.commit(temp_path, final_path))
+        except OSError:
+            result_spool.delete(temp_path)
+            raise
+    return shared
+
+def settle_followers(queued_request: QueuedRequest):
+    """リーダーのジョブの終了時に、相乗りしたリクエストに同じ結果（または失敗）を設定する（イベントループ側）"""
+    for follower, done in singleflight.finish(queued_request.flight_key, queued_request):
+        event_broker.unfollow(follower.request_id, queued_request.request_id)
+        follower.status = queued_request.status
+        follower.error = queued_request.error
+        follower.degradation = queued_request.degradation
+        follower.started_at = follower.started_at or queued_request.started_at
+        follower.completed_at = queued_request.completed_at or time.time()
+        if queued_request.status == RequestStatus.COMPLETED and queued_request.result:
+            try:
+                follower.result = share_result(queued_request.result, follower.request_id)
+            except OSError as e:
+                follower.status = RequestStatus.FAILED
+                follower.error = f"Failed to share the result of request {queued_request.request_id}: {e}"
+        request_status.mark_finished(follower.request_id)
+        publish_request_finished(follower)
+        if not done.done():
+            done.set_result(follower)
+
+def mark_request_cancelled(queued_request: QueuedRequest):
+    """リクエストをキャンセル済み（FAILED）にし、保持している結果を解放する"""
+    if queued_request.result:
+        result_spool.delete(queued_request.result.get("spool_path"))
+    queued_request.result = None
+    queued_request.status = RequestStatus.FAILED
+    queued_request.error = "Cancelled by user"
+    queued_request.completed_at = time.time()
+
+def backend_job_record(queued_request: QueuedRequest) -> JobRecord:
+    """バックエンドの待ち行列に登録するジョブの記録"""
+    return JobRecord(
+        job_id=queued_request.request_id,
+        payload=queued_request.request.dict(),
+        priority=queued_request.request.priority,
+        created_at=queued_request.created_at,
+        submitted_by=job_backend_config.node_id,
+        tenant=queued_request.tenant,
+    )
+
+def claimed_job_request(record: JobRecord, attachment: Optional[bytes]) -> QueuedRequest:
+    """他のノードで受け付けたジョブを、このノードで処理するリクエストとして組み立てる"""
+    ref_audio = None
+    if attachment is not None:
+        ref_audio = UploadBuffer(ingest_config)
+        ref_audio.write(attachment)
+    queued_request = QueuedRequest(
+        request_id=record.job_id,
+        request=GenerateMusicRequest(**record.payload),
+        status=RequestStatus.PENDING,
+        created_at=record.created_at,
+        ref_audio=ref_audio,
+        tenant=record.tenant or DEFAULT_TENANT
+    )
+    # 結果キャッシュには保存する（相乗りは受け付けたノードで行うため、このノードでは使わない）
+    assign_request_keys(queued_request)
+    queued_request.flight_key = None
+    return queued_request
+
+def claimed_job_outcome(queued_request: QueuedRequest) -> tuple:
+    return queued_request.status.value, queued_request.result, queued_request.error
+
+def settle_backend_job(queued_request: QueuedRequest, status: str, result: Optional[Dict], error: Optional[str],
+                       started_at: Optional[float], completed_at: Optional[float]):
+    """このノードで受け付け、他のノードで終了した（または登録に失敗した）ジョブの終了を記録する（イベントループ側）"""
+    queued_request.status = RequestStatus(status)
+    queued_request.error = error
+    queued_request.result = result
+    queued_request.started_at = queued_request.started_at or started_at
+    queued_request.completed_at = completed_at
+    release_ref_audio(queued_request)
+    settle_followers(queued_request)
+    if queued_request.detached:
+        mark_request_cancelled(queued_request)
+    request_status.mark_finished(queued_request.request_id)
+    publish_request_finished(queued_request)
+
+def remote_job_started(queued_request: QueuedRequest, started_at: Optional[float]):
+    """このノードで受け付けたジョブを他のノードが処理し始めた"""
+    if queued_request.status == RequestStatus.PENDING:
+        queued_request.status = RequestStatus.PROCESSING
+        queued_request.started_at = started_at
+        publish_request_started(queued_request)
+
+def abort_claimed_job(queued_request: QueuedRequest):
+    """リースが切れ、他のノードが取得し直したジョブを中断する"""
+    queued_request.cancellation_token.cancel("Job lease lost")
+    scheduler.cancel(queued_request)
+
+def cancel_claimed_job(queued_request: QueuedRequest):
+    if not queued_request.cancellation_token.cancelled:
+        cancel_job(queued_request)
+
+def release_claimed_job(queued_request: QueuedRequest):
+    release_queued_request(queued_request)
+    release_ref_audio(queued_request)
+
+# 分散キューのノード（ジョブの登録・取得・リースの延長・他のノードで終了したジョブの結果の取り込み）
+backend_node = (
+    BackendNode(
+        job_backend,
+        job_backend_config,
+        scheduler,
+        result_spool,
+        from_record=claimed_job_request,
+        is_finished=is_queued_request_finished,
+        outcome=claimed_job_outcome,
+        public_result=public_result,
+        settle=settle_backend_job,
+        on_remote_start=remote_job_started,
+        on_lease_lost=abort_claimed_job,
+        on_cancel_request=cancel_claimed_job,
+        release=release_claimed_job,
+    )
+    if job_backend is not None else None
+)
+
+def backend_record_view(record: JobRecord) -> QueuedRequest:
+    """他のノードで受け付けたジョブを、バックエンドの記録から参照用のリクエストとして組み立てる"""
+    return QueuedRequest(
+        request_id=record.job_id,
+        request=GenerateMusicRequest(**record.payload),
+        status=RequestStatus(record.status),
+        result=record.result,
+        error=record.error,
+        created_at=record.created_at,
+        started_at=record.started_at,
+        completed_at=record.completed_at,
+        tenant=record.tenant or DEFAULT_TENANT
+    )
+
+async def run_generation(request: GenerateMusicRequest, endpoint: Optional[str] = None,
+                         ref_audio: Optional[UploadBuffer] = None) -> QueuedRequest:
+    """
+    同期エンドポイント用：GPUワーカー経由で生成を実行し、完了まで待機する
+    生成中もイベントループは /health や /status に応答できる
+    """
+    queued_request = QueuedRequest(
+        request_id=str(uuid.uuid4()),
+        request=request,
+        status=RequestStatus.PENDING,
+        created_at=time.time(),
+        ref_audio=ref_audio
+    )
+    upload_bytes = ref_audio.size if ref_audio is not None else 0
+    await submit_request(queued_request, endpoint, upload_bytes, store=False)
+    if queued_request.status != RequestStatus.COMPLETED:
+        raise RuntimeError(queued_request.error or "Music generation failed")
+    return queued_request
 
 @app.post("/generate_music")
 async def generate_music(request: GenerateMusicRequest):
@@ -392,7 +1530,7 @@ async def generate_music(request: GenerateMusicRequest):
     return_file_data=True の場合、音楽データを直接レスポンスとして返す
     """
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
         
         # 出力ディレクトリの設定
@@ -409,12 +1547,12 @@ async def generate_music(request: GenerateMusicRequest):
             created_at=time.time()
         )
         
-        with request_lock:
-            request_queue.put(queued_request)
-            request_status[request_id] = queued_request
+        submit_request(queued_request)
         
         return {"success": True, "request_id": request_id}
     
+    except AdmissionRejected:
+        raise
     except Exception as e:
         return {"success": False, "error_message": str(e)}
 
@@ -423,102 +1561,21 @@ async def generate_music_direct(request: GenerateMusicRequest):
     """
     音楽を生成してMP3/WAVデータを直接レスポンスとして返す
     ファイルは作成されず、メモリ内でバイナリデータを直接処理します
+    生成は共有GPUワーカー経由で実行され、完了まで待機します
     """
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
         
-        # 直接音楽生成を実行（ファイル保存なし）
-        results = model_demo(
-            format=request.format,
-            audio_duration=request.audio_duration,
-            prompt=request.prompt,
-            lyrics=request.lyrics,
-            infer_step=request.infer_step,
-            guidance_scale=request.guidance_scale,
-            scheduler_type=request.scheduler_type,
-            cfg_type=request.cfg_type,
-            omega_scale=request.omega_scale,
-            manual_seeds=request.manual_seeds,
-            guidance_interval=request.guidance_interval,
-            guidance_interval_decay=request.guidance_interval_decay,
-            min_guidance_scale=request.min_guidance_scale,
-            use_erg_tag=request.use_erg_tag,
-            use_erg_lyric=request.use_erg_lyric,
-            use_erg_diffusion=request.use_erg_diffusion,
-            oss_steps=request.oss_steps,
-            guidance_scale_text=request.guidance_scale_text,
-            guidance_scale_lyric=request.guidance_scale_lyric,
-            audio2audio_enable=request.audio2audio_enable,
-            ref_audio_strength=request.ref_audio_strength,
-            ref_audio_input=request.ref_audio_input,
-            lora_name_or_path=request.lora_name_or_path,
-            lora_weight=request.lora_weight,
-            return_audio_data=True  # 音楽データを直接返す
-        )
-        
-        # 一時ファイルのクリーンアップ（ref_audio_inputが一時ファイルの場合）
-        if (request.ref_audio_input and 
-            request.ref_audio_input.startswith(tempfile.gettempdir())):
-            try:
-                temp_audio_path = request.ref_audio_input
-                temp_dir = os.path.dirname(temp_audio_path)
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
-            except Exception as cleanup_error:
-                print(f"Warning: Failed to cleanup temporary audio file: {cleanup_error}")
-        
-        # resultsから音楽データを取得
-        if isinstance(results, (list, tuple)) and len(results) > 0:
-            audio_data_dict = results[0]  # 最初の音楽データを取得
-        else:
-            audio_data_dict = results
-        
-        # 音楽データをバイト形式に変換
-        audio_tensor = audio_data_dict['audio']
-        sample_rate = audio_data_dict['sample_rate']
-        format_type = audio_data_dict['format']
-        
-        # PyTorchテンソルをバイト形式に変換
-        import io
-        import torchaudio
-        
-        buffer = io.BytesIO()
-        backend = "soundfile"
-        if format_type == "ogg":
-            backend = "sox"
-        
-        torchaudio.save(
-            buffer, 
-            audio_tensor, 
-            sample_rate=sample_rate, 
-            format=format_type, 
-            backend=backend
-        )
-        audio_bytes = buffer.getvalue()
-        buffer.close()
-        
-        # Content-Typeを設定
-        content_type = "audio/wav"  # デフォルト
-        if format_type.lower() == 'mp3':
-            content_type = "audio/mpeg"
-        elif format_type.lower() == 'wav':
-            content_type = "audio/wav"
-        
-        # ファイル名の生成
-        filename = f"generated_music_{int(time.time())}.{format_type}"
+        # GPUワーカー経由で音楽生成を実行（ファイル保存なし）
+        direct_request = request.copy(update={"return_file_data": True})
+        queued_request = await run_generation(direct_request)
+        result = queued_request.result
         
-        return Response(
-            content=audio_bytes,
-            media_type=content_type,
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"',
-                "Content-Length": str(len(audio_bytes))
-            }
-        )
+        return build_result_response(result, delete_after=True)
             
+    except AdmissionRejected:
+        raise
     except Exception as e:
         # エラー時もref_audio_inputの一時ファイルをクリーンアップ
         if (hasattr(request, 'ref_audio_input') and 
@@ -539,7 +1596,7 @@ async def generate_music_direct(request: GenerateMusicRequest):
 async def generate_music_async(request: GenerateMusicRequest):
     """非同期音楽生成エンドポイント"""
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized.")
         
         # リクエストIDを生成
@@ -553,9 +1610,7 @@ async def generate_music_async(request: GenerateMusicRequest):
             created_at=time.time()
         )
         
-        with request_lock:
-            request_status[request_id] = queued_request
-            request_queue.put(queued_request)
+        submit_request(queued_request)
         
         return {
             "request_id": request_id,
@@ -563,121 +1618,363 @@ async def generate_music_async(request: GenerateMusicRequest):
             "message": "Request has been queued for processing"
         }
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def peek_status(request_id: str) -> Optional[str]:
+    """このノードでの現在のステータス（存在しない・削除済みなら None）"""
+    try:
+        return request_status.lookup(request_id).status.value
+    except KeyError:
+        return None
+
+async def peek_statuses(request_ids: List[str]) -> Dict[str, Optional[str]]:
+    """
+    現在のステータス（存在しない・削除済みなら None）
+    分散キューの場合、このノードにないリクエストはバックエンドの記録を参照する
+    """
+    statuses = {request_id: peek_status(request_id) for request_id in request_ids}
+    remote = [request_id for request_id, status in statuses.items() if status is None]
+    if remote and backend_node is not None:
+        records = await backend_node.call(job_backend.get_many, remote)
+        for request_id, record in records.items():
+            statuses[request_id] = record.status
+    return statuses
+
+async def wait_for_status_change(request_ids: List[str], known: Dict[str, Optional[str]], wait: float):
+    """
+    いずれかのリクエストのステータスが known から変わるまで待機する（最大 wait 秒）
+    このノードのリクエストの状態遷移はイベントで通知されるため、待機中はポーリングしない
+    他のノードで受け付けたリクエストはイベントが届かないため、ACE_QUEUE_POLL_SECONDS ごとにバックエンドを確認する
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(wait, STATUS_MAX_WAIT_SECONDS)
+    while True:
+        statuses = await peek_statuses(request_ids)
+        watched = []
+        polling = False
+        for request_id in request_ids:
+            current = statuses[request_id]
+            if current != known.get(request_id, current):
+                return
+            if current in (RequestStatus.PENDING.value, RequestStatus.PROCESSING.value):
+                watched.append(request_id)
+                polling = polling or peek_status(request_id) is None
+        remaining = deadline - loop.time()
+        if not watched or remaining <= 0:
+            return
+        if polling:
+            remaining = min(remaining, job_backend_config.poll_seconds)
+        await event_broker.wait_for_state_change(watched, remaining)
+
+def build_status_response(request_id: str, queued_request: QueuedRequest) -> Dict:
+    response = {
+        "request_id": request_id,
+        "status": queued_request.status.value,
+        "created_at": queued_request.created_at,
+        "started_at": queued_request.started_at,
+        "completed_at": queued_request.completed_at,
+        "priority": queued_request.request.priority,
+        "deadline": queued_request.request.deadline,
+        "tenant": queued_request.tenant,
+        "preemption_count": queued_request.preemption_count
+    }
+    if queued_request.status in (RequestStatus.PENDING, RequestStatus.PROCESSING):
+        response["estimated_seconds"] = cost_model.estimate(queued_request.request)
+        eta = get_job_eta(request_id)
+        if eta is not None:
+            response["queue_position"] = eta.position
+            response["predicted_start_at"] = eta.predicted_start_at
+            response["predicted_finish_at"] = eta.predicted_finish_at
+            response["poll_after_seconds"] = eta.poll_after()
+    if queued_request.snapshot is not None and queued_request.status == RequestStatus.PENDING:
+        response["resume_step"] = queued_request.snapshot.step_index
+    
+    if queued_request.status == RequestStatus.COMPLETED:
+        # レスポンスにresultを含める際、audio_dataは除外
+        response["result"] = public_result(queued_request.result)
+    elif queued_request.status == RequestStatus.FAILED:
+        response["error"] = queued_request.error
+    
+    return response
+
 @app.get("/status/{request_id}")
-async def get_request_status(request_id: str):
-    """リクエストのステータスを取得"""
-    with request_lock:
-        if request_id not in request_status:
-            raise HTTPException(status_code=404, detail="Request not found")
-        
-        queued_request = request_status[request_id]
-        
-        response = {
-            "request_id": request_id,
-            "status": queued_request.status.value,
-            "created_at": queued_request.created_at,
-            "started_at": queued_request.started_at,
-            "completed_at": queued_request.completed_at
-        }
-        
-        if queued_request.status == RequestStatus.COMPLETED:
-            # レスポンスにresultを含める際、audio_dataは除外
-            result_for_response = queued_request.result.copy() if queued_request.result else None
-            if result_for_response and "audio_data" in result_for_response:
-                # audio_dataは除外し、代わりにファイル情報のみを含める
-                result_for_response = {
-                    "success": result_for_response.get("success", True),
-                    "content_type": result_for_response.get("content_type"),
-                    "format": result_for_response.get("format"),
-                    "audio_size_bytes": len(result_for_response["audio_data"]) if "audio_data" in result_for_response else 0,
-                    "params_json": result_for_response.get("params_json"),
-                    "message": "Audio data ready for download. Use /result/{request_id} to download."
-                }
-            response["result"] = result_for_response
-        elif queued_request.status == RequestStatus.FAILED:
-            response["error"] = queued_request.error
-        
-        return response
+async def get_request_status(request_id: str, wait: float = 0.0):
+    """
+    リクエストのステータスを取得
+    wait > 0 の場合、待機中・処理中のリクエストはステータスが変わるまで（最大 wait 秒）応答を保留する
+    """
+    queued_request = await find_queued_request(request_id)
+    if wait > 0:
+        await wait_for_status_change([request_id], {request_id: queued_request.status.value}, wait)
+        queued_request = await find_queued_request(request_id)
+    return build_status_response(request_id, queued_request)
 
-@app.get("/result/{request_id}")
-async def get_request_result(request_id: str):
-    """完了したリクエストの結果を取得"""
-    with request_lock:
-        if request_id not in request_status:
-            raise HTTPException(status_code=404, detail="Request not found")
-        
-        queued_request = request_status[request_id]
-        
-        if queued_request.status != RequestStatus.COMPLETED:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Request is {queued_request.status.value}, not completed"
-            )
-        
-        result = queued_request.result
-        
-        # ファイルデータを返す場合
-        if "audio_data" in result:
-            # ファイル名の拡張子を正しく設定
-            file_format = result.get("format", queued_request.request.format)
-            filename = f"generated_music_{int(time.time())}.{file_format}"
-            
-            return Response(
-                content=result["audio_data"],
-                media_type=result["content_type"],
-                headers={
-                    "Content-Disposition": f'attachment; filename="{filename}"',
-                    "Content-Length": str(len(result["audio_data"]))
-                }
-            )
+@app.post("/status/batch")
+async def get_request_status_batch(batch: StatusBatchRequest):
+    """
+    複数リクエストのステータスを1回で取得
+    wait > 0 の場合、いずれかのステータスが statuses（省略時は呼び出し時点の値）から変わるまで応答を保留する
+    存在しない・削除済みのリクエストは status_code（404 / 410）と error を返す
+    """
+    if len(batch.request_ids) > STATUS_BATCH_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many request_ids ({len(batch.request_ids)}); the limit is {STATUS_BATCH_LIMIT}"
+        )
+    if batch.wait > 0:
+        known = batch.statuses
+        if known is None:
+            known = await peek_statuses(batch.request_ids)
+        await wait_for_status_change(batch.request_ids, known, batch.wait)
+    
+    found = {}
+    for request_id in batch.request_ids:
+        try:
+            found[request_id] = get_queued_request(request_id)
+        except HTTPException as e:
+            found[request_id] = e
+    # 分散キューの場合、このノードにないリクエストはまとめてバックエンドの記録を参照する
+    remote = [request_id for request_id, item in found.items() if isinstance(item, HTTPException)]
+    if remote and backend_node is not None:
+        records = await backend_node.call(job_backend.get_many, remote)
+        for request_id, record in records.items():
+            found[request_id] = backend_record_view(record)
+    
+    statuses = {}
+    for request_id, item in found.items():
+        if isinstance(item, HTTPException):
+            statuses[request_id] = {"request_id": request_id, "status_code": item.status_code, "error": item.detail}
         else:
-            return result
+            statuses[request_id] = build_status_response(request_id, item)
+    return {"statuses": statuses}
+
+def initial_events(queued_request: QueuedRequest) -> List[Dict]:
+    """接続直後に送る現在の状態"""
+    if is_queued_request_finished(queued_request):
+        return [request_finished_event(queued_request)]
+    events = [{"type": "status", "status": queued_request.status.value}]
+    eta = get_job_eta(queued_request.request_id)
+    if queued_request.status == RequestStatus.PENDING and eta is not None:
+        events.append({"type": "queued", **eta.to_dict()})
+    latest = event_broker.latest(queued_request.request_id)
+    if queued_request.status == RequestStatus.PROCESSING and latest is not None:
+        if latest["type"] == "progress":
+            events.append({"type": "stage", "stage": latest["stage"]})
+        events.append(latest)
+    return events
+
+async def backend_event_stream(queued_request: QueuedRequest, http_request: Request):
+    """
+    他のノードで受け付けたリクエストの進捗（このノードにはイベントが届かない）
+    ACE_QUEUE_POLL_SECONDS ごとにバックエンドの記録を確認し、ステータスの変化と終了を送る
+    """
+    for event in initial_events(queued_request):
+        yield format_sse(event)
+        if event["type"] in TERMINAL_EVENTS:
+            return
+    loop = asyncio.get_running_loop()
+    status = queued_request.status
+    next_keepalive = loop.time() + SSE_KEEPALIVE_SECONDS
+    async for record in backend_node.watch(queued_request.request_id, http_request.is_disconnected):
+        if record is None:
+            yield format_sse({
+                "type": "failed", "status": RequestStatus.FAILED.value,
+                "error": "Job is no longer in the queue backend"
+            })
+            return
+        view = backend_record_view(record)
+        if is_queued_request_finished(view):
+            yield format_sse(request_finished_event(view))
+            return
+        if view.status != status:
+            status = view.status
+            next_keepalive = loop.time() + SSE_KEEPALIVE_SECONDS
+            yield format_sse({"type": "status", "status": status.value})
+        elif loop.time() >= next_keepalive:
+            next_keepalive = loop.time() + SSE_KEEPALIVE_SECONDS
+            yield ": keepalive\n\n"
+
+@app.get("/events/{request_id}")
+async def stream_request_events(request_id: str, http_request: Request):
+    """
+    リクエストの進捗を Server-Sent Events で配信
+    待ち行列での順番、ステージの遷移、拡散ステップ・デコード窓ごとの進捗、完了を送り、完了後に接続を閉じる
+    """
+    queued_request = await find_queued_request(request_id)
+    if backend_node is not None and peek_status(request_id) is None:
+        return StreamingResponse(
+            backend_event_stream(queued_request, http_request),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    async def event_stream():
+        # 購読を開始してから現在の状態を送る（間のイベントを取りこぼさない）
+        subscription = event_broker.subscribe(request_id)
+        try:
+            for event in initial_events(queued_request):
+                yield format_sse(event)
+                if event["type"] in TERMINAL_EVENTS:
+                    return
+            while True:
+                event = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if event is None:
+                    if await http_request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+                if event["type"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            event_broker.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/result/{request_id}")
+async def get_request_result(request_id: str, http_request: Request):
+    """完了したリクエストの結果を取得（Range / If-None-Match に対応）"""
+    queued_request = await find_queued_request(request_id)
+    
+    if queued_request.status != RequestStatus.COMPLETED:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Request is {queued_request.status.value}, not completed"
+        )
+    
+    result = queued_request.result
+    
+    # ファイルデータを返す場合
+    if "audio_data" in result or "spool_path" in result:
+        # ファイル名の拡張子を正しく設定
+        file_format = result.get("format", queued_request.request.format)
+        return build_result_response(result, http_request, file_format=file_format)
+    elif backend_node is not None and "audio_size_bytes" in result:
+        # 他のノードで受け付けたジョブの音楽データはバックエンドから取得する
+        audio_bytes = await backend_node.call(job_backend.get_audio, request_id)
+        if audio_bytes is None:
+            raise HTTPException(status_code=410, detail="Request result is no longer available in the queue backend")
+        return build_audio_response(audio_bytes, result["content_type"], result["format"])
+    else:
+        return result
 
 @app.get("/queue/status")
 async def get_queue_status():
     """キューの状況を取得"""
-    with request_lock:
-        queue_size = request_queue.qsize()
-        
-        status_counts = {
-            "pending": 0,
-            "processing": 0,
-            "completed": 0,
-            "failed": 0
-        }
-        
-        for queued_request in request_status.values():
-            status_counts[queued_request.status.value] += 1
-        
-        return {
-            "queue_size": queue_size,
-            "status_counts": status_counts,
-            "total_requests": len(request_status)
-        }
+    queue_size = scheduler.pending_count()
+    
+    status_counts = {
+        "pending": 0,
+        "processing": 0,
+        "completed": 0,
+        "failed": 0
+    }
+    
+    for queued_request in request_status.values():
+        status_counts[queued_request.status.value] += 1
+    
+    return {
+        "queue_size": queue_size,
+        "status_counts": status_counts,
+        "total_requests": len(request_status),
+        "policy": scheduling_policy.name,
+        "cost_model": cost_model.snapshot(),
+        "degradation": degradation_policy.snapshot(),
+        "result_store": request_status.snapshot(),
+        "admission": admission.snapshot(),
+        "result_cache": result_cache.snapshot(),
+        "single_flight": singleflight.snapshot(),
+        "devices": device_pool.snapshot(),
+        "audio_encoder": audio_encoder.snapshot(),
+        "stage_pipeline": {
+            "enabled": STAGE_PIPELINE_JOBS > 0,
+            "jobs_per_replica": STAGE_PIPELINE_JOBS or None,
+            "queue_size": stage_pipeline_config.queue_size,
+        },
+        "fair_queuing": fair_queuing.snapshot(scheduler.pending_jobs()) if fair_queuing is not None else None,
+        "queue_backend": await backend_node.snapshot() if backend_node is not None else {"backend": "memory"}
+    }
+
+@app.get("/queue/eta")
+async def get_queue_eta():
+    """待機中・実行中の全ジョブの開始・完了予測（実行中、取り出し順の待機中の順）"""
+    now = time.time()
+    schedule = eta_predictor.schedule(now)
+    return {
+        "now": now,
+        "policy": scheduling_policy.name,
+        "drain_at": max((eta.predicted_finish_at for eta in schedule), default=now),
+        "jobs": [eta.to_dict(now) for eta in schedule],
+        "cost_model": cost_model.snapshot()
+    }
 
 @app.delete("/request/{request_id}")
 async def cancel_request(request_id: str):
-    """リクエストをキャンセル（ペンディング状態のみ）"""
-    with request_lock:
-        if request_id not in request_status:
-            raise HTTPException(status_code=404, detail="Request not found")
-        
-        queued_request = request_status[request_id]
-        
-        if queued_request.status == RequestStatus.PENDING:
-            # キューから削除は難しいので、ステータスを変更
-            queued_request.status = RequestStatus.FAILED
-            queued_request.error = "Cancelled by user"
-            queued_request.completed_at = time.time()
-            return {"message": "Request cancelled"}
-        else:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Cannot cancel request in {queued_request.status.value} status"
-            )
+    """
+    リクエストをキャンセル
+    待機中のものは待ち行列から取り除き、処理中のものは次の拡散ステップ（またはデコード窓）で中断する
+    """
+    queued_request = await find_queued_request(request_id)
+    
+    if queued_request.status not in (RequestStatus.PENDING, RequestStatus.PROCESSING):
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Cannot cancel request in {queued_request.status.value} status"
+        )
+    if singleflight.leader_id(request_id) is not None:
+        # 相乗りしたリクエストは離脱のみ（リーダーのジョブは続行する）
+        leave_flight(queued_request)
+        return {"message": "Request cancelled"}
+    if singleflight.followers(queued_request.flight_key):
+        # 相乗りしたリクエストがあるジョブは続行し、このリクエストのみ終了時にキャンセル扱いにする
+        queued_request.detached = True
+        return {"message": "Cancellation requested", "status": queued_request.status.value}
+    return cancel_job(queued_request)
+
+def cancel_job(queued_request: QueuedRequest) -> Dict:
+    """
+    ジョブをキャンセル
+    待機中のものは待ち行列から取り除き、処理中のものは次の拡散ステップ（またはデコード窓）で中断する
+    分散キューでこのノードが取得していないジョブは、バックエンドでキャンセルする（処理中のノードがハートビートで中断する）
+    """
+    if backend_node is not None and not backend_node.is_claimed(queued_request.request_id):
+        backend_node.cancel(queued_request.request_id)
+    if queued_request.status == RequestStatus.PENDING:
+        queued_request.cancellation_token.cancel("Cancelled by user")
+        scheduler.cancel(queued_request)
+        release_ref_audio(queued_request)
+        mark_request_cancelled(queued_request)
+        settle_followers(queued_request)
+        request_status.mark_finished(queued_request.request_id)
+        publish_request_finished(queued_request)
+        publish_queue_positions()
+        if backend_node is not None and not backend_node.is_claimed(queued_request.request_id):
+            backend_node.resolve(queued_request)
+        return {"message": "Request cancelled"}
+    # ワーカーが GenerationCancelled を受けて FAILED に遷移させる
+    queued_request.cancellation_token.cancel("Cancelled by user")
+    return {"message": "Cancellation requested", "status": queued_request.status.value}
+
+def leave_flight(queued_request: QueuedRequest):
+    """相乗りしたリクエストをキャンセルする（他に待つリクエストがいなくなったキャンセル済みのジョブは中断する）"""
+    leader = singleflight.leader(queued_request.flight_key)
+    done = singleflight.leave(queued_request.flight_key, queued_request)
+    event_broker.unfollow(queued_request.request_id, leader.request_id)
+    mark_request_cancelled(queued_request)
+    request_status.mark_finished(queued_request.request_id)
+    publish_request_finished(queued_request)
+    if done is not None and not done.done():
+        done.set_result(queued_request)
+    if leader.detached and not singleflight.followers(leader.flight_key):
+        leader.detached = False
+        cancel_job(leader)
 
 @app.post("/initialize")
 async def initialize(
@@ -688,28 +1985,74 @@ async def initialize(
     cpu_offload: bool = False,
     overlapped_decode: bool = False
 ):
-    """パイプラインを初期化"""
+    """
+    パイプラインを初期化（チェックポイントの読み込みとウォームアップを含む）
+    処理はワーカースレッドで行い、完了まで応答を保留する（その間もイベントループは他のリクエストに応答する）
+    起動時の読み込みなどが実行中の場合は、引数は使わずにその完了を待つ
+    読み込み済みで引数が同じ場合は読み込み直さない
+    再初期化はレプリカ（連続バッチング・段階パイプライン・モデルワーカー）を停止するため、実行中のジョブがある間は409を返す
+    """
+    initialize_kwargs = dict(
+        checkpoint_path=checkpoint_path,
+        device_id=device_id,
+        bf16=bf16,
+        torch_compile=torch_compile,
+        cpu_offload=cpu_offload,
+        overlapped_decode=overlapped_decode
+    )
+    if model_loading is None or model_loading.done():
+        if startup_state.ready and model_demo is not None and initialize_kwargs == loaded_initialize_kwargs:
+            return {"success": True, "message": "Pipeline already initialized"}
+        if device_pool.replicas and scheduler.running_count() > 0:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Cannot re-initialize the pipeline while {scheduler.running_count()} job(s) are running"
+            )
     try:
-        initialize_pipeline(
-            checkpoint_path=checkpoint_path,
-            device_id=device_id,
-            bf16=bf16,
-            torch_compile=torch_compile,
-            cpu_offload=cpu_offload,
-            overlapped_decode=overlapped_decode
-        )
+        await asyncio.shield(start_model_loading(initialize_kwargs))
         return {"success": True, "message": "Pipeline initialized successfully"}
     except Exception as e:
         return {"success": False, "error_message": str(e)}
 
+def readiness() -> Dict:
+    """ジョブを処理できるか（読み込み・ウォームアップが完了し、健全なレプリカがある）"""
+    devices = device_pool.snapshot()["replicas"]
+    healthy = not devices or any(d["healthy"] for d in devices)
+    return {
+        "ready": startup_state.ready and model_demo is not None and healthy and scheduler.started,
+        "healthy": healthy,
+        "devices": devices,
+        "startup": startup_state.snapshot()
+    }
+
 @app.get("/health")
 async def health_check():
     """ヘルスチェック"""
+    state = readiness()
     return {
-        "status": "healthy",
-        "pipeline_loaded": model_demo is not None
+        "status": "healthy" if state["healthy"] else "degraded",
+        "ready": state["ready"],
+        "pipeline_loaded": model_demo is not None,
+        "startup": state["startup"],
+        "devices": state["devices"]
     }
 
+@app.get("/health/live")
+async def liveness_check():
+    """ライブネス：プロセスとイベントループが応答している（読み込み中も 200）"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    レディネス：読み込み・ウォームアップが完了し、ジョブを処理できる場合のみ 200（それ以外は 503）
+    ロードバランサーはこのエンドポイントでウォームアップ済みのサーバにのみ振り分ける
+    """
+    state = readiness()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content={"status": "not_ready", **state})
+    return {"status": "ready", **state}
+
 @app.get("/sample_data")
 async def sample_data():
     """サンプルデータを取得（Gradioアプリのsample機能と同等）"""
@@ -754,22 +2097,18 @@ async def generate_music_with_audio(
     アップロードされたMP3ファイルをref_audio_inputとして使用します
     """
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
         
         # ファイルタイプのチェック
         if not audio_file.content_type.startswith('audio/'):
             raise HTTPException(status_code=400, detail="Uploaded file must be an audio file")
         
-        # 一時ファイルとしてMP3を保存
-        temp_dir = tempfile.mkdtemp()
-        temp_audio_path = os.path.join(temp_dir, f"uploaded_audio_{uuid.uuid4().hex}.mp3")
+        # アップロードされたファイルをチャンク単位で取り込む（メモリ、大きい場合は一時ファイル）
+        ref_audio = new_upload_buffer("/generate_music_with_audio", getattr(audio_file, "size", None), audio_file.filename)
         
         try:
-            # アップロードされたファイルを保存
-            with open(temp_audio_path, "wb") as buffer:
-                content = await audio_file.read()
-                buffer.write(content)
+            await ingest_upload_file(audio_file, ref_audio, ingest_config.chunk_bytes)
             
             # GenerateMusicRequestオブジェクトを作成
             request = GenerateMusicRequest(
@@ -794,7 +2133,7 @@ async def generate_music_with_audio(
                 guidance_scale_lyric=guidance_scale_lyric,
                 audio2audio_enable=True,  # MP3アップロード時は強制的にaudio2audioを有効化
                 ref_audio_strength=ref_audio_strength,
-                ref_audio_input=temp_audio_path,  # アップロードされたファイルパスを設定
+                # 参照音声は取り込んだアップロード（queued_request.ref_audio）を使う
                 lora_name_or_path=lora_name_or_path,
                 lora_weight=lora_weight,
                 return_file_data=return_file_data
@@ -806,12 +2145,11 @@ async def generate_music_with_audio(
                 request_id=request_id,
                 request=request,
                 status=RequestStatus.PENDING,
-                created_at=time.time()
+                created_at=time.time(),
+                ref_audio=ref_audio
             )
             
-            with request_lock:
-                request_queue.put(queued_request)
-                request_status[request_id] = queued_request
+            submit_request(queued_request, "/generate_music_with_audio", ref_audio.size)
             
             return {
                 "success": True, 
@@ -820,15 +2158,12 @@ async def generate_music_with_audio(
             }
             
         except Exception as e:
-            # エラー時は一時ファイルをクリーンアップ
-            try:
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                os.rmdir(temp_dir)
-            except:
-                pass
+            # エラー時は取り込んだ音声を解放
+            ref_audio.close()
             raise e
     
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -863,22 +2198,17 @@ async def generate_music_with_audio_base64(
     Base64エンコードされたMP3データで音楽生成を行う
     """
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
         
-        # Base64デコード
-        try:
-            audio_data = base64.b64decode(audio_base64)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid base64 audio data: {str(e)}")
-        
-        # 一時ファイルとしてMP3を保存
-        temp_dir = tempfile.mkdtemp()
-        temp_audio_path = os.path.join(temp_dir, f"uploaded_audio_{uuid.uuid4().hex}.mp3")
+        # Base64を区切って復号しながら取り込む（復号後の上限は書き込むたびに確認）
+        ref_audio = new_upload_buffer("/generate_music_with_audio_base64")
         
         try:
-            with open(temp_audio_path, "wb") as f:
-                f.write(audio_data)
+            try:
+                ingest_base64_text(audio_base64, ref_audio, ingest_config.chunk_bytes)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid base64 audio data: {str(e)}")
             
             # GenerateMusicRequestオブジェクトを作成
             request = GenerateMusicRequest(
@@ -903,7 +2233,7 @@ async def generate_music_with_audio_base64(
                 guidance_scale_lyric=guidance_scale_lyric,
                 audio2audio_enable=True,  # MP3アップロード時は強制的にaudio2audioを有効化
                 ref_audio_strength=ref_audio_strength,
-                ref_audio_input=temp_audio_path,  # アップロードされたファイルパスを設定
+                # 参照音声は取り込んだアップロード（queued_request.ref_audio）を使う
                 lora_name_or_path=lora_name_or_path,
                 lora_weight=lora_weight,
                 return_file_data=return_file_data
@@ -915,12 +2245,11 @@ async def generate_music_with_audio_base64(
                 request_id=request_id,
                 request=request,
                 status=RequestStatus.PENDING,
-                created_at=time.time()
+                created_at=time.time(),
+                ref_audio=ref_audio
             )
             
-            with request_lock:
-                request_queue.put(queued_request)
-                request_status[request_id] = queued_request
+            submit_request(queued_request, "/generate_music_with_audio_base64", ref_audio.size)
             
             return {
                 "success": True, 
@@ -929,15 +2258,12 @@ async def generate_music_with_audio_base64(
             }
             
         except Exception as e:
-            # エラー時は一時ファイルをクリーンアップ
-            try:
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                os.rmdir(temp_dir)
-            except:
-                pass
+            # エラー時は取り込んだ音声を解放
+            ref_audio.close()
             raise e
     
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -947,22 +2273,17 @@ async def generate_music_with_audio_json(request: GenerateMusicWithBase64Request
     JSON形式でBase64エンコードされたMP3データを受け取って音楽生成を行う
     """
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
         
-        # Base64デコード
-        try:
-            audio_data = base64.b64decode(request.audio_base64)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid base64 audio data: {str(e)}")
-        
-        # 一時ファイルとしてMP3を保存
-        temp_dir = tempfile.mkdtemp()
-        temp_audio_path = os.path.join(temp_dir, f"uploaded_audio_{uuid.uuid4().hex}.mp3")
+        # Base64を区切って復号しながら取り込む（復号後の上限は書き込むたびに確認）
+        ref_audio = new_upload_buffer("/generate_music_with_audio_json")
         
         try:
-            with open(temp_audio_path, "wb") as f:
-                f.write(audio_data)
+            try:
+                ingest_base64_text(request.audio_base64, ref_audio, ingest_config.chunk_bytes)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid base64 audio data: {str(e)}")
             
             # GenerateMusicRequestオブジェクトを作成
             music_request = GenerateMusicRequest(
@@ -987,10 +2308,13 @@ async def generate_music_with_audio_json(request: GenerateMusicWithBase64Request
                 guidance_scale_lyric=request.guidance_scale_lyric,
                 audio2audio_enable=True,  # MP3アップロード時は強制的にaudio2audioを有効化
                 ref_audio_strength=request.ref_audio_strength,
-                ref_audio_input=temp_audio_path,  # アップロードされたファイルパスを設定
+                # 参照音声は取り込んだアップロード（queued_request.ref_audio）を使う
                 lora_name_or_path=request.lora_name_or_path,
                 lora_weight=request.lora_weight,
-                return_file_data=request.return_file_data
+                return_file_data=request.return_file_data,
+                priority=request.priority,
+                deadline=request.deadline,
+                allow_degradation=request.allow_degradation
             )
             
             # リクエストをキューに追加
@@ -999,12 +2323,11 @@ async def generate_music_with_audio_json(request: GenerateMusicWithBase64Request
                 request_id=request_id,
                 request=music_request,
                 status=RequestStatus.PENDING,
-                created_at=time.time()
+                created_at=time.time(),
+                ref_audio=ref_audio
             )
             
-            with request_lock:
-                request_queue.put(queued_request)
-                request_status[request_id] = queued_request
+            submit_request(queued_request, "/generate_music_with_audio_json", ref_audio.size)
             
             return {
                 "success": True, 
@@ -1013,15 +2336,12 @@ async def generate_music_with_audio_json(request: GenerateMusicWithBase64Request
             }
             
         except Exception as e:
-            # エラー時は一時ファイルをクリーンアップ
-            try:
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                os.rmdir(temp_dir)
-            except:
-                pass
+            # エラー時は取り込んだ音声を解放
+            ref_audio.close()
             raise e
     
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1106,6 +2426,63 @@ async def generate_music_with_audio_json_mp3(request: GenerateMusicWithBase64Req
     
     return result
 
+@app.post("/generate_music_with_audio_raw")
+async def generate_music_with_audio_raw(http_request: Request, encoding: str = "binary"):
+    """
+    リクエストボディ（application/octet-stream）の音声データをストリームで取り込んで音楽生成を行う
+    生成パラメータは GenerateMusicRequest と同じ名前のクエリパラメータで指定する（audio2audio は強制的に有効）
+    encoding=base64 の場合、ボディを base64 として読み込みながら復号する
+    """
+    if not pipeline_available():
+        raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
+    if encoding not in ("binary", "base64"):
+        raise HTTPException(status_code=400, detail=f"Unsupported encoding: {encoding} (binary or base64)")
+    
+    params = {key: value for key, value in http_request.query_params.items() if key != "encoding"}
+    params.pop("ref_audio_input", None)
+    params["audio2audio_enable"] = True
+    try:
+        request = GenerateMusicRequest(**params)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    
+    # バイナリの場合は Content-Length で1ファイルの上限を先に確認する
+    declared_bytes = None
+    if encoding == "binary":
+        try:
+            declared_bytes = int(http_request.headers.get("content-length", ""))
+        except ValueError:
+            declared_bytes = None
+    ref_audio = new_upload_buffer("/generate_music_with_audio_raw", declared_bytes)
+    
+    try:
+        try:
+            await ingest_stream(http_request.stream(), ref_audio, Base64Decoder() if encoding == "base64" else None)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid base64 audio data: {str(e)}")
+        if ref_audio.size == 0:
+            raise HTTPException(status_code=400, detail="Request body is empty")
+        
+        request_id = str(uuid.uuid4())
+        queued_request = QueuedRequest(
+            request_id=request_id,
+            request=request,
+            status=RequestStatus.PENDING,
+            created_at=time.time(),
+            ref_audio=ref_audio
+        )
+        submit_request(queued_request, "/generate_music_with_audio_raw", ref_audio.size)
+    except Exception:
+        # エラー時は取り込んだ音声を解放
+        ref_audio.close()
+        raise
+    
+    return {
+        "success": True,
+        "request_id": request_id,
+        "message": f"Audio data ({ref_audio.size} bytes) uploaded and queued for processing"
+    }
+
 @app.post("/generate_music_with_audio_direct_mp3")
 async def generate_music_with_audio_direct_mp3(
     audio_file: UploadFile = File(..., description="MP3 audio file"),
@@ -1134,27 +2511,23 @@ async def generate_music_with_audio_direct_mp3(
     """
     MP3ファイルをアップロードして音楽生成を行い、MP3ファイルを直接レスポンスとして返す
     注意: このエンドポイントは同期的に処理され、完了まで待機します
+    生成は共有GPUワーカー経由で実行されます
     """
     try:
-        if model_demo is None:
+        if not pipeline_available():
             raise HTTPException(status_code=500, detail="Pipeline not initialized. Call /initialize first.")
         
         # ファイルタイプのチェック
         if not audio_file.content_type.startswith('audio/'):
             raise HTTPException(status_code=400, detail="Uploaded file must be an audio file")
         
-        # 一時ファイルとしてMP3を保存
-        temp_dir = tempfile.mkdtemp()
-        temp_audio_path = os.path.join(temp_dir, f"uploaded_audio_{uuid.uuid4().hex}.mp3")
+        # アップロードされたファイルをチャンク単位で取り込む（メモリ、大きい場合は一時ファイル）
+        ref_audio = new_upload_buffer("/generate_music_with_audio_direct_mp3", getattr(audio_file, "size", None), audio_file.filename)
         
         try:
-            # アップロードされたファイルを保存
-            with open(temp_audio_path, "wb") as buffer:
-                content = await audio_file.read()
-                buffer.write(content)
+            await ingest_upload_file(audio_file, ref_audio, ingest_config.chunk_bytes)
             
-            # 直接音楽生成を実行（ファイル保存なし）
-            results = model_demo(
+            request = GenerateMusicRequest(
                 format="mp3",
                 audio_duration=audio_duration,
                 prompt=prompt,
@@ -1176,72 +2549,25 @@ async def generate_music_with_audio_direct_mp3(
                 guidance_scale_lyric=guidance_scale_lyric,
                 audio2audio_enable=True,
                 ref_audio_strength=ref_audio_strength,
-                ref_audio_input=temp_audio_path,
                 lora_name_or_path=lora_name_or_path,
                 lora_weight=lora_weight,
-                return_audio_data=True  # 音楽データを直接返す
+                return_file_data=True  # 音楽データを直接返す
             )
             
-            # 一時ファイルをクリーンアップ
-            try:
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
-            except Exception as cleanup_error:
-                print(f"Warning: Failed to cleanup temporary audio file: {cleanup_error}")
-            
-            # resultsから音楽データを取得
-            if isinstance(results, (list, tuple)) and len(results) > 0:
-                audio_data_dict = results[0]  # 最初の音楽データを取得
-            else:
-                audio_data_dict = results
-            
-            # 音楽データをバイト形式に変換
-            audio_tensor = audio_data_dict['audio']
-            sample_rate = audio_data_dict['sample_rate']
-            format_type = audio_data_dict['format']
-            
-            # PyTorchテンソルをバイト形式に変換
-            import io
-            import torchaudio
-            
-            buffer = io.BytesIO()
-            backend = "soundfile"
-            if format_type == "ogg":
-                backend = "sox"
-            
-            torchaudio.save(
-                buffer, 
-                audio_tensor, 
-                sample_rate=sample_rate, 
-                format=format_type, 
-                backend=backend
-            )
-            audio_bytes = buffer.getvalue()
-            buffer.close()
+            # GPUワーカー経由で音楽生成を実行（取り込んだ音声はワーカー側で解放）
+            queued_request = await run_generation(request, "/generate_music_with_audio_direct_mp3", ref_audio)
+            result = queued_request.result
             
             # MP3ファイルとして直接返す
-            filename = f"generated_music_{int(time.time())}.mp3"
-            return Response(
-                content=audio_bytes,
-                media_type="audio/mpeg",
-                headers={
-                    "Content-Disposition": f'attachment; filename="{filename}"',
-                    "Content-Length": str(len(audio_bytes))
-                }
-            )
+            return build_result_response(result, file_format="mp3", content_type="audio/mpeg", delete_after=True)
             
         except Exception as e:
-            # エラー時は一時ファイルをクリーンアップ
-            try:
-                if os.path.exists(temp_audio_path):
-                    os.remove(temp_audio_path)
-                os.rmdir(temp_dir)
-            except:
-                pass
+            # エラー時は取り込んだ音声を解放
+            ref_audio.close()
             raise e
     
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1264,14 +2590,15 @@ async def generate_music_form(
 ):
     """
     music.pyからのformデータリクエストを処理する専用エンドポイント
-    レガシー互換性のため、パイプラインが初期化されていない場合は自動初期化する
+    レガシー互換性のため、パイプラインが初期化されておらず読み込み中でもない場合（ACE_PRELOAD=0）は初期化する
+    生成は共有GPUワーカー経由で実行されます
     """
     try:
-        # レガシー互換性：パイプラインが初期化されていない場合は自動初期化
-        if model_demo is None:
+        # レガシー互換性：パイプラインが初期化されていない場合は初期化（読み込み中のジョブは完了後に処理される）
+        if not pipeline_available():
             print("Pipeline not initialized. Auto-initializing for legacy compatibility...")
             try:
-                initialize_pipeline()
+                await asyncio.shield(start_model_loading(startup_config.initialize_kwargs()))
                 print("Pipeline auto-initialized successfully")
             except Exception as init_error:
                 print(f"Failed to auto-initialize pipeline: {init_error}")
@@ -1303,120 +2630,22 @@ async def generate_music_form(
             guidance_interval_decay=guidance_interval_decay,
             min_guidance_scale=min_guidance_scale,
             guidance_scale_text=guidance_scale_text,
-            guidance_scale_lyric=guidance_scale_lyric
-        )
-        
-        # メモリクリア（CUDA out of memory対策）
-        import torch
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            print(f"CUDA memory before generation: {torch.cuda.memory_allocated() / 1024**3:.2f} GB")
-        
-        results = model_demo(
-            format=request_obj.format,
-            audio_duration=request_obj.audio_duration,
-            prompt=request_obj.prompt,
-            lyrics=request_obj.lyrics,
-            infer_step=request_obj.infer_step,
-            guidance_scale=request_obj.guidance_scale,
-            scheduler_type=request_obj.scheduler_type,
-            cfg_type=request_obj.cfg_type,
-            omega_scale=request_obj.omega_scale,
-            manual_seeds=request_obj.manual_seeds,
-            guidance_interval=request_obj.guidance_interval,
-            guidance_interval_decay=request_obj.guidance_interval_decay,
-            min_guidance_scale=request_obj.min_guidance_scale,
-            use_erg_tag=request_obj.use_erg_tag,
-            use_erg_lyric=request_obj.use_erg_lyric,
-            use_erg_diffusion=request_obj.use_erg_diffusion,
-            oss_steps=request_obj.oss_steps,
-            guidance_scale_text=request_obj.guidance_scale_text,
-            guidance_scale_lyric=request_obj.guidance_scale_lyric,
-            audio2audio_enable=request_obj.audio2audio_enable,
-            ref_audio_strength=request_obj.ref_audio_strength,
-            ref_audio_input=request_obj.ref_audio_input,
-            lora_name_or_path=request_obj.lora_name_or_path,
-            lora_weight=request_obj.lora_weight,
-            return_audio_data=True  # 音楽データを直接返す
+            guidance_scale_lyric=guidance_scale_lyric,
+            return_file_data=True  # 音楽データを直接返す
         )
         
-        # 生成後のメモリクリア
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            print(f"CUDA memory after generation: {torch.cuda.memory_allocated() / 1024**3:.2f} GB")
+        # GPUワーカー経由で音楽生成を実行
+        queued_request = await run_generation(request_obj)
+        result = queued_request.result
         
-        # resultsから音楽データを取得
         print(f"=== Processing results ===")
-        print(f"Results type: {type(results)}")
-        print(f"Results length: {len(results) if isinstance(results, (list, tuple)) else 'N/A'}")
-        
-        if isinstance(results, (list, tuple)) and len(results) > 0:
-            audio_data_dict = results[0]  # 最初の音楽データを取得
-            print(f"Audio data dict type: {type(audio_data_dict)}")
-            print(f"Audio data dict keys: {list(audio_data_dict.keys()) if isinstance(audio_data_dict, dict) else 'Not dict'}")
-        else:
-            audio_data_dict = results
-            print(f"Audio data dict type (direct): {type(audio_data_dict)}")
-            print(f"Audio data dict keys (direct): {list(audio_data_dict.keys()) if isinstance(audio_data_dict, dict) else 'Not dict'}")
-        
-        # 音楽データをバイト形式に変換
-        try:
-            audio_tensor = audio_data_dict['audio']
-            sample_rate = audio_data_dict['sample_rate']
-            format_type = audio_data_dict['format']
-            
-            print(f"Audio tensor shape: {audio_tensor.shape if hasattr(audio_tensor, 'shape') else 'No shape'}")
-            print(f"Sample rate: {sample_rate}")
-            print(f"Format type: {format_type}")
-        except Exception as extract_error:
-            print(f"Error extracting audio data: {extract_error}")
-            raise HTTPException(status_code=500, detail=f"Failed to extract audio data: {str(extract_error)}")
-        
-        # PyTorchテンソルをバイト形式に変換
-        try:
-            import io
-            import torchaudio
-            
-            buffer = io.BytesIO()
-            backend = "soundfile"
-            if format_type == "ogg":
-                backend = "sox"
-            
-            print(f"Converting audio with backend: {backend}")
-            torchaudio.save(
-                buffer, 
-                audio_tensor, 
-                sample_rate=sample_rate, 
-                format=format_type, 
-                backend=backend
-            )
-            audio_bytes = buffer.getvalue()
-            buffer.close()
-            
-            print(f"Audio bytes length: {len(audio_bytes)}")
-        except Exception as convert_error:
-            print(f"Error converting audio to bytes: {convert_error}")
-            raise HTTPException(status_code=500, detail=f"Failed to convert audio: {str(convert_error)}")
-        
-        # Content-Typeを設定
-        content_type = "audio/wav"  # デフォルト
-        if format_type.lower() == 'mp3':
-            content_type = "audio/mpeg"
-        elif format_type.lower() == 'wav':
-            content_type = "audio/wav"
+        print(f"Format type: {result['format']}")
+        print(f"Audio bytes length: {result_audio_size(result)}")
         
-        # ファイル名の生成
-        filename = f"generated_music_{int(time.time())}.{format_type}"
-        
-        return Response(
-            content=audio_bytes,
-            media_type=content_type,
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"',
-                "Content-Length": str(len(audio_bytes))
-            }
-        )
+        return build_result_response(result, delete_after=True)
             
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"Form data generation error: {e}")
         import traceback
@@ -1432,15 +2661,67 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="ACE-Step Direct API Server")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Host address")
     parser.add_argument("--port", type=int, default=8019, help="Port number")
-    parser.add_argument("--workers", type=int, default=1, help="Number of workers")
+    parser.add_argument("--workers", type=int, default=1, help="Number of model worker processes behind the single HTTP gateway (1 runs the model in the gateway process)")
     parser.add_argument("--reload", action="store_true", help="Enable auto-reload")
+    parser.add_argument("--max-batch-size", type=int, default=None, help="Max requests per dynamic batch (1 disables batching)")
+    parser.add_argument("--batch-wait-ms", type=float, default=None, help="Max time to wait for compatible requests when batching")
+    parser.add_argument("--fair-queuing", action="store_true", help="Share the GPU fairly between tenants (API key, X-Tenant-ID header or client address)")
+    parser.add_argument("--scheduling-policy", type=str, default=None, choices=["fifo", "priority", "sjf"], help="Order in which queued requests are run")
+    parser.add_argument("--continuous-batching", type=int, default=None, help="Number of step-level batching slots (0 disables continuous batching)")
+    parser.add_argument("--stage-pipeline", action="store_true", help="Overlap text encoding, diffusion and audio decoding of consecutive requests")
+    parser.add_argument("--encoder-processes", type=int, default=None, help="Processes that encode MP3/OGG/FLAC results off the GPU worker (0 encodes on the worker thread)")
+    parser.add_argument("--devices", type=str, default=None, help="Comma-separated devices to load a pipeline replica on (e.g. cuda:0,cuda:1, auto, or cpu,cpu to emulate)")
+    parser.add_argument("--device-dispatch", type=str, default=None, choices=["least_loaded", "lora_affinity"], help="How queued jobs are assigned to device replicas")
+    parser.add_argument("--checkpoint-path", type=str, default=None, help="Checkpoint directory loaded at startup")
+    parser.add_argument("--no-preload", action="store_true", help="Do not load and warm up the model at startup (wait for /initialize)")
+    parser.add_argument("--warmup-durations", type=str, default=None, help="Comma-separated audio durations (seconds) generated once at startup to warm up (empty disables)")
+    parser.add_argument("--queue-backend", type=str, default=None, choices=["memory", "sqlite", "redis"], help="Job queue/state backend (sqlite or redis share the queue between processes or nodes)")
+    parser.add_argument("--queue-url", type=str, default=None, help="SQLite database path or Redis URL of the queue backend")
+    parser.add_argument("--node-id", type=str, default=None, help="Name of this node in the shared queue (default: hostname-pid)")
+    parser.add_argument("--max-queued-seconds", type=float, default=None, help="Reject new requests with 429 above this many estimated GPU-seconds of outstanding work (0 disables)")
     
     args = parser.parse_args()
     
+    # uvicornはモジュールを再インポートするため、設定は環境変数で渡す
+    if args.max_batch_size is not None:
+        os.environ["ACE_MAX_BATCH_SIZE"] = str(args.max_batch_size)
+    if args.batch_wait_ms is not None:
+        os.environ["ACE_BATCH_WAIT_MS"] = str(args.batch_wait_ms)
+    if args.scheduling_policy is not None:
+        os.environ["ACE_SCHEDULING_POLICY"] = args.scheduling_policy
+    if args.fair_queuing:
+        os.environ["ACE_FAIR_QUEUING"] = "1"
+    if args.continuous_batching is not None:
+        os.environ["ACE_CONTINUOUS_BATCHING"] = str(args.continuous_batching)
+    if args.encoder_processes is not None:
+        os.environ["ACE_ENCODER_PROCESSES"] = str(args.encoder_processes)
+    if args.stage_pipeline:
+        os.environ["ACE_STAGE_PIPELINE"] = "1"
+    # ジョブの管理は1つのプロセス（ゲートウェイ）で行い、複数指定時はモデルをワーカープロセスで動かす
+    if args.workers > 1:
+        os.environ["ACE_MODEL_WORKERS"] = str(args.workers)
+    if args.devices is not None:
+        os.environ["ACE_DEVICES"] = args.devices
+    if args.device_dispatch is not None:
+        os.environ["ACE_DEVICE_DISPATCH"] = args.device_dispatch
+    if args.max_queued_seconds is not None:
+        os.environ["ACE_ADMISSION_MAX_QUEUED_SECONDS"] = str(args.max_queued_seconds)
+    if args.checkpoint_path is not None:
+        os.environ["ACE_CHECKPOINT_PATH"] = args.checkpoint_path
+    if args.no_preload:
+        os.environ["ACE_PRELOAD"] = "0"
+    if args.warmup_durations is not None:
+        os.environ["ACE_WARMUP_DURATIONS"] = args.warmup_durations
+    if args.queue_backend is not None:
+        os.environ["ACE_QUEUE_BACKEND"] = args.queue_backend
+    if args.queue_url is not None:
+        os.environ["ACE_QUEUE_URL"] = args.queue_url
+    if args.node_id is not None:
+        os.environ["ACE_NODE_ID"] = args.node_id
+    
     uvicorn.run(
         "gradio_compatible_api:app",
         host=args.host,
         port=args.port,
-        workers=args.workers,
         reload=args.reload
     )
@@ -0,0 +1,202 @@
+"""
+DevicePool（acestep.api.device_pool）の割り当てのテスト
+
+パイプラインはスタブを使い、torch・GPUなしで実行できる。
+    python -m pytest tests/test_device_pool.py
+"""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from acestep.api.device_pool import DevicePool, DevicePoolConfig, parse_devices
+
+
+def make_job(seconds: float = 10.0, lora: str = "none"):
+    return SimpleNamespace(seconds=seconds, lora=lora)
+
+
+def make_pool(replicas: int = 2, capacity: int = 1, **config) -> DevicePool:
+    pool = DevicePool(
+        DevicePoolConfig(devices=["cpu"] * replicas, **config),
+        estimate=lambda jobs: sum(job.seconds for job in jobs),
+        lora_of=lambda job: job.lora,
+    )
+    for _ in range(replicas):
+        pool.add("cpu", SimpleNamespace(lora_path=None), capacity=capacity)
+    return pool
+
+
+@pytest.fixture
+def pools():
+    created = []
+
+    def factory(*args, **kwargs) -> DevicePool:
+        pool = make_pool(*args, **kwargs)
+        created.append(pool)
+        return pool
+
+    yield factory
+    for pool in created:
+        pool.clear()
+
+
+def test_parse_devices():
+    assert parse_devices("") == []
+    assert parse_devices("cuda:0, cuda:1") == ["cuda:0", "cuda:1"]
+    assert parse_devices("0,1") == ["cuda:0", "cuda:1"]
+    assert parse_devices("CPU,cpu") == ["cpu", "cpu"]
+    assert parse_devices("auto", lambda: 2) == ["cuda:0", "cuda:1"]
+    assert parse_devices("auto", lambda: 0) == ["cpu"]
+    assert parse_devices("auto") == ["cpu"]
+
+
+def test_replica_devices_with_worker_processes():
+    assert DevicePoolConfig().replica_devices() == [None]
+    assert DevicePoolConfig(devices=["cpu", "cpu"]).replica_count == 2
+    config = DevicePoolConfig(devices=["cuda:0", "cuda:1"], worker_processes=3)
+    assert config.replica_devices() == ["cuda:0", "cuda:1", "cuda:0"]
+
+
+def test_least_loaded_spreads_by_load_per_capacity(pools):
+    pool = pools(replicas=2, capacity=1)
+    first = pool.acquire([make_job(30)])
+    second = pool.acquire([make_job(10)])
+    assert {first.index, second.index} == {0, 1}
+    # 両方とも満杯のときは容量あたりの見積もりGPU秒が少ないレプリカ
+    third = pool.acquire([make_job(5)])
+    assert third is second
+
+
+def test_least_loaded_prefers_replicas_with_free_capacity(pools):
+    pool = pools(replicas=2, capacity=1)
+    pool.replicas[1].capacity = 4
+    busy = pool.acquire([make_job(1)])
+    assert busy.index == 0
+    # レプリカ0は容量を使い切っているため、見積もりGPU秒が多くても空きのあるレプリカ1
+    assert pool.acquire([make_job(100)]).index == 1
+    assert pool.acquire([make_job(100)]).index == 1
+
+
+def test_lora_affinity_within_slack(pools):
+    pool = pools(replicas=2, capacity=4, dispatch="lora_affinity", affinity_slack_seconds=60.0)
+    pool.replicas[1].lora = "style-a"
+    pool.replicas[1].load_seconds = 30.0
+    replica = pool.acquire([make_job(10, lora="style-a")])
+    assert replica.index == 1
+    assert pool.metrics["affinity_hits"] == 1
+
+
+def test_lora_affinity_outside_slack(pools):
+    pool = pools(replicas=2, capacity=1, dispatch="lora_affinity", affinity_slack_seconds=60.0)
+    pool.replicas[1].lora = "style-a"
+    pool.replicas[1].load_seconds = 100.0
+    replica = pool.acquire([make_job(10, lora="style-a")])
+    assert replica.index == 0
+    assert pool.metrics["affinity_hits"] == 0
+
+
+def test_lora_affinity_uses_loaded_lora_of_pipeline(pools):
+    pool = pools(replicas=2, capacity=1, dispatch="lora_affinity")
+    pool.replicas[1].pipeline.lora_path = "style-b"
+    assert pool.acquire([make_job(10, lora="style-b")]).index == 1
+
+
+def test_least_loaded_ignores_lora(pools):
+    pool = pools(replicas=2, capacity=1)
+    pool.replicas[1].lora = "style-a"
+    pool.replicas[1].load_seconds = 1.0
+    assert pool.acquire([make_job(10, lora="style-a")]).index == 0
+
+
+def test_max_failures_cooldown(pools):
+    pool = pools(replicas=2, capacity=1, max_failures=2, cooldown_seconds=60.0)
+    failing = pool.replicas[0]
+    for _ in range(2):
+        jobs = [make_job()]
+        assert pool.acquire(jobs, pinned=failing) is failing
+        pool.release(jobs, error="CUDA out of memory")
+    assert not failing.healthy()
+    assert failing.failed == 2
+    assert failing.consecutive_failures == 0
+    assert failing.last_error == "CUDA out of memory"
+    # クールダウン中は空いていても割り当てない
+    for _ in range(3):
+        assert pool.acquire([make_job()]).index == 1
+    failing.unhealthy_until = time.time() - 1
+    assert failing.healthy()
+    assert pool.acquire([make_job()]) is failing
+
+
+def test_success_resets_consecutive_failures(pools):
+    pool = pools(replicas=1, max_failures=2)
+    replica = pool.replicas[0]
+    jobs = [make_job()]
+    pool.acquire(jobs)
+    pool.release(jobs, error="boom")
+    jobs = [make_job()]
+    pool.acquire(jobs)
+    pool.release(jobs)
+    assert replica.consecutive_failures == 0
+    assert replica.healthy()
+
+
+def test_all_unhealthy_falls_back_to_least_loaded(pools):
+    pool = pools(replicas=2, capacity=1)
+    for replica in pool.replicas:
+        replica.unhealthy_until = time.time() + 60
+    pool.replicas[0].load_seconds = 50.0
+    assert pool.acquire([make_job()]).index == 1
+    assert pool.metrics["unhealthy_fallbacks"] == 1
+
+
+def test_acquire_release_accounting(pools):
+    pool = pools(replicas=2, capacity=2)
+    batch = [make_job(10), make_job(10)]
+    replica = pool.acquire(batch)
+    assert replica.active_jobs == 2
+    assert replica.load_seconds == 20.0
+    assert pool.replica_of(batch[0]) is replica
+    assert pool.metrics["dispatched"] == 1
+    pool.release(batch)
+    assert replica.active_jobs == 0
+    assert replica.load_seconds == 0.0
+    assert replica.completed == 2
+    assert pool.replica_of(batch[0]) is None
+    # 二重の解除は無視する
+    pool.release(batch)
+    assert replica.completed == 2
+
+
+def test_pinned_replica(pools):
+    pool = pools(replicas=2, capacity=1)
+    pool.replicas[1].load_seconds = 1000.0
+    jobs = [make_job()]
+    assert pool.acquire(jobs, pinned=pool.replicas[1]) is pool.replicas[1]
+    pool.release(jobs)
+    # 再初期化で取り除かれたレプリカは無視して選び直す
+    stale = make_pool(replicas=1).replicas[0]
+    try:
+        assert pool.acquire([make_job()], pinned=stale) in pool.replicas
+    finally:
+        stale.shutdown()
+
+
+def test_acquire_without_replicas():
+    pool = DevicePool(DevicePoolConfig(), estimate=lambda jobs: 0.0, lora_of=lambda job: None)
+    with pytest.raises(RuntimeError):
+        pool.acquire([make_job()])
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("ACE_DEVICES", "cpu,cpu")
+    monkeypatch.setenv("ACE_DEVICE_DISPATCH", "lora_affinity")
+    monkeypatch.setenv("ACE_DEVICE_MAX_FAILURES", "0")
+    config = DevicePoolConfig.from_env()
+    assert config.devices == ["cpu", "cpu"]
+    assert config.dispatch == "lora_affinity"
+    assert config.max_failures == 1
+    monkeypatch.setenv("ACE_DEVICE_DISPATCH", "random")
+    with pytest.raises(ValueError):
+        DevicePoolConfig.from_env()
@@ -0,0 +1,255 @@
+"""
+ジョブの待ち行列・状態のバックエンド（acestep.api.job_backend）の共通の振る舞いのテスト
+
+memory / sqlite（一時ファイル）/ redis（fakeredis）で同じテストを実行する。
+fakeredis がない場合、redis のテストはスキップする。
+    python -m pytest tests/test_job_backend.py
+"""
+
+import threading
+import time
+
+import pytest
+
+from acestep.api.job_backend import (
+    COMPLETED,
+    FAILED,
+    PENDING,
+    PROCESSING,
+    JobBackendConfig,
+    JobRecord,
+    MemoryJobBackend,
+    RedisJobBackend,
+    SQLiteJobBackend,
+)
+
+BACKENDS = ("memory", "sqlite", "redis")
+
+
+@pytest.fixture(params=BACKENDS)
+def make_backend(request, tmp_path):
+    """同じ待ち行列を共有するバックエンド（ノードごとの接続）を作る"""
+    created = []
+    shared = {}
+
+    def factory(**config):
+        config = JobBackendConfig(backend=request.param, **config)
+        if request.param == "memory":
+            # プロセス内の実装は同じインスタンスを共有する
+            backend = shared.setdefault("memory", MemoryJobBackend(config))
+        elif request.param == "sqlite":
+            config.url = str(tmp_path / "jobs.sqlite3")
+            backend = SQLiteJobBackend(config)
+        else:
+            fakeredis = pytest.importorskip("fakeredis")
+            server = shared.setdefault("server", fakeredis.FakeServer())
+            backend = RedisJobBackend(config, client=fakeredis.FakeRedis(server=server))
+        created.append(backend)
+        return backend
+
+    yield factory
+    for backend in created:
+        backend.close()
+
+
+def record(job_id: str, priority: int = 0, created_at: float = 0.0) -> JobRecord:
+    return JobRecord(
+        job_id=job_id,
+        payload={"audio_duration": 30.0},
+        priority=priority,
+        created_at=created_at or time.time(),
+        submitted_by="node-a",
+        tenant="tenant-a",
+    )
+
+
+def expire_leases(backend, now_offset: float = 1000.0) -> int:
+    return backend.requeue_expired(time.time() + now_offset)
+
+
+def test_enqueue_and_get(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"))
+    stored = backend.get("job-1")
+    assert stored.status == PENDING
+    assert stored.payload == {"audio_duration": 30.0}
+    assert stored.tenant == "tenant-a"
+    assert stored.submitted_by == "node-a"
+    assert backend.get("missing") is None
+    assert set(backend.get_many(["job-1", "missing"])) == {"job-1"}
+
+
+def test_claim_order_priority_then_creation(make_backend):
+    backend = make_backend()
+    base = time.time()
+    backend.enqueue(record("low-early", priority=0, created_at=base))
+    backend.enqueue(record("high-late", priority=5, created_at=base + 2))
+    backend.enqueue(record("high-early", priority=5, created_at=base + 1))
+    backend.enqueue(record("low-late", priority=0, created_at=base + 3))
+    claimed = []
+    while True:
+        item = backend.claim("node-a")
+        if item is None:
+            break
+        claimed.append(item[0].job_id)
+    assert claimed == ["high-early", "high-late", "low-early", "low-late"]
+
+
+def test_claim_returns_attachment_and_lease(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"), attachment=b"reference audio")
+    claimed, attachment = backend.claim("node-a")
+    assert attachment == b"reference audio"
+    assert claimed.status == PROCESSING
+    assert claimed.node == "node-a"
+    assert claimed.attempts == 1
+    assert claimed.started_at is not None
+    assert backend.get("job-1").status == PROCESSING
+    assert backend.claim("node-b") is None
+
+
+def test_lease_expiry_requeues_then_fails(make_backend):
+    backend = make_backend(max_attempts=2)
+    backend.enqueue(record("job-1"))
+    assert backend.claim("node-a")[0].attempts == 1
+    assert expire_leases(backend) == 1
+    requeued = backend.get("job-1")
+    assert requeued.status == PENDING
+    assert requeued.attempts == 1
+
+    assert backend.claim("node-b")[0].attempts == 2
+    assert expire_leases(backend) == 1
+    failed = backend.get("job-1")
+    assert failed.status == FAILED
+    assert "expired 2 times" in failed.error
+    assert failed.completed_at is not None
+    assert backend.claim("node-c") is None
+    assert expire_leases(backend) == 0
+
+
+def attachment_of(backend, job_id: str):
+    """バックエンドに残っている参照音声"""
+    if isinstance(backend, MemoryJobBackend):
+        return backend._attachments.get(job_id)
+    if isinstance(backend, SQLiteJobBackend):
+        row = backend._conn.execute("SELECT attachment FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row is not None else None
+    return backend.client.get(backend._attachment(job_id))
+
+
+def test_attachment_is_dropped_when_job_finishes(make_backend):
+    backend = make_backend(max_attempts=1)
+    for job_id in ("expired", "completed", "cancelled"):
+        backend.enqueue(record(job_id), attachment=b"reference audio")
+    assert backend.cancel("cancelled") == FAILED
+    expired = backend.claim("node-a")[0].job_id
+    completed = backend.claim("node-a")[0].job_id
+    backend.finish(completed, "node-a", COMPLETED, result={"success": True})
+    expire_leases(backend)
+    assert backend.get(expired).status == FAILED
+    for job_id in ("expired", "completed", "cancelled"):
+        assert attachment_of(backend, job_id) is None
+
+
+def test_heartbeat_extends_and_reports_cancel(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"))
+    backend.claim("node-a")
+    assert backend.heartbeat("job-1", "node-a") is False
+    assert backend.cancel("job-1") == PROCESSING
+    assert backend.heartbeat("job-1", "node-a") is True
+    # キャンセルの要求だけでは終了しない（取得したノードが終了を記録する）
+    assert backend.get("job-1").status == PROCESSING
+
+
+def test_heartbeat_after_losing_lease(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"))
+    backend.claim("node-a")
+    expire_leases(backend)
+    assert backend.heartbeat("job-1", "node-a") is None
+    backend.claim("node-b")
+    assert backend.heartbeat("job-1", "node-a") is None
+    assert backend.heartbeat("job-1", "node-b") is False
+    assert backend.heartbeat("missing", "node-a") is None
+
+
+def test_finish_records_result(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"), attachment=b"reference audio")
+    backend.claim("node-a")
+    result = {"success": True, "format": "wav", "audio_size_bytes": 5}
+    assert backend.finish("job-1", "node-a", COMPLETED, result=result, audio=b"audio")
+    finished = backend.get("job-1")
+    assert finished.status == COMPLETED
+    assert finished.result == result
+    assert finished.completed_at is not None
+    assert backend.get_audio("job-1") == b"audio"
+    # 終了済みのジョブは再び終了できない
+    assert not backend.finish("job-1", "node-a", FAILED, error="late")
+    assert backend.get("job-1").status == COMPLETED
+
+
+def test_finish_from_stale_node(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"))
+    backend.claim("node-a")
+    expire_leases(backend)
+    backend.claim("node-b")
+    assert not backend.finish("job-1", "node-a", COMPLETED, result={"success": True})
+    assert backend.get("job-1").status == PROCESSING
+    assert backend.finish("job-1", "node-b", FAILED, error="boom")
+    finished = backend.get("job-1")
+    assert finished.status == FAILED
+    assert finished.error == "boom"
+
+
+def test_cancel_pending_job(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"), attachment=b"reference audio")
+    assert backend.cancel("job-1", reason="Cancelled by test") == FAILED
+    cancelled = backend.get("job-1")
+    assert cancelled.status == FAILED
+    assert cancelled.error == "Cancelled by test"
+    assert backend.claim("node-a") is None
+    # 終了済み・存在しないジョブ
+    assert backend.cancel("job-1") is None
+    assert backend.cancel("missing") is None
+
+
+def test_cancel_processing_job(make_backend):
+    backend = make_backend()
+    backend.enqueue(record("job-1"))
+    backend.claim("node-a")
+    assert backend.cancel("job-1") == PROCESSING
+    assert backend.get("job-1").cancel_requested
+    assert backend.finish("job-1", "node-a", FAILED, error="Cancelled by user")
+    assert backend.cancel("job-1") is None
+
+
+def test_concurrent_claims_never_share_a_job(make_backend):
+    nodes = [make_backend(), make_backend()]
+    job_ids = [f"job-{i}" for i in range(40)]
+    for job_id in job_ids:
+        nodes[0].enqueue(record(job_id))
+    claimed = {0: [], 1: []}
+    start = threading.Barrier(len(nodes))
+
+    def run(index: int):
+        start.wait()
+        while True:
+            item = nodes[index].claim(f"node-{index}")
+            if item is None:
+                return
+            claimed[index].append(item[0].job_id)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(nodes))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not set(claimed[0]) & set(claimed[1])
+    assert sorted(claimed[0] + claimed[1]) == sorted(job_ids)
+    for index, ids in claimed.items():
+        for job_id in ids:
+            assert nodes[0].get(job_id).node == f"node-{index}"